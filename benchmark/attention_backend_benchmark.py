@@ -0,0 +1,88 @@
+"""
+Time every available attention backend of xFuser on the self attention of
+synthetic PixArt, SD3 and Flux shapes at several resolutions, and show the
+backend the autotuner of `AttentionBackendSelector` keeps for each of them.
+
+Example:
+    python benchmark/attention_backend_benchmark.py --resolutions 512 1024
+"""
+import argparse
+
+import torch
+
+from xfuser.model_executor.layers.attention_backends import (
+    AttentionBackendSelector,
+    xFuserAttentionBackendRegister,
+)
+
+# heads, head_dim, patch size, text tokens joined to the image tokens
+CONFIGS = {
+    "pixart": dict(heads=16, head_dim=72, patch_size=2, text_tokens=0),
+    "sd3": dict(heads=24, head_dim=64, patch_size=2, text_tokens=333),
+    "flux": dict(heads=24, head_dim=128, patch_size=2, text_tokens=512),
+}
+VAE_SCALE_FACTOR = 8
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=list(CONFIGS))
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--heads_divisor",
+        type=int,
+        default=1,
+        help="Divide the number of heads by this to run faster.",
+    )
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"]
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    dtype = getattr(torch, args.dtype)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    backends = xFuserAttentionBackendRegister.get_available_backends()
+    selector = AttentionBackendSelector(iters=args.iters)
+    selector.tuning = True
+    print(
+        f"{'model':>6} {'res':>5} {'tokens':>7} "
+        + " ".join(f"{backend.name + ' (ms)':>16}" for backend in backends)
+        + f" {'auto':>10}"
+    )
+    torch.manual_seed(0)
+    for name in args.models:
+        config = CONFIGS[name]
+        heads = max(1, config["heads"] // args.heads_divisor)
+        for resolution in args.resolutions:
+            tokens = (
+                resolution // VAE_SCALE_FACTOR // config["patch_size"]
+            ) ** 2 + config["text_tokens"]
+            query, key, value = (
+                torch.randn(
+                    args.batch_size, tokens, heads, config["head_dim"],
+                    dtype=dtype, device=args.device,
+                )
+                for _ in range(3)
+            )
+            times = []
+            for backend in backends:
+                if not backend.supports(query, key, None):
+                    times.append("-")
+                    continue
+                elapsed = selector._measure(backend, query, key, value, None)
+                times.append(f"{elapsed * 1000:.2f}")
+            chosen = selector.select(query, key, value).name
+            print(
+                f"{name:>6} {resolution:>5} {tokens:>7} "
+                + " ".join(f"{time:>16}" for time in times)
+                + f" {chosen:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Time the host-side dispatch of the attention blocks of a PipeFusion stage:
+the lookups every block made in the runtime state to find its token range,
+latent rows, positional embedding range and attention path, against reading
+them from the compiled `PatchPlan` of the runtime state.
+
+Only the dispatch is timed, no tensor is computed. The runtime state is built
+on a single process for a synthetic PixArt XL-2 config.
+
+Example:
+    python benchmark/block_dispatch_overhead_benchmark.py --num_pipeline_patch 8
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+
+from xfuser.config import EngineConfig, ModelConfig, RuntimeConfig
+from xfuser.config.config import (
+    DataParallelConfig,
+    ParallelConfig,
+    PipeFusionParallelConfig,
+    SequenceParallelConfig,
+    TensorParallelConfig,
+)
+from xfuser.distributed import (
+    get_runtime_state,
+    get_sequence_parallel_world_size,
+    init_distributed_environment,
+    initialize_model_parallel,
+    initialize_runtime_state,
+)
+from xfuser.distributed.parallel_state import (
+    destroy_distributed_environment,
+    destroy_model_parallel,
+)
+from xfuser.envs import PACKAGES_CHECKER
+
+env_info = PACKAGES_CHECKER.get_packages_info()
+HAS_LONG_CTX_ATTN = env_info["has_long_ctx_attn"]
+HAS_FLASH_ATTN = env_info["has_flash_attn"]
+
+# PixArt-alpha / sigma XL-2
+NUM_BLOCKS = 28
+
+
+def legacy_dispatch():
+    """What a block looked up in the runtime state before the plan."""
+    runtime_state = get_runtime_state()
+    use_long_ctx_kv_cache = HAS_FLASH_ATTN and get_sequence_parallel_world_size() > 1
+    use_long_ctx_attn = HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1
+    single_patch = runtime_state.num_pipeline_patch == 1
+    is_first_patch = runtime_state.pipeline_patch_idx == 0
+    token_num = runtime_state.pp_patches_token_num
+    num_tokens = sum(token_num)
+    if runtime_state.patch_mode:
+        patch_idx = runtime_state.pipeline_patch_idx
+        token_start = sum(token_num[:patch_idx])
+        token_end = token_start + token_num[patch_idx]
+        latent_start = runtime_state.pp_patches_start_idx_local[patch_idx]
+        latent_end = runtime_state.pp_patches_start_idx_local[patch_idx + 1]
+        pos_embed_token_ranges = (
+            tuple(runtime_state.pp_patches_token_start_end_idx[patch_idx]),
+        )
+    else:
+        token_start, token_end = 0, num_tokens
+        latent_start = 0
+        latent_end = runtime_state.pp_patches_start_idx_local[-1]
+        pos_embed_token_ranges = tuple(
+            tuple(runtime_state.pp_patches_token_start_end_idx[i])
+            for i in range(runtime_state.num_pipeline_patch)
+        )
+    return (
+        use_long_ctx_kv_cache, use_long_ctx_attn, single_patch,
+        is_first_patch, num_tokens, token_start, token_end,
+        latent_start, latent_end, pos_embed_token_ranges,
+    )
+
+
+def plan_dispatch():
+    """The same values read from the plan of the current forward."""
+    plan = get_runtime_state().plan
+    return (
+        plan.use_long_ctx_kv_cache, plan.use_long_ctx_attn,
+        plan.num_pipeline_patch == 1, plan.is_first_patch, plan.num_tokens,
+        plan.token_start, plan.token_end, plan.latent_start, plan.latent_end,
+        plan.pos_embed_token_ranges,
+    )
+
+
+def run_generation(dispatch, args) -> float:
+    """Dispatch of every block of a generation, returns the seconds per
+    block."""
+    runtime_state = get_runtime_state()
+    warmup_steps = min(args.warmup_steps, args.steps)
+    start = time.perf_counter()
+    runtime_state.set_patched_mode(patch_mode=False)
+    for _ in range(warmup_steps):
+        for _ in range(NUM_BLOCKS):
+            dispatch()
+    runtime_state.set_patched_mode(patch_mode=True)
+    for _ in range(args.steps - warmup_steps):
+        for _ in range(runtime_state.num_pipeline_patch):
+            for _ in range(NUM_BLOCKS):
+                dispatch()
+            runtime_state.next_patch()
+    num_calls = NUM_BLOCKS * (
+        warmup_steps
+        + (args.steps - warmup_steps) * runtime_state.num_pipeline_patch
+    )
+    return (time.perf_counter() - start) / num_calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--num_pipeline_patch", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup_steps", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--port", type=int, default=29576)
+    args = parser.parse_args()
+
+    init_distributed_environment(
+        world_size=1,
+        rank=0,
+        distributed_init_method=f"tcp://127.0.0.1:{args.port}",
+        local_rank=0,
+        backend="gloo",
+    )
+    initialize_model_parallel()
+
+    parallel_config = ParallelConfig(
+        dp_config=DataParallelConfig(),
+        sp_config=SequenceParallelConfig(ulysses_degree=1, ring_degree=1),
+        pp_config=PipeFusionParallelConfig(pp_degree=1),
+        tp_config=TensorParallelConfig(),
+    )
+    # a single process runs the patches of a stage as the pipeline would
+    parallel_config.pp_config.num_pipeline_patch = args.num_pipeline_patch
+    engine_config = EngineConfig(
+        model_config=ModelConfig(model="PixArt-alpha/PixArt-XL-2-1024-MS"),
+        runtime_config=RuntimeConfig(
+            warmup_steps=args.warmup_steps, dtype=torch.float32
+        ),
+        parallel_config=parallel_config,
+    )
+    pipeline = SimpleNamespace(
+        vae_scale_factor=8,
+        transformer=SimpleNamespace(
+            config=SimpleNamespace(
+                patch_size=2,
+                in_channels=4,
+                num_layers=NUM_BLOCKS,
+                num_attention_heads=16,
+            ),
+            inner_dim=1152,
+        ),
+    )
+    initialize_runtime_state(pipeline, engine_config)
+    get_runtime_state().set_input_parameters(
+        height=args.height,
+        width=args.width,
+        batch_size=1,
+        num_inference_steps=args.steps,
+    )
+    runtime_state = get_runtime_state()
+
+    # both ways must agree on every forward
+    runtime_state.set_patched_mode(patch_mode=False)
+    assert legacy_dispatch() == plan_dispatch()
+    runtime_state.set_patched_mode(patch_mode=True)
+    for _ in range(runtime_state.num_pipeline_patch):
+        assert legacy_dispatch() == plan_dispatch()
+        runtime_state.next_patch()
+
+    times = {}
+    for name, dispatch in (("lookups", legacy_dispatch), ("plan", plan_dispatch)):
+        run_generation(dispatch, args)
+        times[name] = min(run_generation(dispatch, args) for _ in range(args.repeats))
+
+    num_forwards = NUM_BLOCKS * (
+        args.warmup_steps
+        + (args.steps - args.warmup_steps) * runtime_state.num_pipeline_patch
+    )
+    print(
+        f"{runtime_state.num_pipeline_patch} pipeline patches, "
+        f"{args.steps} steps, {num_forwards} block forwards per generation"
+    )
+    print(f"{'':>8} {'per block (us)':>15} {'per generation (ms)':>20}")
+    for name, block_time in times.items():
+        print(
+            f"{name:>8} {block_time * 1e6:>15.3f} "
+            f"{block_time * num_forwards * 1000:>20.3f}"
+        )
+    print(f"speedup: {times['lookups'] / times['plan']:.2f}x")
+
+    destroy_model_parallel()
+    destroy_distributed_environment()
+
+
+if __name__ == "__main__":
+    main()
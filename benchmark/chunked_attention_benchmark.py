@@ -0,0 +1,154 @@
+"""
+Memory against speed of the query-chunked attention of xFuser, over chunk
+sizes, for the self attention of a synthetic PixArt at one resolution.
+
+Each configuration is checked against PyTorch SDPA over the whole sequence.
+The memory column is the size of the scores and probabilities the kernel
+holds at once; on CUDA the measured peak of the call is shown too.
+
+Example:
+    python benchmark/chunked_attention_benchmark.py --resolution 1024
+"""
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from xfuser.model_executor.layers.attention_backends import (
+    attention_scores_bytes,
+    chunked_attention,
+    get_attention_chunk_sizes,
+)
+
+# PixArt-alpha / sigma XL-2
+HEADS = 16
+HEAD_DIM = 72
+PATCH_SIZE = 2
+VAE_SCALE_FACTOR = 8
+
+
+def timed(func, iters: int, device: torch.device):
+    output = func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device) if device.type == "cuda" else 0
+    start = time.perf_counter()
+    for _ in range(iters):
+        output = func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = (time.perf_counter() - start) / iters
+    peak = (
+        torch.cuda.max_memory_allocated(device) - base
+        if device.type == "cuda"
+        else None
+    )
+    return output, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolution", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--heads_divisor",
+        type=int,
+        default=4,
+        help="Divide the number of heads by this to run faster.",
+    )
+    parser.add_argument(
+        "--query_chunk_sizes", type=int, nargs="+", default=[4096, 1024, 256]
+    )
+    parser.add_argument("--key_chunk_sizes", type=int, nargs="+", default=[1024, 256])
+    parser.add_argument(
+        "--memory_budgets_mb", type=int, nargs="+", default=[256, 64, 16]
+    )
+    parser.add_argument("--iters", type=int, default=2)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    heads = max(1, HEADS // args.heads_divisor)
+    tokens = (args.resolution // VAE_SCALE_FACTOR // PATCH_SIZE) ** 2
+    torch.manual_seed(0)
+    query, key, value = (
+        torch.randn(args.batch_size, tokens, heads, HEAD_DIM, device=device)
+        for _ in range(3)
+    )
+
+    def reference():
+        return F.scaled_dot_product_attention(
+            query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2)
+        ).transpose(1, 2)
+
+    # (name, query chunk, key chunk, budget)
+    configs = [("full", tokens, tokens, None)]
+    configs += [
+        (f"q{size}", size, tokens, None)
+        for size in args.query_chunk_sizes
+        if size < tokens
+    ]
+    configs += [
+        (f"q128 k{size}", 128, size, None)
+        for size in args.key_chunk_sizes
+        if size < tokens
+    ]
+    configs += [
+        (f"auto {budget} MB", None, None, budget * 2**20)
+        for budget in args.memory_budgets_mb
+    ]
+
+    with torch.no_grad():
+        expected, reference_time, reference_peak = timed(
+            reference, args.iters, device
+        )
+        print(
+            f"{tokens} tokens, {heads} heads, sdpa over the whole sequence: "
+            f"{reference_time * 1000:.1f} ms"
+            + (
+                f", peak {reference_peak / 2**20:.1f} MB"
+                if reference_peak is not None
+                else ""
+            )
+        )
+        print(
+            f"{'config':>14} {'chunks (q, k)':>14} {'scores (MB)':>12} "
+            f"{'peak (MB)':>10} {'time (ms)':>10} {'slowdown':>9} {'max diff':>9}"
+        )
+        for name, query_chunk_size, key_chunk_size, budget in configs:
+            if budget is not None:
+                query_chunk_size, key_chunk_size = get_attention_chunk_sizes(
+                    args.batch_size, heads, tokens, tokens,
+                    query.element_size(), budget,
+                )
+            output, elapsed, peak = timed(
+                lambda: chunked_attention(
+                    query, key, value,
+                    query_chunk_size=query_chunk_size,
+                    key_chunk_size=key_chunk_size,
+                ),
+                args.iters,
+                device,
+            )
+            scores = attention_scores_bytes(
+                args.batch_size, heads, query_chunk_size,
+                min(key_chunk_size, tokens), query.element_size(),
+            )
+            max_diff = (output - expected).abs().max().item()
+            assert max_diff < 1e-3, f"{name} differs from sdpa by {max_diff}"
+            print(
+                f"{name:>14} {f'{query_chunk_size}, {key_chunk_size}':>14} "
+                f"{scores / 2**20:>12.1f} "
+                f"{'-' if peak is None else f'{peak / 2**20:.1f}':>10} "
+                f"{elapsed * 1000:>10.1f} {elapsed / reference_time:>9.2f} "
+                f"{max_diff:>9.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Time the cross attention of a synthetic PixArt transformer over the patches
+of the denoising steps on CPU, with the K/V of the prompt projected on every
+call as in diffusers, and cached for the whole generation by
+`xFuserCachedCrossAttnProcessor2_0`.
+
+The attention layers are built with random weights, one of them is timed and
+the time is scaled to the number of blocks of the model.
+
+Example:
+    python benchmark/cross_attention_kv_cache_benchmark.py --num_patches 4
+"""
+import argparse
+import copy
+import time
+
+import torch
+from diffusers.models.attention import Attention
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+from xfuser.model_executor.layers.attention_processor import (
+    xFuserCachedCrossAttnProcessor2_0,
+)
+
+# PixArt-alpha / sigma XL-2
+DIM = 1152
+HEADS = 16
+NUM_BLOCKS = 28
+
+
+def run_generation(attention, hidden_states, encoder_hidden_states, args):
+    """Cross attention calls of a generation, returns the seconds per step
+    and the output of the last call."""
+    patches = hidden_states.chunk(args.num_patches, dim=1)
+    output = None
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        for patch in patches:
+            output = attention(patch, encoder_hidden_states=encoder_hidden_states)
+    return (time.perf_counter() - start) / args.steps, output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--image_tokens", type=int, default=1024)
+    parser.add_argument("--text_tokens", type=int, default=300)
+    parser.add_argument("--num_patches", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument(
+        "--width_divisor",
+        type=int,
+        default=1,
+        help="Divide the model width by this to run faster.",
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    dim = DIM // args.width_divisor
+    reference = Attention(
+        query_dim=dim,
+        cross_attention_dim=dim,
+        heads=HEADS,
+        dim_head=dim // HEADS,
+        bias=True,
+        processor=AttnProcessor2_0(),
+    ).eval()
+    cached = copy.deepcopy(reference)
+    processor = xFuserCachedCrossAttnProcessor2_0()
+    cached.set_processor(processor)
+
+    hidden_states = torch.randn(args.batch_size, args.image_tokens, dim)
+    encoder_hidden_states = torch.randn(args.batch_size, args.text_tokens, dim)
+
+    with torch.no_grad():
+        # warm up both paths, the cached one on another prompt
+        run_generation(reference, hidden_states, encoder_hidden_states.clone(), args)
+        run_generation(cached, hidden_states, encoder_hidden_states.clone(), args)
+        processor.hits = processor.misses = 0
+
+        reference_time, reference_output = run_generation(
+            reference, hidden_states, encoder_hidden_states, args
+        )
+        cached_time, cached_output = run_generation(
+            cached, hidden_states, encoder_hidden_states, args
+        )
+    max_diff = (reference_output - cached_output).abs().max().item()
+
+    calls = args.steps * args.num_patches
+    print(
+        f"{calls} cross attention calls per layer: "
+        f"{processor.misses} misses, {processor.hits} hits, "
+        f"max diff {max_diff:.1e}"
+    )
+    print(f"{'':>10} {'per layer (ms)':>15} {'per step, all layers (ms)':>26}")
+    for name, step_time in (("diffusers", reference_time), ("cached", cached_time)):
+        print(
+            f"{name:>10} {step_time * 1000:>15.2f} "
+            f"{step_time * NUM_BLOCKS * 1000:>26.2f}"
+        )
+    saved = (reference_time - cached_time) * NUM_BLOCKS
+    print(
+        f"saved per step: {saved * 1000:.2f} ms "
+        f"({(1 - cached_time / reference_time) * 100:.1f}%)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Speed against quality of the cross-step feature cache of xFuser, over
+intervals and adaptive thresholds, for the denoising loop of a synthetic
+PixArt at one resolution.
+
+The transformer is a stack of PixArt XL-2 like blocks with random weights,
+modulated by the timestep, run by an Euler loop over a smooth token grid.
+As in the transformer wrappers, the blocks but the shallow first and last
+ones are skipped at the steps the cache reuses, their residual added back.
+The error column is the relative error of the final latents against the
+loop without the cache.
+
+Example:
+    python benchmark/feature_cache_benchmark.py --resolution 1024 --steps 20
+"""
+import argparse
+import math
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from xfuser.model_executor.models.transformers.feature_cache import (
+    FeatureCache,
+    get_cached_block_range,
+)
+
+# PixArt-alpha / sigma XL-2
+HEADS = 16
+HEAD_DIM = 72
+LAYERS = 28
+PATCH_SIZE = 2
+VAE_SCALE_FACTOR = 8
+CHANNELS = 4
+
+
+class SyntheticBlock(nn.Module):
+    def __init__(self, dim: int, heads: int):
+        super().__init__()
+        self.heads = heads
+        self.modulation = nn.Linear(dim, 4 * dim)
+        self.norm1 = nn.LayerNorm(dim, elementwise_affine=False)
+        self.to_qkv = nn.Linear(dim, 3 * dim)
+        self.to_out = nn.Linear(dim, dim)
+        self.norm2 = nn.LayerNorm(dim, elementwise_affine=False)
+        self.ff = nn.Sequential(
+            nn.Linear(dim, 4 * dim), nn.GELU(approximate="tanh"), nn.Linear(4 * dim, dim)
+        )
+        for linear in (self.to_out, self.ff[-1]):
+            # keep the residual stream stable over many blocks
+            linear.weight.data.mul_(0.1)
+
+    def forward(self, x: torch.Tensor, temb: torch.Tensor) -> torch.Tensor:
+        batch_size, _, dim = x.shape
+        shift1, scale1, shift2, scale2 = self.modulation(temb)[:, None].chunk(4, dim=-1)
+        norm_x = self.norm1(x) * (1 + scale1) + shift1
+        query, key, value = (
+            t.view(batch_size, -1, self.heads, dim // self.heads).transpose(1, 2)
+            for t in self.to_qkv(norm_x).chunk(3, dim=-1)
+        )
+        attn = F.scaled_dot_product_attention(query, key, value)
+        x = x + self.to_out(attn.transpose(1, 2).reshape(batch_size, -1, dim))
+        return x + self.ff(self.norm2(x) * (1 + scale2) + shift2)
+
+
+class SyntheticTransformer(nn.Module):
+    def __init__(self, dim: int, heads: int, layers: int):
+        super().__init__()
+        self.dim = dim
+        self.proj_in = nn.Linear(CHANNELS, dim)
+        self.time_embed = nn.Sequential(nn.Linear(dim, dim), nn.SiLU(), nn.Linear(dim, dim))
+        self.blocks = nn.ModuleList(SyntheticBlock(dim, heads) for _ in range(layers))
+        self.proj_out = nn.Linear(dim, CHANNELS)
+
+    def timestep_embedding(self, t: float, batch_size: int, device) -> torch.Tensor:
+        half = self.dim // 2
+        freqs = torch.exp(-math.log(10000) * torch.arange(half, device=device) / half)
+        args = t * 1000 * freqs
+        emb = torch.cat([torch.cos(args), torch.sin(args)])
+        return self.time_embed(emb[None].expand(batch_size, -1))
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        t: float,
+        step_idx: int,
+        feature_cache: FeatureCache = None,
+        cached_block_range=None,
+    ) -> torch.Tensor:
+        hidden_states = self.proj_in(x)
+        temb = self.timestep_embedding(t, x.shape[0], x.device)
+        reuse = False
+        for i, block in enumerate(self.blocks):
+            if cached_block_range is not None:
+                cached_start, cached_end = cached_block_range
+                if i == cached_start:
+                    range_input = hidden_states
+                    reuse = feature_cache.begin_step(step_idx, hidden_states)
+                    if reuse:
+                        hidden_states, _ = feature_cache.apply(
+                            hidden_states, None, (0, hidden_states.shape[1])
+                        )
+                if reuse and i < cached_end:
+                    continue
+            hidden_states = block(hidden_states, temb)
+            if cached_block_range is not None and i == cached_end - 1:
+                feature_cache.store(
+                    range_input,
+                    hidden_states,
+                    (0, hidden_states.shape[1]),
+                    hidden_states.shape[1],
+                )
+        return self.proj_out(hidden_states)
+
+
+def smooth_latents(
+    batch_size: int, height: int, width: int, device: torch.device
+) -> torch.Tensor:
+    """`[batch, height * width, channels]` tokens of a smooth random field."""
+    coarse = torch.randn(batch_size, CHANNELS, height // 8 + 1, width // 8 + 1, device=device)
+    field = F.interpolate(coarse, size=(height, width), mode="bicubic", align_corners=False)
+    field = field + 0.1 * torch.randn_like(field)
+    return field.flatten(2).transpose(1, 2).contiguous()
+
+
+def denoise(model, latents, steps, feature_cache=None, cached_block_range=None):
+    x = latents
+    for step_idx in range(steps):
+        t = 1.0 - step_idx / steps
+        velocity = model(x, t, step_idx, feature_cache, cached_block_range)
+        x = x - velocity / steps
+    return x
+
+
+def timed(func, device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    output = func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup_steps", type=int, default=1)
+    parser.add_argument("--shallow_blocks", type=int, default=2)
+    parser.add_argument(
+        "--layers_divisor",
+        type=int,
+        default=4,
+        help="Divide the number of blocks and of heads by this to run faster.",
+    )
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 4])
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.05, 0.1, 0.2],
+        help="Thresholds of the adaptive mode, run with the largest interval.",
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    heads = max(1, HEADS // args.layers_divisor)
+    layers = max(2 * args.shallow_blocks + 1, LAYERS // args.layers_divisor)
+    dim = heads * HEAD_DIM
+    size = args.resolution // VAE_SCALE_FACTOR // PATCH_SIZE
+    torch.manual_seed(0)
+    model = SyntheticTransformer(dim, heads, layers).to(device).eval()
+    latents = smooth_latents(args.batch_size, size, size, device)
+    cached_block_range = get_cached_block_range(
+        (0, layers), num_blocks=layers, shallow_blocks=args.shallow_blocks
+    )
+    num_cached_blocks = cached_block_range[1] - cached_block_range[0]
+
+    configs = [("interval", interval, 0.0) for interval in args.intervals] + [
+        ("adaptive", max(args.intervals), threshold) for threshold in args.thresholds
+    ]
+    with torch.no_grad():
+        denoise(model, latents, 2)
+        expected, reference_time = timed(
+            lambda: denoise(model, latents, args.steps), device
+        )
+        print(
+            f"{size} x {size} tokens, {layers} blocks, {heads} heads, "
+            f"{args.steps} steps without cache: {reference_time * 1000:.0f} ms"
+        )
+        print(
+            f"{'mode':>9} {'interval':>9} {'threshold':>10} {'reused':>7} "
+            f"{'blocks':>7} {'time (ms)':>10} {'speedup':>8} {'rel error':>10}"
+        )
+        for mode, interval, threshold in configs:
+            feature_cache = FeatureCache(
+                interval=interval,
+                mode=mode,
+                threshold=threshold,
+                warmup_steps=args.warmup_steps,
+            )
+            output, elapsed = timed(
+                lambda: denoise(
+                    model, latents, args.steps, feature_cache, cached_block_range
+                ),
+                device,
+            )
+            skipped = feature_cache.num_reused_steps * num_cached_blocks
+            error = ((output - expected).norm() / expected.norm()).item()
+            print(
+                f"{mode:>9} {interval:>9} "
+                f"{threshold if mode == 'adaptive' else '-':>10} "
+                f"{feature_cache.reused_ratio * 100:>6.1f}% "
+                f"{skipped / (args.steps * layers) * 100:>6.1f}% "
+                f"{elapsed * 1000:>10.0f} {reference_time / elapsed:>8.2f} "
+                f"{error:>10.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
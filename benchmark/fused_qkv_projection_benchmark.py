@@ -0,0 +1,152 @@
+"""
+Time the Q/K/V projections of one joint attention block on CPU, run as the
+six separate GEMMs of diffusers against the fused `to_qkv` and `add_qkv`
+GEMMs of the xFuser attention wrapper, for synthetic SD3 and Flux configs.
+
+The attention layers are built with random weights. Only the projections are
+timed; the attention itself is the same in both cases.
+
+Example:
+    python benchmark/fused_qkv_projection_benchmark.py --image_tokens 1024
+"""
+import argparse
+import copy
+import time
+
+import torch
+from diffusers.models.attention import Attention
+from diffusers.models.attention_processor import (
+    FluxAttnProcessor2_0,
+    JointAttnProcessor2_0,
+)
+
+from xfuser.distributed import (
+    init_distributed_environment,
+    initialize_model_parallel,
+)
+from xfuser.distributed.parallel_state import (
+    destroy_distributed_environment,
+    destroy_model_parallel,
+)
+from xfuser.model_executor.layers.attention_processor import (
+    xFuserAttentionWrapper,
+)
+
+# dim, heads, head_dim, blocks with joint attention, text tokens
+CONFIGS = {
+    "sd3": dict(dim=1536, heads=24, dim_head=64, num_blocks=24, text_tokens=333),
+    "flux": dict(dim=3072, heads=24, dim_head=128, num_blocks=19, text_tokens=512),
+}
+
+
+def build_attention(name: str, args) -> Attention:
+    config = CONFIGS[name]
+    dim = config["dim"] // args.width_divisor
+    kwargs = dict(
+        query_dim=dim,
+        cross_attention_dim=None,
+        added_kv_proj_dim=dim,
+        dim_head=config["dim_head"],
+        heads=dim // config["dim_head"],
+        out_dim=dim,
+        context_pre_only=False,
+        bias=True,
+    )
+    if name == "flux":
+        kwargs.update(
+            processor=FluxAttnProcessor2_0(), qk_norm="rms_norm", eps=1e-6
+        )
+    else:
+        kwargs.update(processor=JointAttnProcessor2_0())
+    return Attention(**kwargs).to(args.dtype).eval()
+
+
+def timed(func, iters: int) -> float:
+    func()
+    start = time.perf_counter()
+    for _ in range(iters):
+        func()
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=["sd3", "flux"])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--image_tokens", type=int, default=1024)
+    parser.add_argument(
+        "--width_divisor",
+        type=int,
+        default=1,
+        help="Divide the model width by this to run faster.",
+    )
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--port", type=int, default=29575)
+    args = parser.parse_args()
+    args.dtype = torch.float32
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    init_distributed_environment(
+        world_size=1,
+        rank=0,
+        distributed_init_method=f"tcp://127.0.0.1:{args.port}",
+        local_rank=0,
+        backend="gloo",
+    )
+    initialize_model_parallel()
+
+    print(
+        f"{'model':>6} {'separate (ms)':>14} {'fused (ms)':>11} "
+        f"{'speedup':>8} {'saved/step (ms)':>16} {'max diff':>9}"
+    )
+    torch.manual_seed(0)
+    for name in args.models:
+        attention = build_attention(name, args)
+        reference = copy.deepcopy(attention)
+        wrapper = xFuserAttentionWrapper(attention)
+        dim = attention.query_dim
+        hidden_states = torch.randn(
+            args.batch_size, args.image_tokens, dim, dtype=args.dtype
+        )
+        encoder_hidden_states = torch.randn(
+            args.batch_size, CONFIGS[name]["text_tokens"], dim, dtype=args.dtype
+        )
+
+        def separate():
+            return (
+                reference.to_q(hidden_states),
+                reference.to_k(hidden_states),
+                reference.to_v(hidden_states),
+                reference.add_q_proj(encoder_hidden_states),
+                reference.add_k_proj(encoder_hidden_states),
+                reference.add_v_proj(encoder_hidden_states),
+            )
+
+        def fused():
+            return (
+                *wrapper.project_qkv(hidden_states),
+                *wrapper.project_added_qkv(encoder_hidden_states),
+            )
+
+        with torch.no_grad():
+            max_diff = max(
+                (a - b).abs().max().item()
+                for a, b in zip(separate(), fused())
+            )
+            separate_time = timed(separate, args.iters)
+            fused_time = timed(fused, args.iters)
+        saved = (separate_time - fused_time) * CONFIGS[name]["num_blocks"]
+        print(
+            f"{name:>6} {separate_time * 1000:>14.2f} {fused_time * 1000:>11.2f} "
+            f"{separate_time / fused_time:>8.2f} {saved * 1000:>16.2f} "
+            f"{max_diff:>9.1e}"
+        )
+
+    destroy_model_parallel()
+    destroy_distributed_environment()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Compare the encodings of PipeFusion patch hand-off: plain, quantized and
+temporal delta encoding.
+
+Two CPU processes on the gloo backend form a pipeline of degree 2. The first
+stage sends hidden state patches of shape [batch, tokens, hidden_dim] every
+step, drifting slowly from step to step like DiT activations do. The second
+stage receives them through the recv task queue the way `_async_pipeline`
+does. For every mode it reports the bytes sent, the time per step and the
+relative L2 reconstruction error measured by the sender.
+
+Modes are "none", "int8", "fp8", "delta", "delta_int8" and "delta_fp8".
+
+Example:
+    python benchmark/pipefusion_comm_codec_benchmark.py --delta_keep_ratio 0.1
+"""
+import argparse
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from xfuser.distributed import (
+    get_pp_group,
+    init_distributed_environment,
+    initialize_model_parallel,
+)
+from xfuser.distributed.parallel_state import (
+    destroy_distributed_environment,
+    destroy_model_parallel,
+)
+
+
+def make_patch(args, generator):
+    # activations of DiT blocks have a few tokens with large magnitude
+    token_scale = torch.rand(
+        args.batch_size, args.patch_tokens, 1, generator=generator
+    ).pow(4) * 8 + 0.5
+    patch = torch.randn(
+        args.batch_size, args.patch_tokens, args.hidden_dim, generator=generator
+    ) * token_scale
+    return patch.to(args.dtype)
+
+
+def next_patch(patch, args, generator):
+    drift = torch.randn(patch.shape, generator=generator) * args.step_drift
+    return (patch.float() * (1 + drift)).to(args.dtype)
+
+
+def worker(rank, world_size, port, mode, args, results):
+    init_distributed_environment(
+        world_size=world_size,
+        rank=rank,
+        distributed_init_method=f"tcp://127.0.0.1:{port}",
+        local_rank=rank,
+        backend="gloo",
+    )
+    initialize_model_parallel(pipeline_parallel_degree=world_size)
+    pp_group = get_pp_group()
+    if mode != "none":
+        quantization = mode.split("_")[-1] if mode != "delta" else None
+        pp_group.set_comm_codec(
+            None,
+            quantization=quantization,
+            delta=mode.startswith("delta"),
+            delta_keep_ratio=args.delta_keep_ratio,
+            delta_keyframe_interval=args.delta_keyframe_interval,
+        )
+    patch_shape = [args.batch_size, args.patch_tokens, args.hidden_dim]
+    pp_group.set_recv_buffer(
+        num_pipefusion_patches=args.num_pipeline_patch,
+        patches_shape_list=[patch_shape] * args.num_pipeline_patch,
+        feature_map_shape=[
+            args.batch_size,
+            args.patch_tokens * args.num_pipeline_patch,
+            args.hidden_dim,
+        ],
+        dtype=args.dtype,
+    )
+    generator = torch.Generator().manual_seed(args.seed)
+    patches = [make_patch(args, generator) for _ in range(args.num_pipeline_patch)]
+
+    if not pp_group.is_first_rank:
+        for _ in range(args.num_steps):
+            for patch_idx in range(args.num_pipeline_patch):
+                pp_group.add_pipeline_recv_task(patch_idx)
+        pp_group.recv_next()
+
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    for step in range(args.num_steps):
+        for patch_idx in range(args.num_pipeline_patch):
+            if pp_group.is_first_rank:
+                patches[patch_idx] = next_patch(patches[patch_idx], args, generator)
+                pp_group.pipeline_isend(patches[patch_idx], idx=patch_idx)
+            else:
+                pp_group.get_pipeline_recv_data(idx=patch_idx)
+                pp_group.release_pipeline_recv_data(idx=patch_idx)
+                if not (step == args.num_steps - 1 and
+                        patch_idx == args.num_pipeline_patch - 1):
+                    pp_group.recv_next()
+    torch.distributed.barrier()
+    elapsed = time.perf_counter() - start
+
+    if pp_group.is_first_rank:
+        stats = pp_group.get_comm_codec_stats().get(None, {})
+        results.put(
+            (pp_group.num_sent_bytes, elapsed, stats.get("relative_error", 0.0))
+        )
+
+    destroy_model_parallel()
+    destroy_distributed_environment()
+
+
+def run(mode, port, args):
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    mp.spawn(worker, args=(2, port, mode, args, results), nprocs=2, join=True)
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark encoded PipeFusion transfer on gloo")
+    parser.add_argument("--modes", type=str, nargs="+",
+                        default=["none", "int8", "fp8", "delta_int8", "delta_fp8"],
+                        help="Transfer modes to test")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_pipeline_patch", type=int, default=4,
+                        help="Number of patches per step")
+    parser.add_argument("--num_steps", type=int, default=20,
+                        help="Number of simulated diffusion steps")
+    parser.add_argument("--patch_tokens", type=int, default=1024,
+                        help="Number of tokens in one patch")
+    parser.add_argument("--hidden_dim", type=int, default=1152,
+                        help="Hidden dimension of one token")
+    parser.add_argument("--step_drift", type=float, default=0.02,
+                        help="Relative change of the activations per step")
+    parser.add_argument("--delta_keep_ratio", type=float, default=1.0,
+                        help="Fraction of the residual entries sent in delta modes")
+    parser.add_argument("--delta_keyframe_interval", type=int, default=0,
+                        help="Messages between two keyframes in delta modes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=29565)
+    args = parser.parse_args()
+    args.dtype = torch.float16
+
+    print(f"{'mode':>10} {'MB sent':>10} {'step (ms)':>10} {'rel error':>10}")
+    for i, mode in enumerate(args.modes):
+        sent_bytes, elapsed, error = run(mode, args.port + i, args)
+        print(f"{mode:>10} {sent_bytes / 1024 ** 2:>10.1f} "
+              f"{elapsed / args.num_steps * 1000:>10.2f} {error:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
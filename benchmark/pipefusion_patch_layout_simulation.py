@@ -0,0 +1,80 @@
+"""
+Compare the pipefusion patch layouts of `--pipeline_patch_layout` on the
+simulated schedule of the patched steps: total latency, time until every
+stage is busy and bubble ratio, for several pipefusion degrees.
+
+The patch cost model is the one of `--pipeline_patch_costs`, e.g. measured
+on a stage as the time of a patch per latent row, the fixed time of a patch,
+and the extra time of the first and last patches of a step.
+
+Example:
+    python benchmark/pipefusion_patch_layout_simulation.py \
+        --height 2048 --pp_degrees 4 8 --patch_costs 0.05 0.2 0.5 0.8
+"""
+import argparse
+
+from xfuser.distributed.patch_layout import (
+    PATCH_LAYOUTS,
+    PatchCostModel,
+    plan_patch_heights,
+    simulate_pipefusion_schedule,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--vae_scale_factor", type=int, default=8)
+    parser.add_argument("--patch_size", type=int, default=2)
+    parser.add_argument("--sp_degree", type=int, default=1)
+    parser.add_argument("--pp_degrees", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument(
+        "--num_pipeline_patch",
+        type=int,
+        default=None,
+        help="Defaults to the pipefusion degree.",
+    )
+    parser.add_argument("--num_inference_steps", type=int, default=20)
+    parser.add_argument("--warmup_steps", type=int, default=1)
+    parser.add_argument("--patch_costs", type=float, nargs="*", default=None)
+    args = parser.parse_args()
+
+    latents_height = args.height // args.vae_scale_factor
+    num_steps = max(1, args.num_inference_steps - args.warmup_steps)
+    cost_model = PatchCostModel.from_list(args.patch_costs)
+    print(f"cost model: {cost_model}")
+    print(
+        f"{'pp':>3} {'patches':>7} {'layout':>8} {'latency':>10} "
+        f"{'vs uniform':>10} {'fill':>8} {'bubble':>7}  heights"
+    )
+    for pp_degree in args.pp_degrees:
+        num_patches = args.num_pipeline_patch or pp_degree
+        uniform_makespan = None
+        for layout in PATCH_LAYOUTS:
+            heights = plan_patch_heights(
+                latents_height,
+                num_patches,
+                unit=args.patch_size * args.sp_degree,
+                pp_degree=pp_degree,
+                num_steps=num_steps,
+                layout=layout,
+                cost_model=cost_model,
+            )
+            schedule = simulate_pipefusion_schedule(
+                cost_model.patch_costs(heights),
+                pp_degree=pp_degree,
+                num_steps=num_steps,
+            )
+            if uniform_makespan is None:
+                uniform_makespan = schedule.makespan
+            print(
+                f"{pp_degree:>3} {len(heights):>7} {layout:>8} "
+                f"{schedule.makespan:>10.2f} "
+                f"{schedule.makespan / uniform_makespan:>10.3f} "
+                f"{schedule.fill_time:>8.2f} "
+                f"{schedule.bubble_ratio:>7.3f}  {heights}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Measure how long a PipeFusion stage stalls on patch receives for different
+receive ring depths of `PipelineGroupCoordinator`.
+
+Two CPU processes on the gloo backend form a pipeline of degree 2. The first
+stage produces patches with jittery compute and sends them asynchronously,
+the second stage consumes them with jittery compute the same way
+`_async_pipeline` does, and records the time spent waiting in
+`get_pipeline_recv_data`.
+
+Example:
+    python benchmark/pipefusion_recv_ring_benchmark.py --depths 1 2 4
+"""
+import argparse
+import random
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from xfuser.distributed import (
+    get_pp_group,
+    init_distributed_environment,
+    initialize_model_parallel,
+)
+from xfuser.distributed.parallel_state import (
+    destroy_distributed_environment,
+    destroy_model_parallel,
+)
+
+
+def jittery_compute(rng: random.Random, mean_ms: float, jitter: float):
+    time.sleep(mean_ms * rng.uniform(1 - jitter, 1 + jitter) / 1000)
+
+
+def producer(args, rng: random.Random):
+    pp_group = get_pp_group()
+    for _ in range(args.num_steps):
+        for patch_idx in range(args.num_pipeline_patch):
+            jittery_compute(rng, args.compute_ms, args.jitter)
+            patch = torch.randn(args.patch_tokens, args.hidden_dim)
+            pp_group.pipeline_isend(patch, idx=patch_idx)
+    pp_group.wait_pipeline_sends()
+
+
+def consumer(args, rng: random.Random, release: bool) -> float:
+    pp_group = get_pp_group()
+    for _ in range(args.num_steps):
+        for patch_idx in range(args.num_pipeline_patch):
+            pp_group.add_pipeline_recv_task(patch_idx)
+    pp_group.recv_next()
+
+    stall = 0.0
+    for step in range(args.num_steps):
+        for patch_idx in range(args.num_pipeline_patch):
+            start = time.perf_counter()
+            pp_group.get_pipeline_recv_data(idx=patch_idx)
+            stall += time.perf_counter() - start
+            jittery_compute(rng, args.compute_ms, args.jitter)
+            if release:
+                pp_group.release_pipeline_recv_data(idx=patch_idx)
+            if not (step == args.num_steps - 1 and
+                    patch_idx == args.num_pipeline_patch - 1):
+                pp_group.recv_next()
+    return stall
+
+
+def worker(rank, world_size, port, depth, release, args, results):
+    init_distributed_environment(
+        world_size=world_size,
+        rank=rank,
+        distributed_init_method=f"tcp://127.0.0.1:{port}",
+        local_rank=rank,
+        backend="gloo",
+    )
+    initialize_model_parallel(pipeline_parallel_degree=world_size)
+    pp_group = get_pp_group()
+    patch_shape = [args.patch_tokens, args.hidden_dim]
+    pp_group.set_recv_buffer(
+        num_pipefusion_patches=args.num_pipeline_patch,
+        patches_shape_list=[patch_shape] * args.num_pipeline_patch,
+        feature_map_shape=[
+            args.patch_tokens * args.num_pipeline_patch, args.hidden_dim
+        ],
+        dtype=torch.float32,
+        recv_ring_depth=depth,
+    )
+    rng = random.Random(args.seed + rank)
+
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    if pp_group.is_first_rank:
+        producer(args, rng)
+        torch.distributed.barrier()
+    else:
+        stall = consumer(args, rng, release)
+        torch.distributed.barrier()
+        results.put((stall, time.perf_counter() - start))
+
+    destroy_model_parallel()
+    destroy_distributed_environment()
+
+
+def run(depth, release, port, args):
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    mp.spawn(
+        worker,
+        args=(2, port, depth, release, args, results),
+        nprocs=2,
+        join=True,
+    )
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark PipeFusion receive ring depth on gloo")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 4],
+                        help="Receive ring depths to test")
+    parser.add_argument("--num_pipeline_patch", type=int, default=2,
+                        help="Number of patches per step")
+    parser.add_argument("--num_steps", type=int, default=20,
+                        help="Number of simulated diffusion steps")
+    parser.add_argument("--patch_tokens", type=int, default=2048,
+                        help="Number of tokens in one patch")
+    parser.add_argument("--hidden_dim", type=int, default=1152,
+                        help="Hidden dimension of one token")
+    parser.add_argument("--compute_ms", type=float, default=10.0,
+                        help="Mean compute time of one patch on each stage")
+    parser.add_argument("--jitter", type=float, default=0.8,
+                        help="Relative jitter of the compute time")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=29555)
+    args = parser.parse_args()
+
+    # the first row keeps every buffer until it is reclaimed, which is the
+    #   single outstanding irecv behaviour of a ring without hand-off
+    configs = [(1, False)] + [(depth, True) for depth in args.depths]
+    print(f"{'depth':>6} {'release':>8} {'stall (ms)':>12} "
+          f"{'total (ms)':>12}")
+    for i, (depth, release) in enumerate(configs):
+        stall, total = run(depth, release, args.port + i, args)
+        print(f"{depth:>6} {str(release):>8} {stall * 1000:>12.1f} "
+              f"{total * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Report the predicted cross-node bytes per diffusion step of every rank layout
+`plan_rank_placements` considers for a hybrid parallel configuration.
+
+The topology comes from a topology file, see `ClusterTopology`, or is a
+synthetic one built from --hosts, e.g. `--hosts 8 8` for two 8-GPU boxes
+whose ranks are numbered contiguously, and --interleave to number them
+round-robin across the boxes instead, as some launchers do. The data
+parallel replicas of the chosen layout are listed with their hosts, the
+ranks of a replica being the ones that share its prompts.
+
+Examples:
+    python benchmark/rank_placement_report.py --hosts 8 8 --interleave \
+        --ulysses_degree 4 --pipefusion_parallel_degree 2 --use_cfg_parallel
+    python benchmark/rank_placement_report.py --hosts 8 4 4 --interleave \
+        --data_parallel_degree 2 --ulysses_degree 4 --pipefusion_parallel_degree 2
+"""
+import argparse
+
+from xfuser.distributed.topology import (
+    ClusterTopology,
+    HostTopology,
+    estimate_step_comm_bytes,
+    format_rank_placements,
+    get_data_parallel_replicas,
+    plan_rank_placements,
+)
+
+
+def synthetic_topology(args) -> ClusterTopology:
+    world_size = sum(args.hosts)
+    if args.interleave:
+        ranks = [[] for _ in args.hosts]
+        rank = 0
+        while rank < world_size:
+            for host_idx, num_devices in enumerate(args.hosts):
+                if len(ranks[host_idx]) < num_devices:
+                    ranks[host_idx].append(rank)
+                    rank += 1
+    else:
+        starts = [sum(args.hosts[:i]) for i in range(len(args.hosts))]
+        ranks = [
+            list(range(start, start + num_devices))
+            for start, num_devices in zip(starts, args.hosts)
+        ]
+    return ClusterTopology(
+        hosts=[
+            HostTopology(name=f"node{idx}", ranks=host_ranks, link=args.link)
+            for idx, host_ranks in enumerate(ranks)
+        ],
+        inter_node_link=args.inter_node_link,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--topology_file", type=str, default=None)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[8, 8])
+    parser.add_argument("--interleave", action="store_true")
+    parser.add_argument("--link", type=str, default="nvlink")
+    parser.add_argument("--inter_node_link", type=str, default="infiniband")
+    parser.add_argument("--data_parallel_degree", type=int, default=1)
+    parser.add_argument("--use_cfg_parallel", action="store_true")
+    parser.add_argument("--ulysses_degree", type=int, default=1)
+    parser.add_argument("--ring_degree", type=int, default=1)
+    parser.add_argument("--pipefusion_parallel_degree", type=int, default=1)
+    # PixArt-XL-2 by default
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_layers", type=int, default=28)
+    parser.add_argument("--inner_dim", type=int, default=1152)
+    parser.add_argument("--patch_size", type=int, default=2)
+    parser.add_argument("--in_channels", type=int, default=4)
+    parser.add_argument("--vae_scale_factor", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.topology_file is not None:
+        topology = ClusterTopology.from_file(args.topology_file)
+    else:
+        topology = synthetic_topology(args)
+    cfg_degree = 2 if args.use_cfg_parallel else 1
+    step_comm_bytes = estimate_step_comm_bytes(
+        height=args.height,
+        width=args.width,
+        batch_size=2 * args.batch_size,
+        vae_scale_factor=args.vae_scale_factor,
+        patch_size=args.patch_size,
+        in_channels=args.in_channels,
+        inner_dim=args.inner_dim,
+        num_layers=args.num_layers,
+        ulysses_degree=args.ulysses_degree,
+        ring_degree=args.ring_degree,
+        pipeline_parallel_degree=args.pipefusion_parallel_degree,
+        classifier_free_guidance_degree=cfg_degree,
+    )
+    placements = plan_rank_placements(
+        topology,
+        step_comm_bytes,
+        data_parallel_degree=args.data_parallel_degree,
+        classifier_free_guidance_degree=cfg_degree,
+        ulysses_degree=args.ulysses_degree,
+        ring_degree=args.ring_degree,
+        pipeline_parallel_degree=args.pipefusion_parallel_degree,
+    )
+    print(
+        "hosts: "
+        + ", ".join(f"{host.name}={host.ranks}" for host in topology.hosts)
+    )
+    print(
+        "bytes sent per rank and step: "
+        + ", ".join(f"{k}={v / 2**20:.2f}MB" for k, v in step_comm_bytes.items())
+    )
+    print(format_rank_placements(placements))
+    print(f"chosen: {placements[0].name} {placements[0].ranks}")
+    host_of = {rank: host.name for host in topology.hosts for rank in host.ranks}
+    for idx, ranks in enumerate(
+        get_data_parallel_replicas(placements[0].ranks, args.data_parallel_degree)
+    ):
+        hosts = sorted({host_of[rank] for rank in ranks})
+        print(f"dp replica {idx}: ranks {sorted(ranks)} on {', '.join(hosts)}")
+
+
+if __name__ == "__main__":
+    main()
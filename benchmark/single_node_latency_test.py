@@ -3,6 +3,13 @@ import os
 import subprocess
 import argparse
 
+from xfuser.config.auto_parallel import (
+    HardwareSpec,
+    format_parallel_plans,
+    load_transformer_spec,
+    plan_parallel_configs,
+)
+
 os.environ['CUDA_VISIBLE_DEVICES'] = "0,1,2,3,4,5,6,7"
 
 def run_command(cmd):
@@ -25,6 +32,7 @@ def main():
     parser.add_argument('--script', type=str, required=True, help='Script to run (e.g., tests/test_pixartalpha.py)')
     parser.add_argument('--n_gpus', type=int, default=8, help='Number of GPUs to use')
     parser.add_argument('--no_use_resolution_binning', action='store_true', help='Do not use resolution binning')
+    parser.add_argument('--planned_top_k', type=int, default=None, help='Only run the k configurations with the lowest latency predicted by the auto parallel planner')
     args = parser.parse_args()
     MODEL_ID = args.model_id  # 使用命令行输入的 model_id
     SIZES = args.sizes
@@ -32,6 +40,30 @@ def main():
     N_GPUS = args.n_gpus
     RESOLUTION_BINNING = "--no_use_resolution_binning" if args.no_use_resolution_binning else ""
 
+    if args.planned_top_k is not None:
+        spec = load_transformer_spec(MODEL_ID)
+        for size in SIZES:
+            for warmup_step in [0, 1, 2]:
+                plans = plan_parallel_configs(
+                    spec,
+                    HardwareSpec(devices_per_node=N_GPUS),
+                    world_size=N_GPUS,
+                    height=size,
+                    width=size,
+                    warmup_steps=warmup_step,
+                )[:args.planned_top_k]
+                print(f"Planned configurations for size {size}, warmup_step {warmup_step}")
+                print(format_parallel_plans(plans))
+                for plan in plans:
+                    print(f"Running test for size {size}, {plan.name}, warmup_step {warmup_step}")
+                    cmd = f"torchrun --nproc_per_node={N_GPUS} {SCRIPT} --prompt 'A small cat' --output_type 'latent' --model {MODEL_ID} " \
+                          f"--height {size} --width {size} --warmup_steps {warmup_step} " \
+                          f"{RESOLUTION_BINNING} {'--use_cfg_parallel' if plan.use_cfg_parallel else ''} " \
+                          f"--ulysses_degree {plan.ulysses_degree} --ring_degree {plan.ring_degree} " \
+                          f"--pipefusion_parallel_degree {plan.pipefusion_parallel_degree} --num_pipeline_patch {plan.num_pipeline_patch} "
+                    run_command(cmd)
+        return
+
     dp_degree = 1
     for size in SIZES:
         for cfg_degree in [1, 2]:
@@ -0,0 +1,157 @@
+"""
+Tokens saved against latency of the token merging of xFuser, over merging
+ratios, for a block of a synthetic PixArt at one resolution.
+
+The block is the self attention and feed forward of a PixArt XL-2 block with
+random weights, run on a spatially smooth token grid as the latents of an
+image are. As in the attention processors, the queries and the feed forward
+input are merged and K/V keep every token. The error column is the relative
+error of the block output against the block without merging.
+
+Example:
+    python benchmark/token_merging_benchmark.py --resolution 2048 --patches 4
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from xfuser.model_executor.layers.token_merging import (
+    TokenMatch,
+    get_token_grid_partition,
+)
+
+# PixArt-alpha / sigma XL-2
+HEADS = 16
+HEAD_DIM = 72
+PATCH_SIZE = 2
+VAE_SCALE_FACTOR = 8
+
+
+class SyntheticBlock(nn.Module):
+    def __init__(self, dim: int, heads: int):
+        super().__init__()
+        self.heads = heads
+        self.norm1 = nn.LayerNorm(dim, elementwise_affine=False)
+        self.to_q = nn.Linear(dim, dim)
+        self.to_kv = nn.Linear(dim, 2 * dim)
+        self.to_out = nn.Linear(dim, dim)
+        self.norm2 = nn.LayerNorm(dim, elementwise_affine=False)
+        self.ff = nn.Sequential(
+            nn.Linear(dim, 4 * dim), nn.GELU(approximate="tanh"), nn.Linear(4 * dim, dim)
+        )
+
+    def forward(self, x: torch.Tensor, token_match=None) -> torch.Tensor:
+        batch_size, _, dim = x.shape
+        norm_x = self.norm1(x)
+        query = self.to_q(norm_x if token_match is None else token_match.merge(norm_x))
+        key, value = self.to_kv(norm_x).chunk(2, dim=-1)
+        query, key, value = (
+            t.view(batch_size, -1, self.heads, dim // self.heads).transpose(1, 2)
+            for t in (query, key, value)
+        )
+        attn = F.scaled_dot_product_attention(query, key, value)
+        attn = self.to_out(attn.transpose(1, 2).reshape(batch_size, -1, dim))
+        if token_match is not None:
+            attn = token_match.unmerge(attn)
+        x = x + attn
+
+        norm_x = self.norm2(x)
+        if token_match is None:
+            return x + self.ff(norm_x)
+        return x + token_match.unmerge(self.ff(token_match.merge(norm_x)))
+
+
+def smooth_tokens(
+    batch_size: int, height: int, width: int, dim: int, device: torch.device
+) -> torch.Tensor:
+    """`[batch, height * width, dim]` tokens of a smooth random field."""
+    coarse = torch.randn(batch_size, dim, height // 8 + 1, width // 8 + 1, device=device)
+    field = F.interpolate(coarse, size=(height, width), mode="bicubic", align_corners=False)
+    field = field + 0.1 * torch.randn_like(field)
+    return field.flatten(2).transpose(1, 2).contiguous()
+
+
+def timed(func, iters: int, device: torch.device):
+    output = func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        output = func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return output, (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolution", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--patches",
+        type=int,
+        default=1,
+        help="Rows of the token grid are split into this many patches or "
+        "shards, the block runs on one of them and merges within it.",
+    )
+    parser.add_argument(
+        "--heads_divisor",
+        type=int,
+        default=4,
+        help="Divide the number of heads by this to run faster.",
+    )
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.25, 0.5, 0.75])
+    parser.add_argument("--stride", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    heads = max(1, HEADS // args.heads_divisor)
+    dim = heads * HEAD_DIM
+    width = args.resolution // VAE_SCALE_FACTOR // PATCH_SIZE
+    height = width // args.patches
+    tokens = height * width
+    torch.manual_seed(0)
+    block = SyntheticBlock(dim, heads).to(device).eval()
+    x = smooth_tokens(args.batch_size, height, width, dim, device)
+    src_idx, dst_idx = get_token_grid_partition(height, width, args.stride, device)
+
+    with torch.no_grad():
+        expected, reference_time = timed(lambda: block(x), args.iters, device)
+        print(
+            f"{height} x {width} tokens, {heads} heads, block without merging: "
+            f"{reference_time * 1000:.1f} ms"
+        )
+        print(
+            f"{'ratio':>6} {'tokens':>7} {'saved':>7} {'match (ms)':>11} "
+            f"{'block (ms)':>11} {'speedup':>8} {'rel error':>10}"
+        )
+        for ratio in args.ratios:
+            num_merged = int(tokens * ratio)
+            token_match, match_time = timed(
+                lambda: TokenMatch(block.norm1(x), src_idx, dst_idx, num_merged),
+                args.iters,
+                device,
+            )
+            output, block_time = timed(
+                lambda: block(x, token_match), args.iters, device
+            )
+            elapsed = match_time + block_time
+            error = ((output - expected).norm() / expected.norm()).item()
+            print(
+                f"{ratio:>6.2f} {token_match.num_merged_tokens:>7} "
+                f"{token_match.num_merged / tokens * 100:>6.1f}% "
+                f"{match_time * 1000:>11.2f} {block_time * 1000:>11.1f} "
+                f"{reference_time / elapsed:>8.2f} {error:>10.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -61,9 +61,9 @@ TASK_ARGS="--height $HEIGHT \
 # On 8 gpus, pp=2, ulysses=2, ring=1, cfg_parallel=2 (split batch)
 PARALLEL_ARGS="--pipefusion_parallel_degree 2 --ulysses_degree 2 --ring_degree 1"
 
-# Flux only supports SP, do not set the pipefusion degree
+# Flux does not apply cfg, use the gpus of cfg parallel for ulysses instead
 if [ "$MODEL_TYPE" = "Flux" ]; then
-PARALLEL_ARGS="--ulysses_degree $N_GPUS"
+PARALLEL_ARGS="--pipefusion_parallel_degree 2 --ulysses_degree $((N_GPUS / 2)) --ring_degree 1"
 fi
 
 
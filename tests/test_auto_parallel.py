@@ -0,0 +1,70 @@
+import pytest
+
+from xfuser.config.auto_parallel import (
+    HardwareSpec,
+    TransformerSpec,
+    plan_parallel_configs,
+)
+from xfuser.distributed.patch_layout import plan_patch_heights
+
+# PixArt-XL-2
+SPEC = TransformerSpec(
+    num_layers=28,
+    num_attention_heads=16,
+    attention_head_dim=72,
+    patch_size=2,
+    in_channels=4,
+)
+HEIGHT = 1024
+NUM_INFERENCE_STEPS = 20
+WARMUP_STEPS = 1
+
+
+def plans_by_name(patch_layout):
+    plans = plan_parallel_configs(
+        SPEC,
+        HardwareSpec(devices_per_node=8),
+        world_size=8,
+        height=HEIGHT,
+        width=HEIGHT,
+        num_inference_steps=NUM_INFERENCE_STEPS,
+        warmup_steps=WARMUP_STEPS,
+        patch_layout=patch_layout,
+    )
+    return {plan.name: plan for plan in plans}
+
+
+@pytest.mark.parametrize("patch_layout", ["uniform", "ramp", "cost"])
+def test_planned_patches_match_runtime(patch_layout):
+    plans = plans_by_name(patch_layout)
+    pipelined = [plan for plan in plans.values() if plan.pipefusion_parallel_degree > 1]
+    assert pipelined
+    for plan in pipelined:
+        # the heights `DiTRuntimeState._calc_patches_metadata` plans for the
+        #   configuration
+        assert plan.pipeline_patch_heights == plan_patch_heights(
+            HEIGHT // SPEC.vae_scale_factor,
+            plan.num_pipeline_patch,
+            unit=SPEC.patch_size * plan.ulysses_degree * plan.ring_degree,
+            pp_degree=plan.pipefusion_parallel_degree,
+            num_steps=NUM_INFERENCE_STEPS - WARMUP_STEPS,
+            layout=patch_layout,
+        )
+
+
+def test_ramp_layout_shortens_pipeline_fill():
+    uniform = plans_by_name("uniform")
+    ramp = plans_by_name("ramp")
+    assert uniform.keys() == ramp.keys()
+    ramped = [
+        name for name, plan in ramp.items()
+        if plan.pipefusion_parallel_degree > 1 and plan.num_pipeline_patch > 1
+    ]
+    assert ramped
+    for name in ramped:
+        assert (
+            ramp[name].pipeline_patch_heights[0]
+            < uniform[name].pipeline_patch_heights[0]
+        )
+        assert ramp[name].compute_time == pytest.approx(uniform[name].compute_time)
+        assert ramp[name].bubble_time < uniform[name].bubble_time
@@ -0,0 +1,180 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from xfuser.model_executor.layers.attention_backends import (
+    MIN_QUERY_CHUNK_SIZE,
+    attention_scores_bytes,
+    chunked_attention,
+    get_attention_chunk_sizes,
+)
+
+BATCH_SIZE = 2
+HEADS = 3
+HEAD_DIM = 16
+QUERY_TOKENS = 37
+KEY_TOKENS = 53
+
+
+def sdpa_reference(query, key, value, attention_mask=None):
+    """SDPA over the whole sequence, in the `[batch, tokens, heads,
+    head_dim]` layout of the backends."""
+    return F.scaled_dot_product_attention(
+        query.transpose(1, 2),
+        key.transpose(1, 2),
+        value.transpose(1, 2),
+        attn_mask=attention_mask,
+    ).transpose(1, 2)
+
+
+def random_qkv(query_tokens=QUERY_TOKENS, key_tokens=KEY_TOKENS):
+    generator = torch.Generator().manual_seed(0)
+    query = torch.randn(BATCH_SIZE, query_tokens, HEADS, HEAD_DIM, generator=generator)
+    key = torch.randn(BATCH_SIZE, key_tokens, HEADS, HEAD_DIM, generator=generator)
+    value = torch.randn(BATCH_SIZE, key_tokens, HEADS, HEAD_DIM, generator=generator)
+    return query, key, value
+
+
+def bool_mask(shape):
+    generator = torch.Generator().manual_seed(1)
+    mask = torch.rand(shape, generator=generator) > 0.5
+    # every query attends to at least one key
+    mask[..., 0] = True
+    return mask
+
+
+# (query_chunk_size, key_chunk_size): chunks not dividing the tokens, the
+#   whole keys per query chunk, and one key at a time
+CHUNK_SIZES = [
+    (8, 10),
+    (5, KEY_TOKENS),
+    (QUERY_TOKENS, 7),
+    (16, 1),
+]
+
+
+@pytest.mark.parametrize("query_chunk_size,key_chunk_size", CHUNK_SIZES)
+def test_chunked_attention_without_mask(query_chunk_size, key_chunk_size):
+    query, key, value = random_qkv()
+    output = chunked_attention(
+        query, key, value,
+        query_chunk_size=query_chunk_size,
+        key_chunk_size=key_chunk_size,
+    )
+    torch.testing.assert_close(output, sdpa_reference(query, key, value))
+
+
+@pytest.mark.parametrize("query_chunk_size,key_chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize(
+    "mask_shape",
+    [
+        (BATCH_SIZE, HEADS, QUERY_TOKENS, KEY_TOKENS),
+        (BATCH_SIZE, 1, QUERY_TOKENS, KEY_TOKENS),
+        (1, 1, 1, KEY_TOKENS),
+    ],
+)
+def test_chunked_attention_with_bool_mask(
+    query_chunk_size, key_chunk_size, mask_shape
+):
+    query, key, value = random_qkv()
+    mask = bool_mask(mask_shape)
+    output = chunked_attention(
+        query, key, value, mask,
+        query_chunk_size=query_chunk_size,
+        key_chunk_size=key_chunk_size,
+    )
+    torch.testing.assert_close(output, sdpa_reference(query, key, value, mask))
+
+
+@pytest.mark.parametrize("query_chunk_size,key_chunk_size", CHUNK_SIZES)
+def test_chunked_attention_with_additive_mask(query_chunk_size, key_chunk_size):
+    query, key, value = random_qkv()
+    generator = torch.Generator().manual_seed(2)
+    mask = torch.randn(BATCH_SIZE, 1, QUERY_TOKENS, KEY_TOKENS, generator=generator)
+    # large negative biases, as padding masks use
+    mask[..., KEY_TOKENS // 2 :] -= 1e4
+    output = chunked_attention(
+        query, key, value, mask,
+        query_chunk_size=query_chunk_size,
+        key_chunk_size=key_chunk_size,
+    )
+    torch.testing.assert_close(output, sdpa_reference(query, key, value, mask))
+
+
+@pytest.mark.parametrize("query_chunk_size,key_chunk_size", CHUNK_SIZES)
+def test_chunked_attention_fully_masked_rows(query_chunk_size, key_chunk_size):
+    query, key, value = random_qkv()
+    mask = bool_mask((BATCH_SIZE, HEADS, QUERY_TOKENS, KEY_TOKENS))
+    masked_rows = torch.zeros(QUERY_TOKENS, dtype=torch.bool)
+    masked_rows[[0, 9, QUERY_TOKENS - 1]] = True
+    mask[:, :, masked_rows] = False
+    # keys masked for every query of a chunk of keys
+    mask[..., 10:20] = False
+    output = chunked_attention(
+        query, key, value, mask,
+        query_chunk_size=query_chunk_size,
+        key_chunk_size=key_chunk_size,
+    )
+    expected = sdpa_reference(query, key, value, mask)
+    # rows without any key are left to the kernel, the others must not
+    #   be affected by them
+    torch.testing.assert_close(output[:, ~masked_rows], expected[:, ~masked_rows])
+
+
+def test_chunked_attention_memory_budget():
+    query, key, value = random_qkv(query_tokens=300, key_tokens=KEY_TOKENS)
+    element_size = query.element_size()
+    # below the scores of MIN_QUERY_CHUNK_SIZE queries, the keys are chunked
+    memory_budget = attention_scores_bytes(
+        BATCH_SIZE, HEADS, MIN_QUERY_CHUNK_SIZE, KEY_TOKENS, element_size
+    ) // 4
+    query_chunk_size, key_chunk_size = get_attention_chunk_sizes(
+        BATCH_SIZE, HEADS, 300, KEY_TOKENS, element_size, memory_budget
+    )
+    assert query_chunk_size == MIN_QUERY_CHUNK_SIZE
+    assert key_chunk_size < KEY_TOKENS
+    output = chunked_attention(query, key, value, memory_budget=memory_budget)
+    torch.testing.assert_close(output, sdpa_reference(query, key, value))
+
+
+@pytest.mark.parametrize("query_tokens", [64, 1000])
+def test_chunk_sizes_budget_fits_all_queries(query_tokens):
+    budget = attention_scores_bytes(BATCH_SIZE, HEADS, query_tokens, KEY_TOKENS, 2)
+    assert get_attention_chunk_sizes(
+        BATCH_SIZE, HEADS, query_tokens, KEY_TOKENS, 2, budget
+    ) == (query_tokens, KEY_TOKENS)
+    # one byte less takes one query less, unless that leaves too few
+    query_chunk_size, key_chunk_size = get_attention_chunk_sizes(
+        BATCH_SIZE, HEADS, query_tokens, KEY_TOKENS, 2, budget - 1
+    )
+    if query_tokens - 1 >= MIN_QUERY_CHUNK_SIZE:
+        assert (query_chunk_size, key_chunk_size) == (query_tokens - 1, KEY_TOKENS)
+    else:
+        assert query_chunk_size == query_tokens
+        assert key_chunk_size < KEY_TOKENS
+
+
+def test_chunk_sizes_at_min_query_chunk_size():
+    query_tokens = 4 * MIN_QUERY_CHUNK_SIZE
+    budget = attention_scores_bytes(
+        BATCH_SIZE, HEADS, MIN_QUERY_CHUNK_SIZE, KEY_TOKENS, 2
+    )
+    assert get_attention_chunk_sizes(
+        BATCH_SIZE, HEADS, query_tokens, KEY_TOKENS, 2, budget
+    ) == (MIN_QUERY_CHUNK_SIZE, KEY_TOKENS)
+    # just below, the keys are chunked within the budget
+    query_chunk_size, key_chunk_size = get_attention_chunk_sizes(
+        BATCH_SIZE, HEADS, query_tokens, KEY_TOKENS, 2, budget - 1
+    )
+    assert query_chunk_size == MIN_QUERY_CHUNK_SIZE
+    assert 1 <= key_chunk_size < KEY_TOKENS
+    assert (
+        BATCH_SIZE * HEADS * query_chunk_size * key_chunk_size * (2 * 2 + 8)
+        <= budget - 1
+    )
+
+
+def test_chunk_sizes_tiny_budget():
+    assert get_attention_chunk_sizes(
+        BATCH_SIZE, HEADS, 4 * MIN_QUERY_CHUNK_SIZE, KEY_TOKENS, 2, 1
+    ) == (MIN_QUERY_CHUNK_SIZE, 1)
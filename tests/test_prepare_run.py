@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from xfuser.config import InputConfig
+from xfuser.model_executor.layers.attention_backends import (
+    ATTENTION_BACKEND_SELECTOR,
+    local_attention,
+)
+from xfuser.model_executor.pipelines import (
+    base_pipeline,
+    xFuserFluxPipeline,
+    xFuserStableDiffusion3Pipeline,
+)
+
+
+def runtime_state(pp_degree=1, auto_attn_layer_num_for_pp=False):
+    return SimpleNamespace(
+        runtime_config=SimpleNamespace(warmup_steps=2),
+        parallel_config=SimpleNamespace(
+            cfg_degree=1,
+            sp_degree=1,
+            pp_degree=pp_degree,
+            pp_config=SimpleNamespace(
+                auto_attn_layer_num_for_pp=auto_attn_layer_num_for_pp
+            ),
+        ),
+    )
+
+
+@pytest.fixture
+def patch_runtime(monkeypatch):
+    """Run the pipelines of the tests on a single CPU process, with the
+    runtime state returned by the fixture."""
+
+    def patch(state):
+        monkeypatch.setattr(base_pipeline, "get_runtime_state", lambda: state)
+        monkeypatch.setattr(
+            base_pipeline,
+            "get_pipeline_parallel_world_size",
+            lambda: state.parallel_config.pp_degree,
+        )
+        generator = torch.Generator
+        monkeypatch.setattr(
+            base_pipeline.torch, "Generator", lambda device=None: generator()
+        )
+
+    return patch
+
+
+def test_prepare_run_balances_sd3_blocks(monkeypatch, patch_runtime):
+    patch_runtime(runtime_state(pp_degree=2, auto_attn_layer_num_for_pp=True))
+    calls = []
+
+    def call(self, **kwargs):
+        calls.append(kwargs)
+
+    def balance(self, input_config, run):
+        calls.append("balance")
+        run()
+
+    monkeypatch.setattr(xFuserStableDiffusion3Pipeline, "__call__", call)
+    monkeypatch.setattr(
+        xFuserStableDiffusion3Pipeline, "_balance_transformer_blocks", balance
+    )
+    pipe = object.__new__(xFuserStableDiffusion3Pipeline)
+    pipe.prepare_run(InputConfig(height=256, width=256, batch_size=1))
+
+    assert calls[0] == "balance"
+    assert len(calls) == 3
+    # the SD3 pipeline takes no resolution binning
+    assert all("use_resolution_binning" not in kwargs for kwargs in calls[1:])
+    assert base_pipeline.get_runtime_state().runtime_config.warmup_steps == 2
+
+
+def test_prepare_run_autotunes_sd3_attention(monkeypatch, patch_runtime):
+    patch_runtime(runtime_state())
+    shapes = []
+
+    def call(self, height, width, **kwargs):
+        # one attention of the image tokens of the step
+        tokens = (height // 16) * (width // 16)
+        query = torch.randn(1, tokens, 2, 16)
+        shapes.append(ATTENTION_BACKEND_SELECTOR._shape_key(query, query, None))
+        local_attention(query, query, query)
+
+    monkeypatch.setattr(xFuserStableDiffusion3Pipeline, "__call__", call)
+    ATTENTION_BACKEND_SELECTOR.set_backend("auto")
+    ATTENTION_BACKEND_SELECTOR.clear()
+    pipe = object.__new__(xFuserStableDiffusion3Pipeline)
+    pipe.prepare_run(InputConfig(height=256, width=256, batch_size=1))
+
+    assert not ATTENTION_BACKEND_SELECTOR.tuning
+    assert shapes[0] in ATTENTION_BACKEND_SELECTOR.decisions
+    # decided while tuning, not the preferred backend of an untuned shape
+    assert ATTENTION_BACKEND_SELECTOR._decisions[shapes[0]][1]
+    ATTENTION_BACKEND_SELECTOR.clear()
+
+
+def test_flux_rejects_auto_layer_split(patch_runtime):
+    patch_runtime(runtime_state(pp_degree=2, auto_attn_layer_num_for_pp=True))
+    pipe = object.__new__(xFuserFluxPipeline)
+    with pytest.raises(RuntimeError, match="auto_attn_layer_num_for_pp"):
+        pipe(prompt="", num_inference_steps=1)
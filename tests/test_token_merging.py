@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+from diffusers.models.attention import Attention
+
+from xfuser.model_executor.layers import attention_processor, token_merging
+from xfuser.model_executor.layers.attention_processor import xFuserAttnProcessor2_0
+from xfuser.model_executor.layers.token_merging import TokenMerger
+
+BATCH_SIZE = 2
+DIM = 32
+# 4 x 4 tokens of a 64px image
+WIDTH = 64
+NUM_TOKENS = 16
+
+
+@pytest.fixture
+def token_merger(monkeypatch):
+    runtime_state = SimpleNamespace(
+        step_idx=0,
+        input_config=SimpleNamespace(width=WIDTH, num_inference_steps=20),
+        vae_scale_factor=8,
+        backbone_patch_size=2,
+        plan=SimpleNamespace(
+            use_long_ctx_kv_cache=False,
+            use_long_ctx_attn=False,
+            num_pipeline_patch=1,
+        ),
+    )
+    monkeypatch.setattr(token_merging, "get_runtime_state", lambda: runtime_state)
+    monkeypatch.setattr(
+        attention_processor, "get_runtime_state", lambda: runtime_state
+    )
+    monkeypatch.setattr(attention_processor, "HAS_LONG_CTX_ATTN", False)
+    merger = TokenMerger(ratio=0.5)
+    monkeypatch.setattr(attention_processor, "TOKEN_MERGER", merger)
+    return merger
+
+
+def self_attention():
+    attn = Attention(query_dim=DIM, heads=2, dim_head=DIM // 2)
+    # the K/V projections the attention wrappers fuse
+    attn.to_kv = nn.Linear(DIM, 2 * DIM, bias=False)
+    with torch.no_grad():
+        attn.to_kv.weight.copy_(torch.cat([attn.to_k.weight, attn.to_v.weight]))
+    return attn
+
+
+def test_masked_attention_after_merged_one(token_merger):
+    processor = xFuserAttnProcessor2_0()
+    attn = self_attention()
+    hidden_states = torch.randn(BATCH_SIZE, NUM_TOKENS, DIM)
+    with torch.no_grad():
+        processor(attn, hidden_states)
+        assert token_merger.get_match(hidden_states) is not None
+
+        # a block whose self attention is masked merges nothing, nor does
+        #   its feed forward
+        attention_mask = torch.zeros(BATCH_SIZE, 1, NUM_TOKENS)
+        output = processor(attn, hidden_states, attention_mask=attention_mask)
+    assert output.shape == hidden_states.shape
+    assert token_merger.current is None
+    assert token_merger.get_match(output) is None
+
+
+def test_cross_attention_keeps_match(token_merger):
+    processor = xFuserAttnProcessor2_0()
+    attn = self_attention()
+    hidden_states = torch.randn(BATCH_SIZE, NUM_TOKENS, DIM)
+    with torch.no_grad():
+        processor(attn, hidden_states)
+        token_match = token_merger.current
+        # the cross attention between the self attention and the feed
+        #   forward of a block leaves the match to the feed forward
+        processor(
+            attn,
+            hidden_states,
+            encoder_hidden_states=torch.randn(BATCH_SIZE, 8, DIM),
+            attention_mask=torch.zeros(BATCH_SIZE, 1, 8),
+        )
+    assert token_merger.get_match(hidden_states) is token_match
@@ -0,0 +1,123 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from xfuser.distributed import parallel_state
+from xfuser.distributed.topology import (
+    ClusterTopology,
+    estimate_step_comm_bytes,
+    get_data_parallel_replicas,
+    plan_rank_placements,
+)
+
+WORLD_SIZE = 16
+DEGREES = dict(
+    data_parallel_degree=2,
+    ulysses_degree=4,
+    pipeline_parallel_degree=2,
+)
+
+
+@pytest.fixture
+def topology(tmp_path):
+    """Two 8-GPU boxes whose ranks the launcher numbered round-robin."""
+    path = tmp_path / "topology.json"
+    path.write_text(
+        json.dumps(
+            {
+                "hosts": [
+                    {"name": "node0", "ranks": list(range(0, WORLD_SIZE, 2))},
+                    {"name": "node1", "ranks": list(range(1, WORLD_SIZE, 2))},
+                ],
+                "inter_node_link": "infiniband",
+            }
+        )
+    )
+    return ClusterTopology.from_file(str(path))
+
+
+def plan(topology):
+    # PixArt-XL-2 at 1024px, the batch doubled by classifier free guidance
+    step_comm_bytes = estimate_step_comm_bytes(
+        height=1024,
+        width=1024,
+        batch_size=2,
+        vae_scale_factor=8,
+        patch_size=2,
+        in_channels=4,
+        inner_dim=1152,
+        num_layers=28,
+        ulysses_degree=DEGREES["ulysses_degree"],
+        pipeline_parallel_degree=DEGREES["pipeline_parallel_degree"],
+    )
+    return plan_rank_placements(topology, step_comm_bytes, **DEGREES)
+
+
+def build_groups(monkeypatch, rank, rank_placement):
+    """Group ranks of every kind of group `initialize_model_parallel` builds
+    on `rank`, and the data parallel replica index of the rank."""
+    for name in ("_DP", "_CFG", "_SP", "_PP", "_DP_REPLICA_INDEX"):
+        monkeypatch.setattr(parallel_state, name, None)
+    monkeypatch.setattr(parallel_state, "HAS_LONG_CTX_ATTN", False)
+    monkeypatch.setattr(parallel_state.torch.distributed, "is_initialized", lambda: True)
+    monkeypatch.setattr(
+        parallel_state.torch.distributed, "get_world_size", lambda: WORLD_SIZE
+    )
+    monkeypatch.setattr(
+        parallel_state,
+        "get_world_group",
+        lambda: SimpleNamespace(
+            rank=rank, rank_in_group=rank, local_rank=rank // 2, world_size=WORLD_SIZE
+        ),
+    )
+    groups = {}
+
+    def init_model_parallel_group(group_ranks, local_rank, backend, parallel_mode):
+        groups[parallel_mode] = group_ranks
+
+    monkeypatch.setattr(
+        parallel_state, "init_model_parallel_group", init_model_parallel_group
+    )
+    parallel_state.initialize_model_parallel(
+        sequence_parallel_degree=DEGREES["ulysses_degree"],
+        backend="gloo",
+        rank_placement=rank_placement,
+        **DEGREES,
+    )
+    return groups, parallel_state.get_data_parallel_replica_index()
+
+
+def test_placement_reduces_cross_node_bytes(topology):
+    placements = plan(topology)
+    identity = next(p for p in placements if p.is_identity())
+    best = placements[0]
+    assert identity.total_cross_node_bytes > 0
+    assert best.total_cross_node_bytes < identity.total_cross_node_bytes
+    # a replica per box, nothing but data parallel spans the boxes
+    assert best.total_cross_node_bytes == 0
+
+
+def test_placed_groups_stay_on_one_node(monkeypatch, topology):
+    best = plan(topology)[0]
+    groups, _ = build_groups(monkeypatch, 0, best.ranks)
+    for parallel_mode in ("sequence", "pipeline"):
+        for ranks in groups[parallel_mode]:
+            assert len({topology.host_of_rank[rank] for rank in ranks}) == 1
+    assert groups["data"] == get_data_parallel_replicas(
+        best.ranks, DEGREES["data_parallel_degree"]
+    )
+
+
+def test_replica_index_follows_placed_groups(monkeypatch, topology):
+    best = plan(topology)[0]
+    replicas = get_data_parallel_replicas(
+        best.ranks, DEGREES["data_parallel_degree"]
+    )
+    num_devices = WORLD_SIZE // DEGREES["data_parallel_degree"]
+    for rank in range(WORLD_SIZE):
+        _, replica_index = build_groups(monkeypatch, rank, best.ranks)
+        assert rank in replicas[replica_index]
+        # the replicas are the boxes, not the contiguous ranks
+        assert replica_index == topology.host_of_rank[rank]
+    assert topology.host_of_rank[1] != 1 // num_devices
@@ -2,7 +2,8 @@ from xfuser.model_executor.pipelines import (
     xFuserPixArtAlphaPipeline,
     xFuserPixArtSigmaPipeline,
     xFuserStableDiffusion3Pipeline,
-    xFuserFluxPipeline
+    xFuserFluxPipeline,
+    LatentPreview,
 )
 from xfuser.config import xFuserArgs, EngineConfig
 
@@ -11,6 +12,7 @@ __all__ = [
     "xFuserPixArtSigmaPipeline",
     "xFuserStableDiffusion3Pipeline",
     "xFuserFluxPipeline",
+    "LatentPreview",
     "xFuserArgs",
     "EngineConfig",
 ]
\ No newline at end of file
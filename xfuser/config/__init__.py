@@ -1,4 +1,10 @@
 from .args import FlexibleArgumentParser, xFuserArgs
+from .auto_parallel import (
+    HardwareSpec,
+    TransformerSpec,
+    ParallelPlan,
+    plan_parallel_configs,
+)
 from .config import (
     EngineConfig,
     ParallelConfig,
@@ -22,5 +28,9 @@ __all__ = [
     "DataParallelConfig",
     "ModelConfig",
     "InputConfig",
-    "RuntimeConfig"
+    "RuntimeConfig",
+    "HardwareSpec",
+    "TransformerSpec",
+    "ParallelPlan",
+    "plan_parallel_configs",
 ]
\ No newline at end of file
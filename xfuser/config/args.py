@@ -1,3 +1,4 @@
+import os
 import sys
 import argparse
 import dataclasses
@@ -7,9 +8,17 @@ from typing import Optional, List, Tuple, Union
 import torch
 import torch.distributed
 
+import xfuser.envs as envs
 from xfuser.logger import init_logger
-from xfuser.distributed import init_distributed_environment
+from xfuser.distributed import get_world_group, init_distributed_environment
+from xfuser.config.auto_parallel import (
+    HardwareSpec,
+    format_parallel_plans,
+    load_transformer_spec,
+    plan_parallel_configs,
+)
 from xfuser.config.config import (
+    HAS_LONG_CTX_ATTN,
     EngineConfig,
     ParallelConfig,
     TensorParallelConfig,
@@ -64,6 +73,15 @@ class xFuserArgs:
     # use_cuda_graph: bool = True
     use_parallel_vae: bool = False
     # use_profiler: bool = False
+    attention_backend: str = "auto"
+    attention_memory_budget_mb: int = 0
+    token_merging_ratio: float = 0.0
+    token_merging_schedule: str = "constant"
+    token_merging_stride: int = 2
+    feature_cache_interval: int = 0
+    feature_cache_mode: str = "interval"
+    feature_cache_threshold: float = 0.1
+    feature_cache_shallow_blocks: int = 2
     # Parallel arguments
         # data parallel
     data_parallel_degree: int = 1
@@ -74,10 +92,35 @@ class xFuserArgs:
         # tensor parallel
     tensor_parallel_degree: int = 1
     split_scheme: Optional[str] = 'row'
+        # rank placement
+    topology_file: Optional[str] = None
+        # auto parallel
+    auto_parallel: bool = False
+    auto_parallel_device_tflops: float = 150.0
+    auto_parallel_device_memory_gb: Optional[float] = None
+    auto_parallel_devices_per_node: Optional[int] = None
+    auto_parallel_intra_node_bandwidth: float = 150.0
+    auto_parallel_inter_node_bandwidth: float = 12.5
         # pipefusion parallel
     pipefusion_parallel_degree: int = 1
     num_pipeline_patch: Optional[int] = None
+    pipeline_patch_layout: str = "uniform"
+    pipeline_patch_costs: Optional[List[float]] = None
     attn_layer_num_for_pp: Optional[List[int]] = None
+    auto_attn_layer_num_for_pp: bool = False
+    attn_layer_split_cache: Optional[str] = None
+    pipeline_recv_ring_depth: int = 1
+    pipeline_recv_buffer_pool_mb: int = 0
+    pipeline_comm_quantization: Optional[List[str]] = None
+    pipeline_comm_delta: Optional[List[str]] = None
+    pipeline_comm_delta_keep_ratio: float = 1.0
+    pipeline_comm_delta_keyframe_interval: int = 0
+    pipeline_max_inflight_sends: int = 0
+    pipeline_kv_refresh: str = "none"
+    pipeline_kv_refresh_interval: int = 0
+    pipeline_kv_refresh_steps: Optional[List[int]] = None
+    pipeline_kv_refresh_threshold: float = 0.0
+    pipeline_kv_drift_stats: bool = False
     # Input arguments
     height: int = 1024
     width: int = 1024
@@ -104,6 +147,15 @@ class xFuserArgs:
         # runtime_group.add_argument("--use_cuda_graph", action="store_true")
         runtime_group.add_argument("--use_parallel_vae", action="store_true")
         # runtime_group.add_argument("--use_profiler", action="store_true")
+        runtime_group.add_argument("--attention_backend", type=str, default="auto", choices=["auto", "flash_attn", "xformers", "sdpa", "math", "chunked"], help="Kernel of the attention computed on each rank. 'auto' measures the available ones for each attention shape during prepare_run and keeps the fastest.")
+        runtime_group.add_argument("--attention_memory_budget_mb", type=int, default=0, help="Memory in MB the attention scores of a layer may take. Larger attentions go to the flash, xformers or query-chunked kernels, the chunks of the latter sized to it. 0 for no limit.")
+        runtime_group.add_argument("--token_merging_ratio", type=float, default=0.0, help="Part of the image tokens of each pipeline patch and sequence parallel shard merged by the self attention and feed forward of the PixArt and SD3 blocks. Trades quality for speed, 0 to disable.")
+        runtime_group.add_argument("--token_merging_schedule", type=str, default="constant", choices=["constant", "linear"], help="'constant' merges token_merging_ratio of the tokens at every step, 'linear' decreases it to none at the last step.")
+        runtime_group.add_argument("--token_merging_stride", type=int, default=2, help="Tokens are merged into one token of each stride x stride cell of the token grid.")
+        runtime_group.add_argument("--feature_cache_interval", type=int, default=0, help="The deep blocks of the PixArt and SD3 transformers run at least every this many steps, the other steps reuse the change they made to the hidden states at their last run. Trades quality for speed, 0 or 1 to disable.")
+        runtime_group.add_argument("--feature_cache_mode", type=str, default="interval", choices=["interval", "adaptive"], help="'interval' runs the deep blocks every feature_cache_interval steps, 'adaptive' also runs them once the relative change of their input since their last run reaches feature_cache_threshold.")
+        runtime_group.add_argument("--feature_cache_threshold", type=float, default=0.1, help="Relative L1 change of the input of the deep blocks above which the 'adaptive' feature cache runs them.")
+        runtime_group.add_argument("--feature_cache_shallow_blocks", type=int, default=2, help="Number of first and of last transformer blocks the feature cache always runs.")
 
         # Parallel arguments
         parallel_group = parser.add_argument_group('Parallel Processing Options')
@@ -113,9 +165,35 @@ class xFuserArgs:
         parallel_group.add_argument("--ring_degree", type=int, default=None, help="Ring sequence parallel degree. Used in attention layer.")
         parallel_group.add_argument("--pipefusion_parallel_degree", type=int, default=1, help="Pipefusion parallel degree. Indicates the number of pipeline stages.")
         parallel_group.add_argument("--num_pipeline_patch", type=int, default=None, help="Number of patches the feature map should be segmented in pipefusion parallel.")
+        parallel_group.add_argument("--pipeline_patch_layout", type=str, default="uniform", choices=["uniform", "ramp", "cost"], help="Heights of the pipefusion patches. 'uniform' splits the image evenly, 'ramp' halves the first patch so that the later stages start sooner, 'cost' sizes the first and last patches for the shortest simulated pipeline schedule under --pipeline_patch_costs.")
+        parallel_group.add_argument("--pipeline_patch_costs", default=None, nargs="*", type=float, help="Measured cost model of a pipefusion patch used by --pipeline_patch_layout cost: cost per latent row, fixed cost per patch, extra cost of the first patch and of the last patch of a step, in any time unit. Trailing entries default to 0.")
         parallel_group.add_argument("--attn_layer_num_for_pp", default=None, nargs="*", type=int, help="List representing the number of layers per stage of the pipeline in pipefusion parallel")
+        parallel_group.add_argument("--auto_attn_layer_num_for_pp", action="store_true", help="Time the transformer blocks and the work of every pipefusion stage outside of them at the input size of prepare_run, then split the blocks so that the slowest stage is as fast as possible.")
+        parallel_group.add_argument("--attn_layer_split_cache", type=nullable_str, default=None, help="JSON file caching the splits of --auto_attn_layer_num_for_pp per model, input size and pipefusion degree across runs.")
+        parallel_group.add_argument("--pipeline_recv_ring_depth", type=int, default=1, help="Number of receive buffers per pipeline patch in pipefusion parallel. Values larger than 1 let a stage post receives ahead of its compute.")
+        parallel_group.add_argument("--pipeline_recv_buffer_pool_mb", type=int, default=0, help="Size in MB of the pool keeping pipefusion recv buffers of recently used input sizes for reuse. 0 disables the pool.")
+        parallel_group.add_argument("--pipeline_comm_quantization", default=None, nargs="*", type=str, help="Tensors quantized when sent between pipefusion stages, as name=mode entries with mode int8 or fp8. Use 'patch' for the pipeline patches and the extra tensor name, e.g. encoder_hidden_states, otherwise.")
+        parallel_group.add_argument("--pipeline_comm_delta", default=None, nargs="*", type=str, help="Tensors sent between pipefusion stages as a residual against the previous step, named as in --pipeline_comm_quantization, which also quantizes the residual.")
+        parallel_group.add_argument("--pipeline_comm_delta_keep_ratio", type=float, default=1.0, help="Fraction of the largest residual entries sent by --pipeline_comm_delta, 1.0 sends them all.")
+        parallel_group.add_argument("--pipeline_comm_delta_keyframe_interval", type=int, default=0, help="Send a full tensor every this many messages of a --pipeline_comm_delta slot, 0 only sends one at the start of every generation.")
+        parallel_group.add_argument("--pipeline_max_inflight_sends", type=int, default=0, help="Maximum number of asynchronous sends a pipefusion stage keeps outstanding before waiting for the oldest one. 0 leaves it unbounded.")
+        parallel_group.add_argument("--pipeline_kv_refresh", type=str, default="none", choices=["none", "periodic", "schedule", "drift"], help="Steps after --warmup_steps that run synchronously to refresh the stale K/V of every pipefusion layer. 'periodic' refreshes every --pipeline_kv_refresh_interval steps, 'schedule' the steps of --pipeline_kv_refresh_steps, 'drift' the steps whose stale K/V drifted more than --pipeline_kv_refresh_threshold in the last generation that measured them.")
+        parallel_group.add_argument("--pipeline_kv_refresh_interval", type=int, default=0, help="Refresh every this many steps after the warmup steps with --pipeline_kv_refresh periodic.")
+        parallel_group.add_argument("--pipeline_kv_refresh_steps", default=None, nargs="*", type=int, help="Indices of the steps refreshed with --pipeline_kv_refresh schedule.")
+        parallel_group.add_argument("--pipeline_kv_refresh_threshold", type=float, default=0.0, help="Relative L2 drift between the stale and fresh K/V of a layer above which --pipeline_kv_refresh drift refreshes a step.")
+        parallel_group.add_argument("--pipeline_kv_drift_stats", action="store_true", help="Measure the relative L2 drift between the stale and fresh K/V of every pipefusion layer and step, to tune --pipeline_kv_refresh. Always on with --pipeline_kv_refresh drift.")
         parallel_group.add_argument("--tensor_parallel_degree", type=int, default=1, help="Tensor parallel degree.")
         parallel_group.add_argument("--split_scheme", type=str, default='row', help="Split scheme for tensor parallel.")
+        parallel_group.add_argument("--topology_file", type=nullable_str, default=None, help="JSON file describing the hosts, the ranks on each host and their link bandwidths, used to keep the most communication-heavy parallel groups inside a host. 'auto' groups ranks by hostname. Ranks are placed contiguously if not set.")
+
+        # Auto parallel arguments
+        auto_parallel_group = parser.add_argument_group('Auto Parallel Options')
+        auto_parallel_group.add_argument("--auto_parallel", action="store_true", help="Choose the data parallel, cfg, ulysses, ring and pipefusion degrees and the pipeline patch number with an analytic cost model, overriding the values passed for them. The configuration with the lowest predicted latency for the input size is used.")
+        auto_parallel_group.add_argument("--auto_parallel_device_tflops", type=float, default=150.0, help="Dense half precision TFLOPS a device reaches on large inputs.")
+        auto_parallel_group.add_argument("--auto_parallel_device_memory_gb", type=float, default=None, help="Memory of a device in GB. Defaults to the memory of the local device.")
+        auto_parallel_group.add_argument("--auto_parallel_devices_per_node", type=int, default=None, help="Number of devices per node. Defaults to the local world size.")
+        auto_parallel_group.add_argument("--auto_parallel_intra_node_bandwidth", type=float, default=150.0, help="Per direction bandwidth between devices of a node in GB/s.")
+        auto_parallel_group.add_argument("--auto_parallel_inter_node_bandwidth", type=float, default=12.5, help="Per direction bandwidth between devices of different nodes in GB/s.")
 
         # Input arguments
         input_group = parser.add_argument_group('Input Options')
@@ -144,6 +222,9 @@ class xFuserArgs:
                            "Initializing...")
             init_distributed_environment()
 
+        if self.auto_parallel:
+            self._apply_auto_parallel_plan()
+
         model_config = ModelConfig(
             model=self.model,
             download_dir=self.download_dir,
@@ -155,6 +236,15 @@ class xFuserArgs:
             # use_cuda_graph=self.use_cuda_graph,
             use_parallel_vae=self.use_parallel_vae,
             # use_profiler=self.use_profiler,
+            attention_backend=self.attention_backend,
+            attention_memory_budget_mb=self.attention_memory_budget_mb,
+            token_merging_ratio=self.token_merging_ratio,
+            token_merging_schedule=self.token_merging_schedule,
+            token_merging_stride=self.token_merging_stride,
+            feature_cache_interval=self.feature_cache_interval,
+            feature_cache_mode=self.feature_cache_mode,
+            feature_cache_threshold=self.feature_cache_threshold,
+            feature_cache_shallow_blocks=self.feature_cache_shallow_blocks,
         )
         
         parallel_config = ParallelConfig(
@@ -173,8 +263,25 @@ class xFuserArgs:
             pp_config=PipeFusionParallelConfig(
                 pp_degree=self.pipefusion_parallel_degree,
                 num_pipeline_patch=self.num_pipeline_patch,
+                patch_layout=self.pipeline_patch_layout,
+                patch_costs=self.pipeline_patch_costs,
                 attn_layer_num_for_pp=self.attn_layer_num_for_pp,
+                auto_attn_layer_num_for_pp=self.auto_attn_layer_num_for_pp,
+                attn_layer_split_cache=self.attn_layer_split_cache,
+                recv_ring_depth=self.pipeline_recv_ring_depth,
+                recv_buffer_pool_mb=self.pipeline_recv_buffer_pool_mb,
+                comm_quantization=self.pipeline_comm_quantization,
+                comm_delta=self.pipeline_comm_delta,
+                comm_delta_keep_ratio=self.pipeline_comm_delta_keep_ratio,
+                comm_delta_keyframe_interval=self.pipeline_comm_delta_keyframe_interval,
+                max_inflight_sends=self.pipeline_max_inflight_sends,
+                kv_refresh=self.pipeline_kv_refresh,
+                kv_refresh_interval=self.pipeline_kv_refresh_interval,
+                kv_refresh_steps=self.pipeline_kv_refresh_steps,
+                kv_refresh_threshold=self.pipeline_kv_refresh_threshold,
+                kv_drift_stats=self.pipeline_kv_drift_stats,
             ),
+            topology_file=self.topology_file,
         )
 
         engine_config = EngineConfig(
@@ -195,4 +302,81 @@ class xFuserArgs:
             output_type=self.output_type,
         )
 
-        return engine_config, input_config
\ No newline at end of file
+        return engine_config, input_config
+
+    def _apply_auto_parallel_plan(self):
+        """Plan on the first rank and follow its plan on every rank, since
+        ranks choosing different degrees would hang building the groups."""
+        rank = torch.distributed.get_rank()
+        world_size = torch.distributed.get_world_size()
+        cpu_group = get_world_group().cpu_group
+        device_memory_gb = self.auto_parallel_device_memory_gb
+        if device_memory_gb is None:
+            local_memory_gb = (
+                torch.cuda.get_device_properties(envs.LOCAL_RANK).total_memory
+                / 2**30
+                if torch.cuda.is_available() else None
+            )
+            # plan for the smallest device
+            memories_gb = [None] * world_size
+            torch.distributed.all_gather_object(
+                memories_gb, local_memory_gb, group=cpu_group
+            )
+            memories_gb = [m for m in memories_gb if m is not None]
+            device_memory_gb = min(memories_gb) if memories_gb else None
+
+        plan = [None]
+        if rank == 0:
+            devices_per_node = self.auto_parallel_devices_per_node or int(
+                os.environ.get("LOCAL_WORLD_SIZE", world_size)
+            )
+            hardware = HardwareSpec(
+                device_tflops=self.auto_parallel_device_tflops,
+                device_memory_gb=device_memory_gb,
+                devices_per_node=devices_per_node,
+                intra_node_bandwidth_gbps=self.auto_parallel_intra_node_bandwidth,
+                inter_node_bandwidth_gbps=self.auto_parallel_inter_node_bandwidth,
+            )
+            plans = plan_parallel_configs(
+                load_transformer_spec(self.model, self.download_dir),
+                hardware,
+                world_size=world_size,
+                height=self.height,
+                width=self.width,
+                batch_size=len(self.prompt) if isinstance(self.prompt, list) else 1,
+                num_inference_steps=self.num_inference_steps,
+                warmup_steps=self.warmup_steps,
+                use_sequence_parallel=HAS_LONG_CTX_ATTN,
+                patch_layout=self.pipeline_patch_layout,
+                patch_costs=self.pipeline_patch_costs,
+            )
+            if len(plans) > 0:
+                logger.info(
+                    f"Predicted latency of the parallel configurations:\n"
+                    f"{format_parallel_plans(plans)}"
+                )
+                logger.info(f"Using parallel configuration {plans[0].name}")
+                plan = [plans[0]]
+        torch.distributed.broadcast_object_list(plan, src=0, group=cpu_group)
+        plan = plan[0]
+        if plan is None:
+            raise RuntimeError(
+                f"No parallel configuration of {world_size} devices fits the "
+                f"model and input size"
+            )
+        self.data_parallel_degree = plan.data_parallel_degree
+        self.use_cfg_parallel = plan.use_cfg_parallel
+        self.ulysses_degree = plan.ulysses_degree
+        self.ring_degree = plan.ring_degree
+        self.pipefusion_parallel_degree = plan.pipefusion_parallel_degree
+        self.num_pipeline_patch = plan.num_pipeline_patch
+        self.warmup_steps = plan.warmup_steps
+        if (
+            self.attn_layer_num_for_pp is not None
+            and len(self.attn_layer_num_for_pp) != plan.pipefusion_parallel_degree
+        ):
+            logger.warning(
+                f"attn_layer_num_for_pp {self.attn_layer_num_for_pp} does not "
+                f"match the planned pipefusion degree, splitting layers evenly"
+            )
+            self.attn_layer_num_for_pp = None
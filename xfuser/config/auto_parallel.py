@@ -0,0 +1,468 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from xfuser.distributed.patch_layout import PatchCostModel, plan_patch_heights
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+# Text tokens that join the image tokens in attention, or that image tokens
+# cross-attend to, for the transformer classes xFuser supports
+_TEXT_SEQ_LEN = {
+    "PixArtTransformer2DModel": 300,
+    "SD3Transformer2DModel": 333,
+    "FluxTransformer2DModel": 512,
+}
+
+
+@dataclass
+class HardwareSpec:
+    """Compute and link parameters of the devices a plan runs on.
+
+    `device_tflops` is the dense half precision throughput GEMMs and
+    attention reach on large inputs, `saturation_tokens` the number of
+    tokens at which they reach half of it. Bandwidths are per direction, in
+    GB/s. `device_memory_gb` of None does not limit memory.
+    """
+    device_tflops: float = 150.0
+    device_memory_gb: Optional[float] = None
+    devices_per_node: int = 8
+    intra_node_bandwidth_gbps: float = 150.0
+    inter_node_bandwidth_gbps: float = 12.5
+    message_latency_us: float = 20.0
+    saturation_tokens: int = 1024
+
+
+@dataclass
+class TransformerSpec:
+    """Shape of a DiT backbone as far as the cost model needs it."""
+    num_layers: int
+    num_attention_heads: int
+    attention_head_dim: int
+    patch_size: int
+    in_channels: int
+    vae_scale_factor: int = 8
+    text_seq_len: int = 300
+    # text tokens join the image tokens in attention (SD3, Flux) instead of
+    # being cross-attended to (PixArt)
+    joint_attention: bool = False
+    # classifier free guidance doubles the batch
+    uses_cfg: bool = True
+    num_single_layers: int = 0
+
+    @property
+    def inner_dim(self) -> int:
+        return self.num_attention_heads * self.attention_head_dim
+
+    @classmethod
+    def from_config(
+        cls, config: Dict[str, Any], vae_scale_factor: int = 8
+    ) -> "TransformerSpec":
+        class_name = config.get("_class_name", "PixArtTransformer2DModel")
+        patch_size = config["patch_size"]
+        in_channels = config["in_channels"]
+        if class_name == "FluxTransformer2DModel":
+            # Flux packs 2x2 latent pixels into one token
+            patch_size = 2
+            in_channels = in_channels // 4
+        return cls(
+            num_layers=config["num_layers"],
+            num_attention_heads=config["num_attention_heads"],
+            attention_head_dim=config["attention_head_dim"],
+            patch_size=patch_size,
+            in_channels=in_channels,
+            vae_scale_factor=vae_scale_factor,
+            text_seq_len=_TEXT_SEQ_LEN.get(class_name, 300),
+            joint_attention=class_name != "PixArtTransformer2DModel",
+            uses_cfg=class_name != "FluxTransformer2DModel",
+            num_single_layers=config.get("num_single_layers", 0),
+        )
+
+
+def _load_model_config(
+    model: str, subfolder: str, download_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    if os.path.isdir(model):
+        path = os.path.join(model, subfolder, "config.json")
+    else:
+        from huggingface_hub import hf_hub_download
+
+        path = hf_hub_download(
+            model, "config.json", subfolder=subfolder, cache_dir=download_dir
+        )
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_transformer_spec(
+    model: str, download_dir: Optional[str] = None
+) -> TransformerSpec:
+    """Read the transformer and VAE configs of a diffusers model, without
+    loading its weights."""
+    vae_config = _load_model_config(model, "vae", download_dir)
+    vae_scale_factor = 2 ** (len(vae_config["block_out_channels"]) - 1)
+    return TransformerSpec.from_config(
+        _load_model_config(model, "transformer", download_dir),
+        vae_scale_factor=vae_scale_factor,
+    )
+
+
+@dataclass
+class ParallelPlan:
+    """One legal hybrid parallel configuration and its predicted costs per
+    rank for a whole generation. Times are in seconds, sizes in bytes."""
+    data_parallel_degree: int
+    use_cfg_parallel: bool
+    ulysses_degree: int
+    ring_degree: int
+    pipefusion_parallel_degree: int
+    num_pipeline_patch: int
+    warmup_steps: int
+    # heights of the pipeline patches in latent rows, uniform if None
+    pipeline_patch_heights: Optional[List[int]] = None
+    latency: float = 0.0
+    compute_time: float = 0.0
+    comm_time: float = 0.0
+    bubble_time: float = 0.0
+    comm_bytes: float = 0.0
+    memory_bytes: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return (
+            f"dp{self.data_parallel_degree}_"
+            f"cfg{2 if self.use_cfg_parallel else 1}_"
+            f"ulysses{self.ulysses_degree}_ring{self.ring_degree}_"
+            f"pp{self.pipefusion_parallel_degree}_"
+            f"patch{self.num_pipeline_patch}"
+        )
+
+
+def _pipeline_patch_heights(
+    latents_height: int,
+    patch_size: int,
+    sp_degree: int,
+    num_pipeline_patch: int,
+    pp_degree: int,
+    num_patched_steps: int,
+    patch_layout: str,
+    cost_model: PatchCostModel,
+) -> Optional[List[int]]:
+    """Pipeline patch heights `DiTRuntimeState._calc_patches_metadata` ends
+    up with, None if it would reject the layout."""
+    try:
+        return plan_patch_heights(
+            latents_height,
+            num_pipeline_patch,
+            unit=patch_size * sp_degree,
+            pp_degree=pp_degree,
+            num_steps=max(1, num_patched_steps),
+            layout=patch_layout,
+            cost_model=cost_model,
+        )
+    except ValueError:
+        return None
+
+
+class _CostModel:
+    def __init__(
+        self,
+        spec: TransformerSpec,
+        hardware: HardwareSpec,
+        height: int,
+        width: int,
+        batch_size: int,
+        dtype_bytes: int = 2,
+    ):
+        self.spec = spec
+        self.hardware = hardware
+        self.dtype_bytes = dtype_bytes
+        self.batch_size = batch_size
+        self.latents_height = height // spec.vae_scale_factor
+        self.latents_width = width // spec.vae_scale_factor
+        self.num_tokens = (
+            (self.latents_height // spec.patch_size)
+            * (self.latents_width // spec.patch_size)
+        )
+        self.num_layers = spec.num_layers + spec.num_single_layers
+
+    def _bandwidth(self, span: int) -> float:
+        # groups are built from contiguous ranks, a group spanning more
+        # ranks than a node holds goes over the inter-node links
+        if span <= self.hardware.devices_per_node:
+            return self.hardware.intra_node_bandwidth_gbps * 1e9
+        return self.hardware.inter_node_bandwidth_gbps * 1e9
+
+    def _gemm_time(self, flops: float, tokens: float) -> float:
+        efficiency = tokens / (tokens + self.hardware.saturation_tokens)
+        return flops / (self.hardware.device_tflops * 1e12 * efficiency)
+
+    def _comm_time(self, nbytes: float, num_messages: float, span: int) -> float:
+        if nbytes == 0:
+            return 0.0
+        return (
+            num_messages * self.hardware.message_latency_us * 1e-6
+            + nbytes / self._bandwidth(span)
+        )
+
+    def _param_bytes(self) -> float:
+        d = self.spec.inner_dim
+        # attention and a 4x MLP, doubled for the text stream of joint blocks
+        block_params = 12 * d * d
+        if self.spec.joint_attention:
+            double_block_params = 2 * block_params
+        else:
+            double_block_params = block_params + 4 * d * d
+        return self.dtype_bytes * (
+            self.spec.num_layers * double_block_params
+            + self.spec.num_single_layers * block_params
+        )
+
+    def estimate(self, plan: ParallelPlan, num_inference_steps: int):
+        spec = self.spec
+        d = spec.inner_dim
+        cfg_degree = 2 if plan.use_cfg_parallel else 1
+        sp_degree = plan.ulysses_degree * plan.ring_degree
+        pp_degree = plan.pipefusion_parallel_degree
+        num_patches = plan.num_pipeline_patch
+        batch = (
+            self.batch_size * (2 if spec.uses_cfg else 1)
+            / cfg_degree / plan.data_parallel_degree
+        )
+        text_tokens = spec.text_seq_len if spec.joint_attention else 0
+        seq_len = self.num_tokens + text_tokens
+        stage_layers = self.num_layers / pp_degree
+
+        def layer_compute_time(patches: int) -> float:
+            q_tokens = seq_len / sp_degree / patches
+            flops = 24 * batch * q_tokens * d * d
+            flops += 4 * batch * q_tokens * seq_len * d
+            if not spec.joint_attention:
+                flops += 4 * batch * q_tokens * d * d
+                flops += 4 * batch * q_tokens * spec.text_seq_len * d
+            return self._gemm_time(flops, batch * q_tokens)
+
+        def attn_compute_time(patches: int) -> float:
+            q_tokens = seq_len / sp_degree / patches
+            return self._gemm_time(
+                4 * batch * q_tokens * seq_len * d, batch * q_tokens
+            )
+
+        # hidden states of one layer held by a rank
+        shard_bytes = batch * seq_len * d * self.dtype_bytes / sp_degree
+        latents_bytes = (
+            batch * spec.in_channels * self.latents_height
+            * self.latents_width * self.dtype_bytes
+        )
+
+        def step_costs(patches: int):
+            """Compute, exposed communication and bytes of one step of a
+            stage that runs `patches` patches."""
+            compute = stage_layers * patches * layer_compute_time(patches)
+            comm = 0.0
+            nbytes = 0.0
+            if plan.ulysses_degree > 1:
+                ulysses_bytes = (
+                    4 * stage_layers * shard_bytes
+                    * (plan.ulysses_degree - 1) / plan.ulysses_degree
+                )
+                nbytes += ulysses_bytes
+                comm += self._comm_time(
+                    ulysses_bytes,
+                    4 * stage_layers * patches,
+                    plan.ulysses_degree,
+                )
+            if plan.ring_degree > 1:
+                # every patch attends to the whole stale KV of the ring
+                ring_bytes = (
+                    2 * stage_layers * patches * shard_bytes
+                    * (plan.ring_degree - 1)
+                )
+                nbytes += ring_bytes
+                ring_time = self._comm_time(
+                    ring_bytes,
+                    stage_layers * patches * (plan.ring_degree - 1),
+                    sp_degree,
+                )
+                # overlapped with the attention it feeds
+                comm += max(
+                    0.0,
+                    ring_time
+                    - stage_layers * patches * attn_compute_time(patches),
+                )
+            if cfg_degree > 1:
+                nbytes += latents_bytes / 2
+                comm += self._comm_time(
+                    latents_bytes / 2, 1, sp_degree * pp_degree * cfg_degree
+                )
+            return compute, comm, nbytes
+
+        if pp_degree == 1:
+            compute, comm, nbytes = step_costs(1)
+            plan.compute_time = num_inference_steps * compute
+            plan.comm_time = num_inference_steps * comm
+            plan.comm_bytes = num_inference_steps * nbytes
+            plan.bubble_time = 0.0
+        else:
+            warmup_steps = min(plan.warmup_steps, num_inference_steps)
+            pp_span = sp_degree * pp_degree
+            pp_bytes = shard_bytes + latents_bytes / sp_degree / pp_degree
+            # warmup steps run the full feature map through the stages one
+            # after another
+            sync_compute, sync_comm, sync_bytes = step_costs(1)
+            sync_pp_time = self._comm_time(pp_bytes, 1, pp_span)
+            sync_step = pp_degree * (sync_compute + sync_comm + sync_pp_time)
+            # patched steps keep every stage busy if there are at least as
+            # many patches as stages, the P2P sends overlap with compute
+            compute, comm, nbytes = step_costs(num_patches)
+            pp_time = self._comm_time(pp_bytes, num_patches, pp_span)
+            exposed_comm = comm + max(0.0, pp_time - compute)
+            patch_time = (compute + comm + pp_time) / num_patches
+            idle_time = max(0, pp_degree - num_patches) * patch_time
+            patched_steps = num_inference_steps - warmup_steps
+            # the pipeline fills at the pace of the first patch
+            heights = plan.pipeline_patch_heights
+            first_patch_time = (
+                patch_time if heights is None
+                else (compute + comm + pp_time) * heights[0] / sum(heights)
+            )
+            # filling the pipeline once, and stages waiting for a patch when
+            # there are fewer patches than stages
+            plan.bubble_time = (
+                (pp_degree - 1) * first_patch_time + patched_steps * idle_time
+                if patched_steps > 0 else 0.0
+            )
+            plan.compute_time = (
+                warmup_steps * pp_degree * sync_compute
+                + patched_steps * compute
+            )
+            plan.comm_time = (
+                warmup_steps * pp_degree * (sync_comm + sync_pp_time)
+                + patched_steps * exposed_comm
+            )
+            plan.comm_bytes = (
+                warmup_steps * (sync_bytes + pp_bytes)
+                + patched_steps * (nbytes + pp_bytes)
+            )
+        plan.latency = plan.compute_time + plan.comm_time + plan.bubble_time
+
+        # parameters, transient activations of the full feature map during
+        # warmup or of one patch, the stale KV and the recv buffers
+        full_patches = 1 if pp_degree == 1 or plan.warmup_steps > 0 else num_patches
+        memory = self._param_bytes() / pp_degree
+        memory += 8 * shard_bytes / full_patches
+        if pp_degree > 1:
+            memory += 2 * stage_layers * shard_bytes
+            memory += shard_bytes + latents_bytes / sp_degree
+        plan.memory_bytes = memory
+        return plan
+
+
+def plan_parallel_configs(
+    spec: TransformerSpec,
+    hardware: HardwareSpec,
+    world_size: int,
+    height: int,
+    width: int,
+    batch_size: int = 1,
+    num_inference_steps: int = 20,
+    warmup_steps: int = 1,
+    use_sequence_parallel: bool = True,
+    patch_layout: str = "uniform",
+    patch_costs: Optional[List[float]] = None,
+) -> List[ParallelPlan]:
+    """Estimate every legal hybrid parallel configuration for `world_size`
+    ranks and return them fastest first. Configurations that do not fit in
+    `hardware.device_memory_gb` are left out.
+
+    `warmup_steps` is taken as given, since the cost model cannot tell how
+    many synchronous steps the image quality needs. Sequence parallel
+    degrees above 1 are only considered with `use_sequence_parallel`.
+    Pipeline patches are planned as the runtime does for `patch_layout`
+    and `patch_costs`, see `--pipeline_patch_layout`.
+    """
+    model = _CostModel(spec, hardware, height, width, batch_size)
+    patch_cost_model = PatchCostModel.from_list(patch_costs)
+    plans = []
+    for dp_degree in _divisors(world_size):
+        if batch_size % dp_degree != 0:
+            continue
+        for cfg_degree in (1, 2) if spec.uses_cfg else (1,):
+            if (world_size // dp_degree) % cfg_degree != 0:
+                continue
+            model_parallel_degree = world_size // dp_degree // cfg_degree
+            for pp_degree in _divisors(model_parallel_degree):
+                if pp_degree > model.num_layers:
+                    continue
+                sp_degree = model_parallel_degree // pp_degree
+                if sp_degree > 1 and not use_sequence_parallel:
+                    continue
+                if model.latents_height % sp_degree != 0:
+                    continue
+                for ulysses_degree in _divisors(sp_degree):
+                    if spec.num_attention_heads % ulysses_degree != 0:
+                        continue
+                    ring_degree = sp_degree // ulysses_degree
+                    if pp_degree == 1:
+                        patch_candidates = [1]
+                    else:
+                        patch_candidates = [
+                            max(1, pp_degree // 2), pp_degree, 2 * pp_degree
+                        ]
+                    num_patches_seen = set()
+                    for num_pipeline_patch in patch_candidates:
+                        heights = _pipeline_patch_heights(
+                            model.latents_height,
+                            spec.patch_size,
+                            sp_degree,
+                            num_pipeline_patch,
+                            pp_degree,
+                            num_inference_steps - warmup_steps,
+                            patch_layout,
+                            patch_cost_model,
+                        )
+                        if heights is None or len(heights) in num_patches_seen:
+                            continue
+                        num_patches = len(heights)
+                        num_patches_seen.add(num_patches)
+                        plan = model.estimate(
+                            ParallelPlan(
+                                data_parallel_degree=dp_degree,
+                                use_cfg_parallel=cfg_degree == 2,
+                                ulysses_degree=ulysses_degree,
+                                ring_degree=ring_degree,
+                                pipefusion_parallel_degree=pp_degree,
+                                num_pipeline_patch=num_patches,
+                                warmup_steps=warmup_steps,
+                                pipeline_patch_heights=heights,
+                            ),
+                            num_inference_steps,
+                        )
+                        if (
+                            hardware.device_memory_gb is not None
+                            and plan.memory_bytes
+                            > hardware.device_memory_gb * 2**30
+                        ):
+                            continue
+                        plans.append(plan)
+    return sorted(plans, key=lambda plan: plan.latency)
+
+
+def _divisors(n: int) -> List[int]:
+    return [i for i in range(1, n + 1) if n % i == 0]
+
+
+def format_parallel_plans(plans: List[ParallelPlan]) -> str:
+    lines = [
+        f"{'config':<44} {'latency(s)':>10} {'compute(s)':>10} "
+        f"{'comm(s)':>8} {'bubble(s)':>9} {'comm(GB)':>9} {'memory(GB)':>10}"
+    ]
+    for plan in plans:
+        lines.append(
+            f"{plan.name:<44} {plan.latency:>10.3f} {plan.compute_time:>10.3f} "
+            f"{plan.comm_time:>8.3f} {plan.bubble_time:>9.3f} "
+            f"{plan.comm_bytes / 2**30:>9.3f} {plan.memory_bytes / 2**30:>10.2f}"
+        )
+    return "\n".join(lines)
@@ -12,7 +12,7 @@ from xfuser.envs import CUDA_VERSION, TORCH_VERSION, PACKAGES_CHECKER
 
 logger = init_logger(__name__)
 
-from typing import Union, Optional, List
+from typing import Dict, Union, Optional, List
 
 env_info = PACKAGES_CHECKER.get_packages_info()
 HAS_LONG_CTX_ATTN = env_info["has_long_ctx_attn"]
@@ -47,10 +47,35 @@ class RuntimeConfig:
     use_cuda_graph: bool = False
     use_parallel_vae: bool = False
     use_profiler: bool = False
+    attention_backend: str = "auto"
+    attention_memory_budget_mb: int = 0
+    token_merging_ratio: float = 0.0
+    token_merging_schedule: str = "constant"
+    token_merging_stride: int = 2
+    feature_cache_interval: int = 0
+    feature_cache_mode: str = "interval"
+    feature_cache_threshold: float = 0.1
+    feature_cache_shallow_blocks: int = 2
 
     def __post_init__(self):
         if self.use_cuda_graph:
             check_env()
+        assert self.attention_memory_budget_mb >= 0, \
+            "attention_memory_budget_mb must be greater than or equal to 0"
+        assert 0.0 <= self.token_merging_ratio < 1.0, \
+            "token_merging_ratio must be in [0, 1)"
+        assert self.token_merging_schedule in ["constant", "linear"], \
+            "token_merging_schedule must be 'constant' or 'linear'"
+        assert self.token_merging_stride >= 2, \
+            "token_merging_stride must be greater than or equal to 2"
+        assert self.feature_cache_interval >= 0, \
+            "feature_cache_interval must be greater than or equal to 0"
+        assert self.feature_cache_mode in ["interval", "adaptive"], \
+            "feature_cache_mode must be 'interval' or 'adaptive'"
+        assert self.feature_cache_threshold >= 0.0, \
+            "feature_cache_threshold must be greater than or equal to 0"
+        assert self.feature_cache_shallow_blocks >= 0, \
+            "feature_cache_shallow_blocks must be greater than or equal to 0"
 
 
 @dataclass
@@ -114,11 +139,65 @@ class TensorParallelConfig():
 class PipeFusionParallelConfig():
     pp_degree: int = 1
     num_pipeline_patch: Optional[int] = None
-    attn_layer_num_for_pp: Optional[List[int]] = None,
+    patch_layout: str = "uniform"
+    patch_costs: Optional[List[float]] = None
+    attn_layer_num_for_pp: Optional[List[int]] = None
+    auto_attn_layer_num_for_pp: bool = False
+    attn_layer_split_cache: Optional[str] = None
+    recv_ring_depth: int = 1
+    recv_buffer_pool_mb: int = 0
+    comm_quantization: Optional[List[str]] = None
+    comm_delta: Optional[List[str]] = None
+    comm_delta_keep_ratio: float = 1.0
+    comm_delta_keyframe_interval: int = 0
+    max_inflight_sends: int = 0
+    kv_refresh: str = "none"
+    kv_refresh_interval: int = 0
+    kv_refresh_steps: Optional[List[int]] = None
+    kv_refresh_threshold: float = 0.0
+    kv_drift_stats: bool = False
 
     def __post_init__(self):
         assert self.pp_degree is not None and self.pp_degree >= 1, \
             "pipefusion_degree must be set and greater than 1 to use pipefusion"
+        assert self.patch_layout in ("uniform", "ramp", "cost"), \
+            "patch_layout must be one of uniform, ramp and cost"
+        assert self.patch_costs is None or 1 <= len(self.patch_costs) <= 4, \
+            "patch_costs must have between 1 and 4 entries"
+        assert self.recv_ring_depth >= 1, \
+            "recv_ring_depth must be greater than or equal to 1"
+        assert self.recv_buffer_pool_mb >= 0, \
+            "recv_buffer_pool_mb must be greater than or equal to 0"
+        # "name=mode" entries, "patch" stands for the pipeline patches
+        self.comm_quantization_modes: Dict[Optional[str], str] = {}
+        for entry in self.comm_quantization or []:
+            name, sep, mode = entry.partition("=")
+            if not sep or mode not in ("int8", "fp8"):
+                raise ValueError(
+                    f"Invalid pipeline comm quantization entry {entry}, "
+                    f"expected name=int8 or name=fp8"
+                )
+            self.comm_quantization_modes[
+                None if name == "patch" else name
+            ] = mode
+        self.comm_delta_names = set(
+            None if name == "patch" else name
+            for name in self.comm_delta or []
+        )
+        assert 0.0 < self.comm_delta_keep_ratio <= 1.0, \
+            "comm_delta_keep_ratio must be in (0, 1]"
+        assert self.comm_delta_keyframe_interval >= 0, \
+            "comm_delta_keyframe_interval must be greater than or equal to 0"
+        assert self.max_inflight_sends >= 0, \
+            "max_inflight_sends must be greater than or equal to 0"
+        assert self.kv_refresh in ("none", "periodic", "schedule", "drift"), \
+            "kv_refresh must be one of none, periodic, schedule and drift"
+        assert self.kv_refresh != "periodic" or self.kv_refresh_interval >= 1, \
+            "kv_refresh_interval must be greater than or equal to 1"
+        assert self.kv_refresh != "schedule" or self.kv_refresh_steps, \
+            "kv_refresh_steps must be set to use the schedule kv refresh"
+        assert self.kv_refresh_threshold >= 0.0, \
+            "kv_refresh_threshold must be greater than or equal to 0"
         assert self.pp_degree <= dist.get_world_size(), \
             "pipefusion_degree must be less than or equal to world_size"
         if self.num_pipeline_patch is None:
@@ -134,6 +213,10 @@ class PipeFusionParallelConfig():
                 "attn_layer_num_for_pp must have the same "
                 "length as pp_degree if not None"
             )
+            assert not self.auto_attn_layer_num_for_pp, (
+                "attn_layer_num_for_pp and auto_attn_layer_num_for_pp "
+                "cannot be set at the same time"
+            )
         if self.pp_degree == 1 and self.num_pipeline_patch > 1:
             logger.warning(f"Pipefusion degree is 1, pipeline will not be used,"
                            f"num_pipeline_patch will be ignored")
@@ -145,6 +228,7 @@ class ParallelConfig():
     sp_config: SequenceParallelConfig
     pp_config: PipeFusionParallelConfig
     tp_config: TensorParallelConfig
+    topology_file: Optional[str] = None
 
     def __post_init__(self):
         if self.tp_config.tp_degree > 1:
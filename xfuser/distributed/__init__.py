@@ -10,6 +10,7 @@ from .parallel_state import (
     is_pipeline_last_stage,
     get_data_parallel_world_size,
     get_data_parallel_rank,
+    get_data_parallel_replica_index,
     is_dp_last_rank,
     get_classifier_free_guidance_world_size,
     get_classifier_free_guidance_rank,
@@ -19,6 +20,25 @@ from .parallel_state import (
     initialize_model_parallel,
     model_parallel_is_initialized,
 )
+from .topology import (
+    ClusterTopology,
+    RankPlacement,
+    plan_rank_placements,
+)
+from .patch_layout import (
+    PatchCostModel,
+    plan_patch_heights,
+    simulate_pipefusion_schedule,
+)
+from .execution_plan import (
+    ExecutionPlan,
+    PatchPlan,
+    compile_execution_plan,
+)
+from .kv_refresh import (
+    StaleKVDriftMonitor,
+    StaleKVRefreshPolicy,
+)
 from .runtime_state import (
     get_runtime_state,
     runtime_state_is_initialized,
@@ -37,6 +57,7 @@ __all__ = [
     "is_pipeline_last_stage",
     "get_data_parallel_world_size",
     "get_data_parallel_rank",
+    "get_data_parallel_replica_index",
     "is_dp_last_rank",
     "get_classifier_free_guidance_world_size",
     "get_classifier_free_guidance_rank",
@@ -46,6 +67,17 @@ __all__ = [
     "init_model_parallel_group",
     "initialize_model_parallel",
     "model_parallel_is_initialized",
+    "ClusterTopology",
+    "RankPlacement",
+    "plan_rank_placements",
+    "PatchCostModel",
+    "plan_patch_heights",
+    "simulate_pipefusion_schedule",
+    "ExecutionPlan",
+    "PatchPlan",
+    "compile_execution_plan",
+    "StaleKVDriftMonitor",
+    "StaleKVRefreshPolicy",
     "get_runtime_state",
     "runtime_state_is_initialized",
     "initialize_runtime_state",
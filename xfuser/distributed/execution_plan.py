@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+
+@dataclass(frozen=True)
+class PatchPlan:
+    """What the layers of a stage do in one forward: the whole feature map in
+    sync mode, or one pipeline patch in patch mode.
+
+    Token ranges are in the tokens of this sequence parallel rank, the ones
+    of `pos_embed_token_ranges` in the tokens of the whole image, and latent
+    rows in the latents of this rank.
+    """
+    patch_mode: bool
+    patch_idx: int
+    num_pipeline_patch: int
+    is_first_patch: bool
+    is_last_patch: bool
+    # tokens of the feature map and the ones of this forward in it
+    num_tokens: int
+    token_start: int
+    token_end: int
+    # tokens of this forward in the K/V gathered over the ulysses group
+    ulysses_token_start: int
+    ulysses_token_end: int
+    latent_start: int
+    latent_end: int
+    pos_embed_token_ranges: Tuple[Tuple[int, int], ...]
+    # the stale K/V are kept by the sequence parallel attention rather than
+    #   the KV cache of the attention layers
+    use_long_ctx_kv_cache: bool
+    use_long_ctx_attn: bool
+
+    @property
+    def use_stale_kv_cache(self) -> bool:
+        """Whether the attention layers keep the stale K/V themselves."""
+        return self.num_pipeline_patch > 1 and not self.use_long_ctx_kv_cache
+
+
+@dataclass(frozen=True)
+class ExecutionPlan:
+    """Plans of the forwards of a stage for the current input size."""
+    sync: PatchPlan
+    patches: Tuple[PatchPlan, ...]
+
+    def get(self, patch_mode: bool, patch_idx: int = 0) -> PatchPlan:
+        return self.patches[patch_idx] if patch_mode else self.sync
+
+
+def compile_execution_plan(
+    pp_patches_token_num: Sequence[int],
+    pp_patches_start_idx_local: Sequence[int],
+    pp_patches_token_start_end_idx: Sequence[Sequence[int]],
+    ulysses_degree: int,
+    sp_degree: int,
+    has_long_ctx_attn: bool,
+    has_flash_attn: bool,
+) -> ExecutionPlan:
+    num_pipeline_patch = len(pp_patches_token_num)
+    token_offsets: List[int] = [0]
+    for token_num in pp_patches_token_num:
+        token_offsets.append(token_offsets[-1] + token_num)
+    num_tokens = token_offsets[-1]
+    pos_embed_token_ranges = tuple(
+        (start, end) for start, end in pp_patches_token_start_end_idx
+    )
+    common = dict(
+        num_pipeline_patch=num_pipeline_patch,
+        num_tokens=num_tokens,
+        use_long_ctx_kv_cache=has_flash_attn and sp_degree > 1,
+        use_long_ctx_attn=has_long_ctx_attn and sp_degree > 1,
+    )
+    sync = PatchPlan(
+        patch_mode=False,
+        patch_idx=0,
+        is_first_patch=True,
+        is_last_patch=True,
+        token_start=0,
+        token_end=num_tokens,
+        ulysses_token_start=0,
+        ulysses_token_end=ulysses_degree * num_tokens,
+        latent_start=0,
+        latent_end=pp_patches_start_idx_local[-1],
+        pos_embed_token_ranges=pos_embed_token_ranges,
+        **common,
+    )
+    patches = tuple(
+        PatchPlan(
+            patch_mode=True,
+            patch_idx=patch_idx,
+            is_first_patch=patch_idx == 0,
+            is_last_patch=patch_idx == num_pipeline_patch - 1,
+            token_start=token_offsets[patch_idx],
+            token_end=token_offsets[patch_idx + 1],
+            ulysses_token_start=ulysses_degree * token_offsets[patch_idx],
+            ulysses_token_end=ulysses_degree * token_offsets[patch_idx + 1],
+            latent_start=pp_patches_start_idx_local[patch_idx],
+            latent_end=pp_patches_start_idx_local[patch_idx + 1],
+            pos_embed_token_ranges=(pos_embed_token_ranges[patch_idx],),
+            **common,
+        )
+        for patch_idx in range(num_pipeline_patch)
+    )
+    return ExecutionPlan(sync=sync, patches=patches)
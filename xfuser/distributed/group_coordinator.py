@@ -3,9 +3,10 @@
 # https://github.com/vllm-project/vllm/blob/main/vllm/distributed/parallel_state.py
 # Copyright 2023 The vLLM team.
 # Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
-from collections import namedtuple
-from typing import Any, Dict, List, Optional, Tuple, Union
+from collections import deque, namedtuple, OrderedDict
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
 import pickle
+import time
 
 import torch
 from torch.distributed import Backend, ProcessGroup
@@ -603,6 +604,420 @@ class GroupCoordinator:
             self.cpu_group = None
 
 
+class PipelineRecvRing:
+    """
+    Fixed-depth ring of receive buffers backing one pipeline recv slot
+    (one pipeline patch, the full feature map, or one extra tensor index).
+
+    Every buffer in the ring is in one of three states:
+      FREE: may be used as the destination of a new irecv
+      RECEIVING: an irecv has been posted into it and not consumed yet
+      HELD: handed out to the caller by `get_pipeline_recv_data`
+    At most one buffer is HELD at a time. It goes back to the ring when the
+    caller releases it explicitly or asks for the next tensor of this slot.
+    """
+    FREE = 0
+    RECEIVING = 1
+    HELD = 2
+
+    def __init__(self, buffers: List[torch.Tensor]):
+        assert len(buffers) >= 1, "a recv ring needs at least one buffer"
+        self.buffers = buffers
+        self.states = [PipelineRecvRing.FREE for _ in buffers]
+        self.held_slot: Optional[int] = None
+        self._cursor = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.buffers)
+
+    def acquire(self, reclaim_held: bool = False) -> Optional[int]:
+        """Return a buffer slot for a new irecv, or None if none is free.
+
+        If `reclaim_held` is set and no buffer is free, the held buffer is
+        taken back from the caller. This is what a single-buffer ring has to
+        do, and it relies on the caller being done with the held tensor.
+        """
+        for i in range(self.depth):
+            slot = (self._cursor + i) % self.depth
+            if self.states[slot] == PipelineRecvRing.FREE:
+                self._cursor = (slot + 1) % self.depth
+                self.states[slot] = PipelineRecvRing.RECEIVING
+                return slot
+        if reclaim_held and self.held_slot is not None:
+            slot = self.held_slot
+            self.held_slot = None
+            self.states[slot] = PipelineRecvRing.RECEIVING
+            return slot
+        return None
+
+    def hold(self, slot: int) -> torch.Tensor:
+        assert self.states[slot] == PipelineRecvRing.RECEIVING, (
+            "only a receiving buffer can be handed to the caller")
+        self.release()
+        self.states[slot] = PipelineRecvRing.HELD
+        self.held_slot = slot
+        return self.buffers[slot]
+
+    def release(self):
+        if self.held_slot is not None:
+            self.states[self.held_slot] = PipelineRecvRing.FREE
+            self.held_slot = None
+
+    def reset(self):
+        self.states = [PipelineRecvRing.FREE for _ in self.buffers]
+        self.held_slot = None
+        self._cursor = 0
+
+
+class PipelineBufferPool:
+    """
+    Shape-keyed pool of receive buffers that are not used by the current recv
+    layout. Buffers dropped by a layout change are kept in least recently used
+    order while their total size fits in `max_bytes`, so that switching back to
+    a recently used resolution or batch size reuses them instead of allocating.
+    """
+
+    def __init__(self, device: torch.device, max_bytes: int = 0):
+        self.device = device
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.free_buffers: "OrderedDict[Tuple[Tuple[int, ...], torch.dtype], List[torch.Tensor]]" = OrderedDict()
+
+    def get(self, shape: List[int], dtype: torch.dtype) -> torch.Tensor:
+        key = (tuple(shape), dtype)
+        buffers = self.free_buffers.get(key, None)
+        if not buffers:
+            self.num_misses += 1
+            return torch.zeros(*shape, dtype=dtype, device=self.device)
+        self.num_hits += 1
+        buffer = buffers.pop()
+        if len(buffers) == 0:
+            del self.free_buffers[key]
+        self.num_bytes -= buffer.numel() * buffer.element_size()
+        return buffer
+
+    def put(self, buffer: torch.Tensor):
+        key = (tuple(buffer.shape), buffer.dtype)
+        self.free_buffers.setdefault(key, []).append(buffer)
+        self.free_buffers.move_to_end(key)
+        self.num_bytes += buffer.numel() * buffer.element_size()
+        self._evict()
+
+    def set_max_bytes(self, max_bytes: int):
+        assert max_bytes >= 0, "max_bytes must be greater than or equal to 0"
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.num_bytes > self.max_bytes:
+            key, buffers = next(iter(self.free_buffers.items()))
+            buffer = buffers.pop(0)
+            if len(buffers) == 0:
+                del self.free_buffers[key]
+            self.num_bytes -= buffer.numel() * buffer.element_size()
+
+
+def _align_wire_bytes(nbytes: int) -> int:
+    # tensors packed into one message start at 16 byte aligned offsets so
+    #   that they can be viewed as any dtype without a copy
+    return (nbytes + 15) // 16 * 16
+
+
+def _relative_error(
+    error_sq_sum: Optional[torch.Tensor], ref_sq_sum: Optional[torch.Tensor]
+) -> float:
+    if error_sq_sum is None:
+        return 0.0
+    return (error_sq_sum / ref_sq_sum.clamp(min=1e-12)).sqrt().item()
+
+
+class PipelineCommCodec:
+    """
+    Base class of the encodings applied to a recv slot on the wire. Besides
+    encoding and decoding, a codec tells the receiver how many bytes the next
+    message of a slot takes, and keeps accuracy-vs-bytes statistics of what
+    it encoded without syncing the device.
+    """
+
+    def __init__(self):
+        self.config: Tuple = ()
+        self.sent_bytes = 0
+        self.raw_bytes = 0
+        self.error_sq_sum: Optional[torch.Tensor] = None
+        self.ref_sq_sum: Optional[torch.Tensor] = None
+
+    def reset(self):
+        pass
+
+    def max_wire_nbytes(self, buffer: torch.Tensor) -> int:
+        raise NotImplementedError
+
+    def next_recv_message(self, key, buffer: torch.Tensor) -> Tuple[int, bool]:
+        """Return the size of the next message of slot `key` and whether it
+        is a keyframe."""
+        raise NotImplementedError
+
+    def encode(self, tensor: torch.Tensor, key=None) -> torch.Tensor:
+        raise NotImplementedError
+
+    def decode(
+        self, wire: torch.Tensor, out: torch.Tensor, keyframe: bool = False
+    ) -> torch.Tensor:
+        raise NotImplementedError
+
+    def get_stats(self) -> Dict[str, float]:
+        """Bytes sent, bytes the tensors take unencoded and the relative L2
+        error over every tensor encoded so far."""
+        return {
+            "sent_bytes": self.sent_bytes,
+            "raw_bytes": self.raw_bytes,
+            "relative_error": _relative_error(self.error_sq_sum, self.ref_sq_sum),
+        }
+
+    def _accumulate_error(self, reference: torch.Tensor, reconstructed: torch.Tensor):
+        error_sq = (reconstructed.float() - reference.float()).pow(2).sum()
+        ref_sq = reference.float().pow(2).sum()
+        if self.error_sq_sum is None:
+            self.error_sq_sum = error_sq
+            self.ref_sq_sum = ref_sq
+        else:
+            self.error_sq_sum += error_sq
+            self.ref_sq_sum += ref_sq
+
+
+class PipelineQuantCodec(PipelineCommCodec):
+    """
+    Per-token quantization of tensors sent between pipeline stages. Every row
+    along the last dimension is scaled by its own absmax and stored as int8 or
+    fp8 (e4m3). On the wire, the float32 scales come first, followed by the
+    quantized payload, in one uint8 buffer.
+
+    """
+    MODES = ("int8", "fp8")
+
+    def __init__(self, mode: str, track_error: bool = True):
+        if mode not in PipelineQuantCodec.MODES:
+            raise ValueError(
+                f"Unsupported pipeline comm quantization mode {mode}, "
+                f"supported modes are {PipelineQuantCodec.MODES}"
+            )
+        if mode == "fp8" and not hasattr(torch, "float8_e4m3fn"):
+            raise RuntimeError(
+                "fp8 pipeline comm quantization requires torch>=2.1")
+        super().__init__()
+        self.mode = mode
+        self.config = (mode,)
+        if mode == "int8":
+            self.quant_dtype = torch.int8
+            self.quant_max = 127.0
+        else:
+            self.quant_dtype = torch.float8_e4m3fn
+            self.quant_max = 448.0
+        self.track_error = track_error
+
+    def wire_nbytes(self, shape: torch.Size) -> int:
+        numel = shape.numel()
+        return _align_wire_bytes(numel // shape[-1] * 4) + numel
+
+    def max_wire_nbytes(self, buffer: torch.Tensor) -> int:
+        return self.wire_nbytes(buffer.shape)
+
+    def next_recv_message(self, key, buffer: torch.Tensor) -> Tuple[int, bool]:
+        return self.wire_nbytes(buffer.shape), False
+
+    def quantize(self, scaled: torch.Tensor) -> torch.Tensor:
+        if self.quant_dtype == torch.int8:
+            scaled = scaled.round().clamp(-self.quant_max, self.quant_max)
+        return scaled.to(self.quant_dtype)
+
+    def encode(self, tensor: torch.Tensor, key=None) -> torch.Tensor:
+        rows = tensor.reshape(-1, tensor.shape[-1]).float()
+        scales = rows.abs().amax(dim=-1, keepdim=True).clamp(min=1e-12) / self.quant_max
+        quantized = self.quantize(rows / scales)
+        if self.track_error:
+            self._accumulate_error(rows, quantized.float() * scales)
+
+        scales_nbytes = scales.numel() * 4
+        wire = torch.empty(
+            self.wire_nbytes(tensor.shape), dtype=torch.uint8, device=tensor.device
+        )
+        wire[:scales_nbytes].view(torch.float32).copy_(scales.view(-1))
+        wire[_align_wire_bytes(scales_nbytes):].view(self.quant_dtype).copy_(
+            quantized.view(-1)
+        )
+        self.sent_bytes += wire.numel()
+        self.raw_bytes += tensor.numel() * tensor.element_size()
+        return wire
+
+    def decode(
+        self, wire: torch.Tensor, out: torch.Tensor, keyframe: bool = False
+    ) -> torch.Tensor:
+        """Dequantize `wire` into `out`, which gives the shape and dtype."""
+        num_rows = out.numel() // out.shape[-1]
+        scales = wire[:num_rows * 4].view(torch.float32).view(num_rows, 1)
+        quantized = wire[_align_wire_bytes(num_rows * 4):].view(self.quant_dtype)
+        out.view(num_rows, -1).copy_(
+            quantized.view(num_rows, -1).float() * scales
+        )
+        return out
+
+
+class PipelineDeltaCodec(PipelineCommCodec):
+    """
+    Temporal delta encoding of the tensors of a recv slot. The same patch
+    changes slowly between diffusion steps, so after a raw keyframe only the
+    residual against what the receiver already holds is sent, optionally
+    restricted to the `keep_ratio` largest entries and quantized. The sender
+    replays the reconstruction of the receiver, so errors do not accumulate
+    over steps.
+
+    The first message of a slot after `reset`, and every `keyframe_interval`-th
+    one if it is set, is a keyframe. Both ends count the messages of every slot
+    to agree on the size of each message without a header.
+    """
+
+    def __init__(
+        self,
+        quantization: Optional[str] = None,
+        keep_ratio: float = 1.0,
+        keyframe_interval: int = 0,
+    ):
+        if not 0.0 < keep_ratio <= 1.0:
+            raise ValueError(
+                f"keep_ratio must be in (0, 1], got {keep_ratio}")
+        if keyframe_interval < 0:
+            raise ValueError(
+                f"keyframe_interval must be non-negative, got {keyframe_interval}")
+        super().__init__()
+        self.quant_codec = (
+            PipelineQuantCodec(quantization, track_error=False)
+            if quantization is not None else None
+        )
+        self.mode = "delta"
+        self.config = ("delta", quantization, keep_ratio, keyframe_interval)
+        self.keep_ratio = keep_ratio
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self):
+        # the tensor the receiver holds for every slot this rank sends to
+        self.send_references: Dict[Any, torch.Tensor] = {}
+        self.send_counts: Dict[Any, int] = {}
+        self.recv_counts: Dict[Any, int] = {}
+
+    def max_wire_nbytes(self, buffer: torch.Tensor) -> int:
+        return max(
+            buffer.numel() * buffer.element_size(), self._delta_nbytes(buffer)
+        )
+
+    def next_recv_message(self, key, buffer: torch.Tensor) -> Tuple[int, bool]:
+        count = self.recv_counts.get(key, 0)
+        self.recv_counts[key] = count + 1
+        if self._is_keyframe(count):
+            return buffer.numel() * buffer.element_size(), True
+        return self._delta_nbytes(buffer), False
+
+    def encode(self, tensor: torch.Tensor, key=None) -> torch.Tensor:
+        count = self.send_counts.get(key, 0)
+        self.send_counts[key] = count + 1
+        if self._is_keyframe(count):
+            self.send_references[key] = tensor.clone()
+            wire = tensor.view(-1).view(torch.uint8)
+        else:
+            reference = self.send_references[key]
+            wire = self._encode_residual(
+                tensor.float() - reference.float(), tensor.dtype
+            )
+            self._apply_residual(reference, wire)
+        self._accumulate_error(tensor, self.send_references[key])
+        self.sent_bytes += wire.numel()
+        self.raw_bytes += tensor.numel() * tensor.element_size()
+        return wire
+
+    def decode(
+        self, wire: torch.Tensor, out: torch.Tensor, keyframe: bool = False
+    ) -> torch.Tensor:
+        """Update `out`, the tensor received last for this slot, in place."""
+        if keyframe:
+            out.view(-1).copy_(wire.view(out.dtype))
+        else:
+            self._apply_residual(out, wire)
+        return out
+
+    def _is_keyframe(self, count: int) -> bool:
+        return count == 0 or (
+            self.keyframe_interval > 0 and count % self.keyframe_interval == 0
+        )
+
+    def _num_kept(self, numel: int) -> int:
+        return max(1, int(numel * self.keep_ratio))
+
+    def _delta_nbytes(self, buffer: torch.Tensor) -> int:
+        if self.keep_ratio < 1.0:
+            # float32 scale padded to 16 bytes, int32 indices, then values
+            num_kept = self._num_kept(buffer.numel())
+            value_size = (
+                buffer.element_size() if self.quant_codec is None else 1
+            )
+            return 16 + num_kept * 4 + num_kept * value_size
+        if self.quant_codec is not None:
+            return self.quant_codec.wire_nbytes(buffer.shape)
+        return buffer.numel() * buffer.element_size()
+
+    def _encode_residual(
+        self, residual: torch.Tensor, dtype: torch.dtype
+    ) -> torch.Tensor:
+        if self.keep_ratio == 1.0:
+            if self.quant_codec is not None:
+                return self.quant_codec.encode(residual)
+            return residual.to(dtype).view(-1).view(torch.uint8)
+        flat = residual.view(-1)
+        indices = flat.abs().topk(self._num_kept(flat.numel()), sorted=False).indices
+        values = flat[indices]
+        header = torch.zeros(4, dtype=torch.float32, device=residual.device)
+        if self.quant_codec is not None:
+            scale = values.abs().amax().clamp(min=1e-12) / self.quant_codec.quant_max
+            header[0] = scale
+            values = self.quant_codec.quantize(values / scale)
+        else:
+            values = values.to(dtype)
+        return torch.cat([
+            header.view(torch.uint8),
+            indices.to(torch.int32).view(torch.uint8),
+            values.view(torch.uint8),
+        ])
+
+    def _apply_residual(self, target: torch.Tensor, wire: torch.Tensor):
+        # the sender runs exactly the same ops on its copy of the reference
+        if self.keep_ratio == 1.0:
+            if self.quant_codec is not None:
+                residual = self.quant_codec.decode(
+                    wire,
+                    torch.empty(
+                        target.shape, dtype=torch.float32, device=target.device
+                    ),
+                )
+            else:
+                residual = wire.view(target.dtype).view(target.shape).float()
+            target.copy_(target.float() + residual)
+            return
+        num_kept = self._num_kept(target.numel())
+        indices = wire[16: 16 + num_kept * 4].view(torch.int32).long()
+        values = wire[16 + num_kept * 4:]
+        if self.quant_codec is not None:
+            values = (
+                values.view(self.quant_codec.quant_dtype).float()
+                * wire[:4].view(torch.float32)
+            )
+        else:
+            values = values.view(target.dtype).float()
+        flat = target.view(-1)
+        flat[indices] = (flat[indices].float() + values).to(target.dtype)
+
+
 class PipelineGroupCoordinator(GroupCoordinator):
     """
     available attributes:
@@ -683,12 +1098,39 @@ class PipelineGroupCoordinator(GroupCoordinator):
         self.recv_buffer_set: bool = False
         # self.recv_shape: Optional[torch.Size] = None
         # self.send_shape: Optional[torch.Size] = None
-        self.recv_tasks_queue: List[Union[int, Tuple[str, int]]] = []
-        self.receiving_tasks: List[Tuple[torch.distributed.Work, str, int]] = []
+        # every recv task is the tuple of (name, idx) slots of one message
+        self.recv_tasks_queue: List[Tuple[Tuple[Optional[str], int], ...]] = []
+        # posted receives with the message slots, ring slot and wire segments
+        self.receiving_tasks: List[
+            Tuple[
+                torch.distributed.Work,
+                Tuple[Tuple[Optional[str], int], ...],
+                int,
+                Optional[List[Tuple[int, int, bool]]],
+            ]
+        ] = []
         self.recv_buffer: Optional[Union[List[torch.Tensor], torch.Tensor]] = None
         self.dtype: Optional[torch.dtype] = None
         self.num_pipefusion_patches: Optional[int] = None
         self.extra_tensors_recv_buffer: Dict[str, List[torch.Tensor]] = {}
+        # number of buffers behind every patch / extra tensor recv slot
+        self.recv_ring_depth: int = 1
+        self.recv_rings: Dict[
+            Tuple[Tuple[Optional[str], int], ...], PipelineRecvRing
+        ] = {}
+        # shapes, dtype and ring depth of the current patch recv buffers, both
+        #   ends derive it from the runtime state so it needs no negotiation
+        self.recv_layout: Optional[Tuple] = None
+        self.recv_buffer_pool = PipelineBufferPool(self.device)
+        # recv slot name -> codec for tensors encoded on the wire
+        self.comm_codecs: Dict[Optional[str], PipelineCommCodec] = {}
+        self.num_sent_bytes: int = 0
+        # outstanding isends with the wire tensor they read from, oldest first,
+        #   0 leaves the number in flight unbounded
+        self.send_window: Deque[Tuple[torch.distributed.Work, torch.Tensor]] = deque()
+        self.max_inflight_sends: int = 0
+        self.peak_inflight_sends: int = 0
+        self.send_blocked_time: float = 0.0
 
     def reset_buffer(self):
         self.recv_shape = None
@@ -696,6 +1138,8 @@ class PipelineGroupCoordinator(GroupCoordinator):
         self.recv_tasks_queue = []
         self.receiving_tasks = []
         self.recv_buffer = None
+        self.recv_rings = {}
+        self.recv_layout = None
 
     def set_recv_buffer(
         self,
@@ -703,102 +1147,509 @@ class PipelineGroupCoordinator(GroupCoordinator):
         patches_shape_list: List[List[int]],
         feature_map_shape: List[int],
         dtype: torch.dtype,
+        recv_ring_depth: int = 1,
+        buffer_pool_max_bytes: int = 0,
     ):
         assert isinstance(dtype, torch.dtype), (
             "dtype must be a torch.dtype object")
         assert (isinstance(num_pipefusion_patches, int) and
                 num_pipefusion_patches >= 1), (
                     "num_pipefusion_patches must be greater than or equal to 1")
+        assert isinstance(recv_ring_depth, int) and recv_ring_depth >= 1, (
+            "recv_ring_depth must be greater than or equal to 1")
+        self.recv_buffer_pool.set_max_bytes(buffer_pool_max_bytes)
+        # the sends of the previous generation have all been received by now
+        self.wait_pipeline_sends()
+        self.recv_tasks_queue = []
+        self.receiving_tasks = []
+        for ring in self.recv_rings.values():
+            ring.reset()
+        self.reset_comm_codecs()
+        layout = (
+            num_pipefusion_patches,
+            tuple(tuple(shape) for shape in patches_shape_list),
+            tuple(feature_map_shape),
+            dtype,
+            recv_ring_depth,
+        )
+        if self.recv_buffer_set and layout == self.recv_layout:
+            return
+
         self.dtype = dtype
         self.num_pipefusion_patches = num_pipefusion_patches
+        self.recv_ring_depth = recv_ring_depth
+        old_buffers = self._pop_recv_rings(lambda name: name is None)
+        old_buffers += self.recv_buffer or []
         self.recv_buffer = [
-            torch.zeros(*shape, dtype=self.dtype, device=self.device)
+            self.recv_buffer_pool.get(shape, dtype)
             for shape in patches_shape_list
         ]
         self.recv_buffer.append(
-            torch.zeros(*feature_map_shape, dtype=self.dtype, device=self.device)
+            self.recv_buffer_pool.get(feature_map_shape, dtype)
         )
+        # give the previous buffers back only after drawing the new ones, so
+        #   that eviction never drops a buffer this layout could reuse
+        self._recycle_recv_buffers(old_buffers)
+        self.recv_layout = layout
         self.recv_buffer_set = True
+        logger.debug(
+            f"Pipeline recv buffers set, buffer pool hits: "
+            f"{self.recv_buffer_pool.num_hits}, misses: "
+            f"{self.recv_buffer_pool.num_misses}"
+        )
 
     def set_extra_tensors_recv_buffer(
         self,
         name: str,
         shape: List[int],
         num_buffers: int = 1,
-        dtype: torch.dtype = torch.float16
+        dtype: Optional[torch.dtype] = None,
     ):
+        dtype = dtype or self.dtype
+        assert dtype is not None, (
+            "dtype must be given if set_recv_buffer has not been called")
+        old_buffers = self._pop_recv_rings(lambda ring_name: ring_name == name)
+        old_buffers += self.extra_tensors_recv_buffer.get(name, [])
+        if name in self.comm_codecs:
+            self.comm_codecs[name].reset()
         self.extra_tensors_recv_buffer[name] = [
-            torch.zeros(*shape, dtype=dtype, device=self.device)
+            self.recv_buffer_pool.get(shape, dtype)
             for _ in range(num_buffers)
         ]
+        self._recycle_recv_buffers(old_buffers)
+
+    def set_comm_codec(
+        self,
+        name: Optional[str],
+        quantization: Optional[str] = None,
+        delta: bool = False,
+        delta_keep_ratio: float = 1.0,
+        delta_keyframe_interval: int = 0,
+    ):
+        """Encode the tensors of recv slot `name` on the wire, None stands for
+        the pipeline patches. Both ends of a pipeline must use the same codec.
+
+        `quantization` ("int8" or "fp8") quantizes per token. With `delta`,
+        only the residual against the tensor sent last for the same slot is
+        sent, see `PipelineDeltaCodec`. Patches sent by the last stage back to
+        the first one are latents fed to the scheduler and are always sent
+        as is.
+        """
+        if delta:
+            codec = PipelineDeltaCodec(
+                quantization, delta_keep_ratio, delta_keyframe_interval
+            )
+        elif quantization is not None:
+            codec = PipelineQuantCodec(quantization)
+        else:
+            codec = None
+        current = self.comm_codecs.get(name, None)
+        if (
+            (current.config if current is not None else None)
+            == (codec.config if codec is not None else None)
+        ):
+            return
+        if codec is None:
+            self.comm_codecs.pop(name)
+        else:
+            self.comm_codecs[name] = codec
+        # rings hold wire buffers, whose size depends on the codec
+        self._recycle_recv_buffers(
+            self._pop_recv_rings(lambda ring_name: ring_name == name)
+        )
 
-    def pipeline_send(self, tensor: torch.Tensor) -> None:
-        tensor = tensor.contiguous()
+    def reset_comm_codecs(self):
+        """Forget the state of every codec, e.g. the references of delta
+        encoding. All ranks of the pipeline must call it at the same point
+        with no message in flight."""
+        for codec in self.comm_codecs.values():
+            codec.reset()
+
+    def get_comm_codec_stats(self) -> Dict[Optional[str], Dict[str, float]]:
+        """Accuracy-vs-bytes statistics of everything this rank has sent
+        encoded, per recv slot name."""
+        return {
+            name: codec.get_stats() for name, codec in self.comm_codecs.items()
+        }
+
+    def set_send_window(self, max_inflight_sends: int = 0):
+        """Let at most `max_inflight_sends` asynchronous sends be outstanding,
+        a `pipeline_isend` beyond that waits for the oldest one first. 0
+        leaves the number unbounded, sends are still tracked and their
+        tensors kept alive until they complete."""
+        assert isinstance(max_inflight_sends, int) and max_inflight_sends >= 0, (
+            "max_inflight_sends must be greater than or equal to 0")
+        self.max_inflight_sends = max_inflight_sends
+        while (
+            self.max_inflight_sends > 0
+            and len(self.send_window) > self.max_inflight_sends
+        ):
+            self._wait_oldest_send()
+
+    def wait_pipeline_sends(self):
+        """Wait for every outstanding asynchronous send."""
+        while self.send_window:
+            self._wait_oldest_send()
+
+    def get_send_window_stats(self) -> Dict[str, float]:
+        """Peak number of outstanding asynchronous sends and the seconds
+        `pipeline_isend` spent waiting for the window since the last reset."""
+        return {
+            "inflight_sends": len(self.send_window),
+            "peak_inflight_sends": self.peak_inflight_sends,
+            "send_blocked_time": self.send_blocked_time,
+        }
+
+    def reset_send_window_stats(self):
+        self.peak_inflight_sends = len(self.send_window)
+        self.send_blocked_time = 0.0
+
+    def pipeline_send(
+        self,
+        tensor: torch.Tensor,
+        name: Optional[str] = None,
+        idx: Optional[int] = None,
+    ) -> None:
+        """Send `tensor` to the next stage. `name` and `idx` give the recv
+        slot it lands in, they only matter if the slot has a codec."""
         assert self.recv_buffer_set, (
             "set_recv_buffer must be called before sending tensors")
-        self._pipeline_isend(tensor).wait()
+        self._pipeline_isend(
+            self._encode_send_tensors([tensor], [(name, idx)])
+        ).wait()
 
-    def pipeline_isend(self, tensor: torch.Tensor) -> None:
-        tensor = tensor.contiguous()
+    def pipeline_isend(
+        self,
+        tensor: torch.Tensor,
+        name: Optional[str] = None,
+        idx: Optional[int] = None,
+    ) -> None:
+        """Send `tensor` to the next stage without waiting for it, subject to
+        the window set by `set_send_window`."""
         assert self.recv_buffer_set, (
             "set_recv_buffer must be called before sending tensors")
-        self._pipeline_isend(tensor)
+        self._post_send(self._encode_send_tensors([tensor], [(name, idx)]))
 
     def pipeline_recv(self, idx: Optional[int] = None, name: Optional[str] = None) -> torch.Tensor:
+        return self.pipeline_recv_coalesced([(name, idx)])[0]
+
+    def pipeline_send_coalesced(
+        self,
+        tensors: List[torch.Tensor],
+        slots: List[Tuple[Optional[str], Optional[int]]],
+    ) -> None:
+        """Send several tensors as one message, see `pipeline_recv_coalesced`.
+        `slots` gives the (name, idx) recv slot of every tensor."""
+        assert self.recv_buffer_set, (
+            "set_recv_buffer must be called before sending tensors")
+        self._pipeline_isend(self._encode_send_tensors(tensors, slots)).wait()
+
+    def pipeline_isend_coalesced(
+        self,
+        tensors: List[torch.Tensor],
+        slots: List[Tuple[Optional[str], Optional[int]]],
+    ) -> None:
+        assert self.recv_buffer_set, (
+            "set_recv_buffer must be called before sending tensors")
+        self._post_send(self._encode_send_tensors(tensors, slots))
+
+    def pipeline_recv_coalesced(
+        self, tensors: List[Tuple[Optional[str], Optional[int]]]
+    ) -> List[torch.Tensor]:
+        """Receive a message sent by `pipeline_send_coalesced`.
+
+        `tensors` lists the (name, idx) recv slots the message is made of, in
+        the order the sender packed them. A name of None stands for a pipeline
+        patch. Tensors that are not quantized are returned as views into one
+        flat buffer.
+        """
         assert self.recv_buffer_set, (
             "set_recv_buffer must be called before receiving tensors")
-        if idx is None:
-            idx = -1
-        if name is None:
-            self._pipeline_irecv(self.recv_buffer[idx]).wait()
-            return self.recv_buffer[idx]
-        else:
-            assert self.extra_tensors_recv_buffer.get(name, None) is not None, (
-                "extra tensor shape not set, call set_extra_tensors_recv_buffer first")
-            self._pipeline_irecv(self.extra_tensors_recv_buffer[name][idx]).wait()
-            return self.extra_tensors_recv_buffer[name][idx]
+        members = self._get_recv_members(tensors)
+        buffer = self._get_recv_ring(members).buffers[0]
+        segments = self._next_recv_segments(members)
+        self._pipeline_irecv(self._get_wire_view(buffer, segments)).wait()
+        return self._decode_recv_buffer(members, buffer, segments)
 
     def add_pipeline_recv_task(self, idx: Optional[int] = None, name: Optional[str] = None):
+        self.add_pipeline_coalesced_recv_task([(name, idx)])
+
+    def add_pipeline_coalesced_recv_task(
+        self, tensors: List[Tuple[Optional[str], Optional[int]]]
+    ):
         assert self.recv_buffer_set, (
             "set_recv_buffer must be called before receiving tensors")
-        if name is None:
-            self.recv_tasks_queue.append(idx if idx is not None else -1)
-        else:
-            assert self.extra_tensors_recv_buffer.get(name, None) is not None, (
-                "extra tensor shape not set, call set_extra_tensors_recv_buffer first")
-            self.recv_tasks_queue.append((name, idx if idx is not None else -1))
+        self.recv_tasks_queue.append(self._get_recv_members(tensors))
 
     def get_pipeline_recv_data(self, idx: Optional[int] = None, name: Optional[str] = None) -> torch.Tensor:
+        """Wait for the oldest posted receive and hand its buffer to the caller.
+
+        The returned tensor is owned by the caller until it calls
+        `release_pipeline_recv_data` for the same slot or asks for the next
+        tensor of that slot, whichever comes first.
+        """
+        return self.get_pipeline_coalesced_recv_data([(name, idx)])[0]
+
+    def get_pipeline_coalesced_recv_data(
+        self, tensors: List[Tuple[Optional[str], Optional[int]]]
+    ) -> List[torch.Tensor]:
+        """Coalesced counterpart of `get_pipeline_recv_data`. All returned
+        tensors stay owned by the caller until
+        `release_pipeline_coalesced_recv_data` is called."""
         assert self.recv_buffer_set, (
             "set_recv_buffer must be called before receiving tensors")
         assert len(self.receiving_tasks) > 0, (
             "No tasks to receive, call add_pipeline_recv_task first")
-        if idx is None:
-            idx = -1
-        receiving_task = self.receiving_tasks.pop(0)
-        receiving_task[0].wait()
-        assert receiving_task[1] == name and receiving_task[2] == idx, (
+        members = self._get_recv_members(tensors)
+        work, task_members, slot, segments = self.receiving_tasks.pop(0)
+        work.wait()
+        assert task_members == members, (
             "Received tensor does not match the requested")
-        if name is None:
-            return self.recv_buffer[idx]
-        else:
-            assert self.extra_tensors_recv_buffer.get(name, None) is not None, (
-                "extra tensor shape not set, call set_extra_tensors_recv_buffer first")
-            return self.extra_tensors_recv_buffer[name][idx]
+        buffer = self._get_recv_ring(members).hold(slot)
+        return self._decode_recv_buffer(members, buffer, segments)
+
+    def release_pipeline_recv_data(self, idx: Optional[int] = None, name: Optional[str] = None):
+        """Give the buffer returned by `get_pipeline_recv_data` back to its
+        ring so that a later receive can be posted into it."""
+        self.release_pipeline_coalesced_recv_data([(name, idx)])
+
+    def release_pipeline_coalesced_recv_data(
+        self, tensors: List[Tuple[Optional[str], Optional[int]]]
+    ):
+        self._get_recv_ring(self._get_recv_members(tensors)).release()
+        self._post_ready_recv_tasks()
 
     def recv_next(self):
+        """Post the next queued receive, then keep posting queued receives
+        ahead for as long as their ring has a free buffer."""
         assert self.recv_buffer_set, (
             "set_recv_buffer must be called before receiving tensors")
         if len(self.recv_tasks_queue) == 0:
+            if len(self.receiving_tasks) > 0:
+                # already posted ahead by an earlier call
+                return
             raise ValueError("No more tasks to receive")
-        elif len(self.recv_tasks_queue) > 0:
-            task = self.recv_tasks_queue.pop(0)
-            if isinstance(task, int):
-                idx = task
-                self.receiving_tasks.append((self._pipeline_irecv(self.recv_buffer[idx]), None, idx))
-            elif isinstance(task, Tuple):
-                name, idx = task
-                self.receiving_tasks.append((self._pipeline_irecv(self.extra_tensors_recv_buffer[name][idx]), name, idx))
+        members = self.recv_tasks_queue[0]
+        slot = self._get_recv_ring(members).acquire(
+            reclaim_held=len(self.receiving_tasks) == 0
+        )
+        if slot is not None:
+            self.recv_tasks_queue.pop(0)
+            self._post_recv_task(members, slot)
+        self._post_ready_recv_tasks()
+
+    def _post_ready_recv_tasks(self):
+        # receives must be posted in the order the sender issues them, so stop
+        #   at the first queued task whose ring has no free buffer
+        while len(self.recv_tasks_queue) > 0 and len(self.receiving_tasks) > 0:
+            members = self.recv_tasks_queue[0]
+            slot = self._get_recv_ring(members).acquire()
+            if slot is None:
+                break
+            self.recv_tasks_queue.pop(0)
+            self._post_recv_task(members, slot)
+
+    def _post_recv_task(self, members: Tuple[Tuple[Optional[str], int], ...], slot: int):
+        buffer = self._get_recv_ring(members).buffers[slot]
+        segments = self._next_recv_segments(members)
+        self.receiving_tasks.append((
+            self._pipeline_irecv(self._get_wire_view(buffer, segments)),
+            members,
+            slot,
+            segments,
+        ))
+
+    def _get_recv_members(
+        self, tensors: List[Tuple[Optional[str], Optional[int]]]
+    ) -> Tuple[Tuple[Optional[str], int], ...]:
+        members = []
+        for name, idx in tensors:
+            if idx is None:
+                idx = -1
+            if name is None:
+                idx = idx % len(self.recv_buffer)
+            else:
+                assert self.extra_tensors_recv_buffer.get(name, None) is not None, (
+                    "extra tensor shape not set, call set_extra_tensors_recv_buffer first")
+                idx = idx % len(self.extra_tensors_recv_buffer[name])
+            members.append((name, idx))
+        return tuple(members)
+
+    def _get_recv_buffer(self, name: Optional[str], idx: int) -> torch.Tensor:
+        if name is None:
+            return self.recv_buffer[idx]
+        return self.extra_tensors_recv_buffer[name][idx]
+
+    def _get_recv_ring(
+        self, members: Tuple[Tuple[Optional[str], int], ...]
+    ) -> PipelineRecvRing:
+        if members in self.recv_rings:
+            return self.recv_rings[members]
+        # the full feature map is only received synchronously and needs no ring
+        depth = (
+            1 if (None, len(self.recv_buffer) - 1) in members
+            else self.recv_ring_depth
+        )
+        if self._is_plain_recv(members):
+            # the first buffer of the ring is the `recv_buffer` entry itself
+            buffer = self._get_recv_buffer(*members[0])
+            buffers = [buffer] + [
+                self.recv_buffer_pool.get(buffer.shape, buffer.dtype)
+                for _ in range(depth - 1)
+            ]
+        else:
+            # everything else goes through a byte buffer holding the wire
+            #   format of each member back to back
+            offset, nbytes, _ = self._get_wire_segments(members, advance=False)[-1]
+            buffers = [
+                self.recv_buffer_pool.get([offset + nbytes], torch.uint8)
+                for _ in range(depth)
+            ]
+        self.recv_rings[members] = PipelineRecvRing(buffers)
+        return self.recv_rings[members]
+
+    def _get_comm_codec(
+        self, name: Optional[str], send: bool
+    ) -> Optional[PipelineCommCodec]:
+        if name is None and (self.is_last_rank if send else self.is_first_rank):
+            return None
+        return self.comm_codecs.get(name, None)
+
+    def _is_plain_recv(self, members: Tuple[Tuple[Optional[str], int], ...]) -> bool:
+        # a single tensor without codec is received in place
+        return (
+            len(members) == 1
+            and self._get_comm_codec(members[0][0], send=False) is None
+        )
+
+    def _get_wire_segments(
+        self, members: Tuple[Tuple[Optional[str], int], ...], advance: bool
+    ) -> List[Tuple[int, int, bool]]:
+        """(offset, nbytes, keyframe) of every member of a message. With
+        `advance`, it is the layout of the next message, which codecs count,
+        otherwise the largest layout any message can have."""
+        segments = []
+        offset = 0
+        for name, idx in members:
+            buffer = self._get_recv_buffer(name, idx)
+            codec = self._get_comm_codec(name, send=False)
+            if codec is None:
+                nbytes, keyframe = buffer.numel() * buffer.element_size(), False
+            elif advance:
+                nbytes, keyframe = codec.next_recv_message((name, idx), buffer)
+            else:
+                nbytes, keyframe = codec.max_wire_nbytes(buffer), False
+            segments.append((offset, nbytes, keyframe))
+            offset += _align_wire_bytes(nbytes)
+        return segments
+
+    def _next_recv_segments(
+        self, members: Tuple[Tuple[Optional[str], int], ...]
+    ) -> Optional[List[Tuple[int, int, bool]]]:
+        if self._is_plain_recv(members):
+            return None
+        return self._get_wire_segments(members, advance=True)
+
+    def _get_wire_view(
+        self,
+        buffer: torch.Tensor,
+        segments: Optional[List[Tuple[int, int, bool]]],
+    ) -> torch.Tensor:
+        if segments is None:
+            return buffer
+        offset, nbytes, _ = segments[-1]
+        return buffer[:offset + nbytes]
+
+    def _encode_send_tensors(
+        self,
+        tensors: List[torch.Tensor],
+        slots: List[Tuple[Optional[str], Optional[int]]],
+    ) -> torch.Tensor:
+        segments = []
+        for tensor, (name, idx) in zip(tensors, slots):
+            tensor = tensor.contiguous()
+            codec = self._get_comm_codec(name, send=True)
+            segments.append(
+                tensor if codec is None
+                else codec.encode(tensor, (name, -1 if idx is None else idx))
+            )
+        if len(segments) == 1:
+            wire = segments[0]
+        else:
+            nbytes = [
+                segment.numel() * segment.element_size() for segment in segments
+            ]
+            wire = torch.empty(
+                sum(_align_wire_bytes(n) for n in nbytes[:-1]) + nbytes[-1],
+                dtype=torch.uint8,
+                device=segments[0].device,
+            )
+            offset = 0
+            for segment, n in zip(segments, nbytes):
+                wire[offset: offset + n].copy_(segment.view(-1).view(torch.uint8))
+                offset += _align_wire_bytes(n)
+        self.num_sent_bytes += wire.numel() * wire.element_size()
+        return wire
+
+    def _decode_recv_buffer(
+        self,
+        members: Tuple[Tuple[Optional[str], int], ...],
+        buffer: torch.Tensor,
+        segments: Optional[List[Tuple[int, int, bool]]],
+    ) -> List[torch.Tensor]:
+        if segments is None:
+            return [buffer]
+        tensors = []
+        for (name, idx), (offset, nbytes, keyframe) in zip(members, segments):
+            target = self._get_recv_buffer(name, idx)
+            segment = buffer[offset: offset + nbytes]
+            codec = self._get_comm_codec(name, send=False)
+            if codec is None:
+                tensors.append(segment.view(target.dtype).view(target.shape))
+            else:
+                tensors.append(codec.decode(segment, target, keyframe))
+        return tensors
+
+    def _pop_recv_rings(self, predicate) -> List[torch.Tensor]:
+        """Remove the rings that have a member whose name satisfies
+        `predicate` and return their buffers."""
+        keys = [
+            members for members in self.recv_rings
+            if any(predicate(name) for name, _ in members)
+        ]
+        return [
+            buffer for key in keys for buffer in self.recv_rings.pop(key).buffers
+        ]
+
+    def _recycle_recv_buffers(self, buffers: List[torch.Tensor]):
+        # rings of plain tensors share their first buffer with `recv_buffer`
+        recycled = set()
+        for buffer in buffers:
+            if id(buffer) not in recycled:
+                recycled.add(id(buffer))
+                self.recv_buffer_pool.put(buffer)
+
+    def _post_send(self, wire: torch.Tensor):
+        # completed sends leave the window in order, so that the oldest one
+        #   is always the next to wait for
+        while self.send_window and self.send_window[0][0].is_completed():
+            self.send_window.popleft()
+        if (
+            self.max_inflight_sends > 0
+            and len(self.send_window) >= self.max_inflight_sends
+        ):
+            start = time.perf_counter()
+            while len(self.send_window) >= self.max_inflight_sends:
+                self._wait_oldest_send()
+            self.send_blocked_time += time.perf_counter() - start
+        self.send_window.append((self._pipeline_isend(wire), wire))
+        self.peak_inflight_sends = max(
+            self.peak_inflight_sends, len(self.send_window)
+        )
+
+    def _wait_oldest_send(self):
+        work, _ = self.send_window.popleft()
+        work.wait()
 
     def _pipeline_irecv(self, tensor: torch.tensor):
         return torch.distributed.irecv(
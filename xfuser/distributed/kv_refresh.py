@@ -0,0 +1,139 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+KV_REFRESH_POLICIES = ("none", "periodic", "schedule", "drift")
+
+
+class StaleKVDriftMonitor:
+    """Relative distance between the stale K/V the pipeline patches of a step
+    attend to and the fresh K/V that replace them.
+
+    When a patch writes its fresh K/V into the stale KV cache of a layer, the
+    slot still holds the K/V of the previous step that the other patches of
+    the step attended to. A synchronous step rewrites the whole cache over
+    the K/V of the previous step, which the patches would have attended to,
+    so it is measured the same way. `record` accumulates the squared norms of their
+    difference and of the fresh K/V per layer and step on the device, so
+    that reading the drift is the only sync with the host.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # (layer_idx, step_idx) -> [squared norm of fresh - stale, of fresh]
+        self._sums: Dict[Tuple[int, int], List[torch.Tensor]] = {}
+
+    def reset(self):
+        self._sums = {}
+
+    def record(
+        self,
+        layer_idx: int,
+        step_idx: int,
+        stale: torch.Tensor,
+        fresh: torch.Tensor,
+    ):
+        diff_sq = (fresh.float() - stale.float()).pow(2).sum()
+        ref_sq = fresh.float().pow(2).sum()
+        sums = self._sums.get((layer_idx, step_idx))
+        if sums is None:
+            self._sums[(layer_idx, step_idx)] = [diff_sq, ref_sq]
+        else:
+            sums[0] += diff_sq
+            sums[1] += ref_sq
+
+    def layer_drift(self) -> Dict[int, Dict[int, float]]:
+        """Relative L2 drift of the stale K/V, per layer and step."""
+        drift: Dict[int, Dict[int, float]] = {}
+        for (layer_idx, step_idx), (diff_sq, ref_sq) in sorted(self._sums.items()):
+            drift.setdefault(layer_idx, {})[step_idx] = (
+                (diff_sq / ref_sq.clamp_min(1e-12)).sqrt().item()
+            )
+        return drift
+
+    def step_drift(
+        self, num_steps: int, device: Optional[torch.device] = None
+    ) -> torch.Tensor:
+        """Largest drift over the layers for every step, -1 for the steps
+        without a measure."""
+        drift = torch.full((num_steps,), -1.0, device=device)
+        for (_, step_idx), (diff_sq, ref_sq) in self._sums.items():
+            if step_idx < num_steps:
+                drift[step_idx] = torch.maximum(
+                    drift[step_idx],
+                    (diff_sq / ref_sq.clamp_min(1e-12)).sqrt().to(drift.device),
+                )
+        return drift
+
+
+class StaleKVRefreshPolicy:
+    """Steps of a generation that run synchronously, every stage computing
+    the whole feature map, so that the stale K/V of every layer is
+    refreshed instead of lagging one step behind for the patches after the
+    current one.
+
+    The first `warmup_steps` steps are always synchronous. After them,
+    "periodic" refreshes every `interval`-th step, "schedule" the given
+    `steps`, and "drift" the steps whose measured drift, the largest over
+    the layers in the last generation that measured the step, exceeds
+    `threshold`. Refreshed steps keep being measured, so a step whose drift
+    falls back under `threshold` runs patched again. "none" only keeps the warmup steps.
+    """
+
+    def __init__(
+        self,
+        policy: str = "none",
+        interval: int = 0,
+        steps: Optional[Sequence[int]] = None,
+        threshold: float = 0.0,
+    ):
+        assert policy in KV_REFRESH_POLICIES, f"unknown kv refresh policy {policy}"
+        self.policy = policy
+        self.interval = interval
+        self.steps = set(steps or [])
+        self.threshold = threshold
+        # drift per step of the generations measured so far, -1 if unknown
+        self.drift_profile: Optional[List[float]] = None
+
+    def update_drift_profile(self, step_drift: Sequence[float]):
+        """Fold the drift measured in a generation into the profile, the
+        steps without a measure keeping the previous one."""
+        if self.drift_profile is None or len(self.drift_profile) != len(step_drift):
+            self.drift_profile = [-1.0] * len(step_drift)
+        for step_idx, drift in enumerate(step_drift):
+            if drift >= 0:
+                self.drift_profile[step_idx] = drift
+
+    def sync_steps(self, num_steps: int, warmup_steps: int) -> List[bool]:
+        """For every step, whether it runs synchronously."""
+        sync = [step_idx < warmup_steps for step_idx in range(num_steps)]
+        for step_idx in range(warmup_steps, num_steps):
+            if self.policy == "periodic":
+                sync[step_idx] = (
+                    self.interval > 0
+                    and (step_idx - warmup_steps + 1) % self.interval == 0
+                )
+            elif self.policy == "schedule":
+                sync[step_idx] = step_idx in self.steps
+            elif self.policy == "drift":
+                sync[step_idx] = (
+                    self.drift_profile is not None
+                    and len(self.drift_profile) == num_steps
+                    and self.drift_profile[step_idx] > self.threshold
+                )
+        return sync
+
+    def segments(
+        self, num_steps: int, warmup_steps: int
+    ) -> List[Tuple[bool, int, int]]:
+        """`(sync, start, end)` runs of steps of the same kind, always
+        starting with a synchronous one, which may be empty."""
+        segments = [(True, 0, 0)]
+        for step_idx, sync in enumerate(self.sync_steps(num_steps, warmup_steps)):
+            last_sync, start, _ = segments[-1]
+            if sync == last_sync:
+                segments[-1] = (sync, start, step_idx + 1)
+            else:
+                segments.append((sync, step_idx, step_idx + 1))
+        return segments
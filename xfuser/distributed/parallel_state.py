@@ -17,6 +17,7 @@ from .group_coordinator import (
     GroupCoordinator,
     PipelineGroupCoordinator,
 )
+from .topology import get_data_parallel_replicas
 
 env_info = envs.PACKAGES_CHECKER.get_packages_info()
 HAS_LONG_CTX_ATTN = env_info["has_long_ctx_attn"]
@@ -93,6 +94,8 @@ def get_sp_group() -> GroupCoordinator:
 
 
 _DP: Optional[GroupCoordinator] = None
+# index of the data parallel group of this rank
+_DP_REPLICA_INDEX: Optional[int] = None
 
 
 def get_dp_group() -> GroupCoordinator:
@@ -188,6 +191,7 @@ def initialize_model_parallel(
     tensor_parallel_degree: int = 1,
     pipeline_parallel_degree: int = 1,
     backend: Optional[str] = None,
+    rank_placement: Optional[List[int]] = None,
 ) -> None:
     """
     Initialize model parallel groups.
@@ -201,6 +205,9 @@ def initialize_model_parallel(
         tensor_parallel_degree: number of GPUs used for tensor parallelism.
         pipeline_parallel_degree: number of GPUs used for pipeline parallelism.
         backend: distributed backend of pytorch collective comm.
+        rank_placement: global rank taking the place of each rank in the
+            group arithmetic below, e.g. planned by `plan_rank_placements`.
+            Ranks are used as they are if None.
 
     Let's say we have a total of 16 GPUs denoted by g0 ... g15 and we
     use 2 groups to parallelize the batch dim(dp), 2 groups to parallelize
@@ -226,7 +233,8 @@ def initialize_model_parallel(
     Note that for efficiency, the caller should make sure adjacent ranks
     are on the same DGX box. For example if we are using 2 DGX-1 boxes
     with a total of 16 GPUs, rank 0 to 7 belong to the first box and
-    ranks 8 to 15 belong to the second box.
+    ranks 8 to 15 belong to the second box. Otherwise, pass a
+    `rank_placement` that maps the ranks onto the boxes.
     """
     # Get world size and rank. Ensure some consistencies.
     assert torch.distributed.is_initialized()
@@ -250,17 +258,24 @@ def initialize_model_parallel(
             f"({classifier_free_guidance_degree}) x"
             f"data_parallel_degree ({data_parallel_degree})"
         )
+    if rank_placement is None:
+        rank_placement = list(range(world_size))
+    assert sorted(rank_placement) == list(range(world_size)), (
+        "rank_placement must be a permutation of the ranks of the world"
+    )
 
     # Build the data-parallel groups.
     num_data_parallel_devices: int = world_size // data_parallel_degree
     global _DP
+    global _DP_REPLICA_INDEX
     assert _DP is None, "data parallel group is already initialized"
-    group_ranks = []
-    for i in range(data_parallel_degree):
-        ranks = list(
-            range(i * num_data_parallel_devices, (i + 1) * num_data_parallel_devices)
-        )
-        group_ranks.append(ranks)
+    group_ranks = get_data_parallel_replicas(rank_placement, data_parallel_degree)
+    # the placed ranks of a replica need not be contiguous
+    _DP_REPLICA_INDEX = next(
+        idx
+        for idx, ranks in enumerate(group_ranks)
+        if get_world_group().rank in ranks
+    )
     _DP = init_model_parallel_group(
         group_ranks=group_ranks,
         local_rank=get_world_group().local_rank,
@@ -284,7 +299,7 @@ def initialize_model_parallel(
             start_rank + j * num_splited_batch_devices
             for j in range(classifier_free_guidance_degree)
         ]
-        group_ranks.append(ranks)
+        group_ranks.append([rank_placement[rank] for rank in ranks])
     _CFG = init_model_parallel_group(
         group_ranks=group_ranks,
         local_rank=get_world_group().local_rank,
@@ -302,7 +317,7 @@ def initialize_model_parallel(
         ranks = list(
             range(i * sequence_parallel_degree, (i + 1) * sequence_parallel_degree)
         )
-        group_ranks.append(ranks)
+        group_ranks.append([rank_placement[rank] for rank in ranks])
     _SP = init_model_parallel_group(
         group_ranks=group_ranks,
         local_rank=get_world_group().local_rank,
@@ -313,14 +328,37 @@ def initialize_model_parallel(
     if HAS_LONG_CTX_ATTN and sequence_parallel_degree > 1:
         global _ULYSSES_PG
         global _RING_PG
-        from yunchang import set_seq_parallel_pg
-
-        set_seq_parallel_pg(
-            sp_ulysses_degree=ulysses_degree,
-            sp_ring_degree=ring_degree,
-            rank=get_world_group().rank_in_group,
-            world_size=get_world_group().world_size,
-        )
+        if rank_placement == list(range(world_size)):
+            from yunchang import set_seq_parallel_pg
+
+            set_seq_parallel_pg(
+                sp_ulysses_degree=ulysses_degree,
+                sp_ring_degree=ring_degree,
+                rank=get_world_group().rank_in_group,
+                world_size=get_world_group().world_size,
+            )
+        else:
+            # yunchang builds its groups from contiguous ranks, so build
+            # them from the placed sequence parallel groups instead, with the
+            # same ulysses-inner layout
+            from yunchang.globals import PROCESS_GROUP
+
+            rank = get_world_group().rank_in_group
+            for sp_ranks in group_ranks:
+                for i in range(ring_degree):
+                    ulysses_ranks = sp_ranks[
+                        i * ulysses_degree: (i + 1) * ulysses_degree
+                    ]
+                    group = torch.distributed.new_group(ulysses_ranks)
+                    if rank in ulysses_ranks:
+                        _ULYSSES_PG = group
+                for i in range(ulysses_degree):
+                    ring_ranks = sp_ranks[i::ulysses_degree]
+                    group = torch.distributed.new_group(ring_ranks)
+                    if rank in ring_ranks:
+                        _RING_PG = group
+            PROCESS_GROUP.ULYSSES_PG = _ULYSSES_PG
+            PROCESS_GROUP.RING_PG = _RING_PG
 
     # TODO: implement tensor parallel groups
     assert tensor_parallel_degree == 1, "Tensor parallelism is not implemented"
@@ -360,7 +398,7 @@ def initialize_model_parallel(
             start_rank + j * num_pipeline_per_stage_devices
             for j in range(num_pipeline_parallel_devices)
         ]
-        group_ranks.append(ranks)
+        group_ranks.append([rank_placement[rank] for rank in ranks])
     _PP = init_model_parallel_group(
         group_ranks=group_ranks,
         local_rank=get_world_group().local_rank,
@@ -461,6 +499,13 @@ def get_data_parallel_rank():
     return get_dp_group().rank_in_group
 
 
+def get_data_parallel_replica_index():
+    """Return the index of the data parallel group of this rank among the
+    data parallel groups, i.e. of its share of the prompts."""
+    assert _DP_REPLICA_INDEX is not None, "data parallel group is not initialized"
+    return _DP_REPLICA_INDEX
+
+
 def is_dp_last_rank():
     """Return True if in the last rank data parallel, False otherwise."""
     return get_data_parallel_rank() == (get_data_parallel_world_size() - 1)
@@ -472,6 +517,8 @@ def destroy_model_parallel():
     if _DP:
         _DP.destroy()
     _DP = None
+    global _DP_REPLICA_INDEX
+    _DP_REPLICA_INDEX = None
 
     global _CFG
     if _CFG:
@@ -0,0 +1,193 @@
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+
+PATCH_LAYOUTS = ("uniform", "ramp", "cost")
+_MAX_CANDIDATES = 32
+
+
+@dataclass
+class PipelineSchedule:
+    # time the last patch of the last step leaves the last stage
+    makespan: float
+    # time the last stage starts working, i.e. every stage is busy
+    fill_time: float
+    stage_busy_time: List[float]
+
+    @property
+    def bubble_ratio(self) -> float:
+        total = self.makespan * len(self.stage_busy_time)
+        return 1.0 - sum(self.stage_busy_time) / total if total > 0 else 0.0
+
+
+def simulate_pipefusion_schedule(
+    patch_costs: Sequence[float],
+    pp_degree: int,
+    num_steps: int,
+    p2p_costs: Optional[Sequence[float]] = None,
+) -> PipelineSchedule:
+    """Event simulation of the patched steps of PipeFusion.
+
+    Every stage runs the patches of a step in order, one step after the
+    other. A patch starts on a stage once the previous stage has sent it, and
+    on the first stage once the last stage has sent back its latents of the
+    previous step. `patch_costs[i]` is the compute time of patch i on any
+    stage, `p2p_costs[i]` the time to send it to the next stage.
+    """
+    num_patches = len(patch_costs)
+    p2p_costs = p2p_costs or [0.0] * num_patches
+    stage_free = [0.0] * pp_degree
+    stage_busy = [0.0] * pp_degree
+    fill_time = None
+    # the first step of the first stage depends on nothing
+    upstream = [0.0] * num_patches
+    for step in range(num_steps):
+        for stage in range(pp_degree):
+            finishes = []
+            for patch_idx in range(num_patches):
+                ready = upstream[patch_idx]
+                if step > 0 or stage > 0:
+                    ready += p2p_costs[patch_idx]
+                start = max(stage_free[stage], ready)
+                if stage == pp_degree - 1 and fill_time is None:
+                    fill_time = start
+                stage_free[stage] = start + patch_costs[patch_idx]
+                stage_busy[stage] += patch_costs[patch_idx]
+                finishes.append(stage_free[stage])
+            upstream = finishes
+    return PipelineSchedule(
+        makespan=stage_free[-1],
+        fill_time=fill_time or 0.0,
+        stage_busy_time=stage_busy,
+    )
+
+
+def uniform_patch_heights(
+    latents_height: int,
+    num_patches: int,
+    unit: int,
+) -> List[int]:
+    """Equal patch heights that are multiples of `unit`, the remainder going
+    to the last patch. The number of patches may shrink to respect `unit`."""
+    patch_height = (latents_height + num_patches - 1) // num_patches
+    patch_height = (patch_height + unit - 1) // unit * unit
+    num_patches = (latents_height + patch_height - 1) // patch_height
+    heights = [patch_height for _ in range(num_patches - 1)]
+    last_patch_height = latents_height - patch_height * (num_patches - 1)
+    if last_patch_height % unit != 0:
+        raise ValueError(
+            f"The height of the last pipeline patch is {last_patch_height}, "
+            f"which is not a multiple of (patch_size * num_sp_patches): "
+            f"{unit}. Please try to adjust 'num_pipeline_patches "
+            f"or sp_degree argument so that the condition are met "
+        )
+    heights.append(last_patch_height)
+    return heights
+
+
+@dataclass
+class PatchCostModel:
+    """Compute time of a pipeline patch on a stage, in any time unit: a cost
+    per latent row, a fixed cost per patch, and the extra work done once per
+    step with the first and the last patch, e.g. the step-level scheduler
+    update on the last one."""
+    row_cost: float = 1.0
+    patch_overhead: float = 0.0
+    first_patch_extra: float = 0.0
+    last_patch_extra: float = 0.0
+
+    @classmethod
+    def from_list(cls, costs: Optional[Sequence[float]]) -> "PatchCostModel":
+        """Built from `[row_cost, patch_overhead, first_patch_extra,
+        last_patch_extra]`, trailing entries may be omitted."""
+        if not costs:
+            return cls()
+        assert len(costs) <= 4, (
+            "patch costs are row_cost, patch_overhead, first_patch_extra "
+            "and last_patch_extra"
+        )
+        return cls(*costs)
+
+    def patch_costs(self, heights: Sequence[int]) -> List[float]:
+        costs = [self.patch_overhead + self.row_cost * h for h in heights]
+        costs[0] += self.first_patch_extra
+        costs[-1] += self.last_patch_extra
+        return costs
+
+
+def _spread_heights(
+    num_units: int, num_patches: int, first: int, last: Optional[int] = None
+) -> Optional[List[int]]:
+    """Patch heights in units with the given first (and last) patches and the
+    remaining units spread evenly over the other patches."""
+    fixed = [first] if last is None else [first, last]
+    num_rest = num_patches - len(fixed)
+    rest_units = num_units - sum(fixed)
+    if num_rest == 0:
+        return fixed if rest_units == 0 else None
+    if rest_units < num_rest:
+        return None
+    rest = [
+        rest_units // num_rest + (1 if i < rest_units % num_rest else 0)
+        for i in range(num_rest)
+    ]
+    return [first] + rest + ([] if last is None else [last])
+
+
+def plan_patch_heights(
+    latents_height: int,
+    num_patches: int,
+    unit: int,
+    pp_degree: int,
+    num_steps: int,
+    layout: str = "uniform",
+    cost_model: Optional[PatchCostModel] = None,
+) -> List[int]:
+    """Heights of the pipeline patches in latent rows, multiples of `unit`.
+
+    "uniform" splits the latents evenly. "ramp" halves the first patch, so
+    that the downstream stages start sooner, and spreads its rows over the
+    others. "cost" picks the first and the last heights, the rest being
+    spread evenly, with the shortest simulated schedule of `num_steps`
+    patched steps under `cost_model`, and keeps the uniform layout unless
+    it is beaten.
+    """
+    assert layout in PATCH_LAYOUTS, f"unknown pipeline patch layout {layout}"
+    heights = uniform_patch_heights(latents_height, num_patches, unit)
+    num_patches = len(heights)
+    if layout == "uniform" or num_patches == 1 or pp_degree == 1:
+        return heights
+
+    num_units = latents_height // unit
+    uniform = [h // unit for h in heights]
+    if layout == "ramp":
+        ramp = _spread_heights(
+            num_units, num_patches, first=max(1, uniform[0] // 2)
+        )
+        return [h * unit for h in ramp]
+
+    cost_model = cost_model or PatchCostModel()
+
+    def makespan(unit_heights: List[int]) -> float:
+        return simulate_pipefusion_schedule(
+            cost_model.patch_costs([h * unit for h in unit_heights]),
+            pp_degree=pp_degree,
+            num_steps=num_steps,
+        ).makespan
+
+    best, best_makespan = uniform, makespan(uniform)
+    # bound the search to about _MAX_CANDIDATES heights per end patch
+    stride = (2 * uniform[0] + _MAX_CANDIDATES - 1) // _MAX_CANDIDATES
+    for first in range(1, 2 * uniform[0] + 1, stride):
+        if num_patches == 2:
+            lasts = [num_units - first]
+        else:
+            lasts = range(1, 2 * uniform[0] + 1, stride)
+        for last in lasts:
+            candidate = _spread_heights(num_units, num_patches, first, last)
+            if candidate is None:
+                continue
+            candidate_makespan = makespan(candidate)
+            if candidate_makespan < best_makespan * (1 - 1e-6):
+                best, best_makespan = candidate, candidate_makespan
+    return [h * unit for h in best]
@@ -4,10 +4,11 @@ from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
-from diffusers import DiffusionPipeline
+from diffusers import DiffusionPipeline, FluxPipeline
 import torch.distributed
 
 from xfuser.config.config import ParallelConfig, RuntimeConfig, InputConfig, EngineConfig
+from xfuser.envs import PACKAGES_CHECKER
 from xfuser.logger import init_logger
 from xfuser.distributed.parallel_state import (
     destroy_distributed_environment, 
@@ -19,6 +20,23 @@ from xfuser.distributed.parallel_state import (
     init_distributed_environment, 
     initialize_model_parallel, 
     model_parallel_is_initialized,
+    get_world_group,
+)
+from xfuser.distributed.topology import (
+    ClusterTopology,
+    estimate_step_comm_bytes,
+    format_rank_placements,
+    plan_rank_placements,
+)
+from xfuser.distributed.patch_layout import PatchCostModel, plan_patch_heights
+from xfuser.distributed.execution_plan import (
+    ExecutionPlan,
+    PatchPlan,
+    compile_execution_plan,
+)
+from xfuser.distributed.kv_refresh import (
+    StaleKVDriftMonitor,
+    StaleKVRefreshPolicy,
 )
     
 logger = init_logger(__name__)
@@ -36,14 +54,18 @@ class RuntimeState(metaclass=ABCMeta):
     input_config: InputConfig
     num_pipeline_patch: int
     ready: bool = False
-    def __init__(self, config: EngineConfig):
+    def __init__(
+        self,
+        config: EngineConfig,
+        step_comm_bytes: Optional[Dict[str, float]] = None,
+    ):
         self.parallel_config = config.parallel_config
         self.runtime_config = config.runtime_config
         self.input_config = InputConfig()
         self.num_pipeline_patch = self.parallel_config.pp_config.num_pipeline_patch
         self.ready = False
 
-        self._check_distributed_env(config.parallel_config)
+        self._check_distributed_env(config.parallel_config, step_comm_bytes)
 
     def is_ready(self):
         return self.ready
@@ -51,11 +73,17 @@ class RuntimeState(metaclass=ABCMeta):
     def _check_distributed_env(
         self,
         parallel_config: ParallelConfig,
+        step_comm_bytes: Optional[Dict[str, float]] = None,
     ):
         if not model_parallel_is_initialized():
             logger.warning("Model parallel is not initialized, initializing...")
             if not torch.distributed.is_initialized():
                 init_distributed_environment()
+            rank_placement = None
+            if parallel_config.topology_file is not None:
+                rank_placement = self._plan_rank_placement(
+                    parallel_config, step_comm_bytes
+                )
             initialize_model_parallel(
                 data_parallel_degree=parallel_config.dp_degree,
                 classifier_free_guidance_degree=parallel_config.cfg_degree,
@@ -64,7 +92,41 @@ class RuntimeState(metaclass=ABCMeta):
                 ring_degree=parallel_config.ring_degree,
                 tensor_parallel_degree=parallel_config.tp_degree,
                 pipeline_parallel_degree=parallel_config.pp_degree,
+                rank_placement=rank_placement,
             )
+
+    def _plan_rank_placement(
+        self,
+        parallel_config: ParallelConfig,
+        step_comm_bytes: Optional[Dict[str, float]] = None,
+    ) -> List[int]:
+        if parallel_config.topology_file == "auto":
+            topology = ClusterTopology.detect(group=get_world_group().cpu_group)
+        else:
+            topology = ClusterTopology.from_file(parallel_config.topology_file)
+        if step_comm_bytes is None:
+            # relative weights in the order groups should stay inside a host
+            step_comm_bytes = {"ulysses": 8.0, "ring": 4.0, "pp": 2.0, "cfg": 1.0}
+        placements = plan_rank_placements(
+            topology,
+            step_comm_bytes,
+            data_parallel_degree=parallel_config.dp_degree,
+            classifier_free_guidance_degree=parallel_config.cfg_degree,
+            ulysses_degree=parallel_config.ulysses_degree,
+            ring_degree=parallel_config.ring_degree,
+            pipeline_parallel_degree=parallel_config.pp_degree,
+        )
+        if torch.distributed.get_rank() == 0:
+            logger.info(
+                f"Predicted communication per step of the rank layouts over "
+                f"{len(topology.hosts)} hosts:\n"
+                f"{format_rank_placements(placements)}"
+            )
+        logger.info(
+            f"Using rank layout {placements[0].name}, "
+            f"rank placement {placements[0].ranks}"
+        )
+        return placements[0].ranks
     
     def destory_distributed_env(self):
         if model_parallel_is_initialized():
@@ -77,6 +139,10 @@ class DiTRuntimeState(RuntimeState):
     pipeline_patch_idx: int
     vae_scale_factor: int
     backbone_patch_size: int
+    # latents are packed into [batch, tokens, channels] by the pipeline
+    #   instead of being patchified by the transformer
+    backbone_latents_packed: bool
+    uses_classifier_free_guidance: bool
     pp_patches_height: Optional[List[int]]
     pp_patches_start_idx_local: Optional[List[int]]
     pp_patches_start_end_idx_global: Optional[List[List[int]]]
@@ -86,20 +152,50 @@ class DiTRuntimeState(RuntimeState):
     #   torch.Size: size of tensor
     #   int: number of recv buffer it needs
     pipeline_comm_extra_tensors_info: List[Tuple[str, List[int], int]]
+    step_idx: int
+    # plans of the forwards for the current input size, and the one of the
+    #   current forward
+    execution_plan: Optional[ExecutionPlan]
+    plan: Optional[PatchPlan]
+    kv_refresh_policy: StaleKVRefreshPolicy
+    kv_drift_monitor: StaleKVDriftMonitor
 
     def __init__(self, pipeline: DiffusionPipeline, config: EngineConfig):
-        super().__init__(config)
+        super().__init__(
+            config,
+            step_comm_bytes=self._estimate_step_comm_bytes(
+                pipeline, config.parallel_config
+            ),
+        )
         self.patch_mode = False
         self.pipeline_patch_idx = 0
+        self.step_idx = 0
+        self.execution_plan = None
+        self.plan = None
+        pp_config = config.parallel_config.pp_config
+        self.kv_refresh_policy = StaleKVRefreshPolicy(
+            policy=pp_config.kv_refresh,
+            interval=pp_config.kv_refresh_interval,
+            steps=pp_config.kv_refresh_steps,
+            threshold=pp_config.kv_refresh_threshold,
+        )
+        self.kv_drift_monitor = StaleKVDriftMonitor(
+            enabled=pp_config.kv_drift_stats or pp_config.kv_refresh == "drift"
+        )
+        # number of steps of the generation the monitor is measuring
+        self._kv_drift_num_steps: Optional[int] = None
         self._check_model_and_parallel_config(
             pipeline=pipeline, 
             parallel_config=config.parallel_config
         )
         self._set_model_parameters(
             vae_scale_factor=pipeline.vae_scale_factor,
-            backbone_patch_size=pipeline.transformer.config.patch_size,
+            backbone_patch_size=self._get_backbone_patch_size(pipeline),
             backbone_in_channel=pipeline.transformer.config.in_channels,
             backbone_inner_dim=pipeline.transformer.inner_dim,
+            backbone_latents_packed=isinstance(pipeline, FluxPipeline),
+            # Flux embeds the guidance scale instead of doubling the batch
+            uses_classifier_free_guidance=not isinstance(pipeline, FluxPipeline),
         )
         self.pipeline_comm_extra_tensors_info = []
 
@@ -111,6 +207,10 @@ class DiTRuntimeState(RuntimeState):
         num_inference_steps: Optional[int] = None,
         seed: Optional[int] = None,
     ):
+        steps_changed = (
+            num_inference_steps is not None
+            and num_inference_steps != self.input_config.num_inference_steps
+        )
         self.input_config.num_inference_steps = num_inference_steps or self.input_config.num_inference_steps
         if self.runtime_config.warmup_steps > self.input_config.num_inference_steps:
             self.runtime_config.warmup_steps = self.input_config.num_inference_steps
@@ -123,12 +223,63 @@ class DiTRuntimeState(RuntimeState):
             (batch_size and self.input_config.batch_size != batch_size)
         ):
             self._input_size_change(height, width, batch_size)
+        elif (
+            steps_changed
+            and self.parallel_config.pp_config.patch_layout == "cost"
+        ):
+            # the simulated schedule behind the patch heights depends on it
+            self._input_size_change()
+        # every generation starts with fresh delta encoding references
+        get_pp_group().reset_comm_codecs()
+        self._update_kv_refresh_policy()
 
         self.ready = True
 
     def set_patched_mode(self, patch_mode: bool):
         self.patch_mode = patch_mode
         self.pipeline_patch_idx = 0
+        self._update_plan()
+
+    def set_step(self, step_idx: int):
+        self.step_idx = step_idx
+
+    def get_pipeline_segments(
+        self, num_steps: int
+    ) -> List[Tuple[bool, int, int]]:
+        """`(sync, start, end)` runs of the steps of a generation, the
+        synchronous ones being the warmup steps and the steps refreshing the
+        stale K/V."""
+        return self.kv_refresh_policy.segments(
+            num_steps, self.runtime_config.warmup_steps
+        )
+
+    def get_kv_drift_stats(self) -> Dict[int, Dict[int, float]]:
+        """Relative drift of the stale K/V per attention layer of this stage
+        and step of the last generation, empty unless measured."""
+        return self.kv_drift_monitor.layer_drift()
+
+    def _update_kv_refresh_policy(self):
+        if not self.kv_drift_monitor.enabled:
+            return
+        if self._kv_drift_num_steps is not None:
+            # every rank has to take the same refresh steps, so the drift of
+            #   a step is the largest one over the layers of all the ranks
+            step_drift = self.kv_drift_monitor.step_drift(
+                self._kv_drift_num_steps
+            ).cpu()
+            torch.distributed.all_reduce(
+                step_drift,
+                op=torch.distributed.ReduceOp.MAX,
+                group=get_world_group().cpu_group,
+            )
+            self.kv_refresh_policy.update_drift_profile(step_drift.tolist())
+            if torch.distributed.get_rank() == 0:
+                logger.info(
+                    f"Stale KV drift per step of the last generation: "
+                    f"{[round(drift, 4) for drift in step_drift.tolist()]}"
+                )
+        self.kv_drift_monitor.reset()
+        self._kv_drift_num_steps = self.input_config.num_inference_steps
 
     def next_patch(self):
         if self.patch_mode:
@@ -137,6 +288,52 @@ class DiTRuntimeState(RuntimeState):
                 self.pipeline_patch_idx = 0
         else:
             self.pipeline_patch_idx = 0
+        self._update_plan()
+
+    def _update_plan(self):
+        if self.execution_plan is not None:
+            self.plan = self.execution_plan.get(
+                self.patch_mode, self.pipeline_patch_idx
+            )
+
+    @staticmethod
+    def _get_backbone_patch_size(pipeline: DiffusionPipeline) -> int:
+        """Latent pixels per side of a token of the backbone."""
+        if isinstance(pipeline, FluxPipeline):
+            # Flux packs 2x2 latent pixels into one token of its patch size
+            #   1 transformer
+            return 2
+        return pipeline.transformer.config.patch_size
+
+    @staticmethod
+    def _estimate_step_comm_bytes(
+        pipeline: DiffusionPipeline,
+        parallel_config: ParallelConfig,
+    ) -> Dict[str, float]:
+        # the input size is not known yet, estimate with the default one
+        input_config = InputConfig()
+        transformer_config = pipeline.transformer.config
+        return estimate_step_comm_bytes(
+            height=input_config.height,
+            width=input_config.width,
+            # classifier free guidance doubles the batch
+            batch_size=(
+                (1 if isinstance(pipeline, FluxPipeline) else 2)
+                * (input_config.batch_size or 1)
+            ),
+            vae_scale_factor=pipeline.vae_scale_factor,
+            patch_size=DiTRuntimeState._get_backbone_patch_size(pipeline),
+            in_channels=transformer_config.in_channels,
+            inner_dim=pipeline.transformer.inner_dim,
+            num_layers=(
+                transformer_config.num_layers
+                + getattr(transformer_config, "num_single_layers", 0)
+            ),
+            ulysses_degree=parallel_config.ulysses_degree,
+            ring_degree=parallel_config.ring_degree,
+            pipeline_parallel_degree=parallel_config.pp_degree,
+            classifier_free_guidance_degree=parallel_config.cfg_degree,
+        )
 
     def _check_model_and_parallel_config(
         self,
@@ -157,12 +354,16 @@ class DiTRuntimeState(RuntimeState):
         vae_scale_factor: int, 
         backbone_patch_size: int,
         backbone_inner_dim: int,
-        backbone_in_channel: int
+        backbone_in_channel: int,
+        backbone_latents_packed: bool = False,
+        uses_classifier_free_guidance: bool = True,
     ):
         self.vae_scale_factor = vae_scale_factor
         self.backbone_patch_size = backbone_patch_size
         self.backbone_inner_dim = backbone_inner_dim
         self.backbone_in_channel = backbone_in_channel
+        self.backbone_latents_packed = backbone_latents_packed
+        self.uses_classifier_free_guidance = uses_classifier_free_guidance
 
     def _input_size_change(
         self,
@@ -187,43 +388,41 @@ class DiTRuntimeState(RuntimeState):
         if latents_height % num_sp_patches != 0:
             raise ValueError("The height of the input is not divisible by the number of sequence parallel devices")
 
-        self.num_pipeline_patch = self.parallel_config.pp_config.num_pipeline_patch
-        # Pipeline patches
-        pipeline_patches_height = (
-            latents_height + self.num_pipeline_patch - 1
-        ) // self.num_pipeline_patch
-        # make sure pipeline_patches_height is a multiple of (num_sp_patches * patch_size)
-        pipeline_patches_height = (
-            (pipeline_patches_height + (num_sp_patches * patch_size) - 1) // (patch_size * num_sp_patches)
-        ) * (patch_size * num_sp_patches)
-        # get the number of pipeline that matches patch height requirements
-        num_pipeline_patch = (
-            latents_height + pipeline_patches_height - 1
-        ) // pipeline_patches_height
+        pp_config = self.parallel_config.pp_config
+        self.num_pipeline_patch = pp_config.num_pipeline_patch
+        # Pipeline patches, heights are multiples of (num_sp_patches * patch_size)
+        pipeline_patches_height_list = plan_patch_heights(
+            latents_height,
+            self.num_pipeline_patch,
+            unit=patch_size * num_sp_patches,
+            pp_degree=pp_config.pp_degree,
+            num_steps=max(
+                1,
+                self.input_config.num_inference_steps
+                - self.runtime_config.warmup_steps,
+            ),
+            layout=pp_config.patch_layout,
+            cost_model=PatchCostModel.from_list(pp_config.patch_costs),
+        )
+        num_pipeline_patch = len(pipeline_patches_height_list)
         if num_pipeline_patch != self.num_pipeline_patch:
             logger.warning(
                 f"Pipeline patches num changed from "
                 f"{self.num_pipeline_patch} to {num_pipeline_patch} due "
                 f"to input size and parallelisation requirements"
             )
-        pipeline_patches_height_list = [
-            pipeline_patches_height for _ in range(num_pipeline_patch - 1)
-        ]
-        the_last_pp_patch_height = latents_height - pipeline_patches_height * (num_pipeline_patch - 1)
-        if the_last_pp_patch_height % (patch_size * num_sp_patches) != 0:
-            raise ValueError(
-                f"The height of the last pipeline patch is {the_last_pp_patch_height}, "
-                f"which is not a multiple of (patch_size * num_sp_patches): "
-                f"{patch_size} * {num_sp_patches}. Please try to adjust 'num_pipeline_patches "
-                f"or sp_degree argument so that the condition are met ")
-        pipeline_patches_height_list.append(the_last_pp_patch_height)
+        if pp_config.patch_layout != "uniform":
+            logger.info(
+                f"Pipeline patch heights in latent rows: "
+                f"{pipeline_patches_height_list}"
+            )
 
         # Sequence parallel patches
         # len: sp_degree * num_pipeline_patches
         flatten_patches_height = [
             pp_patch_height // num_sp_patches
-            for _ in range(num_sp_patches)
             for pp_patch_height in pipeline_patches_height_list
+            for _ in range(num_sp_patches)
         ]
         flatten_patches_start_idx = [0] + [
             sum(flatten_patches_height[:i]) for i in range(1, len(flatten_patches_height) + 1)
@@ -265,12 +464,27 @@ class DiTRuntimeState(RuntimeState):
         self.pp_patches_token_start_end_idx = pp_patches_token_start_end_idx
         self.pp_patches_token_num = pp_patches_token_num
 
+        env_info = PACKAGES_CHECKER.get_packages_info()
+        self.execution_plan = compile_execution_plan(
+            pp_patches_token_num=pp_patches_token_num,
+            pp_patches_start_idx_local=pp_patches_start_idx_local,
+            pp_patches_token_start_end_idx=pp_patches_token_start_end_idx,
+            ulysses_degree=self.parallel_config.ulysses_degree,
+            sp_degree=num_sp_patches,
+            has_long_ctx_attn=env_info["has_long_ctx_attn"],
+            has_flash_attn=env_info["has_flash_attn"],
+        )
+        if self.pipeline_patch_idx >= num_pipeline_patch:
+            self.pipeline_patch_idx = 0
+        self._update_plan()
+
 
     def _reset_recv_buffer(self):
         # calc communicator buffer metadata
         batch_size = self.input_config.batch_size
         if get_pipeline_parallel_rank() != 0:
-            batch_size = batch_size * (2 // self.parallel_config.cfg_degree)
+            if self.uses_classifier_free_guidance:
+                batch_size = batch_size * (2 // self.parallel_config.cfg_degree)
             hidden_dim = self.backbone_inner_dim
             num_patches_tokens = [
                 end - start
@@ -285,7 +499,20 @@ class DiTRuntimeState(RuntimeState):
                 sum(num_patches_tokens),
                 hidden_dim,
             ]
-        #TODO: if use distributed scheduler alone sp devices, edit pp rank0 the logic
+        # the first stage receives the latents of its own sequence parallel
+        #   rank, which steps the scheduler on them only
+        elif self.backbone_latents_packed:
+            # packed latents are split into patches along their tokens
+            latents_channels = self.backbone_in_channel
+            patches_shape = [
+                [batch_size, tokens, latents_channels]
+                for tokens in self.pp_patches_token_num
+            ]
+            feature_map_shape = [
+                batch_size,
+                sum(self.pp_patches_token_num),
+                latents_channels,
+            ]
         else:
             latents_channels = self.backbone_in_channel
             latents_width = self.input_config.width // self.vae_scale_factor
@@ -301,11 +528,27 @@ class DiTRuntimeState(RuntimeState):
             ]
 
         # reset pipeline communicator buffer
+        pp_config = self.parallel_config.pp_config
+        for name in (
+            set(pp_config.comm_quantization_modes) | pp_config.comm_delta_names
+        ):
+            get_pp_group().set_comm_codec(
+                name,
+                quantization=pp_config.comm_quantization_modes.get(name, None),
+                delta=name in pp_config.comm_delta_names,
+                delta_keep_ratio=pp_config.comm_delta_keep_ratio,
+                delta_keyframe_interval=pp_config.comm_delta_keyframe_interval,
+            )
+        get_pp_group().set_send_window(pp_config.max_inflight_sends)
         get_pp_group().set_recv_buffer(
             num_pipefusion_patches=self.num_pipeline_patch,
             patches_shape_list=patches_shape,
             feature_map_shape=feature_map_shape,
             dtype=self.runtime_config.dtype,
+            recv_ring_depth=self.parallel_config.pp_config.recv_ring_depth,
+            buffer_pool_max_bytes=(
+                self.parallel_config.pp_config.recv_buffer_pool_mb * 1024 * 1024
+            ),
         )
 
 
@@ -0,0 +1,403 @@
+import itertools
+import json
+import socket
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch.distributed
+
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+# Nominal per direction bandwidth in GB/s of the link classes a topology file
+# can name, used when the file gives no measured bandwidth.
+LINK_BANDWIDTH_GBPS: Dict[str, float] = {
+    "nvlink": 300.0,
+    "xgmi": 100.0,
+    "pcie": 32.0,
+    "infiniband": 25.0,
+    "roce": 12.5,
+    "ethernet": 3.125,
+}
+
+# Dimensions of the parallel groups from the outermost to the innermost one,
+# in the order `initialize_model_parallel` builds the groups from rank
+# arithmetic. Ulysses groups are contiguous inside the sequence parallel
+# groups, the same way yunchang lays them out.
+PARALLEL_DIMS: Tuple[str, ...] = ("dp", "cfg", "pp", "ring", "ulysses")
+
+# How a rank exchanges data inside each kind of group. "all" sends an equal
+# share of its bytes to every other member, "next" sends all of them to the
+# next member of the group.
+_DIM_PATTERNS: Dict[str, str] = {
+    "ulysses": "all",
+    "ring": "next",
+    "pp": "next",
+    "cfg": "all",
+}
+
+
+def _link_bandwidth(link: str, bandwidth_gbps: Optional[float]) -> float:
+    if bandwidth_gbps is not None:
+        return bandwidth_gbps
+    if link not in LINK_BANDWIDTH_GBPS:
+        raise ValueError(
+            f"Unknown link class {link}, expected one of "
+            f"{list(LINK_BANDWIDTH_GBPS)} or a measured bandwidth_gbps"
+        )
+    return LINK_BANDWIDTH_GBPS[link]
+
+
+@dataclass
+class HostTopology:
+    name: str
+    ranks: List[int]
+    link: str = "nvlink"
+    bandwidth_gbps: Optional[float] = None
+
+    @property
+    def intra_node_bandwidth(self) -> float:
+        return _link_bandwidth(self.link, self.bandwidth_gbps)
+
+
+@dataclass
+class ClusterTopology:
+    """Hosts of the job, the global ranks running on each of them and the
+    bandwidth of the links between those ranks.
+
+    A topology file is a JSON object like
+        {
+            "hosts": [
+                {"name": "node0", "ranks": [0, 1, 2, 3], "link": "nvlink"},
+                {"name": "node1", "ranks": [4, 5, 6, 7], "link": "pcie",
+                 "bandwidth_gbps": 24.0}
+            ],
+            "inter_node_link": "infiniband",
+            "inter_node_bandwidth_gbps": 22.5
+        }
+    where a measured `bandwidth_gbps` overrides the nominal bandwidth of
+    its link class.
+    """
+    hosts: List[HostTopology]
+    inter_node_link: str = "infiniband"
+    inter_node_bandwidth_gbps: Optional[float] = None
+    host_of_rank: Dict[int, int] = field(init=False)
+
+    def __post_init__(self):
+        self.host_of_rank = {}
+        for host_idx, host in enumerate(self.hosts):
+            for rank in host.ranks:
+                assert rank not in self.host_of_rank, (
+                    f"rank {rank} is listed on more than one host"
+                )
+                self.host_of_rank[rank] = host_idx
+        assert sorted(self.host_of_rank) == list(range(self.world_size)), (
+            "topology hosts must list every rank from 0 to world_size - 1"
+        )
+
+    @property
+    def world_size(self) -> int:
+        return sum(len(host.ranks) for host in self.hosts)
+
+    @property
+    def inter_node_bandwidth(self) -> float:
+        return _link_bandwidth(self.inter_node_link, self.inter_node_bandwidth_gbps)
+
+    @classmethod
+    def from_dict(cls, desc: Dict) -> "ClusterTopology":
+        return cls(
+            hosts=[
+                HostTopology(
+                    name=host.get("name", f"host{idx}"),
+                    ranks=list(host["ranks"]),
+                    link=host.get("link", "nvlink"),
+                    bandwidth_gbps=host.get("bandwidth_gbps", None),
+                )
+                for idx, host in enumerate(desc["hosts"])
+            ],
+            inter_node_link=desc.get("inter_node_link", "infiniband"),
+            inter_node_bandwidth_gbps=desc.get("inter_node_bandwidth_gbps", None),
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> "ClusterTopology":
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def detect(cls, group=None) -> "ClusterTopology":
+        """Group the ranks of an initialized distributed environment by the
+        hostname they run on. Link classes keep their defaults."""
+        hostnames = [None] * torch.distributed.get_world_size()
+        torch.distributed.all_gather_object(
+            hostnames, socket.gethostname(), group=group
+        )
+        ranks_of_host: Dict[str, List[int]] = {}
+        for rank, hostname in enumerate(hostnames):
+            ranks_of_host.setdefault(hostname, []).append(rank)
+        return cls(
+            hosts=[
+                HostTopology(name=hostname, ranks=ranks)
+                for hostname, ranks in ranks_of_host.items()
+            ]
+        )
+
+
+def estimate_step_comm_bytes(
+    height: int,
+    width: int,
+    batch_size: int,
+    vae_scale_factor: int,
+    patch_size: int,
+    in_channels: int,
+    inner_dim: int,
+    num_layers: int,
+    ulysses_degree: int = 1,
+    ring_degree: int = 1,
+    pipeline_parallel_degree: int = 1,
+    classifier_free_guidance_degree: int = 1,
+    dtype_bytes: int = 2,
+) -> Dict[str, float]:
+    """Bytes one rank sends per diffusion step in each kind of parallel group,
+    following the communication costs of the table in the README. Only the
+    volumes relative to each other and to the link bandwidths matter for rank
+    placement. `batch_size` is the batch seen by the transformer before it is
+    split by classifier free guidance parallel."""
+    latents_height = height // vae_scale_factor
+    latents_width = width // vae_scale_factor
+    num_tokens = (latents_height // patch_size) * (latents_width // patch_size)
+    batch_size = batch_size // classifier_free_guidance_degree
+    sp_degree = ulysses_degree * ring_degree
+    # hidden states of one layer held by a rank of a sequence parallel group
+    shard_bytes = batch_size * num_tokens * inner_dim * dtype_bytes / sp_degree
+    latents_bytes = (
+        batch_size * in_channels * latents_height * latents_width * dtype_bytes
+    )
+    num_stage_layers = num_layers / pipeline_parallel_degree
+    return {
+        # q, k, v and the attention output go through an all-to-all
+        "ulysses": 4 * num_stage_layers * shard_bytes
+        * (ulysses_degree - 1) / ulysses_degree,
+        # k and v shards travel around the ring
+        "ring": 2 * num_stage_layers * shard_bytes * (ring_degree - 1),
+        # hidden states go to the next stage, the latents back to the first one
+        "pp": (shard_bytes + latents_bytes / sp_degree)
+        if pipeline_parallel_degree > 1 else 0.0,
+        # noise predictions are all-gathered to apply guidance
+        "cfg": latents_bytes * (classifier_free_guidance_degree - 1)
+        / classifier_free_guidance_degree,
+    }
+
+
+@dataclass
+class RankPlacement:
+    """Assignment of logical ranks to the global ranks of the job.
+
+    `ranks[i]` is the global rank that takes the place of rank `i` in the
+    contiguous group arithmetic of `initialize_model_parallel`. `dim_order`
+    lists the parallel dimensions from the one spread the most across hosts
+    to the one kept the most inside a host.
+    """
+    dim_order: Tuple[str, ...]
+    ranks: List[int]
+    cross_node_bytes: Dict[str, float]
+    intra_node_bytes: Dict[str, float]
+    predicted_comm_time: float
+
+    @property
+    def name(self) -> str:
+        return "-".join(self.dim_order)
+
+    @property
+    def total_cross_node_bytes(self) -> float:
+        return sum(self.cross_node_bytes.values())
+
+    def is_identity(self) -> bool:
+        return self.ranks == list(range(len(self.ranks)))
+
+
+def _logical_groups(degrees: Dict[str, int], dim: str) -> List[List[int]]:
+    """Logical ranks of every group of `dim`, ordered by their coordinate
+    along `dim`."""
+    sizes = [degrees[d] for d in PARALLEL_DIMS]
+    dim_idx = PARALLEL_DIMS.index(dim)
+    strides = [1] * len(sizes)
+    for i in range(len(sizes) - 2, -1, -1):
+        strides[i] = strides[i + 1] * sizes[i + 1]
+    other_ranges = [
+        range(size) if i != dim_idx else range(1)
+        for i, size in enumerate(sizes)
+    ]
+    groups = []
+    for coords in itertools.product(*other_ranges):
+        base = sum(c * s for c, s in zip(coords, strides))
+        groups.append(
+            [base + j * strides[dim_idx] for j in range(sizes[dim_idx])]
+        )
+    return groups
+
+
+def _place(
+    degrees: Dict[str, int],
+    dim_order: Sequence[str],
+    physical_ranks: List[int],
+) -> List[int]:
+    """Fill `physical_ranks` in order with the logical ranks enumerated with
+    the dimensions of `dim_order` from the outermost to the innermost."""
+    sizes = [degrees[d] for d in PARALLEL_DIMS]
+    placement = [0] * len(physical_ranks)
+    for slot, coords in enumerate(
+        itertools.product(*[range(degrees[d]) for d in dim_order])
+    ):
+        coord_of = dict(zip(dim_order, coords))
+        logical = 0
+        for dim, size in zip(PARALLEL_DIMS, sizes):
+            logical = logical * size + coord_of[dim]
+        placement[logical] = physical_ranks[slot]
+    return placement
+
+
+def evaluate_rank_placement(
+    topology: ClusterTopology,
+    degrees: Dict[str, int],
+    ranks: List[int],
+    step_comm_bytes: Dict[str, float],
+) -> Tuple[Dict[str, float], Dict[str, float], float]:
+    """Cross-node and intra-node bytes sent per step in each kind of group,
+    summed over all ranks, and the predicted communication time in seconds
+    of the slowest rank."""
+    cross_node_bytes = {}
+    intra_node_bytes = {}
+    rank_time = [0.0] * len(ranks)
+    inter_bandwidth = topology.inter_node_bandwidth * 1e9
+    for dim, pattern in _DIM_PATTERNS.items():
+        cross_node_bytes[dim] = 0.0
+        intra_node_bytes[dim] = 0.0
+        nbytes = step_comm_bytes.get(dim, 0.0)
+        if degrees[dim] == 1 or nbytes == 0:
+            continue
+        for group in _logical_groups(degrees, dim):
+            hosts = [topology.host_of_rank[ranks[r]] for r in group]
+            for i, (logical, host) in enumerate(zip(group, hosts)):
+                if pattern == "all":
+                    num_remote = sum(1 for h in hosts if h != host)
+                    cross = nbytes * num_remote / (len(group) - 1)
+                else:
+                    cross = nbytes if hosts[(i + 1) % len(group)] != host else 0.0
+                intra = nbytes - cross
+                cross_node_bytes[dim] += cross
+                intra_node_bytes[dim] += intra
+                intra_bandwidth = (
+                    topology.hosts[host].intra_node_bandwidth * 1e9
+                )
+                rank_time[logical] += (
+                    cross / inter_bandwidth + intra / intra_bandwidth
+                )
+    return cross_node_bytes, intra_node_bytes, max(rank_time)
+
+
+def plan_rank_placements(
+    topology: ClusterTopology,
+    step_comm_bytes: Dict[str, float],
+    data_parallel_degree: int = 1,
+    classifier_free_guidance_degree: int = 1,
+    ulysses_degree: int = 1,
+    ring_degree: int = 1,
+    pipeline_parallel_degree: int = 1,
+) -> List[RankPlacement]:
+    """Rank every layout of the parallel groups over the hosts of
+    `topology` by predicted communication time per step, the best first.
+
+    A layout fills the hosts, largest first, with the logical ranks
+    enumerated in one order of the parallel dimensions, so that the
+    innermost dimension stays inside a host whenever it fits. Layouts tie
+    towards keeping Ulysses inside a host first, then ring, then PipeFusion
+    and then CFG. The identity placement, i.e. contiguous ranks, is always
+    part of the result for comparison.
+    """
+    degrees = {
+        "dp": data_parallel_degree,
+        "cfg": classifier_free_guidance_degree,
+        "pp": pipeline_parallel_degree,
+        "ring": ring_degree,
+        "ulysses": ulysses_degree,
+    }
+    world_size = 1
+    for degree in degrees.values():
+        world_size *= degree
+    if world_size != topology.world_size:
+        raise ValueError(
+            f"parallel degrees {degrees} need {world_size} ranks but the "
+            f"topology has {topology.world_size}"
+        )
+    hosts = sorted(topology.hosts, key=lambda host: -len(host.ranks))
+    physical_ranks = [rank for host in hosts for rank in host.ranks]
+
+    # data parallel groups never communicate, keep them outermost
+    comm_dims = [d for d in ("cfg", "pp", "ring", "ulysses") if degrees[d] > 1]
+    candidates = [(("dp",) + tuple(comm_dims), None)]
+    candidates += [
+        (("dp",) + order, None)
+        for order in itertools.permutations(comm_dims)
+        if order != tuple(comm_dims)
+    ]
+    candidates.append((("identity",), list(range(world_size))))
+
+    placements = []
+    seen = set()
+    for dim_order, ranks in candidates:
+        if ranks is None:
+            ranks = _place(
+                degrees, dim_order + tuple(
+                    d for d in PARALLEL_DIMS if d not in dim_order
+                ), physical_ranks
+            )
+        if tuple(ranks) in seen:
+            continue
+        seen.add(tuple(ranks))
+        cross, intra, comm_time = evaluate_rank_placement(
+            topology, degrees, ranks, step_comm_bytes
+        )
+        placements.append(
+            RankPlacement(
+                dim_order=dim_order,
+                ranks=ranks,
+                cross_node_bytes=cross,
+                intra_node_bytes=intra,
+                predicted_comm_time=comm_time,
+            )
+        )
+    # sorted() is stable, so ties keep the priority order of the candidates
+    return sorted(placements, key=lambda p: p.predicted_comm_time)
+
+
+def get_data_parallel_replicas(
+    rank_placement: Sequence[int], data_parallel_degree: int
+) -> List[List[int]]:
+    """Global ranks of every data parallel replica under `rank_placement`,
+    i.e. the data parallel groups `initialize_model_parallel` builds, in the
+    order the replicas split the prompts."""
+    num_devices = len(rank_placement) // data_parallel_degree
+    return [
+        list(rank_placement[i * num_devices : (i + 1) * num_devices])
+        for i in range(data_parallel_degree)
+    ]
+
+
+def format_rank_placements(placements: List[RankPlacement]) -> str:
+    lines = [
+        f"{'layout':<28} {'time(ms)':>10} {'cross-node MB/step':>20} "
+        + " ".join(f"{dim:>10}" for dim in _DIM_PATTERNS)
+    ]
+    for placement in placements:
+        lines.append(
+            f"{placement.name:<28} "
+            f"{placement.predicted_comm_time * 1e3:>10.3f} "
+            f"{placement.total_cross_node_bytes / 2**20:>20.2f} "
+            + " ".join(
+                f"{placement.cross_node_bytes[dim] / 2**20:>10.2f}"
+                for dim in _DIM_PATTERNS
+            )
+        )
+    return "\n".join(lines)
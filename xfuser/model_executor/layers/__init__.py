@@ -1,13 +1,17 @@
 from .register import xFuserLayerWrappersRegister
 from .base_layer import xFuserLayerBaseWrapper
+from .attention_backends import xFuserAttentionBackendRegister
 from .attention_processor import xFuserAttentionWrapper
 from .conv import xFuserConv2dWrapper
 from .embeddings import xFuserPatchEmbedWrapper
+from .feedforward import xFuserFeedForwardWrapper
 
 __all__ = [
     "xFuserLayerWrappersRegister",
     "xFuserLayerBaseWrapper",
+    "xFuserAttentionBackendRegister",
     "xFuserAttentionWrapper",
     "xFuserConv2dWrapper",
     "xFuserPatchEmbedWrapper",
+    "xFuserFeedForwardWrapper",
 ]
@@ -0,0 +1,520 @@
+import importlib.util
+import math
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from torch.nn import functional as F
+
+from xfuser.logger import init_logger
+from xfuser.envs import PACKAGES_CHECKER
+
+logger = init_logger(__name__)
+
+env_info = PACKAGES_CHECKER.get_packages_info()
+HAS_FLASH_ATTN = env_info["has_flash_attn"]
+HAS_XFORMERS = importlib.util.find_spec("xformers") is not None
+
+# query, key, value in [batch, tokens, heads, head_dim], an optional mask
+#   broadcastable to [batch, heads, query tokens, key tokens], and the
+#   output in the layout of the query
+AttentionFunc = Callable[
+    [torch.Tensor, torch.Tensor, torch.Tensor, Optional[torch.Tensor]],
+    torch.Tensor,
+]
+
+
+@dataclass
+class AttentionBackend:
+    name: str
+    func: AttentionFunc
+    # whether the kernel can run in this process at all
+    is_available: Callable[[], bool]
+    # whether it can run the given query, key and mask
+    supports: Callable[
+        [torch.Tensor, torch.Tensor, Optional[torch.Tensor]], bool
+    ]
+    # order of preference when there is nothing to autotune with
+    priority: int
+    # whether its memory does not grow with query tokens * key tokens
+    memory_bounded: bool = False
+
+
+class xFuserAttentionBackendRegister:
+    _XFUSER_ATTENTION_BACKENDS: Dict[str, AttentionBackend] = {}
+
+    @classmethod
+    def register(
+        cls,
+        name: str,
+        priority: int,
+        is_available: Callable[[], bool] = lambda: True,
+        supports: Callable[
+            [torch.Tensor, torch.Tensor, Optional[torch.Tensor]], bool
+        ] = lambda query, key, attention_mask: True,
+        memory_bounded: bool = False,
+    ):
+        def decorator(func: AttentionFunc):
+            if name in cls._XFUSER_ATTENTION_BACKENDS:
+                raise ValueError(f"Attention backend {name} already registered")
+            cls._XFUSER_ATTENTION_BACKENDS[name] = AttentionBackend(
+                name=name,
+                func=func,
+                is_available=is_available,
+                supports=supports,
+                priority=priority,
+                memory_bounded=memory_bounded,
+            )
+            return func
+
+        return decorator
+
+    @classmethod
+    def get_backend(cls, name: str) -> AttentionBackend:
+        if name not in cls._XFUSER_ATTENTION_BACKENDS:
+            raise ValueError(
+                f"Attention backend {name} is not registered, registered "
+                f"backends: {list(cls._XFUSER_ATTENTION_BACKENDS)}"
+            )
+        return cls._XFUSER_ATTENTION_BACKENDS[name]
+
+    @classmethod
+    def get_available_backends(cls) -> List[AttentionBackend]:
+        """Available backends, the preferred ones first."""
+        return sorted(
+            (
+                backend
+                for backend in cls._XFUSER_ATTENTION_BACKENDS.values()
+                if backend.is_available()
+            ),
+            key=lambda backend: backend.priority,
+        )
+
+
+def _flash_attn_supports(query, key, attention_mask) -> bool:
+    return (
+        attention_mask is None
+        and query.is_cuda
+        and query.dtype in (torch.float16, torch.bfloat16)
+        and query.shape[-1] <= 256
+    )
+
+
+@xFuserAttentionBackendRegister.register(
+    "flash_attn",
+    priority=0,
+    is_available=lambda: HAS_FLASH_ATTN,
+    supports=_flash_attn_supports,
+    memory_bounded=True,
+)
+def flash_attn_attention(query, key, value, attention_mask=None):
+    from flash_attn import flash_attn_func
+
+    return flash_attn_func(query, key, value, dropout_p=0.0, causal=False)
+
+
+@xFuserAttentionBackendRegister.register(
+    "xformers",
+    priority=1,
+    is_available=lambda: HAS_XFORMERS,
+    supports=lambda query, key, attention_mask: (
+        attention_mask is None and query.is_cuda
+    ),
+    memory_bounded=True,
+)
+def xformers_attention(query, key, value, attention_mask=None):
+    from xformers.ops import memory_efficient_attention
+
+    return memory_efficient_attention(query, key, value)
+
+
+@xFuserAttentionBackendRegister.register("sdpa", priority=2)
+def sdpa_attention(query, key, value, attention_mask=None):
+    # the output of sdp = (batch, num_heads, seq_len, head_dim)
+    hidden_states = F.scaled_dot_product_attention(
+        query.transpose(1, 2),
+        key.transpose(1, 2),
+        value.transpose(1, 2),
+        attn_mask=attention_mask,
+        dropout_p=0.0,
+        is_causal=False,
+    )
+    return hidden_states.transpose(1, 2)
+
+
+@xFuserAttentionBackendRegister.register("math", priority=3)
+def math_attention(query, key, value, attention_mask=None):
+    query = query.transpose(1, 2)
+    key = key.transpose(1, 2)
+    value = value.transpose(1, 2)
+    scores = torch.matmul(query, key.transpose(-1, -2)) * query.shape[-1] ** -0.5
+    if attention_mask is not None:
+        if attention_mask.dtype == torch.bool:
+            scores = scores.masked_fill(~attention_mask, float("-inf"))
+        else:
+            scores = scores + attention_mask
+    probs = scores.softmax(dim=-1)
+    return torch.matmul(probs, value).transpose(1, 2)
+
+
+# budget of the attention scores of a chunk when none is set
+DEFAULT_CHUNK_MEMORY_BUDGET = 256 * 2**20
+# below this many queries per chunk, the keys are chunked too
+MIN_QUERY_CHUNK_SIZE = 128
+
+
+def attention_scores_bytes(
+    batch_size: int,
+    heads: int,
+    query_tokens: int,
+    key_tokens: int,
+    element_size: int,
+) -> int:
+    """Bytes of the scores and probabilities an attention kernel that
+    materializes them holds at once."""
+    return 2 * batch_size * heads * query_tokens * key_tokens * element_size
+
+
+def get_attention_chunk_sizes(
+    batch_size: int,
+    heads: int,
+    query_tokens: int,
+    key_tokens: int,
+    element_size: int,
+    memory_budget: int = DEFAULT_CHUNK_MEMORY_BUDGET,
+) -> Tuple[int, int]:
+    """`(query_chunk_size, key_chunk_size)` whose scores fit in
+    `memory_budget` bytes. Only the queries are chunked while the chunks
+    keep at least `MIN_QUERY_CHUNK_SIZE` of them, the keys too otherwise,
+    with float32 online softmax statistics."""
+    query_chunk_size = memory_budget // attention_scores_bytes(
+        batch_size, heads, 1, key_tokens, element_size
+    )
+    if query_chunk_size >= min(query_tokens, MIN_QUERY_CHUNK_SIZE):
+        return min(query_chunk_size, query_tokens), key_tokens
+    query_chunk_size = min(query_tokens, MIN_QUERY_CHUNK_SIZE)
+    # scores, probabilities and their float32 copies
+    key_chunk_size = memory_budget // (
+        batch_size * heads * query_chunk_size * (2 * element_size + 8)
+    )
+    return query_chunk_size, max(1, min(key_chunk_size, key_tokens))
+
+
+def chunked_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    query_chunk_size: Optional[int] = None,
+    key_chunk_size: Optional[int] = None,
+    memory_budget: Optional[int] = None,
+) -> torch.Tensor:
+    """Attention of `[batch, tokens, heads, head_dim]` inputs computed a
+    chunk of queries at a time, and a chunk of keys at a time with an online
+    softmax when `key_chunk_size` is smaller than the keys, so that the
+    scores never take more than `query_chunk_size * key_chunk_size` per
+    head. Chunk sizes not given are chosen for `memory_budget` bytes."""
+    batch_size, query_tokens, heads, head_dim = query.shape
+    key_tokens = key.shape[1]
+    if query_chunk_size is None or key_chunk_size is None:
+        auto_query_chunk_size, auto_key_chunk_size = get_attention_chunk_sizes(
+            batch_size,
+            heads,
+            query_tokens,
+            key_tokens,
+            query.element_size(),
+            memory_budget or DEFAULT_CHUNK_MEMORY_BUDGET,
+        )
+        query_chunk_size = query_chunk_size or auto_query_chunk_size
+        key_chunk_size = key_chunk_size or auto_key_chunk_size
+    if attention_mask is not None:
+        attention_mask = attention_mask.expand(
+            batch_size, heads, query_tokens, key_tokens
+        )
+
+    query = query.transpose(1, 2)
+    key = key.transpose(1, 2)
+    value = value.transpose(1, 2)
+    out = torch.empty(
+        batch_size, query_tokens, heads, value.shape[-1],
+        dtype=query.dtype, device=query.device,
+    )
+    for query_start in range(0, query_tokens, query_chunk_size):
+        query_end = min(query_start + query_chunk_size, query_tokens)
+        query_chunk = query[:, :, query_start:query_end]
+        mask_chunk = (
+            None
+            if attention_mask is None
+            else attention_mask[:, :, query_start:query_end]
+        )
+        if key_chunk_size >= key_tokens:
+            hidden_states = F.scaled_dot_product_attention(
+                query_chunk, key, value, attn_mask=mask_chunk,
+                dropout_p=0.0, is_causal=False,
+            )
+        else:
+            hidden_states = _online_softmax_attention(
+                query_chunk, key, value, mask_chunk, key_chunk_size
+            )
+        out[:, query_start:query_end] = hidden_states.transpose(1, 2)
+    return out
+
+
+def _online_softmax_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor],
+    key_chunk_size: int,
+) -> torch.Tensor:
+    """Attention of `[batch, heads, tokens, head_dim]` inputs over chunks
+    of keys, rescaling the partial results to the running max of the
+    scores."""
+    scale = 1 / math.sqrt(query.shape[-1])
+    stats_shape = (*query.shape[:-1], 1)
+    running_max = torch.full(
+        stats_shape, float("-inf"), dtype=torch.float32, device=query.device
+    )
+    running_sum = torch.zeros(stats_shape, dtype=torch.float32, device=query.device)
+    acc = torch.zeros(
+        (*query.shape[:-1], value.shape[-1]),
+        dtype=torch.float32,
+        device=query.device,
+    )
+    for key_start in range(0, key.shape[2], key_chunk_size):
+        key_end = key_start + key_chunk_size
+        scores = torch.matmul(
+            query, key[:, :, key_start:key_end].transpose(-1, -2)
+        ).float() * scale
+        if attention_mask is not None:
+            mask = attention_mask[..., key_start:key_end]
+            if mask.dtype == torch.bool:
+                scores = scores.masked_fill(~mask, float("-inf"))
+            else:
+                scores = scores + mask.float()
+        new_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+        # rows whose keys are all masked so far subtract 0 instead of -inf
+        safe_max = new_max.masked_fill(new_max == float("-inf"), 0.0)
+        probs = torch.exp(scores - safe_max)
+        correction = torch.exp(running_max - safe_max)
+        running_sum = running_sum * correction + probs.sum(dim=-1, keepdim=True)
+        acc = acc * correction + torch.matmul(
+            probs.to(value.dtype), value[:, :, key_start:key_end]
+        ).float()
+        running_max = new_max
+    return (acc / running_sum).to(query.dtype)
+
+
+@xFuserAttentionBackendRegister.register(
+    "chunked", priority=4, memory_bounded=True
+)
+def chunked_backend_attention(query, key, value, attention_mask=None):
+    return chunked_attention(
+        query,
+        key,
+        value,
+        attention_mask,
+        memory_budget=ATTENTION_BACKEND_SELECTOR.memory_budget,
+    )
+
+
+class AttentionBackendSelector:
+    """Backend of the local attention for each input shape.
+
+    A backend set by name is used for every shape it supports. With "auto",
+    the backend of a shape is measured among the available ones that
+    support it the first time the shape is seen inside `autotuning`, and
+    the decision is cached; shapes seen outside of it take the preferred
+    backend that supports them.
+
+    With a `memory_budget` in bytes, shapes whose attention scores would
+    not fit in it only go to the backends whose memory is bounded.
+    """
+
+    def __init__(
+        self,
+        backend: str = "auto",
+        iters: int = 3,
+        memory_budget: Optional[int] = None,
+    ):
+        self.backend = backend
+        self.iters = iters
+        self.memory_budget = memory_budget
+        self.tuning = False
+        # shape key -> (backend name, whether it was measured or the only
+        #   candidate)
+        self._decisions: Dict[Tuple, Tuple[str, bool]] = {}
+
+    def set_backend(self, backend: str):
+        if backend != "auto":
+            xFuserAttentionBackendRegister.get_backend(backend)
+        if backend != self.backend:
+            self.backend = backend
+            self._decisions = {}
+
+    def set_memory_budget(self, memory_budget: Optional[int]):
+        if memory_budget != self.memory_budget:
+            self.memory_budget = memory_budget
+            self._decisions = {}
+
+    def clear(self):
+        self._decisions = {}
+
+    @property
+    def decisions(self) -> Dict[Tuple, str]:
+        """Backend chosen per `(batch, query tokens, key tokens, heads,
+        head_dim, dtype, device, masked)`."""
+        return {
+            shape_key: name for shape_key, (name, _) in self._decisions.items()
+        }
+
+    @staticmethod
+    def _shape_key(query, key, attention_mask) -> Tuple:
+        batch_size, query_tokens, heads, head_dim = query.shape
+        return (
+            batch_size,
+            query_tokens,
+            key.shape[1],
+            heads,
+            head_dim,
+            query.dtype,
+            query.device,
+            attention_mask is not None,
+        )
+
+    def _candidates(self, query, key, attention_mask) -> List[AttentionBackend]:
+        candidates = [
+            backend
+            for backend in xFuserAttentionBackendRegister.get_available_backends()
+            if backend.supports(query, key, attention_mask)
+        ]
+        if self.memory_budget and attention_scores_bytes(
+            query.shape[0],
+            query.shape[2],
+            query.shape[1],
+            key.shape[1],
+            query.element_size(),
+        ) > self.memory_budget:
+            candidates = [
+                backend for backend in candidates if backend.memory_bounded
+            ]
+        if self.backend != "auto":
+            forced = xFuserAttentionBackendRegister.get_backend(self.backend)
+            if forced in candidates:
+                return [forced]
+        return candidates
+
+    def select(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> AttentionBackend:
+        shape_key = self._shape_key(query, key, attention_mask)
+        decision = self._decisions.get(shape_key, None)
+        # untuned decisions are revisited when tuning
+        if decision is not None and (decision[1] or not self.tuning):
+            return xFuserAttentionBackendRegister.get_backend(decision[0])
+        candidates = self._candidates(query, key, attention_mask)
+        if len(candidates) == 0:
+            raise RuntimeError(
+                f"No attention backend supports the input of shape "
+                f"{tuple(query.shape)} and dtype {query.dtype}"
+            )
+        if len(candidates) == 1 or not self.tuning:
+            backend = candidates[0]
+        else:
+            backend = self._autotune(
+                candidates, query, key, value, attention_mask
+            )
+            logger.info(
+                f"Attention backend for batch, query tokens, key tokens, "
+                f"heads, head_dim {shape_key[:5]} in {query.dtype}: "
+                f"{backend.name}"
+            )
+        self._decisions[shape_key] = (
+            backend.name, self.tuning or len(candidates) == 1
+        )
+        return backend
+
+    def _autotune(
+        self,
+        candidates: List[AttentionBackend],
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> AttentionBackend:
+        best, best_time = None, float("inf")
+        for backend in candidates:
+            try:
+                elapsed = self._measure(
+                    backend, query, key, value, attention_mask
+                )
+            except RuntimeError as e:
+                logger.warning(
+                    f"Attention backend {backend.name} failed on "
+                    f"{tuple(query.shape)}, skipping it: {e}"
+                )
+                continue
+            if elapsed < best_time:
+                best, best_time = backend, elapsed
+        return best if best is not None else candidates[0]
+
+    def _measure(
+        self,
+        backend: AttentionBackend,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> float:
+        with torch.no_grad():
+            backend.func(query, key, value, attention_mask)
+            if query.is_cuda:
+                torch.cuda.synchronize(query.device)
+            start = time.perf_counter()
+            for _ in range(self.iters):
+                backend.func(query, key, value, attention_mask)
+            if query.is_cuda:
+                torch.cuda.synchronize(query.device)
+        return (time.perf_counter() - start) / self.iters
+
+    def __call__(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        return self.select(query, key, value, attention_mask).func(
+            query, key, value, attention_mask
+        )
+
+
+ATTENTION_BACKEND_SELECTOR = AttentionBackendSelector()
+
+
+@contextmanager
+def attention_backend_autotuning():
+    """Measure the backends of the attention shapes first seen inside."""
+    tuning = ATTENTION_BACKEND_SELECTOR.tuning
+    ATTENTION_BACKEND_SELECTOR.tuning = True
+    try:
+        yield ATTENTION_BACKEND_SELECTOR
+    finally:
+        ATTENTION_BACKEND_SELECTOR.tuning = tuning
+
+
+def local_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Attention of `[batch, tokens, heads, head_dim]` inputs on this rank,
+    with the backend chosen for their shape."""
+    return ATTENTION_BACKEND_SELECTOR(query, key, value, attention_mask)
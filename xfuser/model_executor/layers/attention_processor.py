@@ -1,5 +1,5 @@
 import inspect
-from typing import Optional
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
@@ -11,7 +11,6 @@ from diffusers.models.attention_processor import (
     JointAttnProcessor2_0,
     FluxAttnProcessor2_0,
     FluxSingleAttnProcessor2_0,
-    apply_rope,
 )
 
 from xfuser.distributed import (
@@ -22,6 +21,12 @@ from xfuser.distributed import (
 from xfuser.distributed.runtime_state import get_runtime_state
 from xfuser.model_executor.layers import xFuserLayerBaseWrapper
 from xfuser.model_executor.layers import xFuserLayerWrappersRegister
+from xfuser.model_executor.layers.attention_backends import local_attention
+from xfuser.model_executor.layers.token_merging import TOKEN_MERGER
+from xfuser.model_executor.layers.kv_arena import (
+    get_stale_kv_cache,
+    write_stale_kv,
+)
 from xfuser.logger import init_logger
 from xfuser.envs import PACKAGES_CHECKER
 
@@ -32,6 +37,62 @@ HAS_LONG_CTX_ATTN = env_info["has_long_ctx_attn"]
 HAS_FLASH_ATTN = env_info["has_flash_attn"]
 
 
+class xFuserLinearSlice(nn.Module):
+    """Output features `start:end` of a fused linear layer, computed with a
+    view of its parameters. The fused layer is owned, and registered, by the
+    attention wrapper, so moving the wrapper moves the slice too."""
+
+    def __init__(self, fused: nn.Linear, start: int, end: int):
+        super().__init__()
+        # a list keeps the fused layer out of the submodules of the slice
+        self._fused = [fused]
+        self.start = start
+        self.end = end
+        self.in_features = fused.in_features
+        self.out_features = end - start
+
+    @property
+    def weight(self) -> torch.Tensor:
+        return self._fused[0].weight[self.start : self.end]
+
+    @property
+    def bias(self) -> Optional[torch.Tensor]:
+        bias = self._fused[0].bias
+        return None if bias is None else bias[self.start : self.end]
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        return F.linear(input, self.weight, self.bias)
+
+
+def _can_fuse_linears(*linears: Optional[nn.Module]) -> bool:
+    if not all(isinstance(linear, nn.Linear) for linear in linears):
+        return False
+    first = linears[0]
+    return all(
+        linear.in_features == first.in_features
+        and (linear.bias is None) == (first.bias is None)
+        and linear.weight.dtype == first.weight.dtype
+        and linear.weight.device == first.weight.device
+        for linear in linears
+    )
+
+
+def _fuse_linears(*linears: nn.Linear) -> nn.Linear:
+    first = linears[0]
+    fused = nn.Linear(
+        first.in_features,
+        sum(linear.out_features for linear in linears),
+        bias=first.bias is not None,
+        device=first.weight.device,
+        dtype=first.weight.dtype,
+    )
+    with torch.no_grad():
+        fused.weight.copy_(torch.cat([linear.weight for linear in linears]))
+        if first.bias is not None:
+            fused.bias.copy_(torch.cat([linear.bias for linear in linears]))
+    return fused
+
+
 class xFuserAttentionBaseWrapper(xFuserLayerBaseWrapper):
     def __init__(
         self,
@@ -39,6 +100,7 @@ class xFuserAttentionBaseWrapper(xFuserLayerBaseWrapper):
     ):
         super().__init__(module=attention)
 
+        to_q = self.module.to_q
         to_k = self.module.to_k
         to_v = self.module.to_v
         assert isinstance(to_k, nn.Linear)
@@ -46,23 +108,91 @@ class xFuserAttentionBaseWrapper(xFuserLayerBaseWrapper):
         assert (to_k.bias is None) == (to_v.bias is None)
         assert to_k.weight.shape == to_v.weight.shape
 
-        in_size, out_size = to_k.in_features, to_k.out_features
-        to_kv = nn.Linear(
-            in_size,
-            out_size * 2,
-            bias=to_k.bias is not None,
-            device=to_k.weight.device,
-            dtype=to_k.weight.dtype,
+        # The projections are fused into to_qkv for self attention, to_kv
+        #   otherwise. The original layers are replaced by slices of the
+        #   fused ones, so that no weight is stored twice.
+        q_size, kv_size = to_q.out_features, to_k.out_features
+        self.to_qkv = None
+        if _can_fuse_linears(to_q, to_k, to_v):
+            self.to_qkv = _fuse_linears(to_q, to_k, to_v)
+            self.module.to_q = xFuserLinearSlice(self.to_qkv, 0, q_size)
+            self.to_kv = xFuserLinearSlice(
+                self.to_qkv, q_size, q_size + 2 * kv_size
+            )
+            fused, kv_start = self.to_qkv, q_size
+        else:
+            self.to_kv = _fuse_linears(to_k, to_v)
+            fused, kv_start = self.to_kv, 0
+        self.module.to_k = xFuserLinearSlice(fused, kv_start, kv_start + kv_size)
+        self.module.to_v = xFuserLinearSlice(
+            fused, kv_start + kv_size, kv_start + 2 * kv_size
         )
-        to_kv.weight.data[:out_size].copy_(to_k.weight.data)
-        to_kv.weight.data[out_size:].copy_(to_v.weight.data)
+        self._qkv_split_sizes = [q_size, kv_size, kv_size]
 
-        if to_k.bias is not None:
-            assert to_v.bias is not None
-            to_kv.bias.data[:out_size].copy_(to_k.bias.data)
-            to_kv.bias.data[out_size:].copy_(to_v.bias.data)
+        # context projections of joint attention
+        self.add_qkv = None
+        add_projs = [
+            getattr(self.module, name, None)
+            for name in ("add_q_proj", "add_k_proj", "add_v_proj")
+        ]
+        if _can_fuse_linears(*add_projs):
+            self.add_qkv = _fuse_linears(*add_projs)
+            self._add_qkv_split_sizes = [proj.out_features for proj in add_projs]
+            add_q_size, add_k_size, add_v_size = self._add_qkv_split_sizes
+            self.module.add_q_proj = xFuserLinearSlice(self.add_qkv, 0, add_q_size)
+            self.module.add_k_proj = xFuserLinearSlice(
+                self.add_qkv, add_q_size, add_q_size + add_k_size
+            )
+            self.module.add_v_proj = xFuserLinearSlice(
+                self.add_qkv, add_q_size + add_k_size, self.add_qkv.out_features
+            )
+            self.add_kv = xFuserLinearSlice(
+                self.add_qkv, add_q_size, self.add_qkv.out_features
+            )
+
+        # set by the StaleKVArena of the stage holding this layer, if any,
+        #   with the index of the layer in it
+        self.stale_kv_arena = None
+        self.stale_kv_layer_idx = None
+
+    def project_qkv(
+        self, hidden_states: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Query, key and value of `hidden_states` with a single GEMM when
+        the projections are fused, as views of its output."""
+        if self.to_qkv is None:
+            return (
+                self.to_q(hidden_states),
+                self.to_k(hidden_states),
+                self.to_v(hidden_states),
+            )
+        return torch.split(
+            self.to_qkv(hidden_states), self._qkv_split_sizes, dim=-1
+        )
 
-        self.to_kv = to_kv
+    def project_added_qkv(
+        self, encoder_hidden_states: torch.Tensor, need_query: bool = True
+    ) -> Tuple[Optional[torch.Tensor], torch.Tensor, torch.Tensor]:
+        """Context query, key and value of joint attention, the query being
+        None unless `need_query`."""
+        if self.add_qkv is None:
+            return (
+                self.add_q_proj(encoder_hidden_states) if need_query else None,
+                self.add_k_proj(encoder_hidden_states),
+                self.add_v_proj(encoder_hidden_states),
+            )
+        if need_query:
+            return torch.split(
+                self.add_qkv(encoder_hidden_states),
+                self._add_qkv_split_sizes,
+                dim=-1,
+            )
+        key, value = torch.split(
+            self.add_kv(encoder_hidden_states),
+            self._add_qkv_split_sizes[1:],
+            dim=-1,
+        )
+        return None, key, value
 
 class xFuserAttentionProcessorRegister:
     _XFUSER_ATTENTION_PROCESSOR_MAPPING = {}
@@ -169,6 +299,7 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
         *args,
         **kwargs,
     ):
+        plan = get_runtime_state().plan
         if len(args) > 0 or kwargs.get("scale", None) is not None:
             deprecation_message = "The `scale` argument is deprecated and will be ignored. Please remove it, as passing it will raise an error in the future. `scale` should directly be passed while calling the underlying pipeline component i.e., via `cross_attention_kwargs`."
             deprecate("scale", "1.0.0", deprecation_message)
@@ -196,38 +327,45 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
+        # only the queries are merged, K/V keep every token of the stale KV
+        #   cache and of the other ranks
+        token_match = None
+        if encoder_hidden_states is None:
+            if attention_mask is None:
+                token_match = TOKEN_MERGER.match(hidden_states)
+            else:
+                # the feed forward of the block must not take the match of
+                #   a previous block
+                TOKEN_MERGER.clear()
+        if token_match is None:
+            query = attn.to_q(hidden_states)
+        else:
+            query = attn.to_q(token_match.merge(hidden_states))
 
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
         elif attn.norm_cross:
             encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        kv = attn.to_kv(encoder_hidden_states)
-
 #! ---------------------------------------- KV CACHE ----------------------------------------
         if (
-            HAS_FLASH_ATTN
-            and get_sequence_parallel_world_size() > 1
+            plan.use_long_ctx_kv_cache
             and self.use_long_ctx_attn_kvcache
         ):
+            kv = attn.to_kv(encoder_hidden_states)
             key, value = torch.chunk(kv, 2, dim=-1)
             inner_dim = key.shape[-1]
             head_dim = inner_dim // attn.heads
         else:
             # the distributed sparse attention from xfuser
-            if get_runtime_state().num_pipeline_patch == 1:
-                local_kv = kv
+            if plan.num_pipeline_patch == 1:
+                local_kv = attn.to_kv(encoder_hidden_states)
             else:
-                if not get_runtime_state().patch_mode:
-                    local_kv = kv
-                else:
-                    local_kv = attn.activation_cache
-                    token_start_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
-                    token_end_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx+1])
-                    local_kv[:, token_start_idx:token_end_idx, :] = kv
-
-                attn.activation_cache = local_kv
+                # project the fresh tokens straight into the stale KV cache
+                local_kv = get_stale_kv_cache(
+                    attn, batch_size, query.dtype, query.device
+                )
+                write_stale_kv(attn, encoder_hidden_states, local_kv)
 
             key, value = torch.split(local_kv, local_kv.shape[-1] // 2, dim=-1)
             inner_dim = key.shape[-1]
@@ -235,7 +373,7 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
 #! ---------------------------------------- KV CACHE ----------------------------------------
 
 #! ---------------------------------------- ATTENTION ----------------------------------------
-        if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
+        if plan.use_long_ctx_attn:
             query = query.view(batch_size, -1, attn.heads, head_dim)
             key = key.view(batch_size, -1, attn.heads, head_dim)
             value = value.view(batch_size, -1, attn.heads, head_dim)
@@ -245,29 +383,14 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
         else:
-            if HAS_FLASH_ATTN:
-                from flash_attn import flash_attn_func
-
-                query = query.view(batch_size, -1, attn.heads, head_dim)
-                key = key.view(batch_size, -1, attn.heads, head_dim)
-                value = value.view(batch_size, -1, attn.heads, head_dim)
-                hidden_states = flash_attn_func(
-                    query, key, value, dropout_p=0.0, causal=False
-                )
-                hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
-
-            else:
-                query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-                key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-                value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-                # the output of sdp = (batch, num_heads, seq_len, head_dim)
-                # TODO: add support for attn.module.scale when we move to Torch 2.1
-                hidden_states = F.scaled_dot_product_attention(
-                    query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-                )
-
-                hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+            query = query.view(batch_size, -1, attn.heads, head_dim)
+            key = key.view(batch_size, -1, attn.heads, head_dim)
+            value = value.view(batch_size, -1, attn.heads, head_dim)
+            # TODO: add support for attn.module.scale when we move to Torch 2.1
+            hidden_states = local_attention(
+                query, key, value, attention_mask=attention_mask
+            )
+            hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
         #! ORIGIN
         # query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
@@ -290,6 +413,8 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
         hidden_states = attn.to_out[0](hidden_states)
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
+        if token_match is not None:
+            hidden_states = token_match.unmerge(hidden_states)
 
         if attn.residual_connection:
             hidden_states = hidden_states + residual
@@ -298,6 +423,128 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
 
         return hidden_states
 
+
+def tensor_version(tensor: torch.Tensor) -> Optional[int]:
+    """Version counter of `tensor`, bumped by in-place updates, None for
+    inference tensors which have none."""
+    return None if tensor.is_inference() else tensor._version
+
+
+class xFuserCachedCrossAttnProcessor2_0(AttnProcessor2_0):
+    """AttnProcessor2_0 of a cross attention layer that keeps the K/V of the
+    encoder hidden states for as long as it is called with the same, not
+    modified in place, tensor, e.g. for every patch of every step of a
+    generation. Self attention calls fall back to AttnProcessor2_0."""
+
+    def __init__(self):
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        # the source tensor is held, so that its identity cannot be taken
+        #   over by another tensor while the K/V are cached
+        self._source = None
+        self._source_version = None
+        self._key = None
+        self._value = None
+
+    def _get_key_value(
+        self, attn: Attention, encoder_hidden_states: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if (
+            self._source is encoder_hidden_states
+            and self._source_version == tensor_version(encoder_hidden_states)
+        ):
+            self.hits += 1
+            return self._key, self._value
+        self.misses += 1
+        source = encoder_hidden_states
+        batch_size = encoder_hidden_states.shape[0]
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(
+                encoder_hidden_states
+            )
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+        head_dim = key.shape[-1] // attn.heads
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+        self._source, self._source_version = source, tensor_version(source)
+        self._key, self._value = key, value
+        return key, value
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        temb: Optional[torch.Tensor] = None,
+        *args,
+        **kwargs,
+    ) -> torch.Tensor:
+        if encoder_hidden_states is None:
+            return super().__call__(
+                attn, hidden_states, None, attention_mask, temb, *args, **kwargs
+            )
+
+        residual = hidden_states
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = encoder_hidden_states.shape
+
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            # scaled_dot_product_attention expects attention_mask shape to be
+            # (batch, heads, source_length, target_length)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+        key, value = self._get_key_value(attn, encoder_hidden_states)
+        head_dim = key.shape[-1]
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+
+        hidden_states = local_attention(
+            query.transpose(1, 2),
+            key.transpose(1, 2),
+            value.transpose(1, 2),
+            attention_mask=attention_mask,
+        )
+        hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
 @xFuserAttentionProcessorRegister.register(JointAttnProcessor2_0)
 class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
     def __init__(self):
@@ -323,6 +570,7 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
         *args,
         **kwargs,
     ) -> torch.FloatTensor:
+        plan = get_runtime_state().plan
         residual = hidden_states
 
         input_ndim = hidden_states.ndim
@@ -336,60 +584,62 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
 
         batch_size = encoder_hidden_states.shape[0]
 
-        # `sample` projections.
-        query = attn.to_q(hidden_states)
-        key = attn.to_k(hidden_states)
-        value = attn.to_v(hidden_states)
-
-
 #! ---------------------------------------- KV CACHE ----------------------------------------
         # if use sp, use the kvcache inside long_context_attention
         if (
-            HAS_FLASH_ATTN
-            and get_sequence_parallel_world_size() > 1
-            and self.use_long_ctx_attn_kvcache
+            (
+                plan.use_long_ctx_kv_cache
+                and self.use_long_ctx_attn_kvcache
+            )
+            or plan.num_pipeline_patch == 1
         ):
-            pass
+            # `sample` projections.
+            query, key, value = attn.project_qkv(hidden_states)
         else:
-            kv = torch.cat([key, value], dim=-1)
-            if get_runtime_state().num_pipeline_patch == 1:
-                local_kv = kv
-            else:
-                if not get_runtime_state().patch_mode:
-                    local_kv = kv
-                else:
-                    local_kv = attn.activation_cache
-                    token_start_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
-                    token_end_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx+1])
-                    local_kv[:, token_start_idx:token_end_idx, :] = kv
-
-                attn.activation_cache = local_kv
-
+            # `sample` projections, the fresh tokens of K/V go straight into
+            #   the stale KV cache
+            query = attn.to_q(hidden_states)
+            local_kv = get_stale_kv_cache(
+                attn, batch_size, query.dtype, query.device
+            )
+            write_stale_kv(attn, hidden_states, local_kv)
             key, value = torch.split(local_kv, local_kv.shape[-1] // 2, dim=-1)
 #! ---------------------------------------- KV CACHE ----------------------------------------
 
+        # only the queries are merged, K/V keep every token of the stale KV
+        #   cache and of the other ranks. Merging averages tokens, so merging
+        #   the projected queries is merging the tokens before to_q
+        token_match = TOKEN_MERGER.match(hidden_states)
+        if token_match is not None:
+            query = token_match.merge(query)
+        num_query_tokens = query.shape[1]
+
         # `context` projections.
-        if get_runtime_state().pipeline_patch_idx == 0:
-            encoder_hidden_states_query_proj = attn.add_q_proj(encoder_hidden_states)
-        encoder_hidden_states_key_proj = attn.add_k_proj(encoder_hidden_states)
-        encoder_hidden_states_value_proj = attn.add_v_proj(encoder_hidden_states)
+        (
+            encoder_hidden_states_query_proj,
+            encoder_hidden_states_key_proj,
+            encoder_hidden_states_value_proj,
+        ) = attn.project_added_qkv(
+            encoder_hidden_states,
+            need_query=plan.is_first_patch,
+        )
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
 
 #! ---------------------------------------- ATTENTION ----------------------------------------
-        if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
+        if plan.use_long_ctx_attn:
             query = query.view(batch_size, -1, attn.heads, head_dim)
             key = key.view(batch_size, -1, attn.heads, head_dim)
             value = value.view(batch_size, -1, attn.heads, head_dim)
-            if get_runtime_state().pipeline_patch_idx == 0:
+            if plan.is_first_patch:
                 encoder_hidden_states_query_proj = encoder_hidden_states_query_proj.view(batch_size, -1, attn.heads, head_dim)
             encoder_hidden_states_key_proj = encoder_hidden_states_key_proj.view(batch_size, -1, attn.heads, head_dim)
             encoder_hidden_states_value_proj = encoder_hidden_states_value_proj.view(batch_size, -1, attn.heads, head_dim)
             hidden_states = self.hybrid_seq_parallel_attn(
                 query, key, value, dropout_p=0.0, causal=False,
                 joint_tensor_query=encoder_hidden_states_query_proj
-                if get_runtime_state().pipeline_patch_idx == 0
+                if plan.is_first_patch
                 else None,
                 joint_tensor_key=encoder_hidden_states_key_proj,
                 joint_tensor_value=encoder_hidden_states_value_proj,
@@ -397,34 +647,19 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
         else:
-            if get_runtime_state().pipeline_patch_idx == 0:
+            if plan.is_first_patch:
                 query = torch.cat([query, encoder_hidden_states_query_proj], dim=1)
             key = torch.cat([key, encoder_hidden_states_key_proj], dim=1)
             value = torch.cat([value, encoder_hidden_states_value_proj], dim=1)
 
-            if HAS_FLASH_ATTN:
-                from flash_attn import flash_attn_func
-
-                query = query.view(batch_size, -1, attn.heads, head_dim)
-                key = key.view(batch_size, -1, attn.heads, head_dim)
-                value = value.view(batch_size, -1, attn.heads, head_dim)
-                hidden_states = flash_attn_func(
-                    query, key, value, dropout_p=0.0, causal=False
-                )
-                hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
-
-            else:
-                query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-                key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-                value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-                # the output of sdp = (batch, num_heads, seq_len, head_dim)
-                # TODO: add support for attn.module.scale when we move to Torch 2.1
-                hidden_states = F.scaled_dot_product_attention(
-                    query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-                )
-
-                hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+            query = query.view(batch_size, -1, attn.heads, head_dim)
+            key = key.view(batch_size, -1, attn.heads, head_dim)
+            value = value.view(batch_size, -1, attn.heads, head_dim)
+            # TODO: add support for attn.module.scale when we move to Torch 2.1
+            hidden_states = local_attention(
+                query, key, value, attention_mask=attention_mask
+            )
+            hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
         #! ORIGIN
         # query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
@@ -439,16 +674,18 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
         hidden_states = hidden_states.to(query.dtype)
 
         # Split the attention outputs.
-        if get_runtime_state().pipeline_patch_idx == 0:
+        if plan.is_first_patch:
             hidden_states, encoder_hidden_states = (
-                hidden_states[:, : residual.shape[1]],
-                hidden_states[:, residual.shape[1] :],
+                hidden_states[:, :num_query_tokens],
+                hidden_states[:, num_query_tokens:],
             )
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states)
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
+        if token_match is not None:
+            hidden_states = token_match.unmerge(hidden_states)
         if not attn.context_pre_only:
             encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
 
@@ -459,12 +696,41 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
 
         return hidden_states, encoder_hidden_states
 
+
+def apply_rope_to(x: torch.Tensor, freqs_cis: torch.Tensor) -> torch.Tensor:
+    """`apply_rope` of diffusers for a single tensor, so that queries and keys
+    of different lengths can be rotated by their own positions."""
+    x_ = x.float().reshape(*x.shape[:-1], -1, 1, 2)
+    x_out = freqs_cis[..., 0] * x_[..., 0] + freqs_cis[..., 1] * x_[..., 1]
+    return x_out.reshape(*x.shape).type_as(x)
+
+
+def get_flux_rotary_embs(
+    image_rotary_emb: torch.Tensor,
+    num_joint_tokens: int,
+    use_stale_kv: bool,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Rotary embeddings of the joint tokens, of the image queries and of the
+    image keys of the current forward, out of the ones of the joint tokens
+    followed by every image token of this rank.
+
+    The image keys cover every image token when they come from the stale KV
+    cache, the tokens of the current forward otherwise.
+    """
+    plan = get_runtime_state().plan
+    joint_emb = image_rotary_emb[:, :, :num_joint_tokens]
+    image_emb = image_rotary_emb[:, :, num_joint_tokens:]
+    query_emb = image_emb[:, :, plan.token_start : plan.token_end]
+    key_emb = image_emb if use_stale_kv else query_emb
+    return joint_emb, query_emb, key_emb
+
+
 @xFuserAttentionProcessorRegister.register(FluxAttnProcessor2_0)
 class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
     """Attention processor used typically in processing the SD3-like self-attention projections."""
     def __init__(self):
         super().__init__()
-        self.use_long_ctx_attn_kvcache = False
+        self.use_long_ctx_attn_kvcache = True
         if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
             from yunchang import UlyssesAttention
             from xfuser.modules.long_context_attention import xFuserFluxLongContextAttention
@@ -484,6 +750,7 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
         attention_mask: Optional[torch.FloatTensor] = None,
         image_rotary_emb: Optional[torch.Tensor] = None,
     ) -> torch.FloatTensor:
+        plan = get_runtime_state().plan
         input_ndim = hidden_states.ndim
         if input_ndim == 4:
             batch_size, channel, height, width = hidden_states.shape
@@ -495,34 +762,26 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
 
         batch_size = encoder_hidden_states.shape[0]
 
-        # `sample` projections.
-        query = attn.to_q(hidden_states)
-        key = attn.to_k(hidden_states)
-        value = attn.to_v(hidden_states)
-
 #! ---------------------------------------- KV CACHE ----------------------------------------
         # if use sp, use the kvcache inside long_context_attention
-        if (
-            HAS_FLASH_ATTN
-            and get_sequence_parallel_world_size() > 1
-            and self.use_long_ctx_attn_kvcache
-        ):
-            pass
+        use_stale_kv = not (
+            (
+                plan.use_long_ctx_kv_cache
+                and self.use_long_ctx_attn_kvcache
+            )
+            or plan.num_pipeline_patch == 1
+        )
+        if not use_stale_kv:
+            # `sample` projections.
+            query, key, value = attn.project_qkv(hidden_states)
         else:
-            kv = torch.cat([key, value], dim=-1)
-            if get_runtime_state().num_pipeline_patch == 1:
-                local_kv = kv
-            else:
-                if not get_runtime_state().patch_mode:
-                    local_kv = kv
-                else:
-                    local_kv = attn.activation_cache
-                    token_start_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
-                    token_end_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx+1])
-                    local_kv[:, token_start_idx:token_end_idx, :] = kv
-
-                attn.activation_cache = local_kv
-
+            # `sample` projections, the fresh tokens of K/V go straight into
+            #   the stale KV cache
+            query = attn.to_q(hidden_states)
+            local_kv = get_stale_kv_cache(
+                attn, batch_size, query.dtype, query.device
+            )
+            write_stale_kv(attn, hidden_states, local_kv)
             key, value = torch.split(local_kv, local_kv.shape[-1] // 2, dim=-1)
 #! ---------------------------------------- KV CACHE ----------------------------------------
 
@@ -538,14 +797,21 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
         if attn.norm_k is not None:
             key = attn.norm_k(key)
 
-        # `context` projections.
-        encoder_hidden_states_query_proj = attn.add_q_proj(encoder_hidden_states)
-        encoder_hidden_states_key_proj = attn.add_k_proj(encoder_hidden_states)
-        encoder_hidden_states_value_proj = attn.add_v_proj(encoder_hidden_states)
+        # `context` projections, the context stream is only updated with the
+        #   first patch of a step
+        (
+            encoder_hidden_states_query_proj,
+            encoder_hidden_states_key_proj,
+            encoder_hidden_states_value_proj,
+        ) = attn.project_added_qkv(
+            encoder_hidden_states,
+            need_query=plan.is_first_patch,
+        )
 
-        encoder_hidden_states_query_proj = encoder_hidden_states_query_proj.view(
-            batch_size, -1, attn.heads, head_dim
-        ).transpose(1, 2)
+        if plan.is_first_patch:
+            encoder_hidden_states_query_proj = encoder_hidden_states_query_proj.view(
+                batch_size, -1, attn.heads, head_dim
+            ).transpose(1, 2)
         encoder_hidden_states_key_proj = encoder_hidden_states_key_proj.view(
             batch_size, -1, attn.heads, head_dim
         ).transpose(1, 2)
@@ -553,78 +819,69 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
             batch_size, -1, attn.heads, head_dim
         ).transpose(1, 2)
 
-        if attn.norm_added_q is not None:
+        if attn.norm_added_q is not None and plan.is_first_patch:
             encoder_hidden_states_query_proj = attn.norm_added_q(encoder_hidden_states_query_proj)
         if attn.norm_added_k is not None:
             encoder_hidden_states_key_proj = attn.norm_added_k(encoder_hidden_states_key_proj)
 
-        # attention
-        num_encoder_hidden_states_tokens = encoder_hidden_states_query_proj.shape[2]
-        num_query_tokens = query.shape[2]
-        query = torch.cat([encoder_hidden_states_query_proj, query], dim=2)
-        key = torch.cat([encoder_hidden_states_key_proj, key], dim=2)
-        value = torch.cat([encoder_hidden_states_value_proj, value], dim=2)
-
+        num_encoder_hidden_states_tokens = encoder_hidden_states_key_proj.shape[2]
         if image_rotary_emb is not None:
-            # YiYi to-do: update uising apply_rotary_emb
-            # from ..embeddings import apply_rotary_emb
-            # query = apply_rotary_emb(query, image_rotary_emb)
-            # key = apply_rotary_emb(key, image_rotary_emb)
-            query, key = apply_rope(query, key, image_rotary_emb)
-
-#! ---------------------------------------- ATTENTION ----------------------------------------
-        if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
-            query = query.transpose(1,2)
-            key = key.transpose(1,2)
-            value = value.transpose(1,2)
-            encoder_hidden_states_query_proj, query = query.split(
-                [num_encoder_hidden_states_tokens, num_query_tokens], dim=1
+            # the joint and image tokens are rotated apart, the image keys
+            #   may cover more tokens than the queries
+            joint_emb, query_emb, key_emb = get_flux_rotary_embs(
+                image_rotary_emb, num_encoder_hidden_states_tokens, use_stale_kv
             )
-            encoder_hidden_states_key_proj, key = key.split(
-                [num_encoder_hidden_states_tokens, num_query_tokens], dim=1
-            )
-            encoder_hidden_states_value_proj, value = value.split(
-                [num_encoder_hidden_states_tokens, num_query_tokens], dim=1
+            query = apply_rope_to(query, query_emb)
+            key = apply_rope_to(key, key_emb)
+            if plan.is_first_patch:
+                encoder_hidden_states_query_proj = apply_rope_to(
+                    encoder_hidden_states_query_proj, joint_emb
+                )
+            encoder_hidden_states_key_proj = apply_rope_to(
+                encoder_hidden_states_key_proj, joint_emb
             )
+
+#! ---------------------------------------- ATTENTION ----------------------------------------
+        if plan.use_long_ctx_attn:
             hidden_states = self.hybrid_seq_parallel_attn(
-                query, key, value, dropout_p=0.0, causal=False,
-                joint_tensor_query=encoder_hidden_states_query_proj
-                if get_runtime_state().pipeline_patch_idx == 0
+                query.transpose(1, 2),
+                key.transpose(1, 2),
+                value.transpose(1, 2),
+                dropout_p=0.0,
+                causal=False,
+                joint_tensor_query=encoder_hidden_states_query_proj.transpose(1, 2)
+                if plan.is_first_patch
                 else None,
-                joint_tensor_key=encoder_hidden_states_key_proj,
-                joint_tensor_value=encoder_hidden_states_value_proj,
+                joint_tensor_key=encoder_hidden_states_key_proj.transpose(1, 2),
+                joint_tensor_value=encoder_hidden_states_value_proj.transpose(1, 2),
             )
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
         else:
-            if HAS_FLASH_ATTN:
-                from flash_attn import flash_attn_func
-
-                query = query.transpose(1,2)
-                key = key.transpose(1,2)
-                value = value.transpose(1,2)
-                hidden_states = flash_attn_func(
-                    query, key, value, dropout_p=0.0, causal=False
-                )
-                hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
-            else:
-                hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
-                hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+            if plan.is_first_patch:
+                query = torch.cat([encoder_hidden_states_query_proj, query], dim=2)
+            key = torch.cat([encoder_hidden_states_key_proj, key], dim=2)
+            value = torch.cat([encoder_hidden_states_value_proj, value], dim=2)
+            hidden_states = local_attention(
+                query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2)
+            )
+            hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 #! ---------------------------------------- ATTENTION ----------------------------------------
 
         hidden_states = hidden_states.to(query.dtype)
 
-        if get_runtime_state().pipeline_patch_idx == 0:
+        if plan.is_first_patch:
             encoder_hidden_states, hidden_states = (
-                hidden_states[:, : encoder_hidden_states.shape[1]],
-                hidden_states[:, encoder_hidden_states.shape[1] :],
+                hidden_states[:, :num_encoder_hidden_states_tokens],
+                hidden_states[:, num_encoder_hidden_states_tokens:],
             )
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states)
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
-        encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+        if plan.is_first_patch:
+            encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
 
         if input_ndim == 4:
             hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
@@ -637,11 +894,15 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
 class xFuserFluxSingleAttnProcessor2_0(FluxSingleAttnProcessor2_0):
     r"""
     Processor for implementing scaled dot-product attention (enabled by default if you're using PyTorch 2.0).
+
+    The input of the single stream blocks of Flux is the joint tokens followed
+    by the image tokens of the current forward. Only the image tokens go
+    through the stale KV cache, the joint ones are projected on every call.
     """
 
     def __init__(self):
         super().__init__()
-        self.use_long_ctx_attn_kvcache = False
+        self.use_long_ctx_attn_kvcache = True
         if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
             from yunchang import UlyssesAttention
             from xfuser.modules.long_context_attention import xFuserFluxLongContextAttention
@@ -661,82 +922,95 @@ class xFuserFluxSingleAttnProcessor2_0(FluxSingleAttnProcessor2_0):
         attention_mask: Optional[torch.FloatTensor] = None,
         image_rotary_emb: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
+        plan = get_runtime_state().plan
         input_ndim = hidden_states.ndim
 
         if input_ndim == 4:
             batch_size, channel, height, width = hidden_states.shape
             hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
 
-        batch_size, _, _ = hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
-
-        query = attn.to_q(hidden_states)
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
-
-        inner_dim = key.shape[-1]
-        head_dim = inner_dim // attn.heads
-
-        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        batch_size = hidden_states.shape[0]
+        num_image_tokens = plan.token_end - plan.token_start
+        num_joint_tokens = hidden_states.shape[1] - num_image_tokens
 
 #! ---------------------------------------- KV CACHE ----------------------------------------
         # if use sp, use the kvcache inside long_context_attention
-        if (
-            HAS_FLASH_ATTN
-            and get_sequence_parallel_world_size() > 1
-            and self.use_long_ctx_attn_kvcache
-        ):
-            pass
+        use_stale_kv = not (
+            (
+                plan.use_long_ctx_kv_cache
+                and self.use_long_ctx_attn_kvcache
+            )
+            or plan.num_pipeline_patch == 1
+        )
+        if not use_stale_kv:
+            query, key, value = attn.project_qkv(hidden_states)
+            joint_key, key = key.split([num_joint_tokens, num_image_tokens], dim=1)
+            joint_value, value = value.split(
+                [num_joint_tokens, num_image_tokens], dim=1
+            )
         else:
-            kv = torch.cat([key, value], dim=-1)
-            if get_runtime_state().num_pipeline_patch == 1:
-                local_kv = kv
-            else:
-                if not get_runtime_state().patch_mode:
-                    local_kv = kv
-                else:
-                    local_kv = attn.activation_cache
-                    token_start_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
-                    token_end_idx = sum(get_runtime_state().pp_patches_token_num[:get_runtime_state().pipeline_patch_idx+1])
-                    local_kv[:, token_start_idx:token_end_idx, :] = kv
-
-                attn.activation_cache = local_kv
-
+            # cache the image tokens along the tokens, before the heads are
+            #   split out
+            query = attn.to_q(hidden_states)
+            local_kv = get_stale_kv_cache(
+                attn, batch_size, query.dtype, query.device
+            )
+            write_stale_kv(attn, hidden_states[:, num_joint_tokens:], local_kv)
             key, value = torch.split(local_kv, local_kv.shape[-1] // 2, dim=-1)
+            joint_kv = attn.to_kv(hidden_states[:, :num_joint_tokens])
+            joint_key, joint_value = torch.split(
+                joint_kv, joint_kv.shape[-1] // 2, dim=-1
+            )
+        joint_query, query = query.split([num_joint_tokens, num_image_tokens], dim=1)
 #! ---------------------------------------- KV CACHE ----------------------------------------
 
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query, key, value, joint_query, joint_key, joint_value = (
+            tensor.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            for tensor in (query, key, value, joint_query, joint_key, joint_value)
+        )
+
         if attn.norm_q is not None:
             query = attn.norm_q(query)
+            joint_query = attn.norm_q(joint_query)
         if attn.norm_k is not None:
             key = attn.norm_k(key)
+            joint_key = attn.norm_k(joint_key)
 
         # Apply RoPE if needed
         if image_rotary_emb is not None:
-            # YiYi to-do: update uising apply_rotary_emb
-            # from ..embeddings import apply_rotary_emb
-            # query = apply_rotary_emb(query, image_rotary_emb)
-            # key = apply_rotary_emb(key, image_rotary_emb)
-            query, key = apply_rope(query, key, image_rotary_emb)
+            joint_emb, query_emb, key_emb = get_flux_rotary_embs(
+                image_rotary_emb, num_joint_tokens, use_stale_kv
+            )
+            query = apply_rope_to(query, query_emb)
+            key = apply_rope_to(key, key_emb)
+            joint_query = apply_rope_to(joint_query, joint_emb)
+            joint_key = apply_rope_to(joint_key, joint_emb)
 
 #! ---------------------------------------- ATTENTION ----------------------------------------
-        if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
-            query = query.transpose(1,2)
-            key = key.transpose(1,2)
-            value = value.transpose(1,2)
+        if plan.use_long_ctx_attn:
             hidden_states = self.hybrid_seq_parallel_attn(
-                query, key, value, dropout_p=0.0, causal=False
+                query.transpose(1, 2),
+                key.transpose(1, 2),
+                value.transpose(1, 2),
+                dropout_p=0.0,
+                causal=False,
+                joint_tensor_query=joint_query.transpose(1, 2),
+                joint_tensor_key=joint_key.transpose(1, 2),
+                joint_tensor_value=joint_value.transpose(1, 2),
             )
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
         else:
-            # the output of sdp = (batch, num_heads, seq_len, head_dim)
+            query = torch.cat([joint_query, query], dim=2)
+            key = torch.cat([joint_key, key], dim=2)
+            value = torch.cat([joint_value, value], dim=2)
             # TODO: add support for attn.scale when we move to Torch 2.1
-            hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
-            hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+            hidden_states = local_attention(
+                query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2)
+            )
+            hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
 #! ---------------------------------------- ATTENTION ----------------------------------------
 
@@ -745,4 +1019,4 @@ class xFuserFluxSingleAttnProcessor2_0(FluxSingleAttnProcessor2_0):
         if input_ndim == 4:
             hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
 
-        return hidden_states
\ No newline at end of file
+        return hidden_states
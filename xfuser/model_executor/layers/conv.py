@@ -39,10 +39,9 @@ class xFuserConv2dWrapper(xFuserLayerBaseWrapper):
         stride = self.module.stride[0]
         padding = self.module.padding[0]
 
-        idx = get_runtime_state().pipeline_patch_idx
-        pp_patches_start_idx_local = get_runtime_state().pp_patches_start_idx_local
-        h_begin = pp_patches_start_idx_local[idx] - padding
-        h_end = pp_patches_start_idx_local[idx + 1] + padding
+        plan = get_runtime_state().plan
+        h_begin = plan.latent_start - padding
+        h_end = plan.latent_end + padding
         final_padding = [padding, padding, 0, 0]
         if h_begin < 0:
             h_begin = 0
@@ -73,7 +72,8 @@ class xFuserConv2dWrapper(xFuserLayerBaseWrapper):
             output = self.naive_forward(x)
         else:
             if self.is_first_layer:
-                if not get_runtime_state().patch_mode or get_runtime_state().num_pipeline_patch == 1:
+                plan = get_runtime_state().plan
+                if not plan.patch_mode or plan.num_pipeline_patch == 1:
                     self.activation_cache = x
                     output = self.naive_forward(self.activation_cache)
                 else:
@@ -82,7 +82,7 @@ class xFuserConv2dWrapper(xFuserLayerBaseWrapper):
                             [
                                 x.shape[0],
                                 x.shape[1],
-                                get_runtime_state().pp_patches_start_idx_local[-1],
+                                get_runtime_state().execution_plan.sync.latent_end,
                                 x.shape[3],
                             ],
                             dtype=x.dtype,
@@ -92,8 +92,7 @@ class xFuserConv2dWrapper(xFuserLayerBaseWrapper):
                     self.activation_cache[
                         :,
                         :,
-                        get_runtime_state().pp_patches_start_idx_local[get_runtime_state().pipeline_patch_idx]: 
-                        get_runtime_state().pp_patches_start_idx_local[get_runtime_state().pipeline_patch_idx+1],
+                        plan.latent_start:plan.latent_end,
                         :,
                     ] = x
                     output = self.sliced_forward(self.activation_cache)
@@ -76,8 +76,9 @@ class xFuserPatchEmbedWrapper(xFuserLayerBaseWrapper):
                 pos_embed = self.module.pos_embed
         b, c, h = pos_embed.shape
 
-        if get_runtime_state().patch_mode:
-            start, end = get_runtime_state().pp_patches_token_start_end_idx[get_runtime_state().pipeline_patch_idx]
+        pos_embed_token_ranges = get_runtime_state().plan.pos_embed_token_ranges
+        if len(pos_embed_token_ranges) == 1:
+            start, end = pos_embed_token_ranges[0]
             pos_embed = pos_embed[
                 :, 
                 start:end,
@@ -85,13 +86,8 @@ class xFuserPatchEmbedWrapper(xFuserLayerBaseWrapper):
             ]
         else:
             pos_embed_list = [
-                pos_embed[
-                    :,
-                    get_runtime_state().pp_patches_token_start_end_idx[i][0]:
-                    get_runtime_state().pp_patches_token_start_end_idx[i][1],
-                    :,
-                ]
-                for i in range(get_runtime_state().num_pipeline_patch)
+                pos_embed[:, start:end, :]
+                for start, end in pos_embed_token_ranges
             ]
             pos_embed = torch.cat(pos_embed_list, dim=1)
 
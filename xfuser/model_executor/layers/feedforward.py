@@ -0,0 +1,28 @@
+import torch
+
+from diffusers.models.attention import FeedForward
+from xfuser.model_executor.layers import xFuserLayerBaseWrapper
+from xfuser.model_executor.layers import xFuserLayerWrappersRegister
+from xfuser.model_executor.layers.token_merging import TOKEN_MERGER
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+
+@xFuserLayerWrappersRegister.register(FeedForward)
+class xFuserFeedForwardWrapper(xFuserLayerBaseWrapper):
+    """Runs the feed forward of a block on the tokens merged by the self
+    attention of the block, the outputs are unmerged back to every token."""
+
+    def __init__(
+        self,
+        feed_forward: FeedForward,
+    ):
+        super().__init__(module=feed_forward,)
+
+    def forward(self, hidden_states: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        token_match = TOKEN_MERGER.get_match(hidden_states)
+        if token_match is None:
+            return self.module(hidden_states, *args, **kwargs)
+        hidden_states = self.module(token_match.merge(hidden_states), *args, **kwargs)
+        return token_match.unmerge(hidden_states)
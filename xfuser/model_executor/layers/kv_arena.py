@@ -0,0 +1,192 @@
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from xfuser.distributed.runtime_state import get_runtime_state
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+
+class StaleKVArena:
+    """Stale K/V of every attention layer of a pipeline stage in a single
+    buffer.
+
+    Each layer gets a `[batch, tokens, 2 * inner_dim]` view of the buffer as
+    its `activation_cache`, K in the first half of the last dim, V in the
+    second. The views are laid out for the input size of the runtime state
+    on the first request after a `reset` or a change of that size; the
+    buffer only grows, so going back to a smaller size allocates nothing.
+    """
+
+    def __init__(self, layers: Optional[List[nn.Module]] = None):
+        self.layers: List[nn.Module] = []
+        self.buffer: Optional[torch.Tensor] = None
+        self._layout_key: Optional[Tuple] = None
+        self.reset(layers)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the arena buffer."""
+        if self.buffer is None:
+            return 0
+        return self.buffer.numel() * self.buffer.element_size()
+
+    @property
+    def used_bytes(self) -> int:
+        """Bytes covered by the views of the current input size."""
+        if self._layout_key is None:
+            return 0
+        batch_size, num_tokens, _, _ = self._layout_key
+        return (
+            batch_size
+            * num_tokens
+            * self._kv_dim_sum()
+            * self.buffer.element_size()
+        )
+
+    def reset(self, layers: Optional[List[nn.Module]] = None):
+        """Drop the views of the layers, and replace the layers if given.
+        The buffer is kept for the next layout."""
+        if layers is not None:
+            for layer in self.layers:
+                layer.stale_kv_arena = None
+                layer.stale_kv_layer_idx = None
+            self.layers = list(layers)
+            for layer_idx, layer in enumerate(self.layers):
+                layer.stale_kv_arena = self
+                layer.stale_kv_layer_idx = layer_idx
+        for layer in self.layers:
+            layer.activation_cache = None
+        self._layout_key = None
+
+    def release(self):
+        self.reset()
+        self.buffer = None
+
+    def cache(
+        self,
+        layer: nn.Module,
+        batch_size: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ) -> torch.Tensor:
+        """The view of `layer`, laid out for the current input size."""
+        num_tokens = get_runtime_state().plan.num_tokens
+        key = (batch_size, num_tokens, dtype, device)
+        if key != self._layout_key:
+            self._layout(*key)
+        return layer.activation_cache
+
+    def _kv_dim_sum(self) -> int:
+        return sum(layer.to_kv.out_features for layer in self.layers)
+
+    def _layout(
+        self,
+        batch_size: int,
+        num_tokens: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ):
+        numel = batch_size * num_tokens * self._kv_dim_sum()
+        if (
+            self.buffer is None
+            or self.buffer.numel() < numel
+            or self.buffer.dtype != dtype
+            or self.buffer.device != device
+        ):
+            # free the old buffer before allocating the new one
+            self.buffer = None
+            self.buffer = torch.empty(numel, dtype=dtype, device=device)
+            logger.info(
+                f"Stale KV arena of {len(self.layers)} attention layers "
+                f"allocated: {self.nbytes / 2**20:.2f} MB"
+            )
+        offset = 0
+        for layer in self.layers:
+            size = batch_size * num_tokens * layer.to_kv.out_features
+            layer.activation_cache = self.buffer[offset : offset + size].view(
+                batch_size, num_tokens, layer.to_kv.out_features
+            )
+            offset += size
+        self._layout_key = (batch_size, num_tokens, dtype, device)
+
+
+def get_stale_kv_cache(
+    attn: nn.Module,
+    batch_size: int,
+    dtype: torch.dtype,
+    device: torch.device,
+) -> torch.Tensor:
+    """Full-size stale K/V cache of `attn`, a view of its stage arena, or a
+    tensor of its own if it is not part of one."""
+    if attn.stale_kv_arena is not None:
+        return attn.stale_kv_arena.cache(attn, batch_size, dtype, device)
+    shape = (
+        batch_size,
+        get_runtime_state().plan.num_tokens,
+        attn.to_kv.out_features,
+    )
+    cache = attn.activation_cache
+    if (
+        cache is None
+        or cache.shape != shape
+        or cache.dtype != dtype
+        or cache.device != device
+    ):
+        cache = torch.empty(shape, dtype=dtype, device=device)
+        attn.activation_cache = cache
+    return cache
+
+
+def get_stale_kv_slot(attn: nn.Module, cache: torch.Tensor) -> torch.Tensor:
+    """Part of `cache` written by the current forward: the tokens of the
+    current pipeline patch in patch mode, all of them otherwise."""
+    plan = get_runtime_state().plan
+    if not plan.patch_mode:
+        return cache
+    return cache[:, plan.token_start : plan.token_end]
+
+
+def write_stale_kv(
+    attn: nn.Module, input: torch.Tensor, cache: torch.Tensor
+) -> torch.Tensor:
+    """Project `input` with `attn.to_kv` into the slot of the current
+    forward in `cache`. With the drift monitor of the runtime state enabled,
+    the K/V it replaces, stale by one step, is measured against it first.
+    Synchronous steps rewrite the whole map over the K/V of the previous
+    step too and are measured as well, but for the first step."""
+    runtime_state = get_runtime_state()
+    slot = get_stale_kv_slot(attn, cache)
+    monitor = runtime_state.kv_drift_monitor
+    if (
+        monitor.enabled
+        and (runtime_state.plan.patch_mode or runtime_state.step_idx > 0)
+        and attn.stale_kv_layer_idx is not None
+    ):
+        fresh = attn.to_kv(input)
+        monitor.record(
+            attn.stale_kv_layer_idx, runtime_state.step_idx, slot, fresh
+        )
+        slot.copy_(fresh)
+        return cache
+    linear_into(attn.to_kv, input, slot)
+    return cache
+
+
+def linear_into(
+    linear: nn.Linear, input: torch.Tensor, out: torch.Tensor
+) -> torch.Tensor:
+    """`linear(input)` written to `out`, directly by the matmul when both are
+    contiguous."""
+    if out.is_contiguous() and input.is_contiguous():
+        input_2d = input.view(-1, input.shape[-1])
+        out_2d = out.view(-1, out.shape[-1])
+        if linear.bias is None:
+            torch.mm(input_2d, linear.weight.t(), out=out_2d)
+        else:
+            torch.addmm(linear.bias, input_2d, linear.weight.t(), out=out_2d)
+    else:
+        out.copy_(linear(input))
+    return out
@@ -0,0 +1,221 @@
+"""
+Token merging (ToMe) of the image tokens of the transformer blocks.
+
+The self attention of a block matches its image tokens by bipartite soft
+matching: the tokens are split into destinations, one per `stride x stride`
+cell of the token grid, and sources, the rest. The sources most similar to
+a destination are averaged into it. The queries of the attention and the
+input of the feed forward of the block are merged, their outputs unmerged
+back to every token. Keys and values are left whole, so that the stale KV
+cache of PipeFusion and the sequence parallel attention see every token.
+
+Tokens are matched within the tokens of a forward, that is within the
+pipeline patch and the sequence parallel shard of the rank.
+"""
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from xfuser.distributed.runtime_state import get_runtime_state
+
+TOKEN_MERGING_SCHEDULES = ["constant", "linear"]
+
+
+def get_token_grid_partition(
+    height: int, width: int, stride: int, device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Indices of the source and destination tokens of a row-major
+    `height x width` token grid, the destination being the first token of
+    every complete `stride x stride` cell."""
+    is_src = torch.ones(height, width, dtype=torch.bool, device=device)
+    cell_rows = height // stride * stride
+    cell_cols = width // stride * stride
+    is_src[:cell_rows:stride, :cell_cols:stride] = False
+    is_src = is_src.flatten()
+    src_idx = torch.nonzero(is_src).flatten()
+    dst_idx = torch.nonzero(~is_src).flatten()
+    return src_idx, dst_idx
+
+
+class TokenMatch:
+    """Bipartite soft matching of `[batch, tokens, dim]` tokens, merging
+    `num_merged` sources into their most similar destination."""
+
+    def __init__(
+        self,
+        metric: torch.Tensor,
+        src_idx: torch.Tensor,
+        dst_idx: torch.Tensor,
+        num_merged: int,
+    ):
+        batch_size, num_tokens, _ = metric.shape
+        self.num_tokens = num_tokens
+        self.num_merged = min(num_merged, src_idx.numel())
+        self.src_idx = src_idx
+        self.dst_idx = dst_idx
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, src_idx] @ metric[:, dst_idx].transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        # [batch, sources] positions in src_idx of the kept and merged ones
+        self.unmerged_src = edge_idx[:, self.num_merged :]
+        self.merged_src = edge_idx[:, : self.num_merged]
+        # position in dst_idx every merged source goes to
+        self.merged_dst = node_idx.gather(dim=-1, index=self.merged_src)
+
+    @property
+    def num_merged_tokens(self) -> int:
+        """Tokens left after merging."""
+        return self.num_tokens - self.num_merged
+
+    @staticmethod
+    def _gather(x: torch.Tensor, index: torch.Tensor) -> torch.Tensor:
+        return x.gather(
+            dim=1, index=index.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+        )
+
+    def merge(self, x: torch.Tensor) -> torch.Tensor:
+        """`[batch, tokens, dim]` to `[batch, num_merged_tokens, dim]`, the
+        kept sources followed by the destinations."""
+        src = x[:, self.src_idx]
+        dst = x[:, self.dst_idx]
+        unmerged = self._gather(src, self.unmerged_src)
+        merged = self._gather(src, self.merged_src)
+        dst = dst.scatter_reduce(
+            dim=1,
+            index=self.merged_dst.unsqueeze(-1).expand(-1, -1, x.shape[-1]),
+            src=merged,
+            reduce="mean",
+        )
+        return torch.cat([unmerged, dst], dim=1)
+
+    def unmerge(self, x: torch.Tensor) -> torch.Tensor:
+        """Inverse of `merge`, every merged source takes the value of its
+        destination."""
+        batch_size, _, dim = x.shape
+        num_unmerged = self.unmerged_src.shape[1]
+        unmerged, dst = x[:, :num_unmerged], x[:, num_unmerged:]
+        out = x.new_empty(batch_size, self.num_tokens, dim)
+        out[:, self.dst_idx] = dst
+        src_idx = self.src_idx.unsqueeze(0).expand(batch_size, -1)
+        out.scatter_(
+            dim=1,
+            index=src_idx.gather(dim=1, index=self.unmerged_src)
+            .unsqueeze(-1)
+            .expand(-1, -1, dim),
+            src=unmerged,
+        )
+        out.scatter_(
+            dim=1,
+            index=src_idx.gather(dim=1, index=self.merged_src)
+            .unsqueeze(-1)
+            .expand(-1, -1, dim),
+            src=self._gather(dst, self.merged_dst),
+        )
+        return out
+
+
+class TokenMerger:
+    """Matches the image tokens of the current block for the attention
+    processors and keeps the match for the feed forward of the block.
+
+    `ratio` of the tokens of a forward are merged, at every step with the
+    "constant" schedule, or decreasing linearly to none at the last step
+    with the "linear" one: early steps lay out the coarse image and bear
+    merging better.
+    """
+
+    def __init__(
+        self, ratio: float = 0.0, schedule: str = "constant", stride: int = 2
+    ):
+        self.current: Optional[TokenMatch] = None
+        self._partitions: Dict[Tuple, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self.configure(ratio, schedule, stride)
+        self.reset_stats()
+
+    def configure(self, ratio: float, schedule: str, stride: int):
+        if not 0.0 <= ratio < 1.0:
+            raise ValueError(f"token merging ratio must be in [0, 1), got {ratio}")
+        if schedule not in TOKEN_MERGING_SCHEDULES:
+            raise ValueError(
+                f"token merging schedule must be one of "
+                f"{TOKEN_MERGING_SCHEDULES}, got {schedule}"
+            )
+        if stride < 2:
+            raise ValueError(f"token merging stride must be at least 2, got {stride}")
+        self.ratio = ratio
+        self.schedule = schedule
+        self.stride = stride
+        self.current = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ratio > 0.0
+
+    def reset_stats(self):
+        self.num_tokens = 0
+        self.num_merged = 0
+
+    def ratio_at(self, step_idx: int, num_steps: int) -> float:
+        if self.schedule == "linear" and num_steps > 1:
+            return self.ratio * (1.0 - step_idx / (num_steps - 1))
+        return self.ratio
+
+    def _grid_width(self) -> int:
+        runtime_state = get_runtime_state()
+        return (
+            runtime_state.input_config.width
+            // runtime_state.vae_scale_factor
+            // runtime_state.backbone_patch_size
+        )
+
+    def match(self, hidden_states: torch.Tensor) -> Optional[TokenMatch]:
+        """Match the `[batch, tokens, dim]` image tokens of the current
+        forward, rows of the token grid of the image, and keep the match as
+        the current one. None if nothing is merged at this step."""
+        self.current = None
+        if not self.enabled or hidden_states.ndim != 3:
+            return None
+        runtime_state = get_runtime_state()
+        ratio = self.ratio_at(
+            runtime_state.step_idx, runtime_state.input_config.num_inference_steps
+        )
+        num_tokens = hidden_states.shape[1]
+        num_merged = int(num_tokens * ratio)
+        width = self._grid_width()
+        if num_merged == 0 or num_tokens % width != 0:
+            return None
+        key = (num_tokens // width, width, self.stride, hidden_states.device)
+        if key not in self._partitions:
+            self._partitions[key] = get_token_grid_partition(*key)
+        src_idx, dst_idx = self._partitions[key]
+        self.current = TokenMatch(hidden_states, src_idx, dst_idx, num_merged)
+        self.num_tokens += num_tokens
+        self.num_merged += self.current.num_merged
+        return self.current
+
+    def clear(self):
+        """Drop the current match, for a self attention that merges
+        nothing."""
+        self.current = None
+
+    def get_match(self, hidden_states: torch.Tensor) -> Optional[TokenMatch]:
+        """The current match if it applies to `hidden_states`."""
+        if (
+            self.current is None
+            or hidden_states.ndim != 3
+            or hidden_states.shape[1] != self.current.num_tokens
+        ):
+            return None
+        return self.current
+
+    @property
+    def saved_ratio(self) -> float:
+        """Part of the tokens matched since the last `reset_stats` that were
+        merged away."""
+        return self.num_merged / self.num_tokens if self.num_tokens else 0.0
+
+
+TOKEN_MERGER = TokenMerger()
+
@@ -9,10 +9,18 @@ from xfuser.distributed import (
     is_pipeline_last_stage,
     get_pipeline_parallel_world_size,
     get_sequence_parallel_world_size,
+    get_cfg_group,
+    get_sp_group,
 )
 from xfuser.distributed.runtime_state import get_runtime_state
 from xfuser.logger import init_logger
 from xfuser.model_executor.models import xFuserModelBaseWrapper
+from xfuser.model_executor.layers.attention_processor import (
+    xFuserAttentionBaseWrapper,
+)
+from xfuser.model_executor.layers.kv_arena import StaleKVArena
+from .layer_split import get_stage_block_range
+from .feature_cache import FeatureCache, get_cached_block_range
 
 logger = init_logger(__name__)
 
@@ -33,6 +41,16 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
             submodule_addition_args=submodule_addition_args,
         )
         super().__init__(module=transformer)
+        runtime_config = get_runtime_state().runtime_config
+        self.feature_cache = FeatureCache(
+            interval=runtime_config.feature_cache_interval,
+            mode=runtime_config.feature_cache_mode,
+            threshold=runtime_config.feature_cache_threshold,
+            warmup_steps=runtime_config.warmup_steps,
+        )
+        self.feature_cache_shallow_blocks = (
+            runtime_config.feature_cache_shallow_blocks
+        )
 
     def _convert_transformer_for_parallel(
         self,
@@ -46,12 +64,51 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
             return transformer
         else:
             transformer = self._split_transformer_blocks(transformer)
-            return self._wrap_layers(
+            transformer = self._wrap_layers(
                 model=transformer,
                 submodule_classes_to_wrap=submodule_classes_to_wrap,
                 submodule_name_to_wrap=submodule_name_to_wrap,
                 submodule_addition_args=submodule_addition_args,
             )
+            if "all_transformer_blocks" in self.__dict__:
+                # blocks of other stages may be moved to this one later
+                wrapped_layers = self.wrapped_layers
+                start_idx, end_idx = self.transformer_blocks_range
+                for idx, block in enumerate(self.all_transformer_blocks):
+                    if start_idx <= idx < end_idx:
+                        continue
+                    self._wrap_layers(
+                        model=block,
+                        submodule_classes_to_wrap=submodule_classes_to_wrap,
+                        submodule_name_to_wrap=submodule_name_to_wrap,
+                        submodule_addition_args=submodule_addition_args,
+                    )
+                    wrapped_layers += self.wrapped_layers
+                self.wrapped_layers = wrapped_layers
+            self.stale_kv_arena = StaleKVArena(
+                self._get_stage_attention_layers(transformer)
+            )
+            return transformer
+
+    @staticmethod
+    def _get_stage_attention_layers(
+        transformer: nn.Module,
+    ) -> List[xFuserAttentionBaseWrapper]:
+        return [
+            module
+            for module in transformer.modules()
+            if isinstance(module, xFuserAttentionBaseWrapper)
+        ]
+
+    def reset_activation_cache(self):
+        super().reset_activation_cache()
+        if "stale_kv_arena" in self.__dict__:
+            # the blocks of the stage may have changed since the last reset
+            self.stale_kv_arena.reset(
+                self._get_stage_attention_layers(self.module)
+            )
+        if "feature_cache" in self.__dict__:
+            self.feature_cache.reset()
 
     def _split_transformer_blocks(
         self,
@@ -66,36 +123,21 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
             )
 
         # transformer layer split
-        attn_layer_num_for_pp = get_runtime_state().parallel_config.pp_config.attn_layer_num_for_pp
-        pp_rank = get_pipeline_parallel_rank()
-        pp_world_size = get_pipeline_parallel_world_size()
-        if attn_layer_num_for_pp is not None:
-            assert sum(attn_layer_num_for_pp) == len(transformer.transformer_blocks), (
-                "Sum of attn_layer_num_for_pp should be equal to the "
-                "number of transformer blocks"
-            )
-            if is_pipeline_first_stage():
-                transformer.transformer_blocks = transformer.transformer_blocks[
-                    : attn_layer_num_for_pp[0]
-                ]
-            else:
-                transformer.transformer_blocks = transformer.transformer_blocks[
-                    sum(attn_layer_num_for_pp[: pp_rank - 1]) : sum(
-                        attn_layer_num_for_pp[:pp_rank]
-                    )
-                ]
-        else:
-            num_blocks_per_stage = (
-                len(transformer.transformer_blocks) + pp_world_size - 1
-            ) // pp_world_size
-            start_idx = pp_rank * num_blocks_per_stage
-            end_idx = min(
-                (pp_rank + 1) * num_blocks_per_stage,
-                len(transformer.transformer_blocks),
-            )
-            transformer.transformer_blocks = transformer.transformer_blocks[
-                start_idx:end_idx
-            ]
+        pp_config = get_runtime_state().parallel_config.pp_config
+        if pp_config.auto_attn_layer_num_for_pp:
+            # keep every block on the host so that the split can be balanced
+            #   once the input size is known
+            self.all_transformer_blocks = list(transformer.transformer_blocks)
+        self.transformer_blocks_range = get_stage_block_range(
+            num_blocks=len(transformer.transformer_blocks),
+            pp_rank=get_pipeline_parallel_rank(),
+            pp_world_size=get_pipeline_parallel_world_size(),
+            attn_layer_num_for_pp=pp_config.attn_layer_num_for_pp,
+        )
+        start_idx, end_idx = self.transformer_blocks_range
+        transformer.transformer_blocks = transformer.transformer_blocks[
+            start_idx:end_idx
+        ]
         # position embedding
         if not is_pipeline_first_stage():
             transformer.pos_embed = None
@@ -104,10 +146,104 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
             transformer.proj_out = None
         return transformer
 
+    def set_attn_layer_num_for_pp(self, attn_layer_num_for_pp: List[int]):
+        """Re-split the transformer blocks across the pipeline stages. Blocks
+        this stage takes over are moved to the device of its current blocks,
+        blocks it hands over go back to the host."""
+        assert hasattr(self, "all_transformer_blocks"), (
+            "re-splitting transformer blocks requires "
+            "auto_attn_layer_num_for_pp"
+        )
+        start_idx, end_idx = get_stage_block_range(
+            num_blocks=len(self.all_transformer_blocks),
+            pp_rank=get_pipeline_parallel_rank(),
+            pp_world_size=get_pipeline_parallel_world_size(),
+            attn_layer_num_for_pp=attn_layer_num_for_pp,
+        )
+        if (start_idx, end_idx) == self.transformer_blocks_range:
+            return
+        reference = next(self.module.transformer_blocks[0].parameters())
+        old_start_idx, old_end_idx = self.transformer_blocks_range
+        for idx, block in enumerate(self.all_transformer_blocks):
+            in_old = old_start_idx <= idx < old_end_idx
+            in_new = start_idx <= idx < end_idx
+            if in_new and not in_old:
+                block.to(device=reference.device, dtype=reference.dtype)
+            elif in_old and not in_new:
+                block.to("cpu")
+        self.module.transformer_blocks = nn.ModuleList(
+            self.all_transformer_blocks[start_idx:end_idx]
+        )
+        self.transformer_blocks_range = (start_idx, end_idx)
+        if "encoder_hidden_states_cache" in self.__dict__:
+            self.encoder_hidden_states_cache = [
+                None for _ in range(end_idx - start_idx)
+            ]
+        self.reset_activation_cache()
+
     @abstractmethod
     def forward(self, *args, **kwargs):
         pass
 
+    def _get_cached_block_range(self) -> Optional[Tuple[int, int]]:
+        """Range, in the blocks of this stage, of the blocks whose output
+        the feature cache may reuse across steps, None if it may not reuse
+        any."""
+        if not self.feature_cache.enabled or self.training:
+            return None
+        stage_block_range = self.__dict__.get(
+            "transformer_blocks_range", (0, len(self.transformer_blocks))
+        )
+        return get_cached_block_range(
+            stage_block_range,
+            num_blocks=self.config.num_layers,
+            shallow_blocks=self.feature_cache_shallow_blocks,
+        )
+
+    @staticmethod
+    def _reduce_feature_cache_metric(tensor: torch.Tensor) -> torch.Tensor:
+        # ranks of a sequence parallel or cfg group run their blocks together
+        return get_cfg_group().all_reduce(get_sp_group().all_reduce(tensor))
+
+    def _reuse_cached_features(self, range_input: torch.Tensor) -> bool:
+        """Whether this forward skips the cached block range, the same for
+        every patch of a step."""
+        return self.feature_cache.begin_step(
+            get_runtime_state().step_idx,
+            range_input,
+            all_reduce=self._reduce_feature_cache_metric,
+        )
+
+    def _apply_cached_features(
+        self,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        plan = get_runtime_state().plan
+        return self.feature_cache.apply(
+            hidden_states,
+            encoder_hidden_states,
+            (plan.token_start, plan.token_end),
+        )
+
+    def _store_cached_features(
+        self,
+        hidden_states_input: torch.Tensor,
+        hidden_states_output: torch.Tensor,
+        encoder_hidden_states_input: Optional[torch.Tensor] = None,
+        encoder_hidden_states_output: Optional[torch.Tensor] = None,
+    ):
+        plan = get_runtime_state().plan
+        self.feature_cache.store(
+            hidden_states_input,
+            hidden_states_output,
+            (plan.token_start, plan.token_end),
+            plan.num_tokens,
+            encoder_hidden_states_input,
+            encoder_hidden_states_output,
+            is_last_forward=not plan.patch_mode or plan.is_last_patch,
+        )
+
     def _get_patch_height_width(self) -> Tuple[int, int]:
         patch_size = get_runtime_state().backbone_patch_size
         vae_scale_factor = get_runtime_state().vae_scale_factor
@@ -0,0 +1,203 @@
+from typing import Callable, Optional, Tuple
+
+import torch
+
+FEATURE_CACHE_MODES = ["interval", "adaptive"]
+
+
+def get_cached_block_range(
+    stage_block_range: Tuple[int, int],
+    num_blocks: int,
+    shallow_blocks: int,
+) -> Optional[Tuple[int, int]]:
+    """Range, in the blocks of a stage, of its blocks whose features may be
+    reused across steps: every block but the `shallow_blocks` first and last
+    ones of the model. None if the stage has no such block."""
+    start_idx, end_idx = stage_block_range
+    cached_start = max(start_idx, shallow_blocks)
+    cached_end = min(end_idx, num_blocks - shallow_blocks)
+    if cached_start >= cached_end:
+        return None
+    return cached_start - start_idx, cached_end - start_idx
+
+
+class FeatureCache:
+    """Cross-step cache of the residual a range of transformer blocks adds
+    to the hidden states, reused in place of running the blocks.
+
+    The blocks run at least every `interval` steps. In "interval" mode they
+    run exactly every `interval` steps, in "adaptive" mode whenever the
+    relative change of their input, accumulated over the steps since they
+    last ran, reaches `threshold`. The first `warmup_steps` steps always
+    run them.
+
+    A step reuses the residual for all of its pipeline patches or for none,
+    the residuals being kept over the whole feature map of the rank.
+    """
+
+    def __init__(
+        self,
+        interval: int = 0,
+        mode: str = "interval",
+        threshold: float = 0.1,
+        warmup_steps: int = 1,
+    ):
+        self.configure(interval, mode, threshold, warmup_steps)
+        self.reset()
+
+    def configure(
+        self, interval: int, mode: str, threshold: float, warmup_steps: int
+    ):
+        if mode not in FEATURE_CACHE_MODES:
+            raise ValueError(
+                f"feature cache mode must be one of {FEATURE_CACHE_MODES}, "
+                f"got {mode}"
+            )
+        self.interval = interval
+        self.mode = mode
+        self.threshold = threshold
+        self.warmup_steps = max(warmup_steps, 1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 1
+
+    def reset(self):
+        self.hidden_residual: Optional[torch.Tensor] = None
+        self.encoder_residual: Optional[torch.Tensor] = None
+        # whether the residuals cover the whole feature map
+        self._filled = False
+        self._last_full_step = -1
+        self._step_idx = -1
+        self._reuse = False
+        # input of the first forward of the previous step, for the adaptive
+        #   mode
+        self._previous_input: Optional[torch.Tensor] = None
+        self._accumulated_change = 0.0
+        self.num_reused_steps = 0
+        self.num_steps = 0
+
+    def _input_change(
+        self,
+        range_input: torch.Tensor,
+        all_reduce: Optional[Callable[[torch.Tensor], torch.Tensor]],
+    ) -> Optional[float]:
+        previous_input = self._previous_input
+        self._previous_input = range_input.detach().clone()
+        if previous_input is None or previous_input.shape != range_input.shape:
+            return None
+        sums = torch.stack(
+            [
+                (range_input - previous_input).abs().sum(dtype=torch.float32),
+                previous_input.abs().sum(dtype=torch.float32),
+            ]
+        )
+        if all_reduce is not None:
+            # every rank running the blocks together must take the same
+            #   decision
+            sums = all_reduce(sums)
+        diff, reference = sums.tolist()
+        return diff / max(reference, 1e-12)
+
+    def begin_step(
+        self,
+        step_idx: int,
+        range_input: torch.Tensor,
+        all_reduce: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+    ) -> bool:
+        """Whether the step `step_idx` reuses the residual, decided at the
+        first forward of the step. `range_input` is the input of the blocks
+        in that forward, `all_reduce` sums a tensor over the ranks that run
+        the blocks together."""
+        if step_idx == self._step_idx:
+            return self._reuse
+        if step_idx < self._step_idx:
+            # a new generation
+            self.reset()
+        self._step_idx = step_idx
+        self.num_steps += 1
+
+        reuse = (
+            self.enabled
+            and self._filled
+            and step_idx >= self.warmup_steps
+            and step_idx - self._last_full_step < self.interval
+        )
+        if self.mode == "adaptive":
+            change = self._input_change(range_input, all_reduce)
+            if change is None:
+                reuse = False
+            elif reuse:
+                reuse = self._accumulated_change + change < self.threshold
+            self._accumulated_change = (
+                self._accumulated_change + change if reuse else 0.0
+            )
+        if not reuse:
+            self._last_full_step = step_idx
+            self._filled = False
+        else:
+            self.num_reused_steps += 1
+        self._reuse = reuse
+        return reuse
+
+    def apply(
+        self,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor],
+        token_range: Tuple[int, int],
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Output of the blocks out of their input and the cached residual
+        of the tokens `token_range` of the feature map."""
+        start, end = token_range
+        hidden_states = hidden_states + self.hidden_residual[:, start:end]
+        if encoder_hidden_states is not None:
+            if self.encoder_residual is None:
+                encoder_hidden_states = None
+            else:
+                encoder_hidden_states = encoder_hidden_states + self.encoder_residual
+        return hidden_states, encoder_hidden_states
+
+    def store(
+        self,
+        hidden_states_input: torch.Tensor,
+        hidden_states_output: torch.Tensor,
+        token_range: Tuple[int, int],
+        num_tokens: int,
+        encoder_hidden_states_input: Optional[torch.Tensor] = None,
+        encoder_hidden_states_output: Optional[torch.Tensor] = None,
+        is_last_forward: bool = True,
+    ):
+        """Keep the residual the blocks added to the tokens `token_range`
+        of a feature map of `num_tokens` tokens. The encoder hidden states
+        are only given by the forwards that compute them."""
+        batch_size, _, dim = hidden_states_output.shape
+        shape = (batch_size, num_tokens, dim)
+        if (
+            self.hidden_residual is None
+            or self.hidden_residual.shape != shape
+            or self.hidden_residual.dtype != hidden_states_output.dtype
+            or self.hidden_residual.device != hidden_states_output.device
+        ):
+            self.hidden_residual = torch.empty(
+                shape,
+                dtype=hidden_states_output.dtype,
+                device=hidden_states_output.device,
+            )
+        start, end = token_range
+        torch.sub(
+            hidden_states_output,
+            hidden_states_input,
+            out=self.hidden_residual[:, start:end],
+        )
+        if encoder_hidden_states_input is not None:
+            self.encoder_residual = (
+                None
+                if encoder_hidden_states_output is None
+                else encoder_hidden_states_output - encoder_hidden_states_input
+            )
+        self._filled = is_last_forward
+
+    @property
+    def reused_ratio(self) -> float:
+        """Part of the steps since the last reset that reused the residual."""
+        return self.num_reused_steps / self.num_steps if self.num_steps else 0.0
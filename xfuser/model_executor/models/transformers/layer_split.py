@@ -0,0 +1,170 @@
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+
+def get_stage_block_range(
+    num_blocks: int,
+    pp_rank: int,
+    pp_world_size: int,
+    attn_layer_num_for_pp: Optional[List[int]] = None,
+) -> Tuple[int, int]:
+    """Range of the transformer blocks run by pipeline stage `pp_rank`,
+    split by `attn_layer_num_for_pp` or evenly if it is None."""
+    if attn_layer_num_for_pp is not None:
+        assert sum(attn_layer_num_for_pp) == num_blocks, (
+            "Sum of attn_layer_num_for_pp should be equal to the "
+            "number of transformer blocks"
+        )
+        return (
+            sum(attn_layer_num_for_pp[:pp_rank]),
+            sum(attn_layer_num_for_pp[: pp_rank + 1]),
+        )
+    num_blocks_per_stage = (num_blocks + pp_world_size - 1) // pp_world_size
+    start_idx = pp_rank * num_blocks_per_stage
+    end_idx = min((pp_rank + 1) * num_blocks_per_stage, num_blocks)
+    return start_idx, end_idx
+
+
+def solve_layer_split(
+    block_costs: Sequence[float],
+    stage_extra_costs: Sequence[float],
+) -> List[int]:
+    """Number of consecutive blocks per stage that minimizes the cost of the
+    slowest stage, where a stage costs its extra cost plus the cost of its
+    blocks. Every stage gets at least one block."""
+    num_blocks = len(block_costs)
+    num_stages = len(stage_extra_costs)
+    assert num_blocks >= num_stages, (
+        f"cannot split {num_blocks} blocks across {num_stages} stages"
+    )
+    prefix = [0.0]
+    for cost in block_costs:
+        prefix.append(prefix[-1] + cost)
+
+    # best[s][i]: slowest stage when the first s stages run the first i blocks
+    inf = float("inf")
+    best = [[inf] * (num_blocks + 1) for _ in range(num_stages + 1)]
+    choice = [[0] * (num_blocks + 1) for _ in range(num_stages + 1)]
+    best[0][0] = 0.0
+    for s in range(1, num_stages + 1):
+        # leave at least one block to each of the remaining stages
+        for i in range(s, num_blocks - (num_stages - s) + 1):
+            for j in range(s - 1, i):
+                cost = max(
+                    best[s - 1][j],
+                    stage_extra_costs[s - 1] + prefix[i] - prefix[j],
+                )
+                if cost < best[s][i]:
+                    best[s][i] = cost
+                    choice[s][i] = j
+    split = []
+    i = num_blocks
+    for s in range(num_stages, 0, -1):
+        j = choice[s][i]
+        split.append(i - j)
+        i = j
+    return split[::-1]
+
+
+class StageTimer:
+    """Accumulates the time spent in the transformer blocks of a stage and in
+    the rest of its transformer forward, through forward hooks, plus the time
+    of any function wrapped with `wrap`.
+
+    CUDA is synchronized around every timed call, so it is meant for a
+    profiling run only.
+    """
+
+    def __init__(self):
+        self.block_time: Dict[int, float] = defaultdict(float)
+        self.total_time: float = 0.0
+        self.extra_time: float = 0.0
+        self._handles = []
+        self._starts: Dict[int, float] = {}
+
+    @staticmethod
+    def _now() -> float:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _pre_hook(self, key: int):
+        def hook(module, args):
+            self._starts[key] = self._now()
+        return hook
+
+    def _post_hook(self, key: int, record: Callable[[float], None]):
+        def hook(module, args, output):
+            record(self._now() - self._starts.pop(key))
+        return hook
+
+    def attach(self, transformer: nn.Module, blocks: Dict[int, nn.Module]):
+        def record_total(elapsed: float):
+            self.total_time += elapsed
+
+        self._handles.append(
+            transformer.register_forward_pre_hook(self._pre_hook(-1))
+        )
+        self._handles.append(
+            transformer.register_forward_hook(self._post_hook(-1, record_total))
+        )
+        for idx, block in blocks.items():
+            def record_block(elapsed: float, idx=idx):
+                self.block_time[idx] += elapsed
+
+            self._handles.append(block.register_forward_pre_hook(self._pre_hook(idx)))
+            self._handles.append(
+                block.register_forward_hook(self._post_hook(idx, record_block))
+            )
+
+    def wrap(self, func: Callable) -> Callable:
+        def timed_func(*args, **kwargs):
+            start = self._now()
+            output = func(*args, **kwargs)
+            self.extra_time += self._now() - start
+            return output
+        return timed_func
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def stage_extra_time(self) -> float:
+        """Time of the stage spent outside of its transformer blocks."""
+        return self.total_time - sum(self.block_time.values()) + self.extra_time
+
+
+class LayerSplitCache:
+    """Layer splits per (model, resolution, pipefusion degree), kept in
+    memory and in an optional JSON file shared across runs."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.splits: Dict[str, List[int]] = {}
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                self.splits = json.load(f)
+
+    @staticmethod
+    def key(model: str, height: int, width: int, pp_degree: int) -> str:
+        return f"{model}|{height}x{width}|pp{pp_degree}"
+
+    def get(self, key: str) -> Optional[List[int]]:
+        return self.splits.get(key, None)
+
+    def put(self, key: str, split: List[int]):
+        self.splits[key] = split
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump(self.splits, f, indent=2)
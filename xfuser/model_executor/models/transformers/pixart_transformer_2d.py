@@ -1,4 +1,4 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import torch
 import torch.distributed
 import torch.nn as nn
@@ -14,6 +14,11 @@ from xfuser.distributed import (
     is_pipeline_first_stage,
     is_pipeline_last_stage
 )
+from xfuser.model_executor.layers.attention_processor import (
+    xFuserCachedCrossAttnProcessor2_0,
+    tensor_version,
+)
+from xfuser.model_executor.layers.token_merging import TOKEN_MERGER
 from .register import xFuserTransformerWrappersRegister
 from .base_transformer import xFuserTransformerBaseWrapper
 
@@ -26,11 +31,66 @@ class xFuserPixArtTransformer2DWrapper(xFuserTransformerBaseWrapper):
         self,
         transformer: PixArtTransformer2DModel,
     ):
+        # the prompt is the same for every patch of every step, so the cross
+        #   attention K/V are computed once per generation
+        for block in transformer.transformer_blocks:
+            if block.attn2 is not None:
+                block.attn2.set_processor(xFuserCachedCrossAttnProcessor2_0())
         super().__init__(
             transformer=transformer,
             submodule_classes_to_wrap=[nn.Conv2d, PatchEmbed],
-            submodule_name_to_wrap=["attn1"],
+            # the feed forward only runs on merged tokens with token merging
+            submodule_name_to_wrap=["attn1"] + (["ff"] if TOKEN_MERGER.enabled else []),
         )
+        self._caption_source = None
+        self._caption_source_version = None
+        self._caption = None
+
+    def get_cross_attention_kv_cache_stats(self) -> Dict[str, int]:
+        """Calls of the cross attention layers of this stage that reused the
+        cached K/V and that computed them."""
+        stats = {"hits": 0, "misses": 0}
+        for processor in self._get_cross_attention_processors():
+            stats["hits"] += processor.hits
+            stats["misses"] += processor.misses
+        return stats
+
+    def reset_cross_attention_kv_cache_stats(self):
+        for processor in self._get_cross_attention_processors():
+            processor.hits = 0
+            processor.misses = 0
+
+    def _get_cross_attention_processors(
+        self,
+    ) -> List[xFuserCachedCrossAttnProcessor2_0]:
+        return [
+            module.processor
+            for module in self.module.modules()
+            if isinstance(
+                getattr(module, "processor", None),
+                xFuserCachedCrossAttnProcessor2_0,
+            )
+        ]
+
+    def _project_caption(
+        self,
+        encoder_hidden_states: torch.Tensor,
+        batch_size: int,
+        inner_dim: int,
+    ) -> torch.Tensor:
+        # reuse the projection as long as the prompt embeddings are the same,
+        #   so that the cross attention layers keep their K/V
+        if (
+            self._caption_source is encoder_hidden_states
+            and self._caption_source_version
+            == tensor_version(encoder_hidden_states)
+        ):
+            return self._caption
+        caption = self.caption_projection(encoder_hidden_states)
+        self._caption = caption.view(batch_size, -1, inner_dim)
+        self._caption_source = encoder_hidden_states
+        self._caption_source_version = tensor_version(encoder_hidden_states)
+        return self._caption
 
     @xFuserBaseWrapper.forward_check_condition
     def forward(
@@ -130,11 +190,32 @@ class xFuserPixArtTransformer2DWrapper(xFuserTransformerBaseWrapper):
         )
 
         if self.caption_projection is not None:
-            encoder_hidden_states = self.caption_projection(encoder_hidden_states)
-            encoder_hidden_states = encoder_hidden_states.view(batch_size, -1, hidden_states.shape[-1])
+#! ---------------------------------------- MODIFIED BELOW ----------------------------------------
+            encoder_hidden_states = self._project_caption(
+                encoder_hidden_states, batch_size, hidden_states.shape[-1]
+            )
+            #! ORIGIN
+            # encoder_hidden_states = self.caption_projection(encoder_hidden_states)
+            # encoder_hidden_states = encoder_hidden_states.view(batch_size, -1, hidden_states.shape[-1])
+#! ---------------------------------------- MODIFIED ABOVE ----------------------------------------
 
         # 2. Blocks
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+        cached_block_range = self._get_cached_block_range()
+        reuse_cached_features = False
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
         for i, block in enumerate(self.transformer_blocks):
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+            if cached_block_range is not None:
+                cached_start, cached_end = cached_block_range
+                if i == cached_start:
+                    cached_range_input = hidden_states
+                    reuse_cached_features = self._reuse_cached_features(hidden_states)
+                    if reuse_cached_features:
+                        hidden_states, _ = self._apply_cached_features(hidden_states)
+                if reuse_cached_features and i < cached_end:
+                    continue
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
             if self.training and self.gradient_checkpointing:
 
                 def create_custom_forward(module, return_dict=None):
@@ -168,6 +249,10 @@ class xFuserPixArtTransformer2DWrapper(xFuserTransformerBaseWrapper):
                     cross_attention_kwargs=cross_attention_kwargs,
                     class_labels=None,
                 )
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+            if cached_block_range is not None and i == cached_end - 1:
+                self._store_cached_features(cached_range_input, hidden_states)
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
 
         # 3. Output
         #* only the last pp rank needs unpatchify
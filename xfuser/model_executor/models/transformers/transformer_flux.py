@@ -14,9 +14,12 @@ from xfuser.model_executor.base_wrapper import xFuserBaseWrapper
 from xfuser.distributed import (
     get_pipeline_parallel_rank,
     get_pipeline_parallel_world_size,
+    is_pipeline_first_stage,
+    is_pipeline_last_stage,
 )
 from .register import xFuserTransformerWrappersRegister
 from .base_transformer import xFuserTransformerBaseWrapper
+from .layer_split import get_stage_block_range
 
 logger = init_logger(__name__)
 
@@ -32,7 +35,41 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
             submodule_name_to_wrap=["attn"],
         )
         self.encoder_hidden_states_cache = [None for _ in range(len(self.transformer_blocks))]
-        
+        # joint tokens at the input of the single stream blocks
+        self.single_encoder_hidden_states_cache = [
+            None for _ in range(len(self.single_transformer_blocks))
+        ]
+
+    def _split_transformer_blocks(
+        self,
+        transformer: nn.Module,
+    ):
+        """Split the double stream blocks followed by the single stream ones
+        across the pipeline stages, as a single list of blocks."""
+        pp_config = get_runtime_state().parallel_config.pp_config
+        num_double_blocks = len(transformer.transformer_blocks)
+        num_blocks = num_double_blocks + len(transformer.single_transformer_blocks)
+        start_idx, end_idx = get_stage_block_range(
+            num_blocks=num_blocks,
+            pp_rank=get_pipeline_parallel_rank(),
+            pp_world_size=get_pipeline_parallel_world_size(),
+            attn_layer_num_for_pp=pp_config.attn_layer_num_for_pp,
+        )
+        self.transformer_blocks_range = (start_idx, end_idx)
+        transformer.transformer_blocks = transformer.transformer_blocks[
+            min(start_idx, num_double_blocks) : min(end_idx, num_double_blocks)
+        ]
+        transformer.single_transformer_blocks = transformer.single_transformer_blocks[
+            max(start_idx - num_double_blocks, 0) : max(end_idx - num_double_blocks, 0)
+        ]
+        # the rotary position embedding is needed by every stage
+        if not is_pipeline_first_stage():
+            transformer.x_embedder = None
+            transformer.context_embedder = None
+        if not is_pipeline_last_stage():
+            transformer.norm_out = None
+            transformer.proj_out = None
+        return transformer
 
     def forward(
         self,
@@ -86,7 +123,11 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
                 logger.warning(
                     "Passing `scale` via `joint_attention_kwargs` when not using the PEFT backend is ineffective."
                 )
-        hidden_states = self.x_embedder(hidden_states)
+#! ---------------------------------------- MODIFIED BELOW ----------------------------------------
+        #* only pp rank 0 embeds the latents and the prompt
+        if is_pipeline_first_stage():
+            hidden_states = self.x_embedder(hidden_states)
+#! ---------------------------------------- MODIFIED ABOVE ----------------------------------------
 
         timestep = timestep.to(hidden_states.dtype) * 1000
         if guidance is not None:
@@ -98,11 +139,16 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
             if guidance is None
             else self.time_text_embed(timestep, guidance, pooled_projections)
         )
-        encoder_hidden_states = self.context_embedder(encoder_hidden_states)
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+        if is_pipeline_first_stage():
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
+            encoder_hidden_states = self.context_embedder(encoder_hidden_states)
 
-        print(f"{txt_ids.shape=}, {img_ids.shape=}")
+        #* img_ids are the ones of every image token of this sp rank, the
+        #  attention processors pick those of the current patch
         ids = torch.cat((txt_ids, img_ids), dim=1)
         image_rotary_emb = self.pos_embed(ids)
+        plan = get_runtime_state().plan
 
         for index_block, block in enumerate(self.transformer_blocks):
             if self.training and self.gradient_checkpointing:
@@ -126,6 +172,21 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
                     **ckpt_kwargs,
                 )
 
+            elif plan.patch_mode and plan.is_first_patch:
+                self.encoder_hidden_states_cache[index_block] = encoder_hidden_states
+                encoder_hidden_states, hidden_states = block(
+                    hidden_states=hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                )
+            elif plan.patch_mode:
+                _, hidden_states = block(
+                    hidden_states=hidden_states,
+                    encoder_hidden_states=self.encoder_hidden_states_cache[index_block],
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                )
             else:
                 encoder_hidden_states, hidden_states = block(
                     hidden_states=hidden_states,
@@ -134,7 +195,9 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
                     image_rotary_emb=image_rotary_emb,
                 )
 
-        hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+        if len(self.single_transformer_blocks) > 0:
+            num_encoder_hidden_states_tokens = encoder_hidden_states.shape[1]
+            hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
 
         for index_block, block in enumerate(self.single_transformer_blocks):
             if self.training and self.gradient_checkpointing:
@@ -158,17 +221,39 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
                 )
 
             else:
+                #* the joint tokens are only updated with the first patch of
+                #  a step, the other patches attend to the ones it saw
+                if plan.patch_mode and plan.is_first_patch:
+                    # a copy, the rest of the block input is not kept alive
+                    self.single_encoder_hidden_states_cache[index_block] = (
+                        hidden_states[:, :num_encoder_hidden_states_tokens].clone()
+                    )
+                elif plan.patch_mode:
+                    hidden_states[:, :num_encoder_hidden_states_tokens] = (
+                        self.single_encoder_hidden_states_cache[index_block]
+                    )
                 hidden_states = block(
                     hidden_states=hidden_states,
                     temb=temb,
                     image_rotary_emb=image_rotary_emb,
                 )
 
-        hidden_states = hidden_states[:, encoder_hidden_states.shape[1] :, ...]
+        if len(self.single_transformer_blocks) > 0:
+            encoder_hidden_states, hidden_states = (
+                hidden_states[:, :num_encoder_hidden_states_tokens],
+                hidden_states[:, num_encoder_hidden_states_tokens:],
+            )
 
-        hidden_states = self.norm_out(hidden_states, temb)
-        output = self.proj_out(hidden_states)
-        output = output, None
+        #* only the last pp rank projects the output
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+        if is_pipeline_last_stage():
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
+            hidden_states = self.norm_out(hidden_states, temb)
+            output = self.proj_out(hidden_states), None
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+        else:
+            output = hidden_states, encoder_hidden_states
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
 
         if USE_PEFT_BACKEND:
             # remove `lora_scale` from each PEFT layer
@@ -177,4 +262,4 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
         if not return_dict:
             return (output,)
 
-        return Transformer2DModelOutput(sample=output)
\ No newline at end of file
+        return Transformer2DModelOutput(sample=output)
@@ -15,6 +15,7 @@ from xfuser.distributed import (
     is_pipeline_first_stage,
     is_pipeline_last_stage
 )
+from xfuser.model_executor.layers.token_merging import TOKEN_MERGER
 from .register import xFuserTransformerWrappersRegister
 from .base_transformer import xFuserTransformerBaseWrapper
 
@@ -30,7 +31,8 @@ class xFuserSD3Transformer2DWrapper(xFuserTransformerBaseWrapper):
         super().__init__(
             transformer=transformer,
             submodule_classes_to_wrap=[nn.Conv2d, PatchEmbed],
-            submodule_name_to_wrap=["attn"],
+            # the feed forward only runs on merged tokens with token merging
+            submodule_name_to_wrap=["attn"] + (["ff"] if TOKEN_MERGER.enabled else []),
         )
         self.encoder_hidden_states_cache = [None for _ in range(len(self.transformer_blocks))]
 
@@ -99,7 +101,30 @@ class xFuserSD3Transformer2DWrapper(xFuserTransformerBaseWrapper):
 #! ---------------------------------------- ADD ABOVE ----------------------------------------
             encoder_hidden_states = self.context_embedder(encoder_hidden_states)
 
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+        cached_block_range = self._get_cached_block_range()
+        reuse_cached_features = False
+        plan = get_runtime_state().plan
+        # only the forwards of the first patches compute encoder_hidden_states
+        computes_encoder_hidden_states = not plan.patch_mode or plan.is_first_patch
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
         for i, block in enumerate(self.transformer_blocks):
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+            if cached_block_range is not None:
+                cached_start, cached_end = cached_block_range
+                if i == cached_start:
+                    cached_range_input = hidden_states, encoder_hidden_states
+                    reuse_cached_features = self._reuse_cached_features(hidden_states)
+                    if reuse_cached_features:
+                        hidden_states, cached_encoder_hidden_states = self._apply_cached_features(
+                            hidden_states,
+                            encoder_hidden_states if computes_encoder_hidden_states else None,
+                        )
+                        if computes_encoder_hidden_states:
+                            encoder_hidden_states = cached_encoder_hidden_states
+                if reuse_cached_features and i < cached_end:
+                    continue
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
             if self.training and self.gradient_checkpointing:
 
                 def create_custom_forward(module, return_dict=None):
@@ -121,12 +146,13 @@ class xFuserSD3Transformer2DWrapper(xFuserTransformerBaseWrapper):
                 )
 
             else:
-                if get_runtime_state().patch_mode and get_runtime_state().pipeline_patch_idx == 0:
+                plan = get_runtime_state().plan
+                if plan.patch_mode and plan.is_first_patch:
                     self.encoder_hidden_states_cache[i] = encoder_hidden_states
                     encoder_hidden_states, hidden_states = block(
                         hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, temb=temb
                     )
-                elif get_runtime_state().patch_mode:
+                elif plan.patch_mode:
                     _, hidden_states = block(
                         hidden_states=hidden_states, encoder_hidden_states=self.encoder_hidden_states_cache[i], temb=temb
                     )
@@ -134,6 +160,15 @@ class xFuserSD3Transformer2DWrapper(xFuserTransformerBaseWrapper):
                     encoder_hidden_states, hidden_states = block(
                         hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, temb=temb
                     )
+#! ---------------------------------------- ADD BELOW ----------------------------------------
+            if cached_block_range is not None and i == cached_end - 1:
+                if computes_encoder_hidden_states:
+                    self._store_cached_features(
+                        cached_range_input[0], hidden_states, cached_range_input[1], encoder_hidden_states
+                    )
+                else:
+                    self._store_cached_features(cached_range_input[0], hidden_states)
+#! ---------------------------------------- ADD ABOVE ----------------------------------------
 
         #* only the last pp rank needs unpatchify
 #! ---------------------------------------- ADD BELOW ----------------------------------------
@@ -1,4 +1,5 @@
 from .base_pipeline import xFuserPipelineBaseWrapper
+from .latent_stream import LatentPreview
 from .pipeline_pixart_alpha import xFuserPixArtAlphaPipeline
 from .pipeline_pixart_sigma import xFuserPixArtSigmaPipeline
 from .pipeline_stable_diffusion_3 import xFuserStableDiffusion3Pipeline
@@ -6,6 +7,7 @@ from .pipeline_flux import xFuserFluxPipeline
 
 __all__ = [
     "xFuserPipelineBaseWrapper",
+    "LatentPreview",
     "xFuserPixArtAlphaPipeline",
     "xFuserPixArtSigmaPipeline",
     "xFuserStableDiffusion3Pipeline",
@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
 from functools import wraps
-from typing import Callable, Dict, List, Optional, Tuple, Union
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 import torch
 import torch.distributed
 import torch.nn as nn
@@ -12,29 +13,48 @@ from xfuser.config.config import (
 )
 from xfuser.logger import init_logger
 from xfuser.distributed import (
+    get_data_parallel_replica_index,
     get_data_parallel_world_size,
+    get_pipeline_parallel_rank,
     get_sequence_parallel_world_size,
     get_pipeline_parallel_world_size,
     get_classifier_free_guidance_world_size,
     get_classifier_free_guidance_rank,
     is_pipeline_first_stage,
     is_pipeline_last_stage,
+    is_dp_last_rank,
     get_pp_group,
+    get_sp_group,
+    get_dp_group,
     get_world_group,
     get_runtime_state,
     initialize_runtime_state
 )
+from xfuser.distributed.execution_plan import PatchPlan
 from xfuser.model_executor.base_wrapper import xFuserBaseWrapper
+from xfuser.model_executor.layers.attention_backends import (
+    ATTENTION_BACKEND_SELECTOR,
+    attention_backend_autotuning,
+)
+from xfuser.model_executor.layers.token_merging import TOKEN_MERGER
+from .latent_stream import LatentStream
 
 from xfuser.envs import PACKAGES_CHECKER
 PACKAGES_CHECKER.check_diffusers_version()
 
 from xfuser.model_executor.schedulers import *
 from xfuser.model_executor.models.transformers import *
+from xfuser.model_executor.models.transformers.layer_split import (
+    LayerSplitCache,
+    StageTimer,
+    solve_layer_split,
+)
 
 
 logger = init_logger(__name__)
 
+# layer split caches by file path, None for the in-memory only one
+_LAYER_SPLIT_CACHES: Dict[Optional[str], LayerSplitCache] = {}
 
 class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
 
@@ -44,7 +64,20 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         engine_config: EngineConfig,
     ):
         self.module: DiffusionPipeline
+        # previews of the generation run by `stream`, if any
+        self._latent_stream: Optional[LatentStream] = None
         self._init_runtime_state(pipeline=pipeline, engine_config=engine_config)
+        ATTENTION_BACKEND_SELECTOR.set_backend(
+            engine_config.runtime_config.attention_backend
+        )
+        ATTENTION_BACKEND_SELECTOR.set_memory_budget(
+            engine_config.runtime_config.attention_memory_budget_mb * 2**20
+        )
+        TOKEN_MERGER.configure(
+            ratio=engine_config.runtime_config.token_merging_ratio,
+            schedule=engine_config.runtime_config.token_merging_schedule,
+            stride=engine_config.runtime_config.token_merging_stride,
+        )
 
         # backbone
         transformer = getattr(pipeline, "transformer", None)
@@ -98,7 +131,7 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
             batch_size = len(prompt) if isinstance(prompt, list) else 1
             if batch_size > 1:
                 dp_degree = get_runtime_state().parallel_config.dp_degree
-                dp_group_rank = get_world_group().rank // get_data_parallel_world_size()
+                dp_group_rank = get_data_parallel_replica_index()
                 dp_group_batch_size = (batch_size + dp_degree - 1) // dp_degree
                 start_batch_idx = dp_group_rank * dp_group_batch_size
                 end_batch_idx = min((dp_group_rank + 1) * dp_group_batch_size, batch_size)
@@ -129,6 +162,7 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         cfg_parallel_available: bool = True,
         sequence_parallel_available: bool = True,
         pipefusion_parallel_available: bool = True,
+        auto_layer_split_available: bool = True,
     ):
         def decorator(func):
             @wraps(func)
@@ -139,6 +173,11 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
                     raise RuntimeError("Sequence parallelism is not supported by the model")
                 if not pipefusion_parallel_available and get_runtime_state().parallel_config.pp_degree > 1:
                     raise RuntimeError("Pipefusion parallelism is not supported by the model")
+                if (
+                    not auto_layer_split_available
+                    and get_runtime_state().parallel_config.pp_config.auto_attn_layer_num_for_pp
+                ):
+                    raise RuntimeError("auto_attn_layer_num_for_pp is not supported by the model")
                 return func(*args, **kwargs)
             return wrapper
         return decorator
@@ -154,17 +193,229 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         )
         warmup_steps = get_runtime_state().runtime_config.warmup_steps
         get_runtime_state().runtime_config.warmup_steps = sync_steps
-        self.__call__(
-            height=input_config.height,
-            width=input_config.width,
-            prompt=prompt,
-            use_resolution_binning=input_config.use_resolution_binning,
-            num_inference_steps=steps,
-            output_type="latent",
-            generator=torch.Generator(device="cuda").manual_seed(42),
-        )
+
+        def run():
+            self.__call__(
+                height=input_config.height,
+                width=input_config.width,
+                prompt=prompt,
+                num_inference_steps=steps,
+                output_type="latent",
+                generator=torch.Generator(device="cuda").manual_seed(42),
+                **self._get_prepare_run_kwargs(input_config),
+            )
+
+        # the attention backends are measured on the first run, so that the
+        #   layer split is profiled with the backends it will run with
+        with attention_backend_autotuning():
+            if (
+                get_pipeline_parallel_world_size() > 1
+                and get_runtime_state().parallel_config.pp_config.auto_attn_layer_num_for_pp
+            ):
+                self._balance_transformer_blocks(input_config, run)
+            run()
         get_runtime_state().runtime_config.warmup_steps = warmup_steps
 
+    def _get_prepare_run_kwargs(self, input_config: InputConfig) -> Dict[str, Any]:
+        """Arguments of `__call__` specific to the pipeline in the runs of
+        `prepare_run`."""
+        return {"use_resolution_binning": input_config.use_resolution_binning}
+
+    def stream(
+        self,
+        *args,
+        preview_steps: int = 1,
+        preview_downsample: int = 1,
+        preview_decoder: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+        **kwargs,
+    ) -> Iterator[Any]:
+        """Run the pipeline as `__call__` with the same arguments, yielding a
+        `LatentPreview` of the latents every `preview_steps` steps, then the
+        output of the pipeline.
+
+        Like `__call__`, it must run on every rank. Previews are made on the
+        rank decoding the image, out of the latents of the last pipeline
+        stage as its patches finish, averaged over `preview_downsample` x
+        `preview_downsample` cells and given to `preview_decoder` if any,
+        e.g. a tiny autoencoder.
+
+        Closing the generator stops the previews. Without model parallelism
+        it also stops the generation at the next step; with it, the other
+        ranks keep waiting on this one, so the generation runs to its end.
+        """
+        for name in ("callback", "callback_on_step_end"):
+            if kwargs.get(name) is not None:
+                raise ValueError(f"stream does not take {name}")
+        latent_stream = LatentStream(
+            preview_steps=preview_steps,
+            downsample=preview_downsample,
+            decoder=preview_decoder,
+        )
+        if (
+            get_pipeline_parallel_world_size() == 1
+            and get_classifier_free_guidance_world_size() == 1
+            and get_sequence_parallel_world_size() == 1
+        ):
+            # the wrapped pipeline runs its own denoising loop
+            kwargs.update(
+                self._get_naive_preview_kwargs(
+                    lambda step_idx, timestep, latents: self._preview_step(
+                        step_idx, timestep, latents, cancellable=True
+                    ),
+                    kwargs,
+                )
+            )
+        # the device is per thread
+        device = torch.cuda.current_device() if torch.cuda.is_available() else None
+        result = {}
+
+        def run():
+            if device is not None:
+                torch.cuda.set_device(device)
+            try:
+                result["output"] = self.__call__(*args, **kwargs)
+            except BaseException as e:
+                result["error"] = e
+            finally:
+                latent_stream.close()
+
+        self._latent_stream = latent_stream
+        thread = threading.Thread(target=run, name="xfuser-stream", daemon=True)
+        thread.start()
+        try:
+            yield from latent_stream
+        finally:
+            latent_stream.cancel()
+            thread.join()
+            self._latent_stream = None
+        if "error" in result:
+            raise result["error"]
+        yield result["output"]
+
+    def _get_naive_preview_kwargs(
+        self,
+        preview_step: Callable[[int, Any, torch.Tensor], None],
+        call_kwargs: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """Arguments of the wrapped pipeline, called with `call_kwargs`,
+        calling `preview_step` at the end of each step."""
+
+        def callback_on_step_end(pipeline, step_idx, timestep, callback_kwargs):
+            preview_step(step_idx, timestep, callback_kwargs["latents"])
+            return {}
+
+        return {
+            "callback_on_step_end": callback_on_step_end,
+            "callback_on_step_end_tensor_inputs": ["latents"],
+        }
+
+    def _get_preview_latents(self, latents: torch.Tensor) -> torch.Tensor:
+        """`[B, C, H, W]` latents out of the latents of the pipeline."""
+        return latents
+
+    def _preview_step(
+        self,
+        step_idx: int,
+        timestep: Union[float, torch.Tensor],
+        latents: Union[torch.Tensor, List[torch.Tensor]],
+        cancellable: bool = False,
+    ):
+        """Hand the latents of the step `step_idx` to the stream of the
+        generation, if any. Called by every rank of the last pipeline stage
+        with its local latents, or the list of its patch latents.
+        """
+        latent_stream = self._latent_stream
+        if latent_stream is None or not latent_stream.wants(step_idx):
+            return
+        if isinstance(latents, list):
+            latents = torch.cat(latents, dim=-2)
+        if get_sequence_parallel_world_size() > 1:
+            latents = self._gather_sp_latents(latents)
+        if latents is not None and is_dp_last_rank():
+            latent_stream.put(
+                step_idx,
+                timestep,
+                self._get_preview_latents(latents),
+                cancellable=cancellable,
+            )
+
+    def _balance_transformer_blocks(
+        self, input_config: InputConfig, run: Callable[[], None]
+    ):
+        """Split the transformer blocks across the pipeline stages so that the
+        slowest stage is as fast as possible at the size of `input_config`,
+        profiling `run` unless the split is cached."""
+        pp_config = get_runtime_state().parallel_config.pp_config
+        transformer = self.module.transformer
+        if pp_config.attn_layer_split_cache not in _LAYER_SPLIT_CACHES:
+            _LAYER_SPLIT_CACHES[pp_config.attn_layer_split_cache] = (
+                LayerSplitCache(pp_config.attn_layer_split_cache)
+            )
+        cache = _LAYER_SPLIT_CACHES[pp_config.attn_layer_split_cache]
+        key = LayerSplitCache.key(
+            self.module.config._name_or_path,
+            input_config.height,
+            input_config.width,
+            get_pipeline_parallel_world_size(),
+        )
+        # the cache file may only exist on some hosts, follow the first rank
+        split = [cache.get(key)]
+        torch.distributed.broadcast_object_list(
+            split, src=0, group=get_world_group().cpu_group
+        )
+        split = split[0]
+
+        if split is None:
+            timer = StageTimer()
+            start_idx, end_idx = transformer.transformer_blocks_range
+            timer.attach(
+                transformer,
+                {
+                    start_idx + i: block
+                    for i, block in enumerate(transformer.transformer_blocks)
+                },
+            )
+            scheduler = self.module.scheduler
+            if is_pipeline_last_stage():
+                object.__setattr__(scheduler, "step", timer.wrap(scheduler.step))
+            try:
+                run()
+            finally:
+                timer.detach()
+                if "step" in scheduler.__dict__:
+                    object.__delattr__(scheduler, "step")
+
+            records = [None] * get_world_group().world_size
+            torch.distributed.all_gather_object(
+                records,
+                (
+                    get_pipeline_parallel_rank(),
+                    dict(timer.block_time),
+                    timer.stage_extra_time(),
+                ),
+                group=get_world_group().cpu_group,
+            )
+            # every stage of every pipeline must agree on the split, take the
+            #   slowest measurement of each block and stage
+            block_costs = [0.0] * len(transformer.all_transformer_blocks)
+            stage_extra_costs = [0.0] * get_pipeline_parallel_world_size()
+            for pp_rank, block_time, extra_time in records:
+                for idx, elapsed in block_time.items():
+                    block_costs[idx] = max(block_costs[idx], elapsed)
+                stage_extra_costs[pp_rank] = max(
+                    stage_extra_costs[pp_rank], extra_time
+                )
+            split = solve_layer_split(block_costs, stage_extra_costs)
+            logger.info(
+                f"Profiled transformer blocks {block_costs} and stage extras "
+                f"{stage_extra_costs}, splitting blocks to {split}"
+            )
+            if get_world_group().rank == 0:
+                cache.put(key, split)
+        else:
+            logger.info(f"Using cached transformer block split {split}")
+        transformer.set_attn_layer_num_for_pp(split)
+
     def _init_runtime_state(self, pipeline: DiffusionPipeline, engine_config: EngineConfig):
         initialize_runtime_state(pipeline=pipeline, engine_config=engine_config)
 
@@ -217,13 +468,21 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         ):
             return
         for name, shape, cnt in extra_tensors_shape_dict:
-            get_pp_group().set_extra_tensors_recv_buffer(name, shape, cnt)
+            get_pp_group().set_extra_tensors_recv_buffer(
+                name, shape, cnt, dtype=get_runtime_state().runtime_config.dtype
+            )
         get_runtime_state().pipeline_comm_extra_tensors_info = extra_tensors_shape_dict
 
 
 
-    def _init_sync_pipeline(self, latents: torch.Tensor):
+    def _init_sync_pipeline(
+        self, latents: torch.Tensor, after_async: bool = False
+    ):
         get_runtime_state().set_patched_mode(patch_mode=False)
+        # after pipefusion steps only the last stage has latents, already in
+        #   the local layout
+        if after_async:
+            return latents
 
         latents_list = [
             latents[:, :, start_idx: end_idx,:]
@@ -264,6 +523,40 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
 
         return patch_latents
 
+    @staticmethod
+    def _get_patch_latents(
+        latents: torch.Tensor, patch_plan: PatchPlan
+    ) -> torch.Tensor:
+        """Latents of the pipeline patch of `patch_plan` in the local latents
+        of a sequence parallel rank."""
+        return latents[..., patch_plan.latent_start : patch_plan.latent_end, :]
+
+    def _gather_sp_latents(self, latents: torch.Tensor) -> Optional[torch.Tensor]:
+        """Latents of the whole image out of the local latents of the
+        sequence parallel ranks, laid out patch after patch.
+
+        Every rank steps the scheduler on its own latents only, they are
+        gathered once for the VAE, on the rank decoding the image. The other
+        ranks get None.
+        """
+        sp_group = get_sp_group()
+        decode_rank = get_dp_group().ranks[-1]
+        if decode_rank not in sp_group.ranks:
+            return None
+        sp_latents = sp_group.gather(
+            latents, dst=sp_group.ranks.index(decode_rank), dim=0
+        )
+        if sp_latents is None:
+            return None
+        sp_latents_list = sp_latents.chunk(sp_group.world_size, dim=0)
+        latents_list = []
+        for patch_plan in get_runtime_state().execution_plan.patches:
+            latents_list += [
+                self._get_patch_latents(sp_latents, patch_plan)
+                for sp_latents in sp_latents_list
+            ]
+        return torch.cat(latents_list, dim=-2)
+
     def _process_cfg_split_batch(
         self,
         concat_group_0_negative: torch.Tensor,
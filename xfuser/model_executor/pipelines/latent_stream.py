@@ -0,0 +1,100 @@
+import queue
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional, Union
+
+import torch
+from torch.nn import functional as F
+
+
+@dataclass
+class LatentPreview:
+    """Preview of the latents at the end of a denoising step."""
+
+    step_idx: int
+    timestep: Union[float, torch.Tensor]
+    # `[B, C, H, W]` latents, downsampled, or the output of the preview
+    #   decoder
+    preview: torch.Tensor
+
+
+class GenerationCancelled(Exception):
+    """Raised in the denoising loop of a stream closed by its consumer."""
+
+
+class LatentStream:
+    """Previews of a generation, handed from the denoising loop to the
+    consumer of `xFuserPipelineBaseWrapper.stream`.
+
+    The denoising loop calls `put` at the end of each step, a preview is
+    made every `preview_steps` steps. Latents are reduced to previews on the
+    producing side: averaged over `downsample` x `downsample` cells, then
+    given to `decoder` if any.
+    """
+
+    _END = object()
+
+    def __init__(
+        self,
+        preview_steps: int = 1,
+        downsample: int = 1,
+        decoder: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+    ):
+        if preview_steps < 1:
+            raise ValueError(f"preview_steps must be positive, got {preview_steps}")
+        if downsample < 1:
+            raise ValueError(f"downsample must be positive, got {downsample}")
+        self.preview_steps = preview_steps
+        self.downsample = downsample
+        self.decoder = decoder
+        self.cancelled = False
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+
+    def wants(self, step_idx: int) -> bool:
+        """Whether the step `step_idx` is previewed. Ranks gathering the
+        latents of a preview together must agree on it."""
+        return step_idx % self.preview_steps == 0
+
+    def _make_preview(self, latents: torch.Tensor) -> torch.Tensor:
+        if self.downsample > 1:
+            preview = F.avg_pool2d(
+                latents.float(), self.downsample, ceil_mode=True
+            ).to(latents.dtype)
+        else:
+            # the denoising loop goes on with the latents
+            preview = latents.detach().clone()
+        if self.decoder is not None:
+            preview = self.decoder(preview)
+        return preview
+
+    def put(
+        self,
+        step_idx: int,
+        timestep: Union[float, torch.Tensor],
+        latents: torch.Tensor,
+        cancellable: bool = False,
+    ):
+        """Preview `[B, C, H, W]` latents of the step `step_idx`. Raises
+        `GenerationCancelled` if the consumer closed the stream and
+        `cancellable`, otherwise the preview is dropped."""
+        if self.cancelled:
+            if cancellable:
+                raise GenerationCancelled()
+            return
+        self._queue.put(
+            LatentPreview(step_idx, timestep, self._make_preview(latents))
+        )
+
+    def close(self):
+        """End of the generation, called by the producer."""
+        self._queue.put(self._END)
+
+    def cancel(self):
+        """Stop previewing, called by the consumer."""
+        self.cancelled = True
+
+    def __iter__(self) -> Iterator[LatentPreview]:
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            yield item
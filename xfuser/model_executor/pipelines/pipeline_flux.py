@@ -39,6 +39,7 @@ from xfuser.distributed import (
     is_pipeline_first_stage, 
     is_pipeline_last_stage
 )
+from xfuser.distributed.execution_plan import PatchPlan
 from .base_pipeline import xFuserPipelineBaseWrapper
 from .register import xFuserPipelineWrapperRegister
 
@@ -64,23 +65,9 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         )
         return cls(pipeline, engine_config)
 
-    def prepare_run(self, input_config: InputConfig, steps: int = 3, sync_steps: int = 1):
-        prompt = (
-            [""] * input_config.batch_size
-            if input_config.batch_size > 1
-            else ""
-        )
-        warmup_steps = get_runtime_state().runtime_config.warmup_steps
-        get_runtime_state().runtime_config.warmup_steps = sync_steps
-        self.__call__(
-            height=input_config.height,
-            width=input_config.width,
-            prompt=prompt,
-            num_inference_steps=steps,
-            output_type="latent",
-            generator=torch.Generator(device="cuda").manual_seed(42),
-        )
-        get_runtime_state().runtime_config.warmup_steps = warmup_steps
+    def _get_prepare_run_kwargs(self, input_config: InputConfig) -> Dict[str, Any]:
+        # no resolution binning
+        return {}
 
     @property
     def guidance_scale(self):
@@ -99,7 +86,9 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         return self._interrupt
 
     @torch.no_grad()
-    @xFuserPipelineBaseWrapper.check_model_parallel_state(cfg_parallel_available=False, pipefusion_parallel_available=False)
+    @xFuserPipelineBaseWrapper.check_model_parallel_state(
+        cfg_parallel_available=False, auto_layer_split_available=False
+    )
     @xFuserPipelineBaseWrapper.enable_data_parallel
     @xFuserPipelineBaseWrapper.check_to_use_naive_forward
     def __call__(
@@ -284,6 +273,23 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
         self._num_timesteps = len(timesteps)
 
+        #* the image ids of the tokens of this sp rank, in the order the
+        #  pipeline patches lay them out
+        latent_image_ids = torch.cat(
+            [
+                latent_image_ids[..., start_idx:end_idx, :]
+                for start_idx, end_idx in get_runtime_state().pp_patches_token_start_end_idx
+            ],
+            dim=-2,
+        )
+
+        # handle guidance
+        if self.transformer.config.guidance_embeds:
+            guidance = torch.tensor([guidance_scale], device=self._execution_device)
+            guidance = guidance.expand(latents.shape[0])
+        else:
+            guidance = None
+
         num_pipeline_warmup_steps = get_runtime_state().runtime_config.warmup_steps
         # 6. Denoising loop
         with self.progress_bar(total=num_inference_steps) as progress_bar:
@@ -291,7 +297,43 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
                 get_pipeline_parallel_world_size() > 1
                 and len(timesteps) > num_pipeline_warmup_steps
             ):
-                raise RuntimeError("Async pipeline not supported in flux")
+                # * warmup and stale kv refresh steps are synchronized, the
+                #   others run pipefusion
+                segments = get_runtime_state().get_pipeline_segments(len(timesteps))
+                for segment_idx, (sync, start, end) in enumerate(segments):
+                    if sync:
+                        latents = self._sync_pipeline(
+                            latents=latents,
+                            prompt_embeds=prompt_embeds,
+                            pooled_prompt_embeds=pooled_prompt_embeds,
+                            text_ids=text_ids,
+                            latent_image_ids=latent_image_ids,
+                            guidance=guidance,
+                            timesteps=timesteps[start:end],
+                            num_warmup_steps=num_warmup_steps,
+                            progress_bar=progress_bar,
+                            callback_on_step_end=callback_on_step_end,
+                            callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
+                            sync_only=end == len(timesteps),
+                            step_offset=start,
+                            after_async=segment_idx > 0,
+                        )
+                    else:
+                        latents = self._async_pipeline(
+                            latents=latents,
+                            prompt_embeds=prompt_embeds,
+                            pooled_prompt_embeds=pooled_prompt_embeds,
+                            text_ids=text_ids,
+                            latent_image_ids=latent_image_ids,
+                            guidance=guidance,
+                            timesteps=timesteps[start:end],
+                            num_warmup_steps=num_warmup_steps,
+                            progress_bar=progress_bar,
+                            callback_on_step_end=callback_on_step_end,
+                            callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
+                            step_offset=start,
+                            sync_after=end < len(timesteps),
+                        )
             else:
                 latents = self._sync_pipeline(
                     latents=latents,
@@ -299,15 +341,14 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
                     pooled_prompt_embeds=pooled_prompt_embeds,
                     text_ids=text_ids,
                     latent_image_ids=latent_image_ids,
-                    guidance_scale=guidance_scale,
+                    guidance=guidance,
                     timesteps=timesteps,
                     num_warmup_steps=num_warmup_steps,
                     progress_bar=progress_bar,
                     callback_on_step_end=callback_on_step_end,
                     callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
-                    sync_only=True
+                    sync_only=True,
                 )
-        
 
         if get_data_parallel_rank() == get_data_parallel_world_size() - 1:
             if output_type == "latent":
@@ -329,24 +370,75 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         else:
             return None
 
-    def set_flux_extra_comm_tensor(self, prompt_embeds):
-        #TODO(Eigensystem) To be implemented
-        pass
+    def set_flux_extra_comm_tensor(self, prompt_embeds: torch.Tensor):
+        prompt_embeds_shape = prompt_embeds.shape
+        encoder_hidden_states_shape = prompt_embeds_shape[:-1] + (
+            self.transformer.config.num_attention_heads
+            * self.transformer.config.attention_head_dim,
+        )
+        self._set_extra_comm_tensor_for_pipeline(
+            [
+                (
+                    "encoder_hidden_states",
+                    list(encoder_hidden_states_shape),
+                    1,
+                )
+            ]
+        )
 
-    def _init_sync_pipeline(self, latents: torch.Tensor, latent_image_ids: torch.Tensor):
+    def _init_sync_pipeline(
+        self, latents: torch.Tensor, after_async: bool = False
+    ):
         get_runtime_state().set_patched_mode(patch_mode=False)
+        # after pipefusion steps only the last stage has latents, already in
+        #   the local layout
+        if after_async:
+            return latents
 
         latents_list = [
             latents[:, start_idx: end_idx,:]
             for start_idx, end_idx in get_runtime_state().pp_patches_token_start_end_idx
         ]
         latents = torch.cat(latents_list, dim=-2)
-        latent_image_ids_list = [
-            latent_image_ids[:, start_idx: end_idx, :]
-            for start_idx, end_idx in get_runtime_state().pp_patches_token_start_end_idx
-        ]
-        latent_image_ids = torch.cat(latent_image_ids_list, dim=-2)
-        return latents, latent_image_ids
+        return latents
+
+    def _get_naive_preview_kwargs(
+        self,
+        preview_step: Callable[[int, Any, torch.Tensor], None],
+        call_kwargs: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        # the runtime state does not know the image size of the wrapped
+        #   pipeline, its latents are unpacked here
+        default_size = self.default_sample_size * self.vae_scale_factor
+        height = call_kwargs.get("height") or default_size
+        width = call_kwargs.get("width") or default_size
+
+        def callback_on_step_end(pipeline, step_idx, timestep, callback_kwargs):
+            latents = self._unpack_latents(
+                callback_kwargs["latents"], height, width, self.vae_scale_factor
+            )
+            preview_step(step_idx, timestep, latents)
+            return {}
+
+        return {
+            "callback_on_step_end": callback_on_step_end,
+            "callback_on_step_end_tensor_inputs": ["latents"],
+        }
+
+    def _get_preview_latents(self, latents: torch.Tensor) -> torch.Tensor:
+        if latents.ndim == 4:
+            return latents
+        input_config = get_runtime_state().input_config
+        return self._unpack_latents(
+            latents, input_config.height, input_config.width, self.vae_scale_factor
+        )
+
+    @staticmethod
+    def _get_patch_latents(
+        latents: torch.Tensor, patch_plan: PatchPlan
+    ) -> torch.Tensor:
+        # packed latents are split into patches along their tokens
+        return latents[:, patch_plan.token_start : patch_plan.token_end, :]
 
     # synchronized compute the whole feature map in each pp stage
     def _sync_pipeline(
@@ -356,19 +448,22 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         pooled_prompt_embeds: torch.Tensor,
         text_ids: torch.Tensor,
         latent_image_ids: torch.Tensor,
-        guidance_scale,
+        guidance: Optional[torch.Tensor],
         timesteps: List[int],
         num_warmup_steps: int,
         progress_bar,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         sync_only: bool = False,
+        step_offset: int = 0,
+        after_async: bool = False,
     ):
         self.set_flux_extra_comm_tensor(prompt_embeds)
-        latents, latent_image_ids = self._init_sync_pipeline(latents, latent_image_ids)
+        latents = self._init_sync_pipeline(latents, after_async=after_async)
         for i, t in enumerate(timesteps):
             if self.interrupt:
                 continue
+            get_runtime_state().set_step(step_offset + i)
             if is_pipeline_last_stage():
                 last_timestep_latents = latents
 
@@ -377,25 +472,25 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
                 pass
             # all ranks should recv the latent from the previous rank except
             #   the first rank in the first pipeline forward which should use
-            #   the input latent
-            elif is_pipeline_first_stage() and i == 0:
+            #   the input latent, unless pipefusion steps came before
+            elif is_pipeline_first_stage() and i == 0 and not after_async:
                 pass
-            else:
+            elif is_pipeline_first_stage():
                 latents = get_pp_group().pipeline_recv()
-                if not is_pipeline_first_stage():
-                    encoder_hidden_states = get_pp_group().pipeline_recv(0, "encoder_hidden_states")
-
-                            # handle guidance
-            if self.transformer.config.guidance_embeds:
-                guidance = torch.tensor([guidance_scale], device=self._execution_device)
-                guidance = guidance.expand(latents.shape[0])
             else:
-                guidance = None
+                latents, encoder_hidden_states = (
+                    get_pp_group().pipeline_recv_coalesced(
+                        [(None, -1), ("encoder_hidden_states", 0)]
+                    )
+                )
 
             latents, encoder_hidden_states = self._backbone_forward(
                 latents=latents,
-                encoder_hidden_states=prompt_embeds
-                if is_pipeline_first_stage() else encoder_hidden_states,
+                encoder_hidden_states=(
+                    prompt_embeds
+                    if is_pipeline_first_stage()
+                    else encoder_hidden_states
+                ),
                 pooled_prompt_embeds=pooled_prompt_embeds,
                 text_ids=text_ids,
                 latent_image_ids=latent_image_ids,
@@ -416,48 +511,246 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
                     callback_kwargs = {}
                     for k in callback_on_step_end_tensor_inputs:
                         callback_kwargs[k] = locals()[k]
-                    callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
+                    callback_outputs = callback_on_step_end(
+                        self, step_offset + i, t, callback_kwargs
+                    )
 
                     latents = callback_outputs.pop("latents", latents)
                     prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
+                self._preview_step(step_offset + i, t, latents)
 
-            if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
+            if i == len(timesteps) - 1 or (
+                (step_offset + i + 1) > num_warmup_steps
+                and (step_offset + i + 1) % self.scheduler.order == 0
+            ):
                 progress_bar.update()
 
             if XLA_AVAILABLE:
                 xm.mark_step()
 
-            if (
-                sync_only
-                and is_pipeline_last_stage()
-                and i == len(timesteps) - 1
-            ):
+            if sync_only and is_pipeline_last_stage() and i == len(timesteps) - 1:
                 pass
             elif get_pipeline_parallel_world_size() > 1:
-                get_pp_group().pipeline_send(latents)
-                if not is_pipeline_last_stage():
-                    get_pp_group().pipeline_send(encoder_hidden_states)
-
-        if (sync_only and 
-            get_sequence_parallel_world_size() > 1 and
-            is_pipeline_last_stage()
+                if is_pipeline_last_stage():
+                    get_pp_group().pipeline_send(latents)
+                else:
+                    get_pp_group().pipeline_send_coalesced(
+                        [latents, encoder_hidden_states],
+                        [(None, -1), ("encoder_hidden_states", 0)],
+                    )
+
+        if (
+            sync_only
+            and get_sequence_parallel_world_size() > 1
+            and is_pipeline_last_stage()
         ):
-            sp_degree = get_sequence_parallel_world_size()
-            sp_latents_list = get_sp_group().all_gather(latents, separate_tensors=True)
-            # latents_list = []
-            # for pp_patch_idx in range(get_runtime_state().num_pipeline_patch):
-            #     latents_list += [
-            #         sp_latents_list[sp_patch_idx][
-            #             :,
-            #             get_runtime_state().pp_patches_start_idx_local[pp_patch_idx]:
-            #             get_runtime_state().pp_patches_start_idx_local[pp_patch_idx+1],
-            #             :
-            #         ]
-            #         for sp_patch_idx in range(sp_degree)
-            #     ]
-            # latents = torch.cat(latents_list, dim=-2)
-            latents = torch.cat(sp_latents_list, dim=-2)
+            latents = self._gather_sp_latents(latents)
+
+        return latents
+
+    def _init_flux_async_pipeline(
+        self,
+        num_timesteps: int,
+        latents: torch.Tensor,
+        num_pipeline_warmup_steps: int,
+    ):
+        get_runtime_state().set_patched_mode(patch_mode=True)
+
+        if is_pipeline_first_stage():
+            # get latents computed in warmup stage
+            # ignore latents after the last timestep
+            latents = (
+                get_pp_group().pipeline_recv()
+                if num_pipeline_warmup_steps > 0
+                else latents
+            )
+            patch_latents = list(
+                latents.split(get_runtime_state().pp_patches_token_num, dim=-2)
+            )
+        elif is_pipeline_last_stage():
+            patch_latents = list(
+                latents.split(get_runtime_state().pp_patches_token_num, dim=-2)
+            )
+        else:
+            patch_latents = [
+                None for _ in range(get_runtime_state().num_pipeline_patch)
+            ]
+
+        recv_timesteps = (
+            num_timesteps - 1 if is_pipeline_first_stage() else num_timesteps
+        )
+
+        if is_pipeline_first_stage():
+            for _ in range(recv_timesteps):
+                for patch_idx in range(get_runtime_state().num_pipeline_patch):
+                    get_pp_group().add_pipeline_recv_task(patch_idx)
+        else:
+            # encoder_hidden_states travels with the first patch of every step
+            for _ in range(recv_timesteps):
+                get_pp_group().add_pipeline_coalesced_recv_task(
+                    [(None, 0), ("encoder_hidden_states", 0)]
+                )
+                for patch_idx in range(1, get_runtime_state().num_pipeline_patch):
+                    get_pp_group().add_pipeline_recv_task(patch_idx)
+
+        return patch_latents
+
+    # * implement of pipefusion
+    def _async_pipeline(
+        self,
+        latents: torch.Tensor,
+        prompt_embeds: torch.Tensor,
+        pooled_prompt_embeds: torch.Tensor,
+        text_ids: torch.Tensor,
+        latent_image_ids: torch.Tensor,
+        guidance: Optional[torch.Tensor],
+        timesteps: List[int],
+        num_warmup_steps: int,
+        progress_bar,
+        callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
+        callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        step_offset: int = 0,
+        sync_after: bool = False,
+    ):
+        if len(timesteps) == 0:
+            return latents
+        self.set_flux_extra_comm_tensor(prompt_embeds)
+        num_pipeline_patch = get_runtime_state().num_pipeline_patch
+        patch_latents = self._init_flux_async_pipeline(
+            num_timesteps=len(timesteps),
+            latents=latents,
+            num_pipeline_warmup_steps=step_offset,
+        )
+        last_patch_latents = (
+            [None for _ in range(num_pipeline_patch)]
+            if (is_pipeline_last_stage())
+            else None
+        )
+
+        first_async_recv = True
+        for i, t in enumerate(timesteps):
+            if self.interrupt:
+                continue
+            get_runtime_state().set_step(step_offset + i)
+            for patch_idx in range(num_pipeline_patch):
+                if is_pipeline_last_stage():
+                    last_patch_latents[patch_idx] = patch_latents[patch_idx]
+
+                if is_pipeline_first_stage() and i == 0:
+                    pass
+                else:
+                    if first_async_recv:
+                        get_pp_group().recv_next()
+                        first_async_recv = False
+
+                    if not is_pipeline_first_stage() and patch_idx == 0:
+                        patch_latents[patch_idx], last_encoder_hidden_states = (
+                            get_pp_group().get_pipeline_coalesced_recv_data(
+                                [(None, 0), ("encoder_hidden_states", 0)]
+                            )
+                        )
+                    else:
+                        patch_latents[patch_idx] = (
+                            get_pp_group().get_pipeline_recv_data(idx=patch_idx)
+                        )
+
+                patch_latents[patch_idx], next_encoder_hidden_states = (
+                    self._backbone_forward(
+                        latents=patch_latents[patch_idx],
+                        encoder_hidden_states=(
+                            prompt_embeds
+                            if is_pipeline_first_stage()
+                            else last_encoder_hidden_states
+                        ),
+                        pooled_prompt_embeds=pooled_prompt_embeds,
+                        text_ids=text_ids,
+                        latent_image_ids=latent_image_ids,
+                        guidance=guidance,
+                        t=t,
+                    )
+                )
+                if is_pipeline_last_stage():
+                    latents_dtype = patch_latents[patch_idx].dtype
+                    patch_latents[patch_idx] = self._scheduler_step(
+                        patch_latents[patch_idx],
+                        last_patch_latents[patch_idx],
+                        t,
+                    )
+
+                    if patch_latents[patch_idx].dtype != latents_dtype:
+                        if torch.backends.mps.is_available():
+                            # some platforms (eg. apple mps) misbehave due to a pytorch bug: https://github.com/pytorch/pytorch/pull/99272
+                            patch_latents[patch_idx] = patch_latents[patch_idx].to(latents_dtype)
+
+                    if callback_on_step_end is not None:
+                        callback_kwargs = {}
+                        for k in callback_on_step_end_tensor_inputs:
+                            callback_kwargs[k] = locals()[k]
+                        callback_outputs = callback_on_step_end(
+                            self, step_offset + i, t, callback_kwargs
+                        )
+
+                        latents = callback_outputs.pop("latents", latents)
+                        prompt_embeds = callback_outputs.pop(
+                            "prompt_embeds", prompt_embeds
+                        )
+
+                    if i != len(timesteps) - 1:
+                        get_pp_group().pipeline_isend(
+                            patch_latents[patch_idx], idx=patch_idx
+                        )
+                elif patch_idx == 0:
+                    get_pp_group().pipeline_isend_coalesced(
+                        [patch_latents[patch_idx], next_encoder_hidden_states],
+                        [(None, patch_idx), ("encoder_hidden_states", 0)],
+                    )
+                else:
+                    get_pp_group().pipeline_isend(
+                        patch_latents[patch_idx], idx=patch_idx
+                    )
+
+                if is_pipeline_first_stage() and i == 0:
+                    pass
+                else:
+                    # the received patch has been consumed by the backbone,
+                    #   encoder_hidden_states shares the buffer of the first
+                    #   patch and is kept for the whole step
+                    if is_pipeline_first_stage() or patch_idx > 0:
+                        get_pp_group().release_pipeline_recv_data(idx=patch_idx)
+                    if (
+                        not is_pipeline_first_stage()
+                        and patch_idx == num_pipeline_patch - 1
+                    ):
+                        get_pp_group().release_pipeline_coalesced_recv_data(
+                            [(None, 0), ("encoder_hidden_states", 0)]
+                        )
+                    if i == len(timesteps) - 1 and patch_idx == num_pipeline_patch - 1:
+                        pass
+                    else:
+                        get_pp_group().recv_next()
+
+                get_runtime_state().next_patch()
+
+            if is_pipeline_last_stage():
+                self._preview_step(step_offset + i, t, patch_latents)
+            if i == len(timesteps) - 1 or (
+                (i + step_offset + 1) > num_warmup_steps
+                and (i + step_offset + 1) % self.scheduler.order == 0
+            ):
+                progress_bar.update()
 
+            if XLA_AVAILABLE:
+                xm.mark_step()
+
+        latents = None
+        if is_pipeline_last_stage():
+            latents = torch.cat(patch_latents, dim=-2)
+            if sync_after:
+                # the synchronized steps that follow start from the local
+                #   latents on the first stage
+                get_pp_group().pipeline_send(latents)
+            elif get_sequence_parallel_world_size() > 1:
+                latents = self._gather_sp_latents(latents)
         return latents
 
     def _backbone_forward(
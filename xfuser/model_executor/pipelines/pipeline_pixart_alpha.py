@@ -1,5 +1,5 @@
 import os
-from typing import Dict, List, Tuple, Callable, Optional, Union
+from typing import Any, Dict, List, Tuple, Callable, Optional, Union
 
 import torch
 import torch.distributed
@@ -312,34 +312,43 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
                 get_pipeline_parallel_world_size() > 1
                 and len(timesteps) > num_pipeline_warmup_steps
             ):
-                # * warmup stage
-                latents = self._sync_pipeline(
-                    latents=latents,
-                    prompt_embeds=prompt_embeds,
-                    prompt_attention_mask=prompt_attention_mask,
-                    guidance_scale=guidance_scale,
-                    timesteps=timesteps[:num_pipeline_warmup_steps],
-                    num_warmup_steps=num_warmup_steps,
-                    extra_step_kwargs=extra_step_kwargs,
-                    added_cond_kwargs=added_cond_kwargs,
-                    progress_bar=progress_bar,
-                    callback=callback,
-                    callback_steps=callback_steps,
-                )
-                # * pipefusion stage
-                latents = self._async_pipeline(
-                    latents=latents,
-                    prompt_embeds=prompt_embeds,
-                    prompt_attention_mask=prompt_attention_mask,
-                    guidance_scale=guidance_scale,
-                    timesteps=timesteps[num_pipeline_warmup_steps:],
-                    num_warmup_steps=num_warmup_steps,
-                    extra_step_kwargs=extra_step_kwargs,
-                    added_cond_kwargs=added_cond_kwargs,
-                    progress_bar=progress_bar,
-                    callback=callback,
-                    callback_steps=callback_steps,
-                )
+                # * warmup and stale kv refresh steps are synchronized, the
+                #   others run pipefusion
+                segments = get_runtime_state().get_pipeline_segments(len(timesteps))
+                for segment_idx, (sync, start, end) in enumerate(segments):
+                    if sync:
+                        latents = self._sync_pipeline(
+                            latents=latents,
+                            prompt_embeds=prompt_embeds,
+                            prompt_attention_mask=prompt_attention_mask,
+                            guidance_scale=guidance_scale,
+                            timesteps=timesteps[start:end],
+                            num_warmup_steps=num_warmup_steps,
+                            extra_step_kwargs=extra_step_kwargs,
+                            added_cond_kwargs=added_cond_kwargs,
+                            progress_bar=progress_bar,
+                            callback=callback,
+                            callback_steps=callback_steps,
+                            sync_only=end == len(timesteps),
+                            step_offset=start,
+                            after_async=segment_idx > 0,
+                        )
+                    else:
+                        latents = self._async_pipeline(
+                            latents=latents,
+                            prompt_embeds=prompt_embeds,
+                            prompt_attention_mask=prompt_attention_mask,
+                            guidance_scale=guidance_scale,
+                            timesteps=timesteps[start:end],
+                            num_warmup_steps=num_warmup_steps,
+                            extra_step_kwargs=extra_step_kwargs,
+                            added_cond_kwargs=added_cond_kwargs,
+                            progress_bar=progress_bar,
+                            callback=callback,
+                            callback_steps=callback_steps,
+                            step_offset=start,
+                            sync_after=end < len(timesteps),
+                        )
             else:
                 latents = self._sync_pipeline(
                     latents=latents,
@@ -404,6 +413,14 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
             return_dict=False,
         )[0]
 
+    def _get_naive_preview_kwargs(
+        self,
+        preview_step: Callable[[int, Any, torch.Tensor], None],
+        call_kwargs: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        # the wrapped pipeline only takes the legacy per step callback
+        return {"callback": preview_step, "callback_steps": 1}
+
     # synchronized compute the whole feature map in each pp stage
     def _sync_pipeline(
         self,
@@ -419,9 +436,12 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: int = 1,
         sync_only: bool = False,
+        step_offset: int = 0,
+        after_async: bool = False,
     ):
-        latents = self._init_sync_pipeline(latents)
+        latents = self._init_sync_pipeline(latents, after_async=after_async)
         for i, t in enumerate(timesteps):
+            get_runtime_state().set_step(step_offset + i)
             if is_pipeline_last_stage():
                 last_timestep_latents = latents
 
@@ -430,8 +450,8 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
                 pass
             # all ranks should recv the latent from the previous rank except
             #   the first rank in the first pipeline forward which should use
-            #   the input latent
-            elif is_pipeline_first_stage() and i == 0:
+            #   the input latent, unless pipefusion steps came before
+            elif is_pipeline_first_stage() and i == 0 and not after_async:
                 pass
             else:
                 latents = get_pp_group().pipeline_recv()
@@ -449,12 +469,14 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
                 latents = self._scheduler_step(
                     latents, last_timestep_latents, t, extra_step_kwargs
                 )
+                self._preview_step(step_offset + i, t, latents)
             if i == len(timesteps) - 1 or (
-                (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
+                (step_offset + i + 1) > num_warmup_steps
+                and (step_offset + i + 1) % self.scheduler.order == 0
             ):
                 progress_bar.update()
-                if callback is not None and i % callback_steps == 0:
-                    step_idx = i // getattr(self.scheduler, "order", 1)
+                if callback is not None and (step_offset + i) % callback_steps == 0:
+                    step_idx = (step_offset + i) // getattr(self.scheduler, "order", 1)
                     callback(step_idx, t, latents)
 
             if sync_only and is_pipeline_last_stage() and i == len(timesteps) - 1:
@@ -467,22 +489,7 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
             and get_sequence_parallel_world_size() > 1
             and is_pipeline_last_stage()
         ):
-            sp_degree = get_sequence_parallel_world_size()
-            sp_latents_list = get_sp_group().all_gather(latents, separate_tensors=True)
-            latents_list = []
-            for pp_patch_idx in range(get_runtime_state().num_pipeline_patch):
-                latents_list += [
-                    sp_latents_list[sp_patch_idx][
-                        :,
-                        :,
-                        get_runtime_state()
-                        .pp_patches_start_idx_local[pp_patch_idx] : get_runtime_state()
-                        .pp_patches_start_idx_local[pp_patch_idx + 1],
-                        :,
-                    ]
-                    for sp_patch_idx in range(sp_degree)
-                ]
-            latents = torch.cat(latents_list, dim=-2)
+            latents = self._gather_sp_latents(latents)
 
         return latents
 
@@ -500,15 +507,16 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
         progress_bar,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: int = 1,
+        step_offset: int = 0,
+        sync_after: bool = False,
     ):
         if len(timesteps) == 0:
             return latents
         num_pipeline_patch = get_runtime_state().num_pipeline_patch
-        num_pipeline_warmup_steps = get_runtime_state().runtime_config.warmup_steps
         patch_latents = self._init_async_pipeline(
             num_timesteps=len(timesteps),
             latents=latents,
-            num_pipeline_warmup_steps=num_pipeline_warmup_steps,
+            num_pipeline_warmup_steps=step_offset,
         )
         last_patch_latents = (
             [None for _ in range(num_pipeline_patch)]
@@ -518,6 +526,7 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
 
         first_async_recv = True
         for i, t in enumerate(timesteps):
+            get_runtime_state().set_step(step_offset + i)
             for patch_idx in range(num_pipeline_patch):
                 if is_pipeline_last_stage():
                     last_patch_latents[patch_idx] = patch_latents[patch_idx]
@@ -540,20 +549,28 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
                     guidance_scale=guidance_scale,
                 )
                 if is_pipeline_last_stage():
-                    patch_latents[patch_idx] = self._scheduler_step(
-                        patch_latents[patch_idx],
-                        last_patch_latents[patch_idx],
-                        t,
-                        extra_step_kwargs,
-                    )
+                    # nothing waits for the patches of the last step, they
+                    #   are stepped at once over the whole feature map below
                     if i != len(timesteps) - 1:
-                        get_pp_group().pipeline_isend(patch_latents[patch_idx])
+                        patch_latents[patch_idx] = self._scheduler_step(
+                            patch_latents[patch_idx],
+                            last_patch_latents[patch_idx],
+                            t,
+                            extra_step_kwargs,
+                        )
+                        get_pp_group().pipeline_isend(
+                            patch_latents[patch_idx], idx=patch_idx
+                        )
                 else:
-                    get_pp_group().pipeline_isend(patch_latents[patch_idx])
+                    get_pp_group().pipeline_isend(
+                        patch_latents[patch_idx], idx=patch_idx
+                    )
 
                 if is_pipeline_first_stage() and i == 0:
                     pass
                 else:
+                    # the received patch has been consumed by the backbone
+                    get_pp_group().release_pipeline_recv_data(idx=patch_idx)
                     if i == len(timesteps) - 1 and patch_idx == num_pipeline_patch - 1:
                         pass
                     else:
@@ -562,43 +579,47 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
                 get_runtime_state().next_patch()
 
             if i == len(timesteps) - 1 or (
-                (i + num_pipeline_warmup_steps + 1) > num_warmup_steps
-                and (i + num_pipeline_warmup_steps + 1) % self.scheduler.order == 0
+                (i + step_offset + 1) > num_warmup_steps
+                and (i + step_offset + 1) % self.scheduler.order == 0
             ):
                 progress_bar.update()
-                assert callback is None, "callback not supported in async " "pipeline"
+                # the patches of the last step are stepped after the loop
                 if (
                     callback is not None
-                    and i + num_pipeline_warmup_steps % callback_steps == 0
+                    and is_pipeline_last_stage()
+                    and i != len(timesteps) - 1
+                    and (i + step_offset) % callback_steps == 0
                 ):
-                    step_idx = (i + num_pipeline_warmup_steps) // getattr(
+                    step_idx = (i + step_offset) // getattr(
                         self.scheduler, "order", 1
                     )
-                    callback(step_idx, t, patch_latents[patch_idx])
+                    callback(step_idx, t, torch.cat(patch_latents, dim=2))
+            if is_pipeline_last_stage() and i != len(timesteps) - 1:
+                self._preview_step(step_offset + i, t, patch_latents)
 
         latents = None
         if is_pipeline_last_stage():
-            latents = torch.cat(patch_latents, dim=2)
-            if get_sequence_parallel_world_size() > 1:
-                sp_degree = get_sequence_parallel_world_size()
-                sp_latents_list = get_sp_group().all_gather(
-                    latents, separate_tensors=True
+            get_runtime_state().set_patched_mode(patch_mode=False)
+            latents = self._scheduler_step(
+                torch.cat(patch_latents, dim=2),
+                torch.cat(last_patch_latents, dim=2),
+                timesteps[-1],
+                extra_step_kwargs,
+            )
+            step_idx = step_offset + len(timesteps) - 1
+            if callback is not None and step_idx % callback_steps == 0:
+                callback(
+                    step_idx // getattr(self.scheduler, "order", 1),
+                    timesteps[-1],
+                    latents,
                 )
-                latents_list = []
-                for pp_patch_idx in range(get_runtime_state().num_pipeline_patch):
-                    latents_list += [
-                        sp_latents_list[sp_patch_idx][
-                            ...,
-                            get_runtime_state()
-                            .pp_patches_start_idx_local[
-                                pp_patch_idx
-                            ] : get_runtime_state()
-                            .pp_patches_start_idx_local[pp_patch_idx + 1],
-                            :,
-                        ]
-                        for sp_patch_idx in range(sp_degree)
-                    ]
-                latents = torch.cat(latents_list, dim=-2)
+            self._preview_step(step_idx, timesteps[-1], latents)
+            if sync_after:
+                # the synchronized steps that follow start from the local
+                #   latents on the first stage
+                get_pp_group().pipeline_send(latents)
+            elif get_sequence_parallel_world_size() > 1:
+                latents = self._gather_sp_latents(latents)
         return latents
 
     def _backbone_forward(
@@ -65,21 +65,9 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         )
         return cls(pipeline, engine_config)
 
-    def prepare_run(
-        self, input_config: InputConfig, steps: int = 3, sync_steps: int = 1
-    ):
-        prompt = [""] * input_config.batch_size if input_config.batch_size > 1 else ""
-        warmup_steps = get_runtime_state().runtime_config.warmup_steps
-        get_runtime_state().runtime_config.warmup_steps = sync_steps
-        self.__call__(
-            height=input_config.height,
-            width=input_config.width,
-            prompt=prompt,
-            num_inference_steps=steps,
-            output_type="latent",
-            generator=torch.Generator(device="cuda").manual_seed(42),
-        )
-        get_runtime_state().runtime_config.warmup_steps = warmup_steps
+    def _get_prepare_run_kwargs(self, input_config: InputConfig) -> Dict[str, Any]:
+        # no resolution binning
+        return {}
 
     @property
     def guidance_scale(self):
@@ -342,28 +330,37 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                 get_pipeline_parallel_world_size() > 1
                 and len(timesteps) > num_pipeline_warmup_steps
             ):
-                # * warmup stage
-                latents = self._sync_pipeline(
-                    latents=latents,
-                    prompt_embeds=prompt_embeds,
-                    pooled_prompt_embeds=pooled_prompt_embeds,
-                    timesteps=timesteps[:num_pipeline_warmup_steps],
-                    num_warmup_steps=num_warmup_steps,
-                    progress_bar=progress_bar,
-                    callback_on_step_end=callback_on_step_end,
-                    callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
-                )
-                # * pipefusion stage
-                latents = self._async_pipeline(
-                    latents=latents,
-                    prompt_embeds=prompt_embeds,
-                    pooled_prompt_embeds=pooled_prompt_embeds,
-                    timesteps=timesteps[num_pipeline_warmup_steps:],
-                    num_warmup_steps=num_warmup_steps,
-                    progress_bar=progress_bar,
-                    callback_on_step_end=callback_on_step_end,
-                    callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
-                )
+                # * warmup and stale kv refresh steps are synchronized, the
+                #   others run pipefusion
+                segments = get_runtime_state().get_pipeline_segments(len(timesteps))
+                for segment_idx, (sync, start, end) in enumerate(segments):
+                    if sync:
+                        latents = self._sync_pipeline(
+                            latents=latents,
+                            prompt_embeds=prompt_embeds,
+                            pooled_prompt_embeds=pooled_prompt_embeds,
+                            timesteps=timesteps[start:end],
+                            num_warmup_steps=num_warmup_steps,
+                            progress_bar=progress_bar,
+                            callback_on_step_end=callback_on_step_end,
+                            callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
+                            sync_only=end == len(timesteps),
+                            step_offset=start,
+                            after_async=segment_idx > 0,
+                        )
+                    else:
+                        latents = self._async_pipeline(
+                            latents=latents,
+                            prompt_embeds=prompt_embeds,
+                            pooled_prompt_embeds=pooled_prompt_embeds,
+                            timesteps=timesteps[start:end],
+                            num_warmup_steps=num_warmup_steps,
+                            progress_bar=progress_bar,
+                            callback_on_step_end=callback_on_step_end,
+                            callback_on_step_end_tensor_inputs=callback_on_step_end_tensor_inputs,
+                            step_offset=start,
+                            sync_after=end < len(timesteps),
+                        )
             else:
                 latents = self._sync_pipeline(
                     latents=latents,
@@ -427,12 +424,15 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         sync_only: bool = False,
+        step_offset: int = 0,
+        after_async: bool = False,
     ):
         self.set_sd3_extra_comm_tensor(prompt_embeds)
-        latents = self._init_sync_pipeline(latents)
+        latents = self._init_sync_pipeline(latents, after_async=after_async)
         for i, t in enumerate(timesteps):
             if self.interrupt:
                 continue
+            get_runtime_state().set_step(step_offset + i)
             if is_pipeline_last_stage():
                 last_timestep_latents = latents
 
@@ -441,15 +441,17 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                 pass
             # all ranks should recv the latent from the previous rank except
             #   the first rank in the first pipeline forward which should use
-            #   the input latent
-            elif is_pipeline_first_stage() and i == 0:
+            #   the input latent, unless pipefusion steps came before
+            elif is_pipeline_first_stage() and i == 0 and not after_async:
                 pass
-            else:
+            elif is_pipeline_first_stage():
                 latents = get_pp_group().pipeline_recv()
-                if not is_pipeline_first_stage():
-                    encoder_hidden_states = get_pp_group().pipeline_recv(
-                        0, "encoder_hidden_states"
+            else:
+                latents, encoder_hidden_states = (
+                    get_pp_group().pipeline_recv_coalesced(
+                        [(None, -1), ("encoder_hidden_states", 0)]
                     )
+                )
 
             latents, encoder_hidden_states = self._backbone_forward(
                 latents=latents,
@@ -475,7 +477,9 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                     callback_kwargs = {}
                     for k in callback_on_step_end_tensor_inputs:
                         callback_kwargs[k] = locals()[k]
-                    callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
+                    callback_outputs = callback_on_step_end(
+                        self, step_offset + i, t, callback_kwargs
+                    )
 
                     latents = callback_outputs.pop("latents", latents)
                     prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
@@ -485,8 +489,10 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                     negative_pooled_prompt_embeds = callback_outputs.pop(
                         "negative_pooled_prompt_embeds", negative_pooled_prompt_embeds
                     )
+                self._preview_step(step_offset + i, t, latents)
             if i == len(timesteps) - 1 or (
-                (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
+                (step_offset + i + 1) > num_warmup_steps
+                and (step_offset + i + 1) % self.scheduler.order == 0
             ):
                 progress_bar.update()
 
@@ -496,31 +502,20 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
             if sync_only and is_pipeline_last_stage() and i == len(timesteps) - 1:
                 pass
             elif get_pipeline_parallel_world_size() > 1:
-                get_pp_group().pipeline_send(latents)
-                if not is_pipeline_last_stage():
-                    get_pp_group().pipeline_send(encoder_hidden_states)
+                if is_pipeline_last_stage():
+                    get_pp_group().pipeline_send(latents)
+                else:
+                    get_pp_group().pipeline_send_coalesced(
+                        [latents, encoder_hidden_states],
+                        [(None, -1), ("encoder_hidden_states", 0)],
+                    )
 
         if (
             sync_only
             and get_sequence_parallel_world_size() > 1
             and is_pipeline_last_stage()
         ):
-            sp_degree = get_sequence_parallel_world_size()
-            sp_latents_list = get_sp_group().all_gather(latents, separate_tensors=True)
-            latents_list = []
-            for pp_patch_idx in range(get_runtime_state().num_pipeline_patch):
-                latents_list += [
-                    sp_latents_list[sp_patch_idx][
-                        :,
-                        :,
-                        get_runtime_state()
-                        .pp_patches_start_idx_local[pp_patch_idx] : get_runtime_state()
-                        .pp_patches_start_idx_local[pp_patch_idx + 1],
-                        :,
-                    ]
-                    for sp_patch_idx in range(sp_degree)
-                ]
-            latents = torch.cat(latents_list, dim=-2)
+            latents = self._gather_sp_latents(latents)
 
         return latents
 
@@ -561,9 +556,12 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                 for patch_idx in range(get_runtime_state().num_pipeline_patch):
                     get_pp_group().add_pipeline_recv_task(patch_idx)
         else:
+            # encoder_hidden_states travels with the first patch of every step
             for _ in range(recv_timesteps):
-                get_pp_group().add_pipeline_recv_task(0, "encoder_hidden_states")
-                for patch_idx in range(get_runtime_state().num_pipeline_patch):
+                get_pp_group().add_pipeline_coalesced_recv_task(
+                    [(None, 0), ("encoder_hidden_states", 0)]
+                )
+                for patch_idx in range(1, get_runtime_state().num_pipeline_patch):
                     get_pp_group().add_pipeline_recv_task(patch_idx)
 
         return patch_latents
@@ -579,16 +577,17 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         progress_bar,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        step_offset: int = 0,
+        sync_after: bool = False,
     ):
         if len(timesteps) == 0:
             return latents
         self.set_sd3_extra_comm_tensor(prompt_embeds)
         num_pipeline_patch = get_runtime_state().num_pipeline_patch
-        num_pipeline_warmup_steps = get_runtime_state().runtime_config.warmup_steps
         patch_latents = self._init_sd3_async_pipeline(
             num_timesteps=len(timesteps),
             latents=latents,
-            num_pipeline_warmup_steps=num_pipeline_warmup_steps,
+            num_pipeline_warmup_steps=step_offset,
         )
         last_patch_latents = (
             [None for _ in range(num_pipeline_patch)]
@@ -600,6 +599,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         for i, t in enumerate(timesteps):
             if self.interrupt:
                 continue
+            get_runtime_state().set_step(step_offset + i)
             for patch_idx in range(num_pipeline_patch):
                 if is_pipeline_last_stage():
                     last_patch_latents[patch_idx] = patch_latents[patch_idx]
@@ -608,20 +608,19 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                     pass
                 else:
                     if first_async_recv:
-                        if not is_pipeline_first_stage() and patch_idx == 0:
-                            get_pp_group().recv_next()
                         get_pp_group().recv_next()
                         first_async_recv = False
 
                     if not is_pipeline_first_stage() and patch_idx == 0:
-                        last_encoder_hidden_states = (
-                            get_pp_group().get_pipeline_recv_data(
-                                idx=patch_idx, name="encoder_hidden_states"
+                        patch_latents[patch_idx], last_encoder_hidden_states = (
+                            get_pp_group().get_pipeline_coalesced_recv_data(
+                                [(None, 0), ("encoder_hidden_states", 0)]
                             )
                         )
-                    patch_latents[patch_idx] = get_pp_group().get_pipeline_recv_data(
-                        idx=patch_idx
-                    )
+                    else:
+                        patch_latents[patch_idx] = (
+                            get_pp_group().get_pipeline_recv_data(idx=patch_idx)
+                        )
 
                 patch_latents[patch_idx], next_encoder_hidden_states = (
                     self._backbone_forward(
@@ -653,7 +652,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                         for k in callback_on_step_end_tensor_inputs:
                             callback_kwargs[k] = locals()[k]
                         callback_outputs = callback_on_step_end(
-                            self, i, t, callback_kwargs
+                            self, step_offset + i, t, callback_kwargs
                         )
 
                         latents = callback_outputs.pop("latents", latents)
@@ -669,31 +668,46 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                         )
 
                     if i != len(timesteps) - 1:
-                        get_pp_group().pipeline_isend(patch_latents[patch_idx])
+                        get_pp_group().pipeline_isend(
+                            patch_latents[patch_idx], idx=patch_idx
+                        )
+                elif patch_idx == 0:
+                    get_pp_group().pipeline_isend_coalesced(
+                        [patch_latents[patch_idx], next_encoder_hidden_states],
+                        [(None, patch_idx), ("encoder_hidden_states", 0)],
+                    )
                 else:
-                    if patch_idx == 0:
-                        get_pp_group().pipeline_isend(next_encoder_hidden_states)
-                    get_pp_group().pipeline_isend(patch_latents[patch_idx])
+                    get_pp_group().pipeline_isend(
+                        patch_latents[patch_idx], idx=patch_idx
+                    )
 
                 if is_pipeline_first_stage() and i == 0:
                     pass
                 else:
+                    # the received patch has been consumed by the backbone,
+                    #   encoder_hidden_states shares the buffer of the first
+                    #   patch and is kept for the whole step
+                    if is_pipeline_first_stage() or patch_idx > 0:
+                        get_pp_group().release_pipeline_recv_data(idx=patch_idx)
+                    if (
+                        not is_pipeline_first_stage()
+                        and patch_idx == num_pipeline_patch - 1
+                    ):
+                        get_pp_group().release_pipeline_coalesced_recv_data(
+                            [(None, 0), ("encoder_hidden_states", 0)]
+                        )
                     if i == len(timesteps) - 1 and patch_idx == num_pipeline_patch - 1:
                         pass
-                    elif is_pipeline_first_stage():
-                        get_pp_group().recv_next()
                     else:
-                        # recv encoder_hidden_state
-                        if patch_idx == num_pipeline_patch - 1:
-                            get_pp_group().recv_next()
-                        # recv latents
                         get_pp_group().recv_next()
 
                 get_runtime_state().next_patch()
 
+            if is_pipeline_last_stage():
+                self._preview_step(step_offset + i, t, patch_latents)
             if i == len(timesteps) - 1 or (
-                (i + num_pipeline_warmup_steps + 1) > num_warmup_steps
-                and (i + num_pipeline_warmup_steps + 1) % self.scheduler.order == 0
+                (i + step_offset + 1) > num_warmup_steps
+                and (i + step_offset + 1) % self.scheduler.order == 0
             ):
                 progress_bar.update()
 
@@ -703,26 +717,12 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         latents = None
         if is_pipeline_last_stage():
             latents = torch.cat(patch_latents, dim=2)
-            if get_sequence_parallel_world_size() > 1:
-                sp_degree = get_sequence_parallel_world_size()
-                sp_latents_list = get_sp_group().all_gather(
-                    latents, separate_tensors=True
-                )
-                latents_list = []
-                for pp_patch_idx in range(get_runtime_state().num_pipeline_patch):
-                    latents_list += [
-                        sp_latents_list[sp_patch_idx][
-                            ...,
-                            get_runtime_state()
-                            .pp_patches_start_idx_local[
-                                pp_patch_idx
-                            ] : get_runtime_state()
-                            .pp_patches_start_idx_local[pp_patch_idx + 1],
-                            :,
-                        ]
-                        for sp_patch_idx in range(sp_degree)
-                    ]
-                latents = torch.cat(latents_list, dim=-2)
+            if sync_after:
+                # the synchronized steps that follow start from the local
+                #   latents on the first stage
+                get_pp_group().pipeline_send(latents)
+            elif get_sequence_parallel_world_size() > 1:
+                latents = self._gather_sp_latents(latents)
         return latents
 
     def _backbone_forward(
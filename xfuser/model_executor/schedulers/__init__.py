@@ -6,10 +6,12 @@ from .scheduling_dpmsolver_multistep import (
 from .scheduling_flow_match_euler_discrete import (
     xFuserFlowMatchEulerDiscreteSchedulerWrapper,
 )
+from .generic_scheduler import xFuserGenericSchedulerWrapper
 
 __all__ = [
     "xFuserSchedulerWrappersRegister",
     "xFuserSchedulerBaseWrapper",
     "xFuserDPMSolverMultistepSchedulerWrapper",
     "xFuserFlowMatchEulerDiscreteSchedulerWrapper",
+    "xFuserGenericSchedulerWrapper",
 ]
\ No newline at end of file
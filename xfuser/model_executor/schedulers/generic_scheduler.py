@@ -0,0 +1,187 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+from diffusers.schedulers import SchedulerMixin
+
+from xfuser.distributed import (
+    get_runtime_state,
+    is_pipeline_last_stage,
+)
+from xfuser.distributed.execution_plan import PatchPlan
+from .register import xFuserSchedulerWrappersRegister
+from .base_scheduler import xFuserSchedulerBaseWrapper
+
+
+def _copy_containers(value: Any) -> Any:
+    """Copy of the lists of a scheduler attribute, which the scheduler may
+    update in place, sharing the tensors."""
+    if type(value) is list:
+        return [_copy_containers(item) for item in value]
+    if type(value) is tuple:
+        return tuple(_copy_containers(item) for item in value)
+    return value
+
+
+def _partition(
+    value: Any, full_shape: torch.Size, dim: int, start: int, end: int
+) -> Any:
+    """Rows `[start, end)` along `dim` of the feature map tensors in
+    `value`, other values are kept."""
+    if torch.is_tensor(value) and value.shape == full_shape:
+        return value.narrow(dim, start, end - start)
+    if type(value) in (list, tuple):
+        return type(value)(
+            _partition(item, full_shape, dim, start, end) for item in value
+        )
+    return value
+
+
+def _merge(
+    values: List[Any],
+    given: List[Any],
+    original: Any,
+    patch_shapes: List[torch.Size],
+    dim: int,
+) -> Any:
+    """Feature map state out of the states of the patches of a step.
+
+    `values` are the states the patches left, `given` the ones they started
+    from, partitioned from `original`. Patch tensors are concatenated, other
+    values are the same for every patch and taken from the last one.
+    """
+    if all(value is start for value, start in zip(values, given)):
+        # left untouched by the step, no copy of the feature map
+        return original
+    last = values[-1]
+    if all(
+        torch.is_tensor(value) and value.shape == shape
+        for value, shape in zip(values, patch_shapes)
+    ):
+        return torch.cat(values, dim=dim)
+    if type(last) in (list, tuple) and all(
+        type(value) is type(last) and len(value) == len(last) for value in values
+    ):
+        return type(last)(
+            _merge(
+                [value[i] for value in values],
+                [
+                    start[i]
+                    if type(start) is type(last) and len(start) == len(last)
+                    else None
+                    for start in given
+                ],
+                original[i]
+                if type(original) is type(last) and len(original) == len(last)
+                else None,
+                patch_shapes,
+                dim,
+            )
+            for i in range(len(last))
+        )
+    return last
+
+
+@xFuserSchedulerWrappersRegister.register(SchedulerMixin)
+class xFuserGenericSchedulerWrapper(xFuserSchedulerBaseWrapper):
+    """Runs the `step` of any diffusers scheduler on pipeline patches.
+
+    The state of the scheduler is captured at the first patch of a step.
+    Every patch steps from that state, its feature map tensors cut to the
+    rows of the patch, and the states the patches leave are joined back
+    into the feature map state after the last one. The step index thus
+    advances once per step, as do the model output histories of multistep
+    schedulers.
+    """
+
+    def __init__(
+        self,
+        module: SchedulerMixin,
+    ):
+        super().__init__(module=module)
+        # state of the scheduler at the start of the current step
+        self._step_state: Optional[Dict[str, Any]] = None
+        # (state given, state left, sample shape) of the patches stepped
+        self._patch_states: List[Tuple[Dict[str, Any], Dict[str, Any], torch.Size]] = []
+
+    def _get_state(self) -> Dict[str, Any]:
+        return {
+            name: _copy_containers(value)
+            for name, value in vars(self.module).items()
+        }
+
+    def _set_state(self, state: Dict[str, Any]):
+        module_vars = vars(self.module)
+        module_vars.clear()
+        module_vars.update(_copy_containers(state))
+
+    @staticmethod
+    def _get_patch_layout(
+        sample: torch.Tensor, plan: PatchPlan
+    ) -> Tuple[torch.Size, int, int, int]:
+        """Feature map shape, patch dimension and rows of the patch of
+        `sample`: latent rows of `[B, C, H, W]` latents, tokens of packed
+        `[B, N, C]` ones."""
+        full_plan = get_runtime_state().execution_plan.sync
+        if sample.ndim == 4:
+            dim, start, end, full = 2, plan.latent_start, plan.latent_end, full_plan.latent_end
+        else:
+            dim, start, end, full = -2, plan.token_start, plan.token_end, full_plan.token_end
+        full_shape = list(sample.shape)
+        full_shape[dim] = full
+        return torch.Size(full_shape), dim, start, end
+
+    def scale_model_input(self, sample: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        if (
+            not is_pipeline_last_stage()
+            and getattr(self.module, "_step_index", None) is not None
+        ):
+            # stages other than the last one never step, follow the steps of
+            #   the pipeline
+            self.module._step_index = get_runtime_state().step_idx
+        return self.module.scale_model_input(sample, *args, **kwargs)
+
+    @xFuserSchedulerBaseWrapper.check_to_use_naive_step
+    def step(
+        self,
+        model_output: torch.Tensor,
+        timestep: Any,
+        sample: torch.Tensor,
+        *args,
+        **kwargs,
+    ):
+        plan = get_runtime_state().plan
+        if not plan.patch_mode or plan.num_pipeline_patch == 1:
+            return self.module.step(model_output, timestep, sample, *args, **kwargs)
+
+        if plan.is_first_patch:
+            self._step_state = self._get_state()
+            self._patch_states = []
+        full_shape, dim, start, end = self._get_patch_layout(sample, plan)
+        given = {
+            name: _partition(value, full_shape, dim, start, end)
+            for name, value in self._step_state.items()
+        }
+        self._set_state(given)
+        output = self.module.step(model_output, timestep, sample, *args, **kwargs)
+        self._patch_states.append((given, self._get_state(), sample.shape))
+
+        if plan.is_last_patch:
+            patch_shapes = [shape for _, _, shape in self._patch_states]
+            merged = {}
+            for name in self._patch_states[-1][1]:
+                merged[name] = _merge(
+                    [left.get(name) for _, left, _ in self._patch_states],
+                    [given.get(name) for given, _, _ in self._patch_states],
+                    self._step_state.get(name),
+                    patch_shapes,
+                    dim,
+                )
+            self._set_state(merged)
+            self._step_state = None
+            self._patch_states = []
+        else:
+            # the next patch steps from the same state, as does its
+            #   scale_model_input
+            self._set_state(self._step_state)
+        return output
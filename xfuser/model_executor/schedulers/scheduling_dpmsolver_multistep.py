@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 import torch.distributed
@@ -18,6 +18,62 @@ from .base_scheduler import xFuserSchedulerBaseWrapper
 
 @xFuserSchedulerWrappersRegister.register(DPMSolverMultistepScheduler)
 class xFuserDPMSolverMultistepSchedulerWrapper(xFuserSchedulerBaseWrapper):
+    def __init__(
+        self,
+        module: DPMSolverMultistepScheduler,
+    ):
+        super().__init__(module=module)
+        # [solver_order, *latents] model outputs of the last steps over the
+        #   whole feature map of the rank, the head being the current step
+        self._history: Optional[torch.Tensor] = None
+        self._history_head = 0
+        # (sample, model outputs from the newest, noise) coefficients of the
+        #   update of the current step
+        self._step_coefficients: Optional[Tuple[float, List[float], float]] = None
+
+    def _advance_history(self, model_output: torch.Tensor):
+        shape = [
+            self.config.solver_order,
+            model_output.shape[0],
+            model_output.shape[1],
+            get_runtime_state().execution_plan.sync.latent_end,
+            *model_output.shape[3:],
+        ]
+        if (
+            self._history is None
+            or list(self._history.shape) != shape
+            or self._history.device != model_output.device
+        ):
+            # slots are only read once written, lower_order_nums counts them
+            self._history = torch.empty(
+                shape, dtype=torch.float32, device=model_output.device
+            )
+            self._history_head = 0
+        else:
+            self._history_head = (self._history_head + 1) % self.config.solver_order
+
+    def _get_step_coefficients(self, order: int) -> Tuple[float, List[float], float]:
+        """Coefficients of the sample, the `order` newest model outputs and
+        the noise in the update of the current step. The updates are linear
+        in them, so they are read off an update of basis vectors."""
+        basis = torch.eye(order + 2, dtype=torch.float64, device=self.sigmas.device)
+        sample, noise = basis[0], basis[-1]
+        # oldest to newest, as the model outputs of the scheduler
+        model_outputs = list(basis[1:-1].flip(0))
+        if order == 1:
+            x_t = self.dpm_solver_first_order_update(
+                model_outputs[-1], sample=sample, noise=noise
+            )
+        elif order == 2:
+            x_t = self.multistep_dpm_solver_second_order_update(
+                model_outputs, sample=sample, noise=noise
+            )
+        else:
+            x_t = self.multistep_dpm_solver_third_order_update(
+                model_outputs, sample=sample
+            )
+        coefficients = x_t.tolist()
+        return coefficients[0], coefficients[1:-1], coefficients[-1]
 
     @xFuserSchedulerBaseWrapper.check_to_use_naive_step
     def step(
@@ -72,41 +128,24 @@ class xFuserDPMSolverMultistepSchedulerWrapper(xFuserSchedulerBaseWrapper):
             (self.step_index == len(self.timesteps) - 2) and self.config.lower_order_final and len(self.timesteps) < 15
         )
 
+        plan = get_runtime_state().plan
         model_output = self.convert_model_output(model_output, sample=sample)
 
 #! ---------------------------------------- MODIFIED BELOW ----------------------------------------
-        if (
-            get_runtime_state().patch_mode
-            and get_runtime_state().pipeline_patch_idx == 0
-            and self.model_outputs[-1] is None
-        ):
-            self.model_outputs[-1] = torch.zeros(
-                [
-                    model_output.shape[0],
-                    model_output.shape[1],
-                    get_runtime_state().pp_patches_start_idx_local[-1],
-                    model_output.shape[3],
-                ],
-                device=model_output.device,
-                dtype=model_output.dtype,
-            )
-        if get_runtime_state().pipeline_patch_idx == 0:
-            for i in range(self.config.solver_order - 1):
-                self.model_outputs[i] = self.model_outputs[i + 1]
-
-        if get_runtime_state().patch_mode and get_runtime_state().pipeline_patch_idx == 0:
-            assert len(self.model_outputs) >= 2
-            self.model_outputs[-1] = torch.zeros_like(self.model_outputs[-2])
-        if get_runtime_state().patch_mode:
-            self.model_outputs[-1][
-                :,
-                :,
-                get_runtime_state().pp_patches_start_idx_local[get_runtime_state().pipeline_patch_idx]:
-                get_runtime_state().pp_patches_start_idx_local[get_runtime_state().pipeline_patch_idx + 1],
-                :,
-            ] = model_output
-        else:
-            self.model_outputs[-1] = model_output
+        # the history of the model outputs is a ring of full feature maps
+        #   that each patch writes in place, the update of a step being the
+        #   same linear combination of them for every patch
+        if not plan.patch_mode or plan.is_first_patch:
+            self._advance_history(model_output)
+            if self.config.solver_order == 1 or self.lower_order_nums < 1 or lower_order_final:
+                order = 1
+            elif self.config.solver_order == 2 or self.lower_order_nums < 2 or lower_order_second:
+                order = 2
+            else:
+                order = 3
+            self._step_coefficients = self._get_step_coefficients(order)
+        history = self._history[:, :, :, plan.latent_start:plan.latent_end]
+        history[self._history_head].copy_(model_output)
 
         #! ORIGIN:
         # for i in range(self.config.solver_order - 1):
@@ -114,8 +153,6 @@ class xFuserDPMSolverMultistepSchedulerWrapper(xFuserSchedulerBaseWrapper):
         # self.model_outputs[-1] = model_output
 #! ---------------------------------------- MODIFIED ABOVE ----------------------------------------
 
-        # Upcast to avoid precision issues when computing prev_sample
-        sample = sample.to(torch.float32)
         if self.config.algorithm_type in ["sde-dpmsolver", "sde-dpmsolver++"] and variance_noise is None:
             noise = randn_tensor(
                 model_output.shape, generator=generator, device=model_output.device, dtype=torch.float32,
@@ -125,42 +162,34 @@ class xFuserDPMSolverMultistepSchedulerWrapper(xFuserSchedulerBaseWrapper):
         else:
             noise = None
 
-#! ---------------------------------------- ADD BELOW ----------------------------------------
-        if get_runtime_state().patch_mode:
-            model_outputs = []
-            for output in self.model_outputs:
-                model_outputs.append(
-                    output[
-                        :,
-                        :,
-                        get_runtime_state().pp_patches_start_idx_local[get_runtime_state().pipeline_patch_idx]:
-                        get_runtime_state().pp_patches_start_idx_local[get_runtime_state().pipeline_patch_idx + 1],
-                        :,
-                    ]
-                )
-        else:
-            model_outputs = self.model_outputs
-#! ---------------------------------------- ADD ABOVE ----------------------------------------
-
-        if self.config.solver_order == 1 or self.lower_order_nums < 1 or lower_order_final:
-            prev_sample = self.dpm_solver_first_order_update(model_output, sample=sample, noise=noise)
-        elif self.config.solver_order == 2 or self.lower_order_nums < 2 or lower_order_second:
-            prev_sample = self.multistep_dpm_solver_second_order_update(model_outputs, sample=sample, noise=noise)
-        else:
-            prev_sample = self.multistep_dpm_solver_third_order_update(model_outputs, sample=sample)
+#! ---------------------------------------- MODIFIED BELOW ----------------------------------------
+        # Upcast to avoid precision issues when computing prev_sample, the
+        #   history is kept in float32 already
+        sample_coefficient, output_coefficients, noise_coefficient = self._step_coefficients
+        prev_sample = torch.mul(sample.to(torch.float32), sample_coefficient)
+        for i, coefficient in enumerate(output_coefficients):
+            slot = (self._history_head - i) % self.config.solver_order
+            prev_sample.add_(history[slot], alpha=coefficient)
+        if noise is not None:
+            prev_sample.add_(noise, alpha=noise_coefficient)
 
-        if self.lower_order_nums < self.config.solver_order:
-            self.lower_order_nums += 1
+        #! ORIGIN:
+        # if self.config.solver_order == 1 or self.lower_order_nums < 1 or lower_order_final:
+        #     prev_sample = self.dpm_solver_first_order_update(model_output, sample=sample, noise=noise)
+        # elif self.config.solver_order == 2 or self.lower_order_nums < 2 or lower_order_second:
+        #     prev_sample = self.multistep_dpm_solver_second_order_update(self.model_outputs, sample=sample, noise=noise)
+        # else:
+        #     prev_sample = self.multistep_dpm_solver_third_order_update(self.model_outputs, sample=sample)
+#! ---------------------------------------- MODIFIED ABOVE ----------------------------------------
 
         # Cast sample back to expected dtype
         prev_sample = prev_sample.to(model_output.dtype)
 
         # upon completion increase step index by one
         #* increase step index only when the last pipeline patch is done (or not in patch mode)
-        if (
-            not get_runtime_state().patch_mode
-            or get_runtime_state().pipeline_patch_idx == get_runtime_state().num_pipeline_patch - 1
-        ):
+        if not plan.patch_mode or plan.is_last_patch:
+            if self.lower_order_nums < self.config.solver_order:
+                self.lower_order_nums += 1
             self._step_index += 1
 
         if not return_dict:
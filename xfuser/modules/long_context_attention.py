@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Optional, Tuple
 import torch
 from torch import Tensor
 
@@ -34,8 +34,113 @@ class xFuserLongContextAttention(LongContextAttention):
             use_pack_qkv=use_pack_qkv,
         )
         self.use_kv_cache = use_kv_cache
+        # K/V of the image tokens, views of the cache buffer
         self.kv_cache = None
-        
+        # [2, batch, joint + image tokens, heads, head_dim], the K/V of the
+        #   joint tokens kept before or after the image ones
+        self._kv_buffer = None
+        self._kv_layout_key = None
+
+    def _layout_kv_cache(
+        self,
+        key_layer: Tensor,
+        num_image_tokens: int,
+        num_joint_tokens: int,
+        joint_tensor_first: bool,
+    ):
+        batch_size, _, heads, head_dim = key_layer.shape
+        layout_key = (
+            batch_size,
+            num_image_tokens,
+            num_joint_tokens,
+            joint_tensor_first,
+            heads,
+            head_dim,
+            key_layer.dtype,
+            key_layer.device,
+        )
+        if layout_key == self._kv_layout_key:
+            return
+        # free the old buffer before allocating the new one
+        self.kv_cache = self._kv_buffer = None
+        self._kv_buffer = torch.empty(
+            (2, batch_size, num_image_tokens + num_joint_tokens, heads, head_dim),
+            dtype=key_layer.dtype,
+            device=key_layer.device,
+        )
+        image_start = num_joint_tokens if joint_tensor_first else 0
+        self.kv_cache = [
+            kv[:, image_start : image_start + num_image_tokens]
+            for kv in self._kv_buffer
+        ]
+        self._kv_layout_key = layout_key
+
+    def _update_kv_cache(
+        self,
+        key_layer: Tensor,
+        value_layer: Tensor,
+        joint_tensor_key: Optional[Tensor],
+        joint_tensor_value: Optional[Tensor],
+        joint_tensor_first: bool,
+    ) -> Tuple[Tensor, Tensor]:
+        """Write the K/V of the tokens of this forward, gathered over the
+        ulysses group, and the joint K/V into the cache in place, and return
+        the views of the cache to attend to.
+
+        The cache is laid out per pipeline patch, the tokens of every
+        ulysses rank for a patch next to each other, the same in sync and
+        patch mode so that a patch overwrites exactly its own stale K/V.
+        """
+        plan = get_runtime_state().plan
+        ulysses_world_size = torch.distributed.get_world_size(self.ulysses_pg)
+        num_joint_tokens = (
+            0 if joint_tensor_key is None else joint_tensor_key.shape[1]
+        )
+        if not plan.patch_mode:
+            self._layout_kv_cache(
+                key_layer,
+                ulysses_world_size * plan.num_tokens,
+                num_joint_tokens,
+                joint_tensor_first,
+            )
+            # [batch, ulysses rank, tokens of the rank, heads, head_dim]
+            keys = key_layer.unflatten(1, (ulysses_world_size, plan.num_tokens))
+            values = value_layer.unflatten(1, (ulysses_world_size, plan.num_tokens))
+            token_start = 0
+            for token_num in get_runtime_state().pp_patches_token_num:
+                token_end = token_start + token_num
+                for cache, gathered in zip(self.kv_cache, (keys, values)):
+                    cache[
+                        :,
+                        ulysses_world_size * token_start:
+                            ulysses_world_size * token_end,
+                    ].view(
+                        cache.shape[0], ulysses_world_size, token_num,
+                        *cache.shape[2:],
+                    ).copy_(gathered[:, :, token_start:token_end])
+                token_start = token_end
+        else:
+            if self.kv_cache is None:
+                raise ValueError(
+                    "xFuserLongContextAttention kvcache is None in patch mode"
+                )
+            if num_joint_tokens != self._kv_layout_key[2]:
+                raise ValueError(
+                    f"xFuserLongContextAttention kvcache laid out for "
+                    f"{self._kv_layout_key[2]} joint tokens, got "
+                    f"{num_joint_tokens} in patch mode"
+                )
+            self.kv_cache[0][:, plan.ulysses_token_start:plan.ulysses_token_end] = key_layer
+            self.kv_cache[1][:, plan.ulysses_token_start:plan.ulysses_token_end] = value_layer
+
+        if num_joint_tokens == 0:
+            return self.kv_cache[0], self.kv_cache[1]
+        joint_start = 0 if joint_tensor_first else self.kv_cache[0].shape[1]
+        joint_end = joint_start + num_joint_tokens
+        self._kv_buffer[0, :, joint_start:joint_end] = joint_tensor_key
+        self._kv_buffer[1, :, joint_start:joint_end] = joint_tensor_value
+        return self._kv_buffer[0], self._kv_buffer[1]
+
 
     def forward(
         self,
@@ -117,54 +222,13 @@ class xFuserLongContextAttention(LongContextAttention):
             )
 
         if self.use_kv_cache:
-            ulysses_world_size = torch.distributed.get_world_size(self.ulysses_pg)
-            pp_patches_token_num = get_runtime_state().pp_patches_token_num
-            if not get_runtime_state().patch_mode:
-                key_list = [
-                    key.split(pp_patches_token_num, dim=1)
-                    for key in torch.chunk(key_layer, ulysses_world_size, dim=1)
-                ]
-                value_list = [
-                    value.split(pp_patches_token_num, dim=1)
-                    for value in torch.chunk(value_layer, ulysses_world_size, dim=1)
-                ]
-                cached_key = torch.cat([
-                    key_list[rank][pp_patch_idx]
-                    for rank in range(ulysses_world_size)
-                    for pp_patch_idx in range(len(pp_patches_token_num))
-                ], dim=1)
-                cached_value = torch.cat([
-                    value_list[rank][pp_patch_idx]
-                    for rank in range(ulysses_world_size)
-                    for pp_patch_idx in range(len(pp_patches_token_num))
-                ], dim=1)
-                self.kv_cache = [cached_key, cached_value]
-                if joint_tensor_key is not None and joint_tensor_value is not None:
-                    ring_key = torch.cat([cached_key, joint_tensor_key], dim=1)
-                    ring_value = torch.cat([cached_value, joint_tensor_value], dim=1)
-                else:
-                    ring_key = cached_key
-                    ring_value = cached_value
-            else:
-                if self.kv_cache is None:
-                    raise ValueError(
-                        "xFuserLongContextAttention kvcache is None in patch mode"
-                    )
-                cached_key, cached_value = self.kv_cache
-                token_start_idx = ulysses_world_size * sum(pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
-                token_end_idx = ulysses_world_size * sum(pp_patches_token_num[:get_runtime_state().pipeline_patch_idx + 1])
-                cached_key[:, token_start_idx:token_end_idx, ...] = key_layer
-                cached_value[:, token_start_idx:token_end_idx, ...] = value_layer
-                self.kv_cache = [cached_key, cached_value]
-                if joint_tensor_key is not None and joint_tensor_value is not None:
-                    ring_key, ring_value = (
-                        torch.cat([cached_key, joint_tensor_key], dim=1), 
-                        torch.cat([cached_value, joint_tensor_value], dim=1)
-                    )
-                else:
-                    ring_key = cached_key
-                    ring_value = cached_value
-
+            ring_key, ring_value = self._update_kv_cache(
+                key_layer,
+                value_layer,
+                joint_tensor_key,
+                joint_tensor_value,
+                joint_tensor_first=False,
+            )
 
             out = self.ring_attn_fn(
                 query_layer,
@@ -297,54 +361,13 @@ class xFuserFluxLongContextAttention(xFuserLongContextAttention):
             )
 
         if self.use_kv_cache:
-            ulysses_world_size = torch.distributed.get_world_size(self.ulysses_pg)
-            pp_patches_token_num = get_runtime_state().pp_patches_token_num
-            if not get_runtime_state().patch_mode:
-                key_list = [
-                    key.split(pp_patches_token_num, dim=1)
-                    for key in torch.chunk(key_layer, ulysses_world_size, dim=1)
-                ]
-                value_list = [
-                    value.split(pp_patches_token_num, dim=1)
-                    for value in torch.chunk(value_layer, ulysses_world_size, dim=1)
-                ]
-                cached_key = torch.cat([
-                    key_list[rank][pp_patch_idx]
-                    for rank in range(ulysses_world_size)
-                    for pp_patch_idx in range(len(pp_patches_token_num))
-                ], dim=1)
-                cached_value = torch.cat([
-                    value_list[rank][pp_patch_idx]
-                    for rank in range(ulysses_world_size)
-                    for pp_patch_idx in range(len(pp_patches_token_num))
-                ], dim=1)
-                self.kv_cache = [cached_key, cached_value]
-                if joint_tensor_key is not None and joint_tensor_value is not None:
-                    ring_key = torch.cat([joint_tensor_key, cached_key], dim=1)
-                    ring_value = torch.cat([joint_tensor_value, cached_value], dim=1)
-                else:
-                    ring_key = cached_key
-                    ring_value = cached_value
-            else:
-                if self.kv_cache is None:
-                    raise ValueError(
-                        "xFuserLongContextAttention kvcache is None in patch mode"
-                    )
-                cached_key, cached_value = self.kv_cache
-                token_start_idx = ulysses_world_size * sum(pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
-                token_end_idx = ulysses_world_size * sum(pp_patches_token_num[:get_runtime_state().pipeline_patch_idx + 1])
-                cached_key[:, token_start_idx:token_end_idx, ...] = key_layer
-                cached_value[:, token_start_idx:token_end_idx, ...] = value_layer
-                self.kv_cache = [cached_key, cached_value]
-                if joint_tensor_key is not None and joint_tensor_value is not None:
-                    ring_key, ring_value = (
-                        torch.cat([joint_tensor_key, cached_key], dim=1), 
-                        torch.cat([joint_tensor_value, cached_value], dim=1)
-                    )
-                else:
-                    ring_key = cached_key
-                    ring_value = cached_value
-
+            ring_key, ring_value = self._update_kv_cache(
+                key_layer,
+                value_layer,
+                joint_tensor_key,
+                joint_tensor_value,
+                joint_tensor_first=True,
+            )
 
             out = self.ring_attn_fn(
                 query_layer,